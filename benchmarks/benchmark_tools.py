@@ -0,0 +1,312 @@
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from glob import glob
+from multiprocessing import get_context
+from os.path import join
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from expedia_stub_server import ExpediaStubServer, FaultConfig
+from synthetic_data import write_scale
+
+sys.path.append("../data_tools")
+sys.path.append("../odbc")
+sys.path.append("../scrape")
+
+STAGES = ["scrape", "extract", "format", "load"]
+LOADED_TABLES = ["search", "flight", "fare"]
+
+
+def get_peak_rss_mb():
+    """Get the peak resident memory of this process and of its finished children.
+
+    Return
+    ------
+    peak_rss: dict
+        Keys self and children, in MB.
+    """
+    # ru_maxrss is in KB on Linux
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def get_latency_percentiles(latencies):
+    """Summarize latencies in seconds as percentiles in milliseconds."""
+    latencies = np.array(latencies) * 1000
+    if len(latencies) == 0:
+        return {}
+    return {"p50": float(np.percentile(latencies, 50)),
+            "p90": float(np.percentile(latencies, 90)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max())}
+
+
+def timed(function, *args, **kwargs):
+    """Run function and return its elapsed time in seconds."""
+    start_time = perf_counter()
+    function(*args, **kwargs)
+    return perf_counter() - start_time
+
+
+def prepare_scale(work_folder, scale, seed=0):
+    """Create the input of every stage for one scale, this time is not measured.
+
+    Parameters
+    ----------
+    work_folder: str
+        Folder where the data of the benchmarks is written.
+    scale: str
+        One of synthetic_data.SCALES keys.
+    seed: int (default=0)
+        Seed of the synthetic data.
+
+    Return
+    ------
+    scale_folder: str
+        Folder with the json files and the structured parquet of the scale.
+    """
+    from flight_extractor import FlightExtractor
+
+    scale_folder = join(work_folder, scale)
+    parquet_path = join(scale_folder, "structured_data.parquet")
+    if not os.path.isfile(parquet_path):
+        json_paths = write_scale(scale_folder, scale=scale, seed=seed)
+        structured_data, error_log_df = FlightExtractor(json_paths).structure_all_jsons()
+        structured_data.to_parquet(parquet_path)
+    return scale_folder
+
+
+def benchmark_scrape(scale_folder, n_jobs, n_latency_samples):
+    """Benchmark collect_flight_data against a local server with synthetic data."""
+    from flight_scrape import collect_flight_data
+
+    server = ExpediaStubServer(fault_config=FaultConfig(latency="constant", latency_ms=0))
+    server.start()
+
+    tasks = list()
+    for json_path in glob(join(scale_folder, "data", "*", "*", "*", "*.json")):
+        flight_day = os.path.basename(os.path.dirname(json_path)).replace("flight_day_", "")
+        flight_day = datetime.strptime(flight_day, "%Y-%m-%d").date()
+        origin, destination = os.path.basename(json_path)[:-5].split("_to_")
+        tasks.append((origin, destination, flight_day))
+
+    output_folder = join(scale_folder, "scrape_output")
+    today = datetime.now().date()
+    collect = partial(collect_flight_data, overwrite_data=True, path=output_folder,
+                      base_url=server.base_url)
+    try:
+        latencies = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(timed)(collect, today, 0, 0, origin, destination, flight_day)
+            for origin, destination, flight_day in tasks
+        )
+    finally:
+        server.stop()
+    return {"n_items": len(tasks), "n_rows": None, "latencies": latencies}
+
+
+def benchmark_extract(scale_folder, n_jobs, n_latency_samples):
+    """Benchmark FlightExtractor.structure_all_jsons."""
+    from flight_extractor import FlightExtractor
+
+    json_paths = sorted(glob(join(scale_folder, "data", "*", "*", "*", "*.json")))
+    extractor = FlightExtractor(json_paths)
+    structured_data, error_log_df = extractor.structure_all_jsons(n_jobs=n_jobs)
+    latencies = [timed(extractor._structure_json, json_path)
+                 for json_path in json_paths[:n_latency_samples]]
+    return {"n_items": len(json_paths), "n_rows": len(structured_data), "latencies": latencies}
+
+
+def benchmark_format(scale_folder, n_jobs, n_latency_samples):
+    """Benchmark DatabaseFormat.transform_all_parquets without inserting data."""
+    database_format = get_database_format([join(scale_folder, "structured_data.parquet")])
+    tables = database_format.transform_all_parquets(n_jobs=n_jobs)
+    latencies = [timed(database_format._transform_parquet, parquet_path)
+                 for parquet_path in database_format.parquet_paths[:n_latency_samples]]
+    n_rows = sum(len(table) for table in tables.values())
+    return {"n_items": len(database_format.parquet_paths), "n_rows": n_rows,
+            "latencies": latencies}
+
+
+def benchmark_load(scale_folder, n_jobs, n_latency_samples):
+    """Benchmark insert_database_parallel for the search, flight and fare tables."""
+    import database_tools as dt
+
+    database_format = get_database_format([join(scale_folder, "structured_data.parquet")])
+    tables = database_format.transform_all_parquets(n_jobs=n_jobs)
+    dt.truncate_cascade_table("search")
+
+    latencies = list()
+    n_rows = 0
+    for table_name in LOADED_TABLES:
+        latencies.append(timed(dt.insert_database_parallel, tables[table_name], table_name,
+                               n_jobs=n_jobs))
+        n_rows += len(tables[table_name])
+    return {"n_items": len(LOADED_TABLES), "n_rows": n_rows, "latencies": latencies}
+
+
+def get_database_format(parquet_paths):
+    """DatabaseFormat that does not call the geocoding service."""
+    from database_format import DatabaseFormat
+
+    class BenchmarkDatabaseFormat(DatabaseFormat):
+        def get_city_from_coordinates(self, coordinates):
+            return [None] * len(coordinates)
+
+    return BenchmarkDatabaseFormat(parquet_paths, next_search_id=0)
+
+
+def run_stage(stage, scale_folder, n_jobs=-1, n_latency_samples=50):
+    """Run one stage and measure it. It should run in a new process, see benchmark.
+
+    Return
+    ------
+    result: dict
+        Throughput, latency percentiles and peak resident memory of the stage.
+    """
+    from joblib.externals.loky import get_reusable_executor
+
+    # StageMetrics must not reset the peak memory of the process and of the workers
+    os.environ["FLIGHT_METRICS_RESET_PEAK_RSS"] = "0"
+    stage_function = {"scrape": benchmark_scrape, "extract": benchmark_extract,
+                      "format": benchmark_format, "load": benchmark_load}[stage]
+    start_time = perf_counter()
+    output = stage_function(scale_folder, n_jobs, n_latency_samples)
+    wall_time = perf_counter() - start_time
+
+    # The joblib workers must finish to be counted in RUSAGE_CHILDREN
+    get_reusable_executor().shutdown(wait=True)
+    peak_rss = get_peak_rss_mb()
+
+    result = {
+        "wall_time_s": wall_time,
+        "n_items": output["n_items"],
+        "n_rows": output["n_rows"],
+        "items_per_s": output["n_items"] / wall_time,
+        "rows_per_s": None if output["n_rows"] is None else output["n_rows"] / wall_time,
+        "latency_ms": get_latency_percentiles(output["latencies"]),
+        "peak_rss_mb": peak_rss["self"],
+        "peak_rss_children_mb": peak_rss["children"],
+    }
+    return result
+
+
+def benchmark(stages, scales, work_folder, n_jobs=-1, n_latency_samples=50, seed=0):
+    """Run every stage at every scale, each one in a new process.
+
+    Parameters
+    ----------
+    stages: list[str]
+        Stages to run, values of STAGES. format and load need the database, see
+        postgres_fixture.LocalPostgres.
+    scales: list[str]
+        Scales to run, keys of synthetic_data.SCALES.
+    work_folder: str
+        Folder where the data of the benchmarks is written.
+    n_jobs: int (default=-1, all cores)
+        Number of cores used by each stage.
+    n_latency_samples: int (default=50)
+        Number of items timed one by one to compute the latency percentiles.
+    seed: int (default=0)
+        Seed of the synthetic data.
+
+    Return
+    ------
+    results: dict
+        Metadata of the run and the list of results of each stage and scale.
+    """
+    for stage in stages:
+        assert stage in STAGES, f"stage must be one of {STAGES}"
+
+    results = {"created_at": datetime.now().isoformat(),
+               "git_commit": get_git_commit(),
+               "python": platform.python_version(),
+               "cpu_count": os.cpu_count(),
+               "results": list()}
+    for scale in scales:
+        scale_folder = prepare_scale(work_folder, scale, seed=seed)
+        for stage in stages:
+            print(f"Running stage {stage} at scale {scale}...")
+            # A new process for each measure, so the peak memory is not shared
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                result = executor.submit(run_stage, stage, scale_folder,
+                                         n_jobs, n_latency_samples).result()
+            result.update({"stage": stage, "scale": scale})
+            print(f"Done in {result['wall_time_s']:.2f} s, {result['items_per_s']:.2f} items/s")
+            results["results"].append(result)
+    return results
+
+
+def save_results(results, results_folder="results"):
+    """Save the results in results_folder/<created_at>.json and return the path."""
+    os.makedirs(results_folder, exist_ok=True)
+    file_name = results["created_at"].replace(":", "-") + ".json"
+    results_path = join(results_folder, file_name)
+    with open(results_path, "w") as file:
+        json.dump(results, file, indent=4)
+    return results_path
+
+
+def compare_results(previous_results, current_results, tolerance=0.10):
+    """Compare two benchmark runs.
+
+    Parameters
+    ----------
+    previous_results: dict
+        Results of the reference run, as saved by save_results.
+    current_results: dict
+        Results of the new run.
+    tolerance: float (default=0.10)
+        Relative change considered noise.
+
+    Return
+    ------
+    comparison: pd.DataFrame
+        One line per stage, scale and metric with the previous and current values,
+        the relative change and whether it is a regression.
+    """
+    metrics = {"wall_time_s": "lower", "latency_p90_ms": "lower", "peak_rss_mb": "lower",
+               "peak_rss_children_mb": "lower", "items_per_s": "higher"}
+
+    def to_dataframe(results):
+        dataframe = pd.DataFrame(results["results"])
+        dataframe["latency_p90_ms"] = dataframe["latency_ms"].map(
+            lambda latency: latency.get("p90")
+        )
+        return dataframe.set_index(["stage", "scale"])[list(metrics)]
+
+    previous = to_dataframe(previous_results)
+    current = to_dataframe(current_results)
+    comparison = (
+        pd.concat({"previous": previous.stack(), "current": current.stack()}, axis=1)
+        .dropna()
+        .rename_axis(["stage", "scale", "metric"])
+        .reset_index()
+    )
+    comparison["relative_change"] = comparison["current"] / comparison["previous"] - 1
+    better_when_lower = comparison["metric"].map(metrics) == "lower"
+    comparison["regression"] = (
+        (better_when_lower & (comparison["relative_change"] > tolerance))
+        | (~better_when_lower & (comparison["relative_change"] < -tolerance))
+    )
+    return comparison
+
+
+def get_git_commit():
+    """Get the current git commit, or None outside a git repository."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
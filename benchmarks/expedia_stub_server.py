@@ -0,0 +1,266 @@
+import json
+import os
+import random
+import threading
+from collections import Counter
+from datetime import datetime
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+from urllib.parse import parse_qs, urlparse
+
+from synthetic_data import SyntheticExpediaData
+
+
+class FaultConfig():
+    """Latency and faults injected by the stub server."""
+    def __init__(self, latency="lognormal", latency_ms=300, latency_sigma=0.5,
+                 error_rate=0.0, throttle_rate=0.0, max_requests_per_second=None,
+                 truncated_json_rate=0.0, invalid_json_rate=0.0, empty_result_rate=0.0,
+                 seed=0):
+        """
+        Parameters
+        ----------
+        latency: str (default="lognormal")
+            Latency distribution, one of "constant", "uniform" (0 to 2 * latency_ms)
+            or "lognormal" (median latency_ms).
+        latency_ms: float (default=300)
+            Typical latency in milliseconds.
+        latency_sigma: float (default=0.5)
+            Sigma of the lognormal distribution, larger values give heavier tails.
+        error_rate: float (default=0.0)
+            Fraction of requests answered with HTTP 500.
+        throttle_rate: float (default=0.0)
+            Fraction of requests answered with HTTP 429.
+        max_requests_per_second: float (default=None)
+            If it is not None, requests above this rate are answered with HTTP 429.
+        truncated_json_rate: float (default=0.0)
+            Fraction of requests answered with only half of the json.
+        invalid_json_rate: float (default=0.0)
+            Fraction of requests answered with an HTML page instead of json.
+        empty_result_rate: float (default=0.0)
+            Fraction of requests answered with json without legs and offers.
+        seed: int (default=0)
+            Seed of the random generator of the faults.
+        """
+        assert latency in ("constant", "uniform", "lognormal"), (
+            "latency must be 'constant', 'uniform' or 'lognormal'"
+        )
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.truncated_json_rate = truncated_json_rate
+        self.invalid_json_rate = invalid_json_rate
+        self.empty_result_rate = empty_result_rate
+        self.random_generator = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample_latency(self):
+        """Sample one latency in seconds."""
+        with self.lock:
+            if self.latency == "constant":
+                latency_ms = self.latency_ms
+            elif self.latency == "uniform":
+                latency_ms = self.random_generator.uniform(0, 2 * self.latency_ms)
+            else:
+                latency_ms = self.random_generator.lognormvariate(0, self.latency_sigma)
+                latency_ms *= self.latency_ms
+        return latency_ms / 1000
+
+    def sample_fault(self):
+        """Sample the fault of one request, None means a normal answer."""
+        faults = [("error", self.error_rate), ("throttle", self.throttle_rate),
+                  ("truncated_json", self.truncated_json_rate),
+                  ("invalid_json", self.invalid_json_rate),
+                  ("empty_result", self.empty_result_rate)]
+        with self.lock:
+            value = self.random_generator.random()
+        for fault, rate in faults:
+            if value < rate:
+                return fault
+            value -= rate
+        return None
+
+
+class ExpediaStubServer():
+    """Local server that answers /api/flight/search like Expedia.
+
+    The answers come from recorded json files, matched by route, or from
+    SyntheticExpediaData. Use it with the base_url parameter of collect_flight_data.
+
+    Example
+    -------
+    with ExpediaStubServer(fault_config=FaultConfig(error_rate=0.05)) as server:
+        collect_flight_data(..., base_url=server.base_url)
+    """
+    def __init__(self, host="localhost", port=0, recorded_folder=None,
+                 fault_config=None, synthetic_data=None):
+        """
+        Parameters
+        ----------
+        host: str (default="localhost")
+            Host of the server.
+        port: int (default=0)
+            Port of the server, 0 chooses a free port.
+        recorded_folder: str (default=None)
+            Folder with json files saved by flight_scrape.py. If it is None, the
+            answers are synthetic.
+        fault_config: FaultConfig (default=None)
+            Latency and faults, by default FaultConfig() (only latency).
+        synthetic_data: SyntheticExpediaData (default=None)
+            Generator of the synthetic answers, by default SyntheticExpediaData().
+        """
+        self.fault_config = FaultConfig() if fault_config is None else fault_config
+        self.synthetic_data = SyntheticExpediaData() if synthetic_data is None else synthetic_data
+        self.recorded_paths = dict()
+        if recorded_folder is not None:
+            for json_path in glob(os.path.join(recorded_folder, "**", "*_to_*.json"),
+                                  recursive=True):
+                route = os.path.basename(json_path).split(".")[0]
+                self.recorded_paths.setdefault(route, []).append(json_path)
+
+        self.statistics = Counter()
+        self.statistics_lock = threading.Lock()
+        self.request_times = list()
+        self.server = ThreadingHTTPServer((host, port), self._get_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Start the server in a background thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve_forever(self):
+        """Run the server in the current thread."""
+        print(f"Serving on {self.base_url}")
+        self.server.serve_forever()
+
+    def get_statistics(self):
+        """Get the number of requests by answer type."""
+        with self.statistics_lock:
+            return dict(self.statistics)
+
+    def get_payload(self, query):
+        """Build the json answer of a search."""
+        route = f"{query['departureAirport']}_to_{query['arrivalAirport']}"
+        if route in self.recorded_paths:
+            with self.fault_config.lock:
+                json_path = self.fault_config.random_generator.choice(self.recorded_paths[route])
+            with open(json_path, "r") as file:
+                payload = json.load(file)
+            payload.pop("search_time", None)
+            return payload
+
+        flight_day = datetime.strptime(query["departureDate"], "%Y-%m-%d").date()
+        now = datetime.now()
+        payload = self.synthetic_data.generate_search(now.date(), now.hour, 0,
+                                                      query["departureAirport"],
+                                                      query["arrivalAirport"], flight_day)
+        payload.pop("search_time", None)
+        return payload
+
+    def _is_over_rate_limit(self):
+        """Sliding window of one second over the request times."""
+        if self.fault_config.max_requests_per_second is None:
+            return False
+        now = monotonic()
+        with self.statistics_lock:
+            self.request_times = [time for time in self.request_times if now - time < 1]
+            self.request_times.append(now)
+            return len(self.request_times) > self.fault_config.max_requests_per_second
+
+    def _count(self, answer_type):
+        with self.statistics_lock:
+            self.statistics[answer_type] += 1
+            self.statistics["requests"] += 1
+
+    def _get_handler(self):
+        stub_server = self
+
+        class SearchHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/api/flight/search":
+                    stub_server._count("not_found")
+                    return self._send(404, b"Not found", "text/plain")
+
+                sleep(stub_server.fault_config.sample_latency())
+                fault = stub_server.fault_config.sample_fault()
+                if stub_server._is_over_rate_limit():
+                    fault = "throttle"
+
+                if fault == "error":
+                    stub_server._count("error")
+                    return self._send(500, b"Internal Server Error", "text/plain")
+                if fault == "throttle":
+                    stub_server._count("throttle")
+                    return self._send(429, b"Too Many Requests", "text/plain",
+                                      headers={"Retry-After": "1"})
+                if fault == "invalid_json":
+                    stub_server._count("invalid_json")
+                    return self._send(200, b"<html><body>Access denied</body></html>",
+                                      "text/html")
+
+                try:
+                    query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                    payload = stub_server.get_payload(query)
+                except (KeyError, ValueError):
+                    stub_server._count("bad_request")
+                    return self._send(400, b"Bad request", "text/plain")
+
+                if fault == "empty_result":
+                    payload["legs"] = []
+                    payload["offers"] = []
+                body = json.dumps(payload).encode()
+                if fault == "truncated_json":
+                    body = body[:len(body) // 2]
+                stub_server._count(fault if fault is not None else "success")
+                return self._send(200, body, "application/json")
+
+            def _send(self, status, body, content_type, headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                return
+
+        return SearchHandler
+
+
+if __name__ == "__main__":
+    port = 8080
+    recorded_folder = None
+    fault_config = FaultConfig(latency="lognormal", latency_ms=300, error_rate=0.02,
+                               throttle_rate=0.02, truncated_json_rate=0.01,
+                               invalid_json_rate=0.01)
+    ExpediaStubServer(port=port, recorded_folder=recorded_folder,
+                      fault_config=fault_config).serve_forever()
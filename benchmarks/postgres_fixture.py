@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from os.path import join
+from time import sleep
+
+
+SQL_SETUP_FILES = ["flight_database_config.sql", "create_index.sql", "create_functions.sql"]
+
+
+class LocalPostgres():
+    """Throwaway PostgreSQL cluster with the flight database, used by the benchmarks.
+
+    The cluster is created with initdb in a temporary folder, so the PostgreSQL binaries
+    (initdb, pg_ctl and psql) must be installed. While the cluster is running, the
+    FLIGHT_DATABASE_CONFIG environment variable points odbc.connection.load_conn to it.
+    """
+    def __init__(self, port=55432, sql_folder="../setup/sql", bin_folder=None):
+        """
+        Parameters
+        ----------
+        port: int (default=55432)
+            Port of the cluster, it should not be the port of the production database.
+        sql_folder: str (default="../setup/sql")
+            Folder with the sql files used to create the flight database.
+        bin_folder: str (default=None)
+            Folder of the PostgreSQL binaries. If it is None, they are searched in PATH.
+        """
+        self.port = port
+        self.sql_folder = sql_folder
+        self.bin_folder = bin_folder
+        self.data_folder = None
+        self.config_file = None
+        self.previous_config_file = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Create the cluster, start it and create the flight database."""
+        self.data_folder = tempfile.mkdtemp(prefix="flight_benchmark_pg_")
+        cluster_folder = join(self.data_folder, "cluster")
+        self._run("initdb", "-D", cluster_folder, "-U", "postgres", "--auth=trust")
+        self._run("pg_ctl", "-D", cluster_folder, "-l", join(self.data_folder, "postgres.log"),
+                  "-o", f"-p {self.port} -k {self.data_folder}", "-w", "start")
+
+        # Without ON_ERROR_STOP psql skips a failed statement and exits with 0
+        for sql_file in SQL_SETUP_FILES:
+            self._run("psql", "-h", "localhost", "-p", str(self.port), "-U", "postgres",
+                      "-d", "postgres", "-q", "-v", "ON_ERROR_STOP=1",
+                      "-f", join(self.sql_folder, sql_file))
+
+        config = {"host": "localhost", "port": self.port, "database": "flight",
+                  "user": "postgres", "password": "", "schema": "flight"}
+        self.config_file = join(self.data_folder, "database_config.json")
+        with open(self.config_file, "w") as file:
+            json.dump(config, file)
+        self.previous_config_file = os.environ.get("FLIGHT_DATABASE_CONFIG")
+        os.environ["FLIGHT_DATABASE_CONFIG"] = self.config_file
+        return config
+
+    def stop(self):
+        """Stop the cluster and delete its files."""
+        if self.data_folder is None:
+            return
+        try:
+            self._run("pg_ctl", "-D", join(self.data_folder, "cluster"), "-m", "fast", "stop")
+        finally:
+            if self.previous_config_file is None:
+                os.environ.pop("FLIGHT_DATABASE_CONFIG", None)
+            else:
+                os.environ["FLIGHT_DATABASE_CONFIG"] = self.previous_config_file
+            # The server may take a moment to release its files
+            sleep(1)
+            shutil.rmtree(self.data_folder, ignore_errors=True)
+            self.data_folder = None
+
+    def _run(self, binary, *args):
+        """Run a PostgreSQL binary and raise an error if it fails."""
+        if self.bin_folder is not None:
+            binary = join(self.bin_folder, binary)
+        process = subprocess.run([binary, *args], stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE, text=True)
+        if process.returncode != 0:
+            raise RuntimeError(f"{binary} failed with exit code {process.returncode}: "
+                               f"{process.stderr.strip()}")
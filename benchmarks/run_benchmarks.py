@@ -0,0 +1,37 @@
+import json
+from glob import glob
+from os.path import join
+
+from benchmark_tools import benchmark, compare_results, save_results
+from postgres_fixture import LocalPostgres
+
+
+if __name__ == "__main__":
+    stages = ["scrape", "extract", "format", "load"]
+    scales = ["small", "medium", "large"]
+    work_folder = "/tmp/flight_benchmarks"
+    results_folder = "results"
+    n_jobs = -1
+    # If True format and load run on a throwaway PostgreSQL cluster
+    use_local_postgres = True
+
+    previous_results_paths = sorted(glob(join(results_folder, "*.json")))
+
+    if use_local_postgres:
+        with LocalPostgres():
+            results = benchmark(stages, scales, work_folder, n_jobs=n_jobs)
+    else:
+        results = benchmark(stages, scales, work_folder, n_jobs=n_jobs)
+
+    results_path = save_results(results, results_folder=results_folder)
+    print(f"Results saved in {results_path}")
+
+    if len(previous_results_paths) > 0:
+        with open(previous_results_paths[-1], "r") as file:
+            previous_results = json.load(file)
+        comparison = compare_results(previous_results, results)
+        print(f"Comparison with {previous_results_paths[-1]}:")
+        print(comparison.to_string(index=False))
+        regressions = comparison[comparison["regression"]]
+        if not regressions.empty:
+            print(f"{len(regressions)} regressions found!")
@@ -0,0 +1,211 @@
+import sys
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from benchmark_tools import prepare_scale
+from postgres_fixture import LocalPostgres
+from run_query_benchmark import load_scale
+
+sys.path.append("../odbc")
+import database_tools as dt
+from connection import load_conn
+
+# Index options compared, see database_tools.INDEX_OPTIONS
+INDEX_CONFIGURATIONS = {
+    "default": None,
+    "brin": ["brin"],
+    "covering": ["covering"],
+    "brin_covering": ["brin", "covering"],
+}
+INDEXED_TABLES = ["search", "flight", "fare"]
+# Columns of the BRIN indexes, their physical order is measured by get_physical_order
+BRIN_COLUMNS = {"search": ["operationalSearchTime", "insertionTime"],
+                "flight": ["insertionTime"], "fare": ["insertionTime"]}
+# Queries of the time ranges and routes that the options target
+QUERIES = {
+    "time_range": """
+        SELECT count(*), max("flightDay")
+        FROM flight.search
+        WHERE "operationalSearchTime" >= %(start)s AND "operationalSearchTime" < %(end)s
+    """,
+    "route_time_range": """
+        SELECT "searchId", "flightDay"
+        FROM flight.search
+        WHERE "originCode" = %(origin)s AND "destinationCode" = %(destination)s
+            AND "operationalSearchTime" >= %(start)s AND "operationalSearchTime" < %(end)s
+    """,
+    "leg_fares": """
+        SELECT "searchId", "totalFare"
+        FROM flight.fare
+        WHERE "legId" = %(leg_id)s
+    """,
+}
+
+
+def get_query_parameters():
+    """Parameters of QUERIES taken from the loaded data: one hour of searches, the most
+    searched route and the most offered leg."""
+    with load_conn() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT min("operationalSearchTime") FROM flight.search')
+            start = cursor.fetchone()[0]
+            cursor.execute("""
+                SELECT "originCode", "destinationCode" FROM flight.search
+                GROUP BY 1, 2 ORDER BY count(*) DESC LIMIT 1
+            """)
+            origin, destination = cursor.fetchone()
+            cursor.execute("""
+                SELECT "legId" FROM flight.fare GROUP BY 1 ORDER BY count(*) DESC LIMIT 1
+            """)
+            leg_id = cursor.fetchone()[0]
+    conn.close()
+    return {"start": start, "end": start + pd.Timedelta(hours=1), "origin": origin,
+            "destination": destination, "leg_id": leg_id}
+
+
+def drop_secondary_indexes(table_name, schema="flight"):
+    """Drop the indexes of the table except the primary key."""
+    with load_conn() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT indexname FROM pg_indexes
+                WHERE schemaname = %s AND tablename = %s AND indexname <> %s
+            """, (schema, table_name, f"{table_name}_pkey"))
+            for (index_name,) in cursor.fetchall():
+                cursor.execute(f'DROP INDEX {schema}."{index_name}"')
+    conn.close()
+
+
+def build_indexes(index_options, schema="flight"):
+    """Create the indexes of every table and measure each one.
+
+    Return
+    ------
+    index_log: list[dict]
+        Table, index, seconds to create it and its size in MB.
+    """
+    index_log = list()
+    indexes_config = dt.get_indexes_config(index_options)
+    with load_conn() as conn:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            for table_name in INDEXED_TABLES:
+                for index_config in indexes_config[table_name]:
+                    if index_config.get("unique") == "UNIQUE":
+                        continue
+                    start_time = perf_counter()
+                    cursor.execute(dt.get_index_command(table_name, index_config, schema=schema))
+                    seconds = perf_counter() - start_time
+                    cursor.execute("SELECT pg_relation_size(%s)",
+                                   (f'{schema}."{index_config["index_name"]}"',))
+                    index_log.append({"table": table_name, "index": index_config["index_name"],
+                                      "seconds": seconds,
+                                      "size_mb": cursor.fetchone()[0] / 2**20})
+                cursor.execute(f"VACUUM ANALYZE {schema}.{table_name}")
+    conn.close()
+    return index_log
+
+
+def get_physical_order(schema="flight"):
+    """Correlation between the heap order and the value order of the BRIN_COLUMNS.
+
+    A BRIN index is precise when it is close to 1. DatabaseFormat sorts the rows of each
+    batch and inserts the search table with one worker, but flight and fare are inserted
+    in parallel: their rows of one load are in interleaved pages, ordered only by the
+    insert transaction of each worker.
+
+    Return
+    ------
+    physical_order: pd.DataFrame
+        Table, column and correlation from pg_stats.
+    """
+    with load_conn() as conn:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            for table_name in BRIN_COLUMNS:
+                cursor.execute(f"ANALYZE {schema}.{table_name}")
+        physical_order = pd.read_sql("""
+            SELECT tablename AS table, attname AS column, correlation
+            FROM pg_stats
+            WHERE schemaname = %(schema)s AND tablename = ANY(%(tables)s)
+        """, conn, params={"schema": schema, "tables": list(BRIN_COLUMNS)})
+    conn.close()
+    is_brin_column = [column in BRIN_COLUMNS[table_name] for table_name, column
+                      in zip(physical_order["table"], physical_order["column"])]
+    return physical_order[is_brin_column].reset_index(drop=True)
+
+
+def time_queries(queries, parameters, n_repeats=5):
+    """Median time of each query, after one run that is not measured."""
+    query_times = dict()
+    with load_conn() as conn:
+        with conn.cursor() as cursor:
+            for query_name, query in queries.items():
+                cursor.execute(query, parameters)
+                cursor.fetchall()
+                times = list()
+                for _ in range(n_repeats):
+                    start_time = perf_counter()
+                    cursor.execute(query, parameters)
+                    cursor.fetchall()
+                    times.append(perf_counter() - start_time)
+                query_times[query_name] = float(np.median(times))
+    conn.close()
+    return query_times
+
+
+def index_benchmark(index_configurations, n_repeats=5):
+    """Build the indexes of each configuration on the loaded tables and measure them.
+
+    Parameters
+    ----------
+    index_configurations: dict
+        Name and index_options of each configuration.
+    n_repeats: int (default=5)
+        Number of measured runs of each query.
+
+    Return
+    ------
+    report: pd.DataFrame
+        For each configuration, the seconds to build its secondary indexes, their size
+        in MB and the median time of each query in ms.
+    """
+    parameters = get_query_parameters()
+    rows = list()
+    for configuration, index_options in index_configurations.items():
+        for table_name in INDEXED_TABLES:
+            drop_secondary_indexes(table_name)
+        index_log = build_indexes(index_options)
+        query_times = time_queries(QUERIES, parameters, n_repeats=n_repeats)
+        row = {"configuration": configuration,
+               "build_s": sum(index["seconds"] for index in index_log),
+               "size_mb": sum(index["size_mb"] for index in index_log)}
+        row.update({f"{query_name}_ms": seconds * 1000
+                    for query_name, seconds in query_times.items()})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    scales = ["small", "medium", "large"]
+    work_folder = "/tmp/flight_benchmarks"
+    n_repeats = 5
+    # If True the database is a throwaway PostgreSQL cluster
+    use_local_postgres = True
+
+    for scale in scales:
+        scale_folder = prepare_scale(work_folder, scale)
+        if use_local_postgres:
+            with LocalPostgres():
+                load_scale(scale_folder)
+                physical_order = get_physical_order()
+                report = index_benchmark(INDEX_CONFIGURATIONS, n_repeats=n_repeats)
+        else:
+            load_scale(scale_folder)
+            physical_order = get_physical_order()
+            report = index_benchmark(INDEX_CONFIGURATIONS, n_repeats=n_repeats)
+        print(f"Scale {scale}:")
+        print(physical_order.to_string(index=False))
+        print(report.to_string(index=False))
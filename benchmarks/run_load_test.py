@@ -0,0 +1,104 @@
+import sys
+import tempfile
+from datetime import date, timedelta
+from functools import partial
+from time import perf_counter
+
+from joblib import Parallel, delayed
+
+from benchmark_tools import get_latency_percentiles
+from expedia_stub_server import ExpediaStubServer, FaultConfig
+
+sys.path.append("../scrape")
+from flight_scrape import AIRPORT_PAIRS, collect_flight_data
+
+
+def timed_collect(collect, task):
+    """Run collect_flight_data for one task and return (elapsed seconds, success)."""
+    flight_day, departure_airport, arrival_airport = task
+    start_time = perf_counter()
+    success = collect(date.today(), 0, 0, departure_airport, arrival_airport, flight_day)
+    return perf_counter() - start_time, success
+
+
+def load_test(tasks, fault_config=None, n_jobs=8, maxExceptions=5, timeout=None,
+              retry_sleep_seconds=10, prefer="processes", recorded_folder=None):
+    """Run the scraper against the stub server and measure it.
+
+    Parameters
+    ----------
+    tasks: list[tuple]
+        List of (flight_day, departure_airport, arrival_airport).
+    fault_config: FaultConfig (default=None)
+        Latency and faults of the stub server.
+    n_jobs: int (default=8)
+        Number of parallel collect_flight_data calls, as in runner_collect_flight_data.
+    maxExceptions: int (default=5)
+        maxExceptions of collect_flight_data.
+    timeout: float (default=None)
+        timeout of collect_flight_data.
+    retry_sleep_seconds: float (default=10)
+        retry_sleep_seconds of collect_flight_data.
+    prefer: str (default="processes")
+        joblib backend preference, runner_collect_flight_data uses processes.
+    recorded_folder: str (default=None)
+        Folder with recorded json files served by the stub server.
+
+    Return
+    ------
+    report: dict
+        tasks/s, server requests/s, task latency percentiles, success ratio of the
+        tasks and the count of each answer type of the server.
+    """
+    with tempfile.TemporaryDirectory() as output_folder, \
+            ExpediaStubServer(fault_config=fault_config,
+                              recorded_folder=recorded_folder) as server:
+        collect = partial(collect_flight_data, maxExceptions=maxExceptions,
+                          overwrite_data=True, path=output_folder, base_url=server.base_url,
+                          timeout=timeout, retry_sleep_seconds=retry_sleep_seconds)
+        start_time = perf_counter()
+        outputs = Parallel(n_jobs=n_jobs, prefer=prefer)(
+            delayed(timed_collect)(collect, task) for task in tasks
+        )
+        wall_time = perf_counter() - start_time
+        server_statistics = server.get_statistics()
+
+    latencies = [latency for latency, success in outputs]
+    n_success = sum(success is True for latency, success in outputs)
+    report = {
+        "n_jobs": n_jobs,
+        "tasks": len(tasks),
+        "wall_time_s": wall_time,
+        "tasks_per_s": len(tasks) / wall_time,
+        "requests_per_s": server_statistics.get("requests", 0) / wall_time,
+        "task_latency_ms": get_latency_percentiles(latencies),
+        "success_ratio": n_success / len(tasks),
+        "server_answers": server_statistics,
+    }
+    return report
+
+
+if __name__ == "__main__":
+    n_flight_days = 3
+    n_jobs_list = [4, 8, 16]
+    maxExceptions = 2
+    timeout = 10
+    retry_sleep_seconds = 1
+    fault_config = FaultConfig(latency="lognormal", latency_ms=400, latency_sigma=0.6,
+                               error_rate=0.03, throttle_rate=0.02, max_requests_per_second=20,
+                               truncated_json_rate=0.01, invalid_json_rate=0.01)
+
+    tasks = [(date.today() + timedelta(days=day), departure_airport, arrival_airport)
+             for day in range(1, n_flight_days + 1)
+             for departure_airport, arrival_airport in AIRPORT_PAIRS]
+
+    for n_jobs in n_jobs_list:
+        report = load_test(tasks, fault_config=fault_config, n_jobs=n_jobs,
+                           maxExceptions=maxExceptions, timeout=timeout,
+                           retry_sleep_seconds=retry_sleep_seconds)
+        print(f"n_jobs = {n_jobs}: {report['tasks_per_s']:.2f} tasks/s, "
+              f"{report['requests_per_s']:.2f} requests/s, "
+              f"p50 = {report['task_latency_ms']['p50']:.0f} ms, "
+              f"p99 = {report['task_latency_ms']['p99']:.0f} ms, "
+              f"success ratio = {report['success_ratio']:.3f}")
+        print(f"Server answers: {report['server_answers']}")
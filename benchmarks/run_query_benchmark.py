@@ -0,0 +1,116 @@
+import sys
+from os.path import join
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from benchmark_tools import get_database_format, prepare_scale
+from postgres_fixture import LocalPostgres
+
+sys.path.append("../odbc")
+import lake_query_tools
+import query_tools as qt
+
+# Typical analytical queries of the notebooks, the same SQL runs on both engines
+QUERIES = {
+    "route_day_fare": """
+        SELECT S."originCode", S."destinationCode",
+            DATE_TRUNC('day', S."operationalSearchTime") AS search_day,
+            AVG(F."totalFare") AS average_fare, MIN(F."totalFare") AS min_fare,
+            count(*) AS offers
+        FROM flight.fare F
+            JOIN flight.search S ON S."searchId" = F."searchId"
+        GROUP BY S."originCode", S."destinationCode", search_day
+    """,
+    "route_unique_legs": """
+        SELECT S."originCode", S."destinationCode", count(DISTINCT F."legId") AS legs
+        FROM flight.fare F
+            JOIN flight.search S ON S."searchId" = F."searchId"
+        GROUP BY S."originCode", S."destinationCode"
+    """,
+    "leg_fare_variability": """
+        SELECT "legId", stddev("totalFare") AS standard_deviation,
+            max("totalFare") - min("totalFare") AS amplitude,
+            AVG("totalFare") AS average, count(*) AS number_lines
+        FROM flight.fare
+        GROUP BY "legId"
+    """,
+    "days_to_departure_fare": """
+        SELECT S."flightDay" - CAST(S."operationalSearchTime" AS DATE) AS days_to_departure,
+            AVG(F."totalFare") AS average_fare, count(*) AS offers
+        FROM flight.fare F
+            JOIN flight.search S ON S."searchId" = F."searchId"
+        GROUP BY days_to_departure
+    """,
+}
+
+
+def load_scale(scale_folder):
+    """Insert the structured parquet of a scale in the database and return its path."""
+    parquet_path = join(scale_folder, "structured_data.parquet")
+    database_format = get_database_format([parquet_path])
+    database_format.inset_on_database = True
+    database_format.transform_all_parquets()
+    return parquet_path
+
+
+def query_benchmark(queries, lake_paths, n_repeats=5):
+    """Run every query on PostgreSQL and on the lake and measure it.
+
+    Parameters
+    ----------
+    queries: dict[str]
+        Name and SQL of each query.
+    lake_paths: list[str]
+        Parquet files of the lake, the same data that is in the database.
+    n_repeats: int (default=5)
+        Number of measured runs of each query, after one run that is not measured.
+
+    Return
+    ------
+    report: pd.DataFrame
+        Median and minimum time of each query and engine, the number of rows returned
+        and the speedup of the lake.
+    """
+    engines = {
+        "postgres": qt.run_query,
+        "lake": lambda query: lake_query_tools.run_query(query, lake_paths=lake_paths),
+    }
+    rows = list()
+    for query_name, query in queries.items():
+        for engine, run_query in engines.items():
+            # The first run warms the caches and the lake connection
+            result = run_query(query)
+            times = list()
+            for _ in range(n_repeats):
+                start_time = perf_counter()
+                run_query(query)
+                times.append(perf_counter() - start_time)
+            rows.append({"query": query_name, "engine": engine, "rows": len(result),
+                         "median_s": float(np.median(times)), "min_s": min(times)})
+
+    report = pd.DataFrame(rows)
+    postgres_median = report[report["engine"] == "postgres"].set_index("query")["median_s"]
+    report["speedup"] = report["query"].map(postgres_median) / report["median_s"]
+    return report
+
+
+if __name__ == "__main__":
+    scales = ["small", "medium", "large"]
+    work_folder = "/tmp/flight_benchmarks"
+    n_repeats = 5
+    # If True the database is a throwaway PostgreSQL cluster
+    use_local_postgres = True
+
+    for scale in scales:
+        scale_folder = prepare_scale(work_folder, scale)
+        if use_local_postgres:
+            with LocalPostgres():
+                parquet_path = load_scale(scale_folder)
+                report = query_benchmark(QUERIES, [parquet_path], n_repeats=n_repeats)
+        else:
+            parquet_path = load_scale(scale_folder)
+            report = query_benchmark(QUERIES, [parquet_path], n_repeats=n_repeats)
+        print(f"Scale {scale}:")
+        print(report.to_string(index=False))
@@ -0,0 +1,266 @@
+import json
+import random
+from datetime import datetime, timedelta
+from os import makedirs
+from os.path import join
+
+
+AIRPORTS = {
+    "BSB": ("Brasilia", -15.869167, -47.920834),
+    "CGH": ("Sao Paulo", -23.626110, -46.656387),
+    "GRU": ("Sao Paulo", -23.435556, -46.473057),
+    "POA": ("Porto Alegre", -29.994444, -51.171391),
+    "CNF": ("Belo Horizonte", -19.624443, -43.971943),
+    "GIG": ("Rio de Janeiro", -22.809999, -43.250557),
+    "SDU": ("Rio de Janeiro", -22.910461, -43.163133),
+    "SSA": ("Salvador", -12.908611, -38.322498),
+    "MAO": ("Manaus", -3.038611, -60.049721),
+}
+
+AIRLINES = [("G3", "GOL"), ("AD", "Azul"), ("LA", "LATAM Airlines Brasil")]
+
+EQUIPMENTS = [("738", "Boeing 737-800"), ("7M8", "Boeing 737 MAX 8"),
+              ("320", "Airbus A320"), ("E95", "Embraer 195"), ("AT7", "ATR 72")]
+
+# Number of legs, offers per leg and segments per leg of one search
+SCALES = {
+    "small": {"n_hours": 1, "n_flight_days": 2, "n_routes": 4, "n_legs": 40},
+    "medium": {"n_hours": 2, "n_flight_days": 5, "n_routes": 8, "n_legs": 80},
+    "large": {"n_hours": 4, "n_flight_days": 10, "n_routes": 16, "n_legs": 120},
+}
+
+
+class SyntheticExpediaData():
+    """Deterministic generator of json files with the structure returned by Expedia.
+
+    The files are written with the folder structure of scrape/flight_scrape.py, so they
+    can be used as input of FlightExtractor.
+    """
+    def __init__(self, seed=0, n_legs=80, max_segments=3):
+        """
+        Parameters
+        ----------
+        seed: int (default=0)
+            Seed of the random generator, the same seed always generates the same data.
+        n_legs: int (default=80)
+            Number of legs of each search, each leg has one offer.
+        max_segments: int (default=3)
+            Maximum number of segments of each leg.
+        """
+        self.seed = seed
+        self.n_legs = n_legs
+        self.max_segments = max_segments
+
+    def generate_search(self, today, hour, minute, origin, destination, flight_day):
+        """Generate the json of one search.
+
+        Parameters
+        ----------
+        today: datetime.date
+            Day the data was collected.
+        hour: int
+            Hour the data was collected.
+        minute: int
+            Minute the data was collected.
+        origin: str
+            Three-character IATA airport code for the initial location.
+        destination: str
+            Three-character IATA airport code for the arrival location.
+        flight_day: datetime.date
+            Day of the flight.
+
+        Return
+        ------
+        data: dict
+            Json data with the keys legs, offers, searchCities and search_time.
+        """
+        random_generator = random.Random(
+            f"{self.seed}_{today}_{hour}_{minute}_{origin}_{destination}_{flight_day}"
+        )
+        legs = list()
+        offers = list()
+        for leg_index in range(self.n_legs):
+            leg = self._generate_leg(random_generator, origin, destination, flight_day)
+            legs.append(leg)
+            offers.append(self._generate_offer(random_generator, leg))
+
+        data = {
+            "legs": legs,
+            "offers": offers,
+            "searchCities": [
+                {"code": origin, "city": AIRPORTS[origin][0]},
+                {"code": destination, "city": AIRPORTS[destination][0]},
+            ],
+            "search_time": datetime(today.year, today.month, today.day,
+                                    hour, minute).isoformat(),
+        }
+        return data
+
+    def write_scrape(self, path, today, hours, flight_days, routes, minute=0):
+        """Write the json files of several searches.
+
+        Parameters
+        ----------
+        path: str
+            Directory where the data folder is created.
+        today: datetime.date
+            Day the data was collected.
+        hours: list[int]
+            Hours the data was collected.
+        flight_days: list[datetime.date]
+            Days of the flights.
+        routes: list[tuple[str]]
+            List of (origin, destination).
+        minute: int (default=0)
+            Minute the data was collected.
+
+        Return
+        ------
+        json_paths: list[str]
+            Path of each written json.
+        """
+        json_paths = list()
+        for hour in hours:
+            for flight_day in flight_days:
+                folder = join(path, "data", f"today_{today}", f"hour_{hour}_minute_{minute}",
+                              f"flight_day_{flight_day}")
+                makedirs(folder, exist_ok=True)
+                for origin, destination in routes:
+                    data = self.generate_search(today, hour, minute, origin,
+                                                destination, flight_day)
+                    json_path = join(folder, f"{origin}_to_{destination}.json")
+                    with open(json_path, "w") as file:
+                        json.dump(data, file)
+                    json_paths.append(json_path)
+        return json_paths
+
+    def _generate_leg(self, random_generator, origin, destination, flight_day):
+        """Generate one leg with 1 to max_segments segments."""
+        n_segments = random_generator.randint(1, self.max_segments)
+        stops = [origin]
+        connections = [code for code in AIRPORTS if code not in (origin, destination)]
+        stops += random_generator.sample(connections, n_segments - 1)
+        stops += [destination]
+
+        departure_time = datetime(flight_day.year, flight_day.month, flight_day.day,
+                                  random_generator.randint(0, 22),
+                                  random_generator.choice([0, 15, 30, 45]))
+        airline_code, airline_name = random_generator.choice(AIRLINES)
+        segments = list()
+        for index in range(n_segments):
+            duration_in_seconds = random_generator.randint(45, 240) * 60
+            arrival_time = departure_time + timedelta(seconds=duration_in_seconds)
+            equipment_code, equipment_description = random_generator.choice(EQUIPMENTS)
+            departure_city, departure_latitude, departure_longitude = AIRPORTS[stops[index]]
+            arrival_city, arrival_latitude, arrival_longitude = AIRPORTS[stops[index + 1]]
+            segments.append({
+                "departureTime": departure_time.strftime("%I:%M%p"),
+                "departureTimeEpochSeconds": int(departure_time.timestamp()),
+                "departureTimeRaw": departure_time.isoformat() + ".000-03:00",
+                "departureTimeZoneOffsetSeconds": -10800,
+                "arrivalTime": arrival_time.strftime("%I:%M%p"),
+                "arrivalTimeEpochSeconds": int(arrival_time.timestamp()),
+                "arrivalTimeRaw": arrival_time.isoformat() + ".000-03:00",
+                "arrivalTimeZoneOffsetSeconds": -10800,
+                "flightNumber": str(random_generator.randint(1000, 9999)),
+                "stops": 0,
+                "airlineCode": airline_code,
+                "airlineName": airline_name,
+                "externalAirlineCode": airline_code,
+                "operatingAirlineName": airline_name,
+                "equipmentCode": equipment_code,
+                "equipmentDescription": equipment_description,
+                "departureAirportCode": stops[index],
+                "departureAirportName": departure_city,
+                "departureAirportLatitude": departure_latitude,
+                "departureAirportLongitude": departure_longitude,
+                "arrivalAirportCode": stops[index + 1],
+                "arrivalAirportName": arrival_city,
+                "arrivalAirportLatitude": arrival_latitude,
+                "arrivalAirportLongitude": arrival_longitude,
+                "duration": f"PT{duration_in_seconds // 3600}H{duration_in_seconds % 3600 // 60}M",
+                "durationInSeconds": duration_in_seconds,
+                "elapsedDays": 0,
+                "distance": random_generator.randint(200, 1800),
+                "airlineImageFileName": f"{airline_code}.png",
+            })
+            departure_time = arrival_time + timedelta(minutes=random_generator.randint(40, 180))
+
+        first_departure_time = datetime.fromisoformat(segments[0]["departureTimeRaw"][:19])
+        total_seconds = int((arrival_time - first_departure_time).total_seconds())
+        leg = {
+            "legId": "%032x" % random_generator.getrandbits(128),
+            "baggageFeesUrl": "https://www.expedia.com/Flights-BagFees",
+            "freeCancellationBy": {"raw": (flight_day - timedelta(days=1)).isoformat()},
+            "travelDuration": f"PT{total_seconds // 3600}H{total_seconds % 3600 // 60}M",
+            "isNonStop": n_segments == 1,
+            "segments": segments,
+        }
+        return leg
+
+    def _generate_offer(self, random_generator, leg):
+        """Generate the offer of one leg."""
+        base_fare = round(random_generator.uniform(150, 2500), 2)
+        taxes = round(base_fare * 0.1, 2)
+        fees = 0.0
+        total_fare = round(base_fare + taxes + fees, 2)
+        offer = {
+            "legIds": [leg["legId"]],
+            "fareBasisCode": random_generator.choice(["LA7NA0RF", "QLX0C0ST", "YUP14NA"]),
+            "isBasicEconomy": random_generator.random() < 0.3,
+            "isRefundable": random_generator.random() < 0.1,
+            "isFreeChangeAvailable": random_generator.random() < 0.2,
+            "taxes": taxes,
+            "fees": fees,
+            "showFees": False,
+            "currency": "USD",
+            "baseFare": base_fare,
+            "totalFare": total_fare,
+            "numberOfTickets": 1,
+            "hasSeatMap": True,
+            "providerCode": "ExpediaFlights",
+            "seatsRemaining": random_generator.randint(0, 9),
+            "averageTotalPricePerTicket": {"amount": total_fare, "currency": "USD"},
+            "flightFulfillmentMethod": ["ETICKET"],
+            "loyaltyInfo": {"isBurnApplied": False,
+                            "earn": {"points": {"base": int(total_fare),
+                                                "bonus": 0,
+                                                "total": int(total_fare)}}},
+            "segmentAttributes": [[{"bookingCode": "Y", "cabinClass": "coach"}]
+                                  for segment in leg["segments"]],
+            "productKey": "product_key",
+            "mobileShoppingKey": "mobile_shopping_key",
+        }
+        return offer
+
+
+def write_scale(path, scale="small", seed=0, today=None):
+    """Write the synthetic scrape of one of the SCALES.
+
+    Parameters
+    ----------
+    path: str
+        Directory where the data folder is created.
+    scale: str (default="small")
+        One of the SCALES keys.
+    seed: int (default=0)
+        Seed of the random generator.
+    today: datetime.date (default=datetime(2023, 6, 1))
+        Day the data was collected.
+
+    Return
+    ------
+    json_paths: list[str]
+        Path of each written json.
+    """
+    assert scale in SCALES, f"scale must be one of {list(SCALES)}"
+    if today is None:
+        today = datetime(2023, 6, 1).date()
+    config = SCALES[scale]
+    routes = [(origin, destination) for origin in AIRPORTS for destination in AIRPORTS
+              if origin != destination][:config["n_routes"]]
+    flight_days = [today + timedelta(days=day) for day in range(1, config["n_flight_days"] + 1)]
+    hours = list(range(config["n_hours"]))
+
+    synthetic_data = SyntheticExpediaData(seed=seed, n_legs=config["n_legs"])
+    return synthetic_data.write_scrape(path, today, hours, flight_days, routes)
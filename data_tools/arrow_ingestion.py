@@ -0,0 +1,542 @@
+import json
+import os
+import re
+import sys
+import threading
+from collections import Counter, deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import abspath, dirname, join
+from time import sleep
+
+import pyarrow as pa
+import requests
+
+sys.path.append(join(dirname(abspath(__file__)), "..", "utils"))
+from metrics import StageMetrics
+
+sys.path.append(join(dirname(abspath(__file__)), "..", "odbc"))
+
+# Prefix of the batches in the filePath column of the data_upload table
+ARROW_SOURCE_PREFIX = "arrow://"
+BATCH_NAME_PATTERN = re.compile(r"^[\w.=\-]+$")
+# Answers of the service that send_arrow_stream retries: nothing of the batch was
+# inserted. A load error (500) may leave a partial insert, it is never retried.
+RETRIED_STATUS_CODES = (400, 502, 503, 504)
+
+
+class BatchLoadError(Exception):
+    """The load of a batch failed after it started, part of it may be inserted."""
+
+
+class ArrowIngestionServer():
+    """HTTP service of the database machine that loads Arrow IPC streams.
+
+    The collector machines send the output of FlightExtractor with send_arrow_stream
+    instead of writing a parquet and transferring it by SFTP. Each request carries
+    one batch:
+    - POST /ingest/<batch_name>: the body is an Arrow IPC stream, it may use chunked
+      transfer encoding and the IPC buffer compression (lz4 or zstd). The batch is
+      loaded before the answer, so a 200 answer is the acknowledgement. A batch
+      already loaded is answered with status "duplicate" and not loaded again.
+    - GET /status: number of batches by result, the failed batches and the last batches.
+
+    The tables of a batch are inserted one after another and data_upload last, so a
+    load that fails can leave part of the batch inserted. The batch is then recorded
+    as failed before the 500 answer and the later requests of it are answered with
+    409, so it is never inserted twice. Delete its rows (e.g. with
+    odbc/run_delete_rows_by_insertionTime.py) and call clear_failed_batch to accept
+    it again.
+
+    The batches are loaded one at a time, because the searchId of a batch depends
+    on the batches loaded before it. load_batch also holds database_tools.load_lock,
+    so it does not take the searchIds of a parquet load of run_database_format.py.
+
+    Example
+    -------
+    ArrowIngestionServer(port=8766).serve_forever()
+    """
+    def __init__(self, host="0.0.0.0", port=8766, load_function=None,
+                 is_loaded_function=None, token=None, history_size=100,
+                 failed_batches_path=None):
+        """
+        Parameters
+        ----------
+        host: str (default="0.0.0.0")
+            Host of the service.
+        port: int (default=8766)
+            Port of the service, 0 chooses a free port.
+        load_function: callable (default=None)
+            Function (data: pd.DataFrame, batch_name: str) -> dict that loads one
+            batch, by default load_batch.
+        is_loaded_function: callable (default=None)
+            Function (batch_name: str) -> bool, by default is_batch_loaded.
+        token: str (default=None)
+            If it is not None, the requests must have the header
+            "Authorization: Bearer <token>". By default the FLIGHT_INGESTION_TOKEN
+            environment variable is used, if it is set.
+        history_size: int (default=100)
+            Number of batches kept in the status.
+        failed_batches_path: str (default=None)
+            JSON file where the failed batches are kept, so they are still refused
+            after a restart. If None they are only kept in memory.
+        """
+        self.load_function = load_batch if load_function is None else load_function
+        self.is_loaded_function = (is_batch_loaded if is_loaded_function is None
+                                   else is_loaded_function)
+        self.token = os.environ.get("FLIGHT_INGESTION_TOKEN") if token is None else token
+        self.load_lock = threading.Lock()
+        self.statistics_lock = threading.Lock()
+        self.statistics = Counter()
+        self.history = deque(maxlen=history_size)
+        self.failed_batches_path = failed_batches_path
+        self.failed_batches = dict()
+        if failed_batches_path is not None and os.path.isfile(failed_batches_path):
+            with open(failed_batches_path, "r") as file:
+                self.failed_batches = json.load(file)
+
+        self.server = ThreadingHTTPServer((host, port), self._get_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Start the service in a background thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the service."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve_forever(self):
+        """Run the service in the current thread."""
+        print(f"Serving on {self.base_url}")
+        self.server.serve_forever()
+
+    def ingest(self, batch_name, source):
+        """Read one Arrow IPC stream and load it.
+
+        Parameters
+        ----------
+        batch_name: str
+            Name of the batch, it identifies the batch in the data_upload table.
+        source: file-like
+            Arrow IPC stream.
+
+        Return
+        ------
+        ack: dict
+            batch_name, status ("loaded", "duplicate" or "load_failed"), rows and
+            record_batches.
+
+        Raises
+        ------
+        BatchLoadError
+            If load_function fails, the batch is recorded as failed.
+        """
+        with self.load_lock:
+            if batch_name in self.failed_batches:
+                status = "load_failed"
+            elif self.is_loaded_function(batch_name):
+                status = "duplicate"
+            else:
+                status = None
+            if status is not None:
+                # The body is read, so the client receives the answer after sending it
+                while len(source.read(2**20)) > 0:
+                    pass
+                return {"batch_name": batch_name, "status": status}
+
+            with StageMetrics("ingest.read_stream", batch=batch_name) as stage_metrics:
+                reader = pa.ipc.open_stream(pa.PythonFile(source, mode="r"))
+                record_batches = [record_batch for record_batch in reader]
+                n_record_batches = len(record_batches)
+                table = pa.Table.from_batches(record_batches, schema=reader.schema)
+                data = table.to_pandas()
+                stage_metrics.rows = len(data)
+            del table, record_batches
+
+            try:
+                with StageMetrics("ingest.load_batch", rows=len(data), batch=batch_name,
+                                  verbose=True):
+                    summary = self.load_function(data, batch_name)
+            except Exception as error:
+                self._set_failed_batch(batch_name, str(error))
+                raise BatchLoadError(f"load of {batch_name} failed: {error}") from error
+        return {"batch_name": batch_name, "status": "loaded", "rows": len(data),
+                "record_batches": n_record_batches, **(summary or {})}
+
+    def get_status(self):
+        """Get the number of batches by result, the failed batches and the last batches."""
+        with self.statistics_lock:
+            return {"batches": dict(self.statistics), "failed_batches": dict(self.failed_batches),
+                    "last_batches": list(self.history)}
+
+    def clear_failed_batch(self, batch_name):
+        """Accept again a failed batch, after its partial insert was deleted."""
+        with self.load_lock:
+            self.failed_batches.pop(batch_name, None)
+            self._save_failed_batches()
+
+    def _set_failed_batch(self, batch_name, error_message):
+        self.failed_batches[batch_name] = {"time": datetime.now().isoformat(),
+                                           "error": error_message}
+        self._save_failed_batches()
+
+    def _save_failed_batches(self):
+        if self.failed_batches_path is None:
+            return
+        temporary_path = self.failed_batches_path + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(self.failed_batches, file, indent=4)
+        os.replace(temporary_path, self.failed_batches_path)
+
+    def _record(self, batch_name, status, detail=None):
+        with self.statistics_lock:
+            self.statistics[status] += 1
+            self.history.append({"batch_name": batch_name, "status": status,
+                                 "time": datetime.now().isoformat(), "detail": detail})
+
+    def _get_handler(self):
+        ingestion_server = self
+
+        class IngestionHandler(BaseHTTPRequestHandler):
+            # Keep-alive and chunked requests need HTTP/1.1
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if not self._is_authorized():
+                    return self._send_json(401, {"error": "unauthorized"})
+                if self.path == "/status":
+                    return self._send_json(200, ingestion_server.get_status())
+                return self._send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                if not self._is_authorized():
+                    return self._send_json(401, {"error": "unauthorized"})
+                parts = self.path.strip("/").split("/")
+                if len(parts) != 2 or parts[0] != "ingest":
+                    return self._send_json(404, {"error": "not found"})
+                batch_name = parts[1]
+                if BATCH_NAME_PATTERN.match(batch_name) is None:
+                    return self._send_json(400, {"error": "invalid batch name"})
+
+                body = HTTPBodyReader(
+                    self.rfile,
+                    content_length=self.headers.get("Content-Length"),
+                    chunked="chunked" in self.headers.get("Transfer-Encoding", "").lower()
+                )
+                try:
+                    ack = ingestion_server.ingest(batch_name, body)
+                except pa.ArrowInvalid as error:
+                    # Truncated or corrupted stream, the client sends it again
+                    ingestion_server._record(batch_name, "invalid_stream", str(error))
+                    return self._send_json(400, {"batch_name": batch_name,
+                                                 "error": f"invalid stream: {error}"})
+                except BatchLoadError as error:
+                    ingestion_server._record(batch_name, "load_error", str(error))
+                    return self._send_json(500, {"batch_name": batch_name,
+                                                 "status": "load_failed",
+                                                 "error": f"load error: {error}"})
+                except Exception as error:
+                    # Nothing was inserted, e.g. the database is not reachable
+                    ingestion_server._record(batch_name, "not_loaded", str(error))
+                    return self._send_json(503, {"batch_name": batch_name,
+                                                 "error": f"not loaded: {error}"})
+
+                if not body.is_exhausted():
+                    self.close_connection = True
+                ingestion_server._record(batch_name, ack["status"], ack.get("rows"))
+                if ack["status"] == "load_failed":
+                    return self._send_json(409, {**ack, "error": "a previous load of the "
+                                                 "batch failed, see clear_failed_batch"})
+                return self._send_json(200, ack)
+
+            def _is_authorized(self):
+                if ingestion_server.token is None:
+                    return True
+                return self.headers.get("Authorization") == f"Bearer {ingestion_server.token}"
+
+            def _send_json(self, status, payload):
+                # The body of a refused request may not have been read
+                if status >= 400:
+                    self.close_connection = True
+                body = json.dumps(payload, default=str).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if self.close_connection:
+                    self.send_header("Connection", "close")
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                return
+
+        return IngestionHandler
+
+
+class HTTPBodyReader():
+    """Read-only file-like object over a request body, chunked or with Content-Length."""
+    def __init__(self, rfile, content_length=None, chunked=False):
+        """
+        Parameters
+        ----------
+        rfile: file-like
+            Socket file of the request.
+        content_length: str or int (default=None)
+            Content-Length header, used when the body is not chunked.
+        chunked: bool (default=False)
+            If True the body uses chunked transfer encoding.
+        """
+        self.rfile = rfile
+        self.chunked = chunked
+        self.remaining = None if content_length is None else int(content_length)
+        self.buffer = b""
+        self.position = 0
+        self.eof = not chunked and self.remaining in (None, 0)
+        self.closed = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self.buffer += self._read_next()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(data)
+        return data
+
+    def is_exhausted(self):
+        """True if the whole body was read, so the connection can be reused."""
+        return self.eof and len(self.buffer) == 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def writable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.closed = True
+
+    def _read_next(self):
+        if not self.chunked:
+            data = self.rfile.read(min(self.remaining, 2**20))
+            self.remaining -= len(data)
+            if self.remaining == 0 or len(data) == 0:
+                self.eof = True
+            return data
+
+        size_line = self.rfile.readline()
+        if size_line == b"":
+            self.eof = True
+            return b""
+        size = int(size_line.split(b";")[0].strip(), 16)
+        if size == 0:
+            # Trailers end with an empty line
+            while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            self.eof = True
+            return b""
+        data = self.rfile.read(size)
+        self.rfile.readline()
+        return data
+
+
+class _ChunkSink():
+    """Write-only file-like object that keeps the bytes written since the last pop."""
+    def __init__(self):
+        self.chunks = list()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        return
+
+    def close(self):
+        self.closed = True
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = list()
+        return data
+
+
+def iter_arrow_stream(dataframe, compression="zstd", chunk_rows=50_000):
+    """Serialize a DataFrame as an Arrow IPC stream, one piece per record batch.
+
+    Parameters
+    ----------
+    dataframe: pd.DataFrame
+        Output of FlightExtractor.structure_all_jsons.
+    compression: str (default="zstd")
+        IPC buffer compression, "zstd", "lz4" or None.
+    chunk_rows: int (default=50_000)
+        Rows of each record batch, each one is sent as one HTTP chunk.
+
+    Return
+    ------
+    pieces: generator[bytes]
+        Pieces of the stream.
+    """
+    table = pa.Table.from_pandas(dataframe, preserve_index=False)
+    sink = _ChunkSink()
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), table.schema,
+                           options=options) as writer:
+        yield sink.pop()
+        for record_batch in table.to_batches(max_chunksize=chunk_rows):
+            writer.write_batch(record_batch)
+            yield sink.pop()
+    yield sink.pop()
+
+
+def send_arrow_stream(dataframe, url, batch_name, compression="zstd", chunk_rows=50_000,
+                      token=None, max_n_attempts=5, backoff_seconds=5, timeout=3600):
+    """Send a DataFrame to the ArrowIngestionServer and wait for the acknowledgement.
+
+    Parameters
+    ----------
+    dataframe: pd.DataFrame
+        Output of FlightExtractor.structure_all_jsons.
+    url: str
+        Base url of the service, e.g. "http://10.0.0.5:8766".
+    batch_name: str
+        Name of the batch, letters, digits, "_", ".", "=" and "-". The same name is
+        never loaded twice: a batch already loaded is answered as "duplicate" and a
+        batch whose load failed is refused (see ArrowIngestionServer).
+    compression: str (default="zstd")
+        IPC buffer compression, "zstd", "lz4" or None.
+    chunk_rows: int (default=50_000)
+        Rows of each record batch.
+    token: str (default=None)
+        Token of the service, by default the FLIGHT_INGESTION_TOKEN environment variable.
+    max_n_attempts: int (default=5)
+        Maximum number of attempts. The connection errors and the answers of
+        RETRIED_STATUS_CODES are retried, nothing of the batch was inserted. A load
+        error (500) or a batch refused after one (409) is raised at once.
+    backoff_seconds: float (default=5)
+        Wait before the second attempt, it doubles after each attempt.
+    timeout: float (default=3600)
+        Seconds to wait for the acknowledgement, the batch is loaded before it.
+
+    Return
+    ------
+    ack: dict
+        Answer of the service, see ArrowIngestionServer.ingest.
+    """
+    assert BATCH_NAME_PATTERN.match(batch_name) is not None, (
+        f"batch_name must match {BATCH_NAME_PATTERN.pattern}"
+    )
+    if token is None:
+        token = os.environ.get("FLIGHT_INGESTION_TOKEN")
+    headers = {"Content-Type": "application/vnd.apache.arrow.stream"}
+    if token is not None:
+        headers["Authorization"] = f"Bearer {token}"
+
+    error_message = None
+    for attempt in range(1, max_n_attempts + 1):
+        try:
+            with StageMetrics("ingest.send_stream", rows=len(dataframe), batch=batch_name,
+                              attempt=attempt):
+                # A generator body is sent with chunked transfer encoding
+                response = requests.post(f"{url}/ingest/{batch_name}",
+                                         data=iter_arrow_stream(dataframe, compression,
+                                                                chunk_rows),
+                                         headers=headers, timeout=timeout)
+            if response.status_code == 200:
+                return response.json()
+            error_message = f"HTTP {response.status_code}: {response.text}"
+            if response.status_code not in RETRIED_STATUS_CODES:
+                break
+        except requests.RequestException as error:
+            error_message = str(error)
+
+        print(f"ATTEMPT NUMBER {attempt}, batch {batch_name} was not acknowledged: "
+              f"{error_message}")
+        if attempt < max_n_attempts:
+            sleep(backoff_seconds * 2 ** (attempt - 1))
+    raise ConnectionError(f"Batch {batch_name} was not acknowledged: {error_message}")
+
+
+def load_batch(data, batch_name, deduplicate_legs=False, micro_batch=True,
+               update_fare_curve=False, index_options=None):
+    """Load one batch with DatabaseFormat, the default load of ArrowIngestionServer.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Output of FlightExtractor.structure_all_jsons.
+    batch_name: str
+        Name of the batch, saved in the data_upload table with ARROW_SOURCE_PREFIX.
+    deduplicate_legs: bool (default=False)
+        See DatabaseFormat.
+    micro_batch: bool (default=True)
+        See DatabaseFormat, the batches are usually one hour or one day.
+    update_fare_curve: bool (default=False)
+        See DatabaseFormat.
+    index_options: list[str] (default=None)
+        See DatabaseFormat.
+
+    Return
+    ------
+    summary: dict
+        Number of rows inserted in each table.
+    """
+    import database_tools as dt
+    from database_format import DatabaseFormat
+
+    # The searchIds are taken from the search table, run_database_format.py may be
+    # loading parquets at the same time
+    with dt.load_lock():
+        database_format = DatabaseFormat([], inset_on_database=True,
+                                         deduplicate_legs=deduplicate_legs,
+                                         micro_batch=micro_batch,
+                                         update_fare_curve=update_fare_curve,
+                                         index_options=index_options)
+        tables = database_format.transform_dataframe(data, ARROW_SOURCE_PREFIX + batch_name)
+    return {f"{table_name}_rows": len(table) for table_name, table in tables.items()}
+
+
+def is_batch_loaded(batch_name):
+    """Check the data_upload table, the default is_loaded_function of ArrowIngestionServer."""
+    import query_tools as qt
+
+    data_upload = qt.run_query(f"""
+        SELECT 1
+        FROM flight.data_upload
+        WHERE "filePath" = '{ARROW_SOURCE_PREFIX + batch_name}'
+        LIMIT 1
+    """)
+    return not data_upload.empty
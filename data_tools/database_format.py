@@ -1,22 +1,43 @@
 import json
 import sys
 from datetime import datetime
+from glob import glob
 from os.path import join
-from time import time
+from pprint import pprint
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 from geopy.geocoders import Nominatim
 from joblib import Parallel, delayed
+from derived_columns import get_derived_columns
+from structured_dataset import list_dataset_files, read_structured_file
+from structured_schema import join_list_columns
 
 sys.path.append("../odbc")
 import database_tools as dt
+import fare_curve_cube as fc
 import query_tools as qt
+import schema_validation as sv
 from connection import load_conn
 
 sys.path.append("../utils")
+from metrics import StageMetrics, measure_stage
 from tools import get_relevant_path
 
+# Order of the rows of each batch in the tables: the rows of a time range and route are
+# stored in neighbouring pages, which keeps the BRIN indexes small and precise
+# (see database_tools.INDEX_OPTIONS) and the time range scans short
+LOAD_ORDER_COLUMNS = ["operational_search_time", "origin_code", "destination_code"]
+# Tables inserted by one worker when the rows are sorted: parallel workers append their
+# partitions to interleaved heap pages, which would mix the time ranges of the
+# operationalSearchTime BRIN index. The BRIN indexes of flight and fare are on
+# insertionTime, the timestamp of each insert transaction, so their parallel inserts
+# only mix the seconds of one load
+SERIAL_INSERT_TABLES = ["search"]
+# Separator of the columns and text of the nulls in the text hashed by get_leg_hash
+LEG_HASH_SEPARATOR = "\x1f"
+LEG_HASH_NULL = "\\N"
 
 class DatabaseFormat:
     """Transform structured raw data into database format.
@@ -29,10 +50,17 @@ class DatabaseFormat:
     - airline
     - equipment
     - data_upload
+
+    With deduplicate_legs=True the flight table is replaced by the leg table, which
+    stores the static leg attributes once per legHash, and the fare table keeps
+    only the price/seat observation of each search together with its legHash.
     """
 
     def __init__(self, parquet_paths, separator="||", next_search_id=None,
-                 inset_on_database=False, bypass_table_insert=None):
+                 inset_on_database=False, bypass_table_insert=None,
+                 deduplicate_legs=False, micro_batch=False, validate_before_insert=True,
+                 update_fare_curve=False, add_derived_columns=True, sort_rows=True,
+                 index_options=None):
         """
         Parameters
         ----------
@@ -44,14 +72,46 @@ class DatabaseFormat:
             information for each segment separated by separator="||".
         next_search_id: int (default=None)
             Next value of the search_id column. This is used in tables: search, flight, fare.
+            If it is None, the maximum of the search table plus one, the loads hold
+            database_tools.load_lock from here until the insert.
         inset_on_database: bool (default=False)
             If True insert data in database.
         bypass_table_insert: list (default=None)
             List of tables not to upload to the database
+        deduplicate_legs: bool (default=False)
+            If True write the static leg data to the leg table, keyed by legHash,
+            instead of repeating it in the flight table for every search.
+        micro_batch: bool (default=False)
+            If True the load is tuned for small frequent batches, such as one
+            collection hour: only the airports, airlines and equipments that are
+            not in the database are geocoded and appended, the indexes are kept
+            during the insert and the rows are loaded with COPY.
+        validate_before_insert: bool (default=True)
+            If True each table is coerced to the column types of the database and
+            the invalid rows are saved with the rows not inserted, with the reason,
+            before the insert (see schema_validation.validate_table).
+        update_fare_curve: bool (default=False)
+            If True the inserted fares are added to the fare_curve table, the cube of
+            the fares by days to departure (see fare_curve_cube.py).
+        add_derived_columns: bool (default=True)
+            If True the typed columns derived_columns.DERIVED_COLUMNS are computed
+            and inserted: daysToDeparture in the search table, departureHour,
+            timeOfDay and travelDurationMinutes in the flight or leg table. The
+            queries use them instead of parsing the text columns for every row.
+        sort_rows: bool (default=True)
+            If True the rows of each parquet are sorted by LOAD_ORDER_COLUMNS before
+            the searchId is assigned, so the tables are written in time order. The
+            SERIAL_INSERT_TABLES are then inserted by one worker, so that order
+            reaches the heap pages.
+        index_options: list[str] (default=None)
+            Options of the indexes created after the insert, e.g. ["brin", "covering"],
+            see database_tools.get_indexes_config.
         """
         self.parquet_paths = parquet_paths
         self.separator = separator
         self.unique_value_tables = ["airport", "airline", "equipment"]
+        self.unique_value_keys = {"airport": "airportCode", "airline": "airlineCode",
+                                  "equipment": "equipmentCode"}
         self.tables_columns = {
             "search": ["searchId", "searchTime", "operationalSearchTime", "flightDay",
                        "originCode", "destinationCode"],
@@ -70,6 +130,37 @@ class DatabaseFormat:
             "airline": ["airlineCode", "airlineName", "externalAirlineCode", "operatingAirlineName"],
             "equipment": ["equipmentCode", "equipmentDescription"],
         }
+
+        assert isinstance(deduplicate_legs, bool), (
+                f"deduplicate_legs must be bool, it is {type(deduplicate_legs)}"
+            )
+        self.deduplicate_legs = deduplicate_legs
+        self.deduplicated_tables = []
+        if self.deduplicate_legs:
+            self.leg_static_columns = [column for column in self.tables_columns.pop("flight")
+                                       if column != "searchId"]
+            self.tables_columns["leg"] = ["legHash"] + self.leg_static_columns
+            self.tables_columns["fare"] = self.tables_columns["fare"] + ["legHash"]
+            self.deduplicated_tables = ["leg"]
+
+        assert isinstance(add_derived_columns, bool), (
+                f"add_derived_columns must be bool, it is {type(add_derived_columns)}"
+            )
+        self.add_derived_columns = add_derived_columns
+
+        assert isinstance(sort_rows, bool), f"sort_rows must be bool, it is {type(sort_rows)}"
+        self.sort_rows = sort_rows
+        self.index_options = index_options
+        self.derived_tables_columns = {}
+        if self.add_derived_columns:
+            # Added after leg_static_columns, they do not change the legHash
+            leg_table = "leg" if self.deduplicate_legs else "flight"
+            self.derived_tables_columns = {
+                "search": ["daysToDeparture"],
+                leg_table: ["departureHour", "timeOfDay", "travelDurationMinutes"],
+            }
+            for table_name, derived_columns in self.derived_tables_columns.items():
+                self.tables_columns[table_name] = self.tables_columns[table_name] + derived_columns
         if next_search_id is None:
             self.next_search_id = qt.get_max_search_id() + 1
         else:
@@ -90,6 +181,21 @@ class DatabaseFormat:
                 f"bypass_table_insert must be list, it is {type(bypass_table_insert)}"
             )
             self.bypass_table_insert = bypass_table_insert
+
+        assert isinstance(micro_batch, bool), (
+                f"micro_batch must be bool, it is {type(micro_batch)}"
+            )
+        self.micro_batch = micro_batch
+
+        assert isinstance(validate_before_insert, bool), (
+                f"validate_before_insert must be bool, it is {type(validate_before_insert)}"
+            )
+        self.validate_before_insert = validate_before_insert
+
+        assert isinstance(update_fare_curve, bool), (
+                f"update_fare_curve must be bool, it is {type(update_fare_curve)}"
+            )
+        self.update_fare_curve = update_fare_curve
         
 
     def transform_all_parquets(self, n_jobs=-1):
@@ -105,52 +211,193 @@ class DatabaseFormat:
         tables: dict[pd.DataFrame]
             Dictionary with all tables in the database format.
         """
-        tables_list = Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(
-            [delayed(self._transform_parquet)(parquet_path)
-             for parquet_path in self.parquet_paths]
-        )
-        
-        tables = self._post_processing(tables_list)
+        with StageMetrics("format.transform_all_parquets",
+                          files=len(self.parquet_paths)) as stage_metrics:
+            tables_list = Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(
+                [delayed(self._transform_parquet)(parquet_path)
+                 for parquet_path in self.parquet_paths]
+            )
+
+            tables = self._post_processing(tables_list)
+            stage_metrics.rows = sum(len(table) for table in tables.values())
         
         if self.inset_on_database:
-            print("Saving data...")
-            for table_name, table in tables.items():
-                if table_name in self.bypass_table_insert:
-                    print(f"Skipping {table_name}, it has {len(table_name)} lines.")
-                    continue
-                
-                start_time = time()
-                if_exists = "replace" if table_name in self.unique_value_tables else "append"
-                temporarily_disable_table_indexes = True if table_name in ("search", "flight", "fare") else False
-
-                print((f"Saving {table_name} table... {len(table)} lines, if_exists = {if_exists}, "
-                       f"temporarily_disable_table_indexes = {temporarily_disable_table_indexes}"))
-                dataframe_not_inserted = dt.insert_database_parallel(table, table_name, if_exists=if_exists,
-                                                                     temporarily_disable_table_indexes=temporarily_disable_table_indexes)
-                end_time = time()
-                print(f"Done in {(end_time - start_time)/60} min!")
-                
-                self.save_dataframe_not_inserted(dataframe_not_inserted, table_name)
-
-            dataframe_not_inserted = self.insert_data_upload_table(self.parquet_paths)
-            self.save_dataframe_not_inserted(dataframe_not_inserted, "data_upload")
+            self.insert_tables(tables, self.parquet_paths)
         
         return tables
 
+    def transform_dataframe(self, data, source_name):
+        """Transform structured raw data already in memory into database format.
+
+        It is used by the Arrow ingestion service, which receives the output of
+        FlightExtractor without a parquet file.
+
+        Parameters
+        ----------
+        data: pd.DataFrame
+            Output of FlightExtractor.structure_all_jsons.
+        source_name: str
+            Name of the data, it is saved in the data_upload table like the parquet paths.
+
+        Return
+        ------
+        tables: dict[pd.DataFrame]
+            Dictionary with all tables in the database format.
+        """
+        with StageMetrics("format.transform_dataframe", source=source_name) as stage_metrics:
+            tables = self._post_processing([self._transform_data(data)])
+            stage_metrics.rows = sum(len(table) for table in tables.values())
+
+        if self.inset_on_database:
+            self.insert_tables(tables, [source_name])
+        return tables
+
+    def insert_tables(self, tables, file_paths):
+        """Insert the tables on database and register file_paths in the data_upload table.
+
+        Parameters
+        ----------
+        tables: dict[pd.DataFrame]
+            Output of transform_all_parquets or transform_dataframe.
+        file_paths: list[str]
+            Sources of the tables.
+        """
+        print("Saving data...")
+        fare_search_ids_not_loaded = pd.Series(dtype="int64")
+        for table_name, table in tables.items():
+            if table_name in self.bypass_table_insert:
+                print(f"Skipping {table_name}, it has {len(table_name)} lines.")
+                continue
+            
+            if_exists = ("replace" if table_name in self.unique_value_tables
+                         and not self.micro_batch else "append")
+            # Rebuilding the indexes of the whole table costs more than a small batch
+            temporarily_disable_table_indexes = (
+                table_name in ("search", "flight", "fare") and not self.micro_batch
+            )
+
+            # Legs already stored by previous searches are skipped by the database
+            if table_name in self.deduplicated_tables:
+                method = dt.insert_on_conflict_do_nothing
+            else:
+                method = dt.insert_copy if self.micro_batch else "multi"
+
+            dataframe_not_valid = pd.DataFrame()
+            if self.validate_before_insert:
+                with StageMetrics("format.validate_table", rows=len(table), table=table_name):
+                    table, dataframe_not_valid = sv.validate_table(
+                        table, table_name,
+                        check_unique=table_name not in self.deduplicated_tables
+                    )
+
+            # None is the default of insert_database_parallel, half of the cores
+            n_jobs = 1 if self.sort_rows and table_name in SERIAL_INSERT_TABLES else None
+
+            print((f"Saving {table_name} table... {len(table)} lines, if_exists = {if_exists}, "
+                   f"temporarily_disable_table_indexes = {temporarily_disable_table_indexes}"))
+            with StageMetrics("format.save_table", rows=len(table), table=table_name,
+                              verbose=True):
+                dataframe_not_inserted = dt.insert_database_parallel(table, table_name, if_exists=if_exists,
+                                                                     method=method, n_jobs=n_jobs,
+                                                                     temporarily_disable_table_indexes=temporarily_disable_table_indexes,
+                                                                     index_options=self.index_options)
+            
+            if table_name in self.deduplicated_tables:
+                with StageMetrics("format.check_leg_hash_collisions", rows=len(table),
+                                  table=table_name) as stage_metrics:
+                    collisions = self.get_leg_hash_collisions(table)
+                    stage_metrics.labels["collisions"] = len(collisions)
+                if len(collisions) > 0:
+                    print(f"Warning: {len(collisions)} legs of {table_name} have the "
+                          "legHash of another legId, they were not inserted")
+                dataframe_not_inserted = pd.concat([dataframe_not_inserted, collisions])
+
+            dataframe_not_loaded = pd.concat([dataframe_not_valid, dataframe_not_inserted])
+            self.save_dataframe_not_inserted(dataframe_not_loaded, table_name)
+            if table_name == "fare" and "searchId" in dataframe_not_loaded.columns:
+                fare_search_ids_not_loaded = dataframe_not_loaded["searchId"]
+
+        if (self.update_fare_curve and "fare" in tables
+                and "fare" not in self.bypass_table_insert):
+            with StageMetrics("format.update_fare_curve", verbose=True) as stage_metrics:
+                cube = fc.aggregate_fare_curve(
+                    self.get_fare_curve_data(tables, fare_search_ids_not_loaded),
+                    separator=self.separator
+                )
+                fc.upsert_fare_curve(cube)
+                stage_metrics.rows = len(cube)
+
+        dataframe_not_inserted = self.insert_data_upload_table(file_paths)
+        self.save_dataframe_not_inserted(dataframe_not_inserted, "data_upload")
+
+    def get_fare_curve_data(self, tables, fare_search_ids_not_loaded=None):
+        """Join the fares with their search and leg data, the input of the fare curve cube.
+
+        Parameters
+        ----------
+        tables: dict[pd.DataFrame]
+            Output of transform_all_parquets or transform_dataframe.
+        fare_search_ids_not_loaded: pd.Series (default=None)
+            searchId of the fares that were not inserted, they are not counted.
+
+        Return
+        ------
+        data: pd.DataFrame
+            Columns fare_curve_cube.SOURCE_COLUMNS.
+        """
+        fare = tables["fare"]
+        if fare_search_ids_not_loaded is not None:
+            fare = fare[~fare["searchId"].isin(fare_search_ids_not_loaded)]
+
+        leg_columns = ["airlineCode", "departureTimeRaw"]
+        search_columns = ["searchId", "originCode", "destinationCode", "flightDay",
+                          "operationalSearchTime"]
+        if self.deduplicate_legs:
+            data = fare[["searchId", "legHash", "totalFare"]].merge(
+                tables["leg"][["legHash"] + leg_columns], on="legHash"
+            )
+        else:
+            data = fare[["searchId", "totalFare"]].merge(
+                tables["flight"][["searchId"] + leg_columns], on="searchId"
+            )
+        data = data.merge(tables["search"][search_columns], on="searchId")
+        return data[fc.SOURCE_COLUMNS]
+
+    @measure_stage("format.transform_parquet",
+                   rows=lambda tables: sum(len(table) for table in tables.values()))
     def _transform_parquet(self, parquet_path):
         """Transform structured raw data from 1 parquet into database format.
 
         Parameters
         ----------
         parquet_path: str
-            One parquet path.
+            One parquet path, flat or of the partitioned dataset.
+
+        Return
+        ------
+        tables: dict[pd.DataFrame]
+            Dictionary with all tables in the database format.
+        """
+        data = read_structured_file(parquet_path)
+        return self._transform_data(data)
+
+    def _transform_data(self, data):
+        """Transform structured raw data into database format.
+
+        Parameters
+        ----------
+        data: pd.DataFrame
+            Structured raw data of one parquet or of one ingested batch.
 
         Return
         ------
         tables: dict[pd.DataFrame]
             Dictionary with all tables in the database format.
         """
-        data = pd.read_parquet(parquet_path)
+        # Typed parquets keep the segments as lists, the database stores them joined
+        data = join_list_columns(data, separator=self.separator)
+        if self.sort_rows:
+            data = data.sort_values(LOAD_ORDER_COLUMNS, kind="stable")
         data.reset_index(drop=True, inplace=True)
         data.reset_index(names="searchId", inplace=True)
 
@@ -162,6 +409,13 @@ class DatabaseFormat:
              "destination_code": "destinationCode"
         }
         data.rename(columns=rename_search_table, inplace=True)
+        if self.add_derived_columns:
+            derived_columns = [column for columns in self.derived_tables_columns.values()
+                               for column in columns]
+            data[derived_columns] = get_derived_columns(data, derived_columns)
+        if self.deduplicate_legs:
+            data["legHash"] = self.get_leg_hash(data, self.leg_static_columns)
+
         tables = {}
         for table_name, table_columns in self.tables_columns.items():
             if "airport" in table_name:
@@ -171,8 +425,79 @@ class DatabaseFormat:
             
             if table_name in self.unique_value_tables:                
                 tables[table_name] = tables[table_name].drop_duplicates()
+            elif table_name in self.deduplicated_tables:
+                tables[table_name] = tables[table_name].drop_duplicates(subset="legHash")
         return tables
 
+    @staticmethod
+    def get_leg_hash(data, columns):
+        """Hash the static leg fields of each row.
+
+        Rows with the same legId and the same static attributes (segments, equipment,
+        coordinates...) have the same hash, whatever search they come from. The hash
+        is taken over one canonical text per row, see get_canonical_text, so it does
+        not depend on the dtypes of the columns (e.g. bool or "True", int64 or
+        float64, None or NaN).
+
+        Parameters
+        ----------
+        data: pd.DataFrame
+            Data with the legId and the static leg columns.
+        columns: list[str]
+            Static leg columns, they must include legId.
+
+        Return
+        ------
+        leg_hash: pd.Series
+            Signed 64 bits hash of each row, it fits in a BIGINT column.
+        """
+        leg_text = get_canonical_text(data[columns[0]])
+        for column in columns[1:]:
+            leg_text = leg_text + LEG_HASH_SEPARATOR + get_canonical_text(data[column])
+        leg_hash = pd.util.hash_pandas_object(leg_text, index=False)
+        return leg_hash.astype("int64")
+
+    @staticmethod
+    def get_leg_hash_collisions(leg, schema="flight", chunk_size=10_000):
+        """Get the legs whose legHash is stored in the database with another legId.
+
+        The leg table is inserted with ON CONFLICT DO NOTHING, so the leg of a hash
+        collision would be dropped without error and its fares joined to another leg.
+
+        Parameters
+        ----------
+        leg: pd.DataFrame
+            Leg table of the batch, after its insert.
+        schema: str (default="flight")
+            The name of the database schema.
+        chunk_size: int (default=10_000)
+            Number of hashes of each query.
+
+        Return
+        ------
+        collisions: pd.DataFrame
+            Rows of leg whose legHash belongs to another legId, with the stored legId
+            in dt.INSERT_ERROR_COLUMN.
+        """
+        leg_hashes = leg["legHash"].unique()
+        stored_leg_list = list()
+        for start in range(0, len(leg_hashes), chunk_size):
+            hashes = ", ".join(str(int(leg_hash))
+                               for leg_hash in leg_hashes[start:start + chunk_size])
+            stored_leg_list.append(qt.run_query(f"""
+                SELECT "legHash", "legId" AS "storedLegId"
+                FROM {schema}.leg
+                WHERE "legHash" IN ({hashes})
+            """))
+        if len(stored_leg_list) == 0:
+            return leg.iloc[:0]
+        stored_leg = pd.concat(stored_leg_list, ignore_index=True)
+        collisions = leg.merge(stored_leg, on="legHash", how="inner")
+        collisions = collisions[collisions["legId"] != collisions["storedLegId"]]
+        collisions[dt.INSERT_ERROR_COLUMN] = ("legHash collision with the stored legId "
+                                              + collisions["storedLegId"].astype(str))
+        return collisions.drop(columns="storedLegId")
+
     def _transform_airport_data(self, data):
         """Transform structured raw data into airport table format.
 
@@ -241,8 +566,24 @@ class DatabaseFormat:
                 end_search_id = self.next_search_id + len(tables[table_key])
                 tables[table_key]["searchId"] = range(self.next_search_id, end_search_id)
             
+            # Legs repeated between parquets are stored once
+            if table_key in self.deduplicated_tables:
+                tables[table_key] = tables[table_key].drop_duplicates(subset="legHash",
+                                                                      ignore_index=True)
+
             # Get unique values
-            if table_key in self.unique_value_tables:
+            if table_key in self.unique_value_tables and self.micro_batch:
+                # Only the new values are appended, the table is not rewritten
+                key = self.unique_value_keys[table_key]
+                database_keys = qt.run_query(
+                    f'SELECT "{key}" FROM flight.{table_key}'
+                )[key]
+                tables[table_key] = self._get_unique_values(tables[table_key])
+                tables[table_key] = (
+                    tables[table_key][~tables[table_key][key].isin(database_keys)]
+                    .drop_duplicates(subset=key, ignore_index=True)
+                )
+            elif table_key in self.unique_value_tables:
                 database_table = qt.get_table(table_key)
                 tables[table_key] = pd.concat([tables[table_key], database_table])
                 tables[table_key] = self._get_unique_values(tables[table_key])
@@ -340,7 +681,14 @@ class DatabaseFormat:
             file_name = (table_name + "_" + datetime.now().strftime("%Y%m%d_%Hh_%mmin")
                          + ".parquet")
             save_path = join(get_relevant_path("database_format_not_inserted"), file_name)
-            dataframe_not_inserted.to_parquet(save_path)
+            try:
+                dataframe_not_inserted.to_parquet(save_path)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Rows rejected by the validation can mix types in a column
+                object_columns = dataframe_not_inserted.select_dtypes("object").columns
+                dataframe_not_inserted.astype(
+                    {column: "string" for column in object_columns}
+                ).to_parquet(save_path)
     
     @staticmethod
     def insert_data_upload_table(file_paths):
@@ -360,4 +708,97 @@ class DatabaseFormat:
         data_upload = pd.DataFrame({"filePath": file_paths})
         dataframe_not_inserted = dt.insert_database_parallel(data_upload, "data_upload",
                                                              temporarily_disable_table_indexes=False)
-        return dataframe_not_inserted
\ No newline at end of file
+        return dataframe_not_inserted
+
+
+def get_canonical_text(series):
+    """Text of each value that does not depend on the dtype of the column.
+
+    The nulls (None, NaN, NA, NaT) are LEG_HASH_NULL, the floats without fraction
+    are written as integers and the other values are str(value).
+
+    Parameters
+    ----------
+    series: pd.Series
+        Column of any dtype, e.g. categorical, boolean, Int64 or object.
+
+    Return
+    ------
+    text: pd.Series
+        Column of str.
+    """
+    is_null = series.isna()
+    values = series.astype("object")
+    if pd.api.types.is_float_dtype(series):
+        is_integer = ~is_null & (series % 1 == 0)
+        values[is_integer] = series[is_integer].astype("int64").astype("object")
+    elif pd.api.types.infer_dtype(series, skipna=True) in ("floating", "mixed-integer-float",
+                                                           "mixed"):
+        # An object column with floats, maybe mixed with other types
+        values = values.map(lambda value: int(value) if isinstance(value, float)
+                            and value.is_integer() else value)
+    return values.astype(str).where(~is_null, LEG_HASH_NULL)
+
+
+def format_new_parquets(deduplicate_legs=False, micro_batch=False, n_jobs=-1,
+                        update_fare_curve=False, index_options=None):
+    """Transform and insert the structured parquets not yet in the data_upload table.
+
+    The parquets are the flat files of the structured_data folder and the files of
+    the partitioned dataset of the structured_dataset folder.
+
+    Parameters
+    ----------
+    deduplicate_legs: bool (default=False)
+        If True store static leg data once in the leg table instead of the flight table.
+    micro_batch: bool (default=False)
+        If True use the load for small frequent batches, see DatabaseFormat.
+    n_jobs: int (default=-1, all cores)
+        Number of cores.
+    update_fare_curve: bool (default=False)
+        If True add the fares to the fare_curve table, see DatabaseFormat.
+    index_options: list[str] (default=None)
+        Options of the indexes, see DatabaseFormat.
+
+    Return
+    ------
+    parquet_paths: list[str]
+        Parquet files inserted on database.
+    """
+    # The searchIds are taken from the search table, a concurrent load would take them too
+    with dt.load_lock():
+        return _format_new_parquets(deduplicate_legs=deduplicate_legs,
+                                    micro_batch=micro_batch, n_jobs=n_jobs,
+                                    update_fare_curve=update_fare_curve,
+                                    index_options=index_options)
+
+
+def _format_new_parquets(deduplicate_legs, micro_batch, n_jobs, update_fare_curve,
+                         index_options):
+    data_upload = qt.get_table("data_upload")
+    files_already_computed = set(data_upload["filePath"].unique())
+
+    parquet_paths = glob(
+        join(get_relevant_path("structured_data"), "*.parquet")
+    )
+    dataset_path = get_relevant_path("structured_dataset")
+    if dataset_path is not None:
+        # The compacted files have the rows of files already inserted
+        parquet_paths += list_dataset_files(dataset_path, include_compacted=False)
+
+    parquet_paths = list(set(parquet_paths) - files_already_computed)
+    parquet_paths.sort()
+
+    print("Parquets number: ", len(parquet_paths))
+    pprint(parquet_paths)
+    if len(parquet_paths) == 0:
+        return parquet_paths
+
+    with StageMetrics("format.run_database_format", files=len(parquet_paths), verbose=True):
+        database_format = DatabaseFormat(parquet_paths, inset_on_database=True,
+                                         deduplicate_legs=deduplicate_legs,
+                                         micro_batch=micro_batch,
+                                         update_fare_curve=update_fare_curve,
+                                         index_options=index_options)
+        database_format.transform_all_parquets(n_jobs=n_jobs)
+    return parquet_paths
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+# Buckets of the departure hour, the same as the SQL function get_time_of_day
+# (setup/sql/create_functions.sql): [0, 6), [6, 12), [12, 18) and [18, 24)
+TIME_OF_DAY_HOURS = [0, 6, 12, 18, 24]
+TIME_OF_DAY_LABELS = ["overnight", "morning", "afternoon", "evening"]
+# ISO 8601 durations such as "PT2H29M" or "P1DT3H5M"
+ISO_DURATION_PATTERN = r"^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?)?$"
+# Columns computed at load time (see DatabaseFormat) and the database columns they
+# are computed from
+DERIVED_COLUMNS = {
+    "daysToDeparture": ["flightDay", "operationalSearchTime"],
+    "departureHour": ["departureTimeRaw"],
+    "timeOfDay": ["departureTimeRaw"],
+    "travelDurationMinutes": ["travelDuration"],
+}
+
+
+def get_derived_columns(data, columns=None):
+    """Compute derived columns from the database format columns.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Data in the database format, with the source columns of DERIVED_COLUMNS.
+    columns: list[str] (default=None)
+        Derived columns to compute, by default all of them.
+
+    Return
+    ------
+    derived_data: pd.DataFrame
+        The derived columns, with the index of data. The values that can not be
+        computed are null.
+    """
+    columns = list(DERIVED_COLUMNS) if columns is None else columns
+    unknown_columns = [column for column in columns if column not in DERIVED_COLUMNS]
+    assert len(unknown_columns) == 0, f"columns {unknown_columns} are not in DERIVED_COLUMNS"
+
+    derived_data = pd.DataFrame(index=data.index)
+    if "departureHour" in columns or "timeOfDay" in columns:
+        departure_hour = get_departure_hour(data["departureTimeRaw"])
+    for column in columns:
+        if column == "daysToDeparture":
+            derived_data[column] = get_days_to_departure(data["flightDay"],
+                                                         data["operationalSearchTime"])
+        elif column == "departureHour":
+            derived_data[column] = departure_hour
+        elif column == "timeOfDay":
+            derived_data[column] = get_time_of_day(departure_hour)
+        elif column == "travelDurationMinutes":
+            derived_data[column] = get_duration_minutes(data["travelDuration"])
+    return derived_data
+
+
+def get_first_segment(values, separator="||"):
+    """Get the value of the first segment of a segment column joined by separator.
+
+    Parameters
+    ----------
+    values: pd.Series
+        Segment column of the database format, e.g. airlineCode "G3||AD".
+    separator: str (default="||")
+        Separator of the segments.
+
+    Return
+    ------
+    first_segment: pd.Series
+        Value of the first segment, e.g. "G3".
+    """
+    return values.astype(str).str.partition(separator)[0].where(values.notna())
+
+
+def get_departure_hour(departure_time_raw):
+    """Get the local departure hour of the first segment.
+
+    The raw times are ISO 8601 in the local time of the airport, e.g.
+    "2023-06-01T10:00:00.000-03:00", and the first segment comes first, so the hour
+    is read from the characters 11 and 12 without splitting the segments.
+
+    Parameters
+    ----------
+    departure_time_raw: pd.Series
+        departureTimeRaw column, joined by "||".
+
+    Return
+    ------
+    departure_hour: pd.Series
+        Hour between 0 and 23 (Int64), null if the time can not be read.
+    """
+    hours = pd.to_numeric(departure_time_raw.astype(str).str.slice(11, 13), errors="coerce")
+    hours = hours.where((hours >= 0) & (hours < 24))
+    return hours.astype("Int64")
+
+
+def get_time_of_day(departure_hour):
+    """Get the time of day bucket of each departure hour, like get_time_of_day in SQL.
+
+    Parameters
+    ----------
+    departure_hour: pd.Series
+        Hours, see get_departure_hour.
+
+    Return
+    ------
+    time_of_day: pd.Series
+        One of TIME_OF_DAY_LABELS, null if the hour is null.
+    """
+    buckets = np.searchsorted(TIME_OF_DAY_HOURS, departure_hour.fillna(-1).to_numpy(),
+                              side="right") - 1
+    labels = np.array(TIME_OF_DAY_LABELS + [None], dtype=object)
+    # -1 (null hours) selects the None at the end
+    return pd.Series(labels[buckets], index=departure_hour.index)
+
+
+def get_days_to_departure(flight_day, operational_search_time):
+    """Get the number of days between the search and the flight.
+
+    Parameters
+    ----------
+    flight_day: pd.Series
+        Flight dates, as dates, timestamps or text.
+    operational_search_time: pd.Series
+        Search times, as timestamps or text such as "2023-06-01T10:00".
+
+    Return
+    ------
+    days_to_departure: pd.Series
+        Days (Int64), 0 for a flight on the day of the search.
+    """
+    flight_day = pd.to_datetime(flight_day, errors="coerce")
+    search_day = pd.to_datetime(operational_search_time, errors="coerce").dt.normalize()
+    return (flight_day - search_day).dt.days.astype("Int64")
+
+
+def get_duration_minutes(duration):
+    """Convert ISO 8601 durations, e.g. the travelDuration "PT2H29M", to minutes.
+
+    Parameters
+    ----------
+    duration: pd.Series
+        ISO 8601 durations with days, hours, minutes and seconds.
+
+    Return
+    ------
+    duration_minutes: pd.Series
+        Whole minutes (Int64), null if the duration can not be read.
+    """
+    parts = duration.astype(str).str.extract(ISO_DURATION_PATTERN)
+    parts = parts.apply(pd.to_numeric, errors="coerce")
+    minutes = (parts[0].fillna(0) * 24 * 60 + parts[1].fillna(0) * 60 + parts[2].fillna(0)
+               + parts[3].fillna(0) // 60)
+    # "P" and "PT" alone match the pattern without any part
+    is_valid = parts.notna().any(axis=1) & duration.notna()
+    return minutes.where(is_valid).astype("Int64")
@@ -1,8 +1,15 @@
+import hashlib
 import os
+import shlex
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from glob import glob
+from queue import Empty, Queue
+from threading import Lock
+from time import sleep
 
 import paramiko
+from structured_dataset import get_dataset_root, list_dataset_files
 
 sys.path.append("../utils")
 import tools
@@ -65,7 +72,351 @@ def file_transfer(local_file, destination_path,
     return
 
         
-def structured_data_transfer(paths_to_transfer=None, deleting_local_file=True):
+class SFTPTransferPool():
+    """Transfer many files over a small pool of reusable SFTP sessions.
+
+    Each session is authenticated once and reused for several files. Files are sent
+    concurrently, partial uploads are resumed from the remote file size and every
+    transfer is verified before the local file can be deleted.
+
+    The sha256 of the local file is computed while it is sent, and the one of the
+    remote file by running remote_sha256_command on the server, so the file does
+    not travel back. If the server does not run commands (e.g. an SFTP only
+    account), the remote file is read back once per file.
+    """
+    def __init__(self, host, user, password, port=22, n_connections=4,
+                 window_size=2**27, max_packet_size=2**15, buffer_size=2**20,
+                 max_n_attempts=3, verify_checksum=True, connect_function=None,
+                 remote_sha256_command="sha256sum"):
+        """
+        Parameters
+        ----------
+        host: str
+            The hostname or IP address of the remote server.
+        user: str
+            The user for authentication.
+        password: str
+            The password for authentication.
+        port: int (default=22)
+            The SSH port of the remote server.
+        n_connections: int (default=4)
+            Number of SFTP sessions kept open, it is also the number of files sent
+            at the same time.
+        window_size: int (default=2**27)
+            SSH channel window size in bytes. Larger windows keep more data in
+            flight on high latency links.
+        max_packet_size: int (default=2**15)
+            SSH channel maximum packet size in bytes.
+        buffer_size: int (default=2**20)
+            Size of each block read from the local file and written to the remote file.
+        max_n_attempts: int (default=3)
+            Maximum number of attempts to transfer one file. Each new attempt resumes
+            from the bytes already on the remote server.
+        verify_checksum: bool (default=True)
+            If True compare the sha256 of the local and remote files, otherwise
+            only the sizes are compared.
+        connect_function: callable (default=None)
+            Function with signature (host, port, user, password, window_size,
+            max_packet_size) that returns an object with the paramiko.SFTPClient
+            interface and a transport attribute (paramiko.Transport, used to run
+            remote_sha256_command, or None). If it is None, paramiko is used. It
+            allows the pool to be used against a local SSH server stand-in.
+        remote_sha256_command: str (default="sha256sum")
+            Command run on the server with the quoted remote path, its output starts
+            with the sha256. If it is None, or it fails, the remote file is read back.
+        """
+        assert n_connections >= 1, "n_connections must be a positive number."
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+        self.n_connections = n_connections
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.buffer_size = buffer_size
+        self.max_n_attempts = max_n_attempts
+        self.verify_checksum = verify_checksum
+        self.remote_sha256_command = remote_sha256_command
+        if connect_function is None:
+            self.connect_function = self._paramiko_connect
+        else:
+            self.connect_function = connect_function
+        self.sessions = Queue()
+        self.opened_sessions = list()
+        self.sessions_lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def transfer_all(self, files_to_transfer, deleting_local_file=False):
+        """Transfer all files concurrently.
+
+        Parameters
+        ----------
+        files_to_transfer: list[tuple[str]]
+            List of (local_file, destination_path).
+        deleting_local_file: bool (default=False)
+            If True delete each local file after its transfer was verified.
+
+        Return
+        ------
+        transfer_log: list[dict]
+            One dict per file with the keys local_file, destination_path,
+            transferred_bytes, success and error_message.
+        """
+        transfer_log = list()
+        with ThreadPoolExecutor(max_workers=self.n_connections) as executor:
+            futures = [
+                executor.submit(self.transfer, local_file, destination_path,
+                                deleting_local_file=deleting_local_file)
+                for local_file, destination_path in files_to_transfer
+            ]
+            for future in as_completed(futures):
+                transfer_log.append(future.result())
+        return transfer_log
+
+    def transfer(self, local_file, destination_path, deleting_local_file=False):
+        """Transfer one file, resuming a partial upload if there is one.
+
+        Parameters
+        ----------
+        local_file: str
+            The path of the file to transfer.
+        destination_path: str
+            The destination path on the remote server.
+        deleting_local_file: bool (default=False)
+            If True delete the local file after its transfer was verified.
+
+        Return
+        ------
+        file_log: dict
+            Keys local_file, destination_path, transferred_bytes, success and
+            error_message.
+        """
+        file_log = {"local_file": local_file, "destination_path": destination_path,
+                    "transferred_bytes": 0, "success": False, "error_message": None}
+        counter = 1
+        while self.max_n_attempts >= counter:
+            sftp_client = None
+            try:
+                sftp_client = self._acquire_session()
+                self._makedirs(sftp_client, os.path.dirname(destination_path))
+                transferred_bytes, local_hash = self._put_resuming(
+                    sftp_client, local_file, destination_path
+                )
+                file_log["transferred_bytes"] += transferred_bytes
+                self._verify(sftp_client, local_file, destination_path, local_hash)
+                file_log["success"] = True
+                file_log["error_message"] = None
+                self._release_session(sftp_client)
+                break
+            except Exception as error:
+                print(f"ATTEMPT NUMBER {counter}, error transferring {local_file}: {error}")
+                file_log["error_message"] = str(error)
+                # A broken session is discarded instead of going back to the pool
+                if sftp_client is not None:
+                    self._discard_session(sftp_client)
+                sleep(counter)
+            counter += 1
+
+        if file_log["success"] and deleting_local_file:
+            print(f"Deleting local file {local_file}!")
+            os.remove(local_file)
+        return file_log
+
+    def close(self):
+        """Close all SFTP sessions."""
+        while not self.sessions.empty():
+            self.sessions.get_nowait()
+        for sftp_client in self.opened_sessions:
+            self._close_session(sftp_client)
+        self.opened_sessions = list()
+
+    @staticmethod
+    def _makedirs(sftp_client, remote_folder):
+        """Create the remote folder and its parents, like os.makedirs(exist_ok=True)."""
+        missing_folders = list()
+        while remote_folder not in ("", "/"):
+            try:
+                sftp_client.stat(remote_folder)
+                break
+            except IOError:
+                missing_folders.append(remote_folder)
+                remote_folder = os.path.dirname(remote_folder)
+        for folder in reversed(missing_folders):
+            try:
+                sftp_client.mkdir(folder)
+            except IOError:
+                # Another session created it in the meantime
+                sftp_client.stat(folder)
+
+    def _put_resuming(self, sftp_client, local_file, destination_path):
+        """Send the bytes of local_file that are not yet on the remote file.
+
+        Return
+        ------
+        transferred_bytes: int
+            Number of bytes sent in this call.
+        local_hash: str
+            sha256 of local_file, the bytes already on the remote file are read from
+            the local file and the other ones are hashed while they are sent.
+        """
+        local_size = os.path.getsize(local_file)
+        try:
+            offset = sftp_client.stat(destination_path).st_size
+        except IOError:
+            offset = 0
+
+        if offset > local_size:
+            # The remote file is not a prefix of the local one, start over
+            sftp_client.remove(destination_path)
+            offset = 0
+        sha256 = hashlib.sha256()
+        with open(local_file, "rb") as local:
+            while local.tell() < offset:
+                sha256.update(local.read(min(self.buffer_size, offset - local.tell())))
+        if offset == local_size:
+            return 0, sha256.hexdigest()
+
+        transferred_bytes = 0
+        mode = "ab" if offset > 0 else "wb"
+        with open(local_file, "rb") as local, sftp_client.open(destination_path, mode) as remote:
+            if hasattr(remote, "set_pipelined"):
+                remote.set_pipelined(True)
+            local.seek(offset)
+            while True:
+                block = local.read(self.buffer_size)
+                if not block:
+                    break
+                remote.write(block)
+                sha256.update(block)
+                transferred_bytes += len(block)
+        return transferred_bytes, sha256.hexdigest()
+
+    def _verify(self, sftp_client, local_file, destination_path, local_hash):
+        """Check that the remote file is equal to the local file.
+
+        Parameters
+        ----------
+        local_hash: str
+            sha256 of the local file, returned by _put_resuming.
+
+        Raises
+        ------
+            IOError: If the sizes or the checksums are different.
+        """
+        local_size = os.path.getsize(local_file)
+        remote_size = sftp_client.stat(destination_path).st_size
+        if local_size != remote_size:
+            raise IOError(f"Size mismatch, local = {local_size}; remote = {remote_size}")
+
+        if self.verify_checksum:
+            remote_hash = self._get_remote_sha256(sftp_client, destination_path)
+            if local_hash != remote_hash:
+                # The remote file is corrupted, the next attempt must send it again
+                sftp_client.remove(destination_path)
+                raise IOError(f"Checksum mismatch for {destination_path}")
+
+    def _get_remote_sha256(self, sftp_client, destination_path):
+        """Compute the sha256 of the remote file on the server, or read it back if the
+        server can not run remote_sha256_command."""
+        transport = getattr(sftp_client, "transport", None)
+        if self.remote_sha256_command is not None and transport is not None:
+            try:
+                channel = transport.open_session()
+                try:
+                    channel.exec_command(f"{self.remote_sha256_command} "
+                                         f"{shlex.quote(destination_path)}")
+                    output = channel.makefile("rb").read().decode()
+                    exit_status = channel.recv_exit_status()
+                finally:
+                    channel.close()
+                if exit_status == 0 and len(output.split()) > 0:
+                    return output.split()[0]
+                print(f"{self.remote_sha256_command} failed with status {exit_status}, "
+                      f"{destination_path} is read back")
+            except Exception as error:
+                print(f"{self.remote_sha256_command} could not run, "
+                      f"{destination_path} is read back: {error}")
+        return self._sha256(sftp_client.open(destination_path, "rb"))
+
+    def _sha256(self, file):
+        """Compute the sha256 of an opened file and close it."""
+        sha256 = hashlib.sha256()
+        with file:
+            if hasattr(file, "prefetch"):
+                file.prefetch()
+            while True:
+                block = file.read(self.buffer_size)
+                if not block:
+                    break
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    def _acquire_session(self):
+        """Get an idle session, opening a new one if the pool is not full."""
+        while True:
+            with self.sessions_lock:
+                open_new_session = (self.sessions.empty()
+                                    and len(self.opened_sessions) < self.n_connections)
+                if open_new_session:
+                    # Reserve the slot before connecting so other threads do not exceed the pool
+                    self.opened_sessions.append(None)
+            if open_new_session:
+                break
+            try:
+                return self.sessions.get(timeout=1)
+            except Empty:
+                # A broken session may have been discarded, check again for a free slot
+                continue
+
+        try:
+            sftp_client = self.connect_function(self.host, self.port, self.user, self.password,
+                                                self.window_size, self.max_packet_size)
+        finally:
+            with self.sessions_lock:
+                self.opened_sessions.remove(None)
+        with self.sessions_lock:
+            self.opened_sessions.append(sftp_client)
+        return sftp_client
+
+    def _release_session(self, sftp_client):
+        self.sessions.put(sftp_client)
+
+    def _discard_session(self, sftp_client):
+        with self.sessions_lock:
+            if sftp_client in self.opened_sessions:
+                self.opened_sessions.remove(sftp_client)
+        self._close_session(sftp_client)
+
+    @staticmethod
+    def _close_session(sftp_client):
+        try:
+            sftp_client.close()
+            if getattr(sftp_client, "transport", None) is not None:
+                sftp_client.transport.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _paramiko_connect(host, port, user, password, window_size, max_packet_size):
+        """Open an authenticated paramiko SFTP session with tuned window sizes."""
+        transport = paramiko.Transport((host, port),
+                                       default_window_size=window_size,
+                                       default_max_packet_size=max_packet_size)
+        transport.connect(username=user, password=password)
+        sftp_client = paramiko.SFTPClient.from_transport(transport,
+                                                         window_size=window_size,
+                                                         max_packet_size=max_packet_size)
+        sftp_client.transport = transport
+        return sftp_client
+
+
+def structured_data_transfer(paths_to_transfer=None, deleting_local_file=True,
+                             n_connections=4, dataset_path=None):
     """Transfer structured data files to destination folder with optional deletion of local files.
 
     Parameters
@@ -75,6 +426,20 @@ def structured_data_transfer(paths_to_transfer=None, deleting_local_file=True):
         
     deleting_local_file: bool (default=True)
         Flag indicating whether to delete local files after transfer.
+        Files are only deleted after their transfer was verified.
+
+    n_connections: int (default=4)
+        Number of SFTP sessions used to transfer files at the same time.
+
+    dataset_path: str (default=None)
+        If not None and paths_to_transfer is None, the files of this partitioned
+        dataset (see structured_dataset.py) are also transferred, to the same
+        partition folders of the structured_dataset_destination folder.
+
+    Return
+    ------
+    transfer_log: list[dict]
+        The log of each file transfer, see SFTPTransferPool.transfer_all.
     """
     structured_data_origin = tools.get_relevant_path("structured_data")
     
@@ -82,6 +447,8 @@ def structured_data_transfer(paths_to_transfer=None, deleting_local_file=True):
         paths_to_transfer = glob(
             os.path.join(structured_data_origin , "*.parquet")
         )
+        if dataset_path is not None:
+            paths_to_transfer += list_dataset_files(dataset_path)
     elif isinstance(paths_to_transfer, str):
         paths_to_transfer = [paths_to_transfer]
     
@@ -89,19 +456,37 @@ def structured_data_transfer(paths_to_transfer=None, deleting_local_file=True):
 
     ip = get_public_ip()
     structured_data_destination = tools.get_relevant_path("structured_data_destination")
+    structured_dataset_destination = tools.get_relevant_path("structured_dataset_destination")
     structured_data_transfer_credentials = tools.get_structured_data_transfer_credentials()    
     destination_ip = structured_data_transfer_credentials.get("host", "")
 
+    transfer_log = list()
     if ip != destination_ip:
+        files_to_transfer = list()
         for local_file_path in paths_to_transfer:
             file_name = os.path.basename(local_file_path)
+            local_dataset_path = get_dataset_root(local_file_path)
+            if local_dataset_path is None:
+                destination_path = os.path.join(
+                    structured_data_destination, (f"ip={ip}_" + file_name)
+                )
+            else:
+                # "ip-" instead of "ip=", the readers of the dataset take "=" for a partition
+                partition_folder = os.path.relpath(os.path.dirname(local_file_path),
+                                                   local_dataset_path)
+                destination_path = os.path.join(
+                    structured_dataset_destination, partition_folder, f"ip-{ip}_" + file_name
+                )
+            files_to_transfer.append((local_file_path, destination_path))
+
+        print(f"Moving {len(files_to_transfer)} files...")
+        with SFTPTransferPool(**structured_data_transfer_credentials,
+                              n_connections=n_connections) as transfer_pool:
+            transfer_log = transfer_pool.transfer_all(files_to_transfer,
+                                                      deleting_local_file=deleting_local_file)
 
-            print(f"Moving the file {file_name}...")
-            destination_path = os.path.join(
-                structured_data_destination, (f"ip={ip}_" + file_name)
-            )
-            file_transfer(local_file=local_file_path,
-                          destination_path=destination_path,
-                          **structured_data_transfer_credentials,
-                          deleting_local_file=deleting_local_file)
-    return
\ No newline at end of file
+        for file_log in transfer_log:
+            if not file_log["success"]:
+                print(f"Error: {file_log['local_file']} was not transferred, "
+                      f"{file_log['error_message']}")
+    return transfer_log
@@ -1,28 +1,63 @@
 import json
+import re
+import socket
+import sys
+from datetime import datetime
+from glob import glob
+from os.path import abspath, dirname, isfile, join
 
 import pandas as pd
 from joblib import Parallel, delayed
 from map_collected_data import extract_info_from_path
+from structured_dataset import (list_compacted_batches, list_dataset_batches,
+                                write_structured_dataset)
+from structured_schema import apply_structured_schema, get_segment_columns
+from tqdm import tqdm
+
+sys.path.append("../utils")
+from arrow_handoff import read_arrow_files, write_arrow_partitions
+from metrics import StageMetrics
+
+sys.path.append(join(dirname(abspath(__file__)), "..", "scrape"))
+from circuit_breaker import RouteCircuitBreaker
+
+# Written in the hour folder when the hour was structured by structure_completed_hours
+EXTRACTED_MARKER = "_EXTRACTED"
+# Prefix of the error log messages of files that were structured, e.g. unmatched offers
+WARNING_PREFIX = "Warning: "
 
 
 class FlightExtractor():
     """Structure the data collected from flight_scrape.py."""
-    def __init__(self, json_paths):
+    def __init__(self, json_paths, typed_output=False):
         """
         Parameters
         ----------
         json_paths: list[str]
             List of json's path whose data should be structured.
+        typed_output: bool (default=False)
+            If True the segment columns are lists and the other columns are converted to
+            the typed schema of structured_schema.py (categorical, boolean, numeric
+            and timestamp). Otherwise every segment column is a "||" joined str.
         """
         self.json_paths = json_paths
+        self.typed_output = typed_output
         
-    def structure_all_jsons(self, n_jobs=-1):
+    def structure_all_jsons(self, n_jobs=-1, handoff="arrow", json_batch_size=100):
         """Structure all json's with parallel processing.
 
         Parameters
         ----------
         n_jobs: int (default=-1, all cores)
             Number of colors.
+        handoff: str (default="arrow")
+            How the results of the workers come back:
+                arrow: each worker writes its batch to an Arrow IPC file (in /dev/shm
+                    when it exists) that is memory mapped by this process, so the
+                    results are not pickled.
+                None: the results are pickled.
+        json_batch_size: int (default=100)
+            Number of json's structured by each task of the workers.
     
         Return
         ------
@@ -31,20 +66,67 @@ class FlightExtractor():
         error_log_df: pd.DataFrame
             The log of problems during data structuring.
         """
-        output_list = Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(
-            [delayed(self._structure_json)(json_path) for json_path in self.json_paths]
-        )
-        
-        structured_data_list = list()
-        error_log_list = list()
-        for structured_data, error_log_df in output_list:
-            structured_data_list.append(structured_data)
-            error_log_list.append(error_log_df)
-        structured_data = pd.concat(structured_data_list, ignore_index=True)
-        error_log_df = pd.concat(error_log_list, ignore_index=True)
+        assert handoff in ("arrow", None), "handoff must be 'arrow' or None"
+        json_batches = [self.json_paths[start:start + json_batch_size]
+                        for start in range(0, len(self.json_paths), json_batch_size)]
+        with StageMetrics("extract.structure_all_jsons", files=len(self.json_paths),
+                          handoff=handoff) as stage_metrics:
+            output_list = Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(
+                [delayed(self._structure_json_batch)(json_batch, handoff)
+                 for json_batch in json_batches]
+            )
+
+            structured_data_list = list()
+            error_log_list = list()
+            for structured_data, error_log_df in output_list:
+                structured_data_list.append(structured_data)
+                error_log_list.append(error_log_df)
+            structured_data = read_arrow_files(structured_data_list)
+            error_log_df = pd.concat(error_log_list, ignore_index=True)
+
+            if self.typed_output:
+                structured_data = apply_structured_schema(structured_data,
+                                                          self.get_segment_columns(structured_data))
+            stage_metrics.rows = len(structured_data)
+
+        return structured_data, error_log_df
+
+    def _structure_json_batch(self, json_paths, handoff="arrow"):
+        """Structure several json's in one worker.
+
+        Parameters
+        ----------
+        json_paths: list[str]
+            Json paths whose data should be structured.
+        handoff: str (default="arrow")
+            See structure_all_jsons.
 
+        Return
+        ------
+        structured_data: str or pd.DataFrame
+            Path of the Arrow IPC file with the structured data, or the structured
+            data if handoff is None or the data could not be converted to Arrow.
+        error_log_df: pd.DataFrame
+            The log of problems during data structuring.
+        """
+        with StageMetrics("extract.structure_json_batch", files=len(json_paths)) as stage_metrics:
+            output_list = [self._structure_json(json_path) for json_path in json_paths]
+            structured_data = pd.concat([output[0] for output in output_list], ignore_index=True)
+            error_log_df = pd.concat([output[1] for output in output_list], ignore_index=True)
+            stage_metrics.rows = len(structured_data)
+        if handoff == "arrow":
+            handoff_path, _ = write_arrow_partitions(structured_data, n_partitions=1,
+                                                     prefix="flight_extractor_")
+            if handoff_path is not None:
+                return handoff_path, error_log_df
         return structured_data, error_log_df
 
+    @staticmethod
+    def get_segment_columns(structured_data):
+        """Get the columns that hold one list of values per flight segment, see
+        structured_schema.get_segment_columns."""
+        return get_segment_columns(structured_data)
+
     def _structure_json(self, json_path):
         """Structure one json data.
         
@@ -60,33 +142,57 @@ class FlightExtractor():
         error_log_df: pd.DataFrame
             The log of problems during data structuring.
         """
-        data, error_log_df = self._read_json(json_path)
-        data, error_log_df = self._data_checks(data, json_path)
+        data, read_log_df = self._read_json(json_path)
+        data, checks_log_df = self._data_checks(data, json_path)
+        error_log_list = [read_log_df, checks_log_df]
         
         structured_data = pd.DataFrame()
         
         if data is not None:
+            # Offers are joined to their leg by legId, Expedia does not keep them in
+            # the same order and several offers can share one leg
+            legs_by_id = {flight_info.get('legId'): flight_info for flight_info in data['legs']}
+            structured_flights = dict()
             structured_data_list = list()
-            for flight_info, fare_info in zip(data['legs'], data['offers']):
-
-                is_the_same_flight = flight_info['legId'] == fare_info['legIds'][0]
-                if not is_the_same_flight:
+            n_unmatched_offers = 0
+            for fare_info in data['offers']:
+                leg_id = (fare_info.get('legIds') or [None])[0]
+                if leg_id not in legs_by_id:
+                    n_unmatched_offers += 1
                     continue
 
-                structured_flight_df = self._structure_flight_information(flight_info)
+                if leg_id not in structured_flights:
+                    structured_flights[leg_id] = self._structure_flight_information(
+                        legs_by_id[leg_id]
+                    )
                 structured_fare_df = self._structure_fare_information(fare_info)
                 structured_df = pd.concat(
-                    [structured_flight_df, structured_fare_df], axis="columns"
+                    [structured_flights[leg_id], structured_fare_df], axis="columns"
                 )
                 structured_data_list.append(structured_df)
-            structured_data = pd.concat(structured_data_list, ignore_index=True)
-            structured_collect_df = self._structure_collect_information(data, json_path)
-            structured_collect_df = (
-                structured_collect_df
-                .loc[structured_collect_df.index.repeat(len(structured_data))]
-                .reset_index(drop=True)
-            )
-            structured_data = pd.concat([structured_collect_df, structured_data], axis="columns")
+
+            n_unmatched_legs = len(legs_by_id) - len(structured_flights)
+            # The file is still structured, unless no offer has its leg
+            prefix = WARNING_PREFIX if len(structured_data_list) > 0 else ""
+            for n_unmatched, error_message in [
+                (n_unmatched_offers, f"{prefix}{n_unmatched_offers} offers without leg"),
+                (n_unmatched_legs, f"{prefix}{n_unmatched_legs} legs without offer"),
+            ]:
+                if n_unmatched > 0:
+                    error_log_list.append(pd.DataFrame({"json_path": [json_path],
+                                                        "error_message": [error_message]}))
+
+            if len(structured_data_list) > 0:
+                structured_data = pd.concat(structured_data_list, ignore_index=True)
+                structured_collect_df = self._structure_collect_information(data, json_path)
+                structured_collect_df = (
+                    structured_collect_df
+                    .loc[structured_collect_df.index.repeat(len(structured_data))]
+                    .reset_index(drop=True)
+                )
+                structured_data = pd.concat([structured_collect_df, structured_data],
+                                            axis="columns")
+        error_log_df = pd.concat(error_log_list, ignore_index=True)
         return structured_data, error_log_df
     
     def _read_json(self, json_path):
@@ -141,11 +247,7 @@ class FlightExtractor():
                 for key in necessary_keys:
                     assert key in data.keys(), error_message
                 
-                error_message = ("Legs and offers not same length, "
-                                 f"legs = {len(data['legs'])}; offers = {len(data['offers'])}")
-                assert len(data['legs']) == len(data['offers']), error_message
-                
-                
+                # Legs and offers can differ in length, _structure_json joins them by legId
                 error_message = ("Legs or offers with len 0. "
                                  f"legs = {len(data['legs'])}; offers = {len(data['offers'])}")
                 assert len(data['legs']) > 0 and len(data['offers']) > 0, error_message
@@ -186,6 +288,12 @@ class FlightExtractor():
             for key, value in segment.items():
                 if key in blocked_keys_segments:
                     continue
+                if self.typed_output:
+                    if index == 0:
+                        structured_data_dict[key] = [[value]]
+                    else:
+                        structured_data_dict.setdefault(key, [[]])[0].append(value)
+                    continue
                 value = str(value)
                 if index == 0:
                     structured_data_dict[key] = [value + separator]
@@ -247,6 +355,12 @@ class FlightExtractor():
                             else "||")
             for attributes in segment:
                 for key, value in attributes.items():
+                    if self.typed_output:
+                        if index == 0:
+                            structured_data_dict[key] = [[value]]
+                        else:
+                            structured_data_dict.setdefault(key, [[]])[0].append(value)
+                        continue
                     value = str(value)
                     if index == 0:
                         structured_data_dict[key] = [value + separator]
@@ -292,3 +406,235 @@ class FlightExtractor():
         }
         structured_data_df = pd.DataFrame(structured_data_dict)
         return structured_data_df
+
+
+def structure_days(days_path_list, path_to_save, start_date, end_date, overwrite_files=False,
+                   circuit_breaker_path=None, n_jobs=-1, ingestion_url=None, dataset_path=None):
+    """Structure the json's of each collection day into one parquet per day.
+
+    Parameters
+    ----------
+    days_path_list: list[str]
+        Folders "today_<date>" written by flight_scrape.py.
+    path_to_save: str
+        Folder of the "<date>_structured_data.parquet" files, the error logs are
+        saved in its logs folder.
+    start_date: datetime.date
+        First day to structure.
+    end_date: datetime.date
+        Last day to structure.
+    overwrite_files: bool (default=False)
+        If False the days that already have a parquet are skipped.
+    circuit_breaker_path: str (default=None)
+        If not None the extraction results feed the scraper circuit breaker.
+    n_jobs: int (default=-1, all cores)
+        Number of cores.
+    ingestion_url: str (default=None)
+        If not None the data is sent to the ArrowIngestionServer of this url
+        instead of being written to a parquet, see save_structured_data.
+    dataset_path: str (default=None)
+        If not None the data is written to this partitioned dataset instead of
+        one parquet per day, see save_structured_data.
+
+    Return
+    ------
+    structured_data_paths: list[str]
+        Parquet files written, or batches sent.
+    """
+    computed_days = []
+    if not overwrite_files:
+        structured_data_list = glob(join(path_to_save, "*.parquet"))
+        # Hourly parquets (see structure_hour) do not count as computed days
+        computed_days = [
+            re.findall(r"(\d{4}-\d{2}-\d{2})_structured_data", path)
+            for path in structured_data_list
+        ]
+        computed_days = [day[0] for day in computed_days if len(day) > 0]
+        if dataset_path is not None:
+            # The files of the compacted days are removed, their names are kept apart
+            dataset_batches = (set(list_dataset_batches(dataset_path))
+                               | list_compacted_batches(dataset_path))
+            computed_days += [batch_name for batch_name in dataset_batches
+                              if re.fullmatch(r"\d{4}-\d{2}-\d{2}", batch_name)]
+
+    structured_data_paths = list()
+    for day_path in tqdm(days_path_list):
+        day_str = re.findall(r"today_(\d{4}-\d{2}-\d{2})", day_path)[0]
+        day = datetime.strptime(day_str, "%Y-%m-%d").date()
+        if ((day < start_date or end_date < day) or
+            (not overwrite_files and day_str in computed_days)):
+            continue
+        filenames_all = glob(join(day_path, "*/*/*.json"), recursive = True)
+        if len(filenames_all) > 0:
+            print(f"Structure data of the day {day_str}")
+
+            extractor = FlightExtractor(filenames_all, typed_output=True)
+            structured_data, error_log_df = extractor.structure_all_jsons(n_jobs=n_jobs)
+            if circuit_breaker_path is not None:
+                RouteCircuitBreaker(circuit_breaker_path).update_from_extraction(filenames_all,
+                                                                                error_log_df)
+
+            structured_data_path = save_structured_data(structured_data, path_to_save,
+                                                        day_str, ingestion_url=ingestion_url,
+                                                        dataset_path=dataset_path, day=day_str)
+            if not error_log_df.empty:
+                error_log_path = join(path_to_save, "logs", day_str + "_error_log.csv")
+                error_log_df.to_csv(error_log_path, index=False)
+            structured_data_paths.append(structured_data_path)
+            del structured_data
+            del error_log_df
+    return structured_data_paths
+
+
+def structure_hour(hour_path, path_to_save, circuit_breaker_path=None, n_jobs=-1,
+                   ingestion_url=None, dataset_path=None):
+    """Structure the json's of one collection hour into one parquet.
+
+    Parameters
+    ----------
+    hour_path: str
+        Folder "today_<date>/hour_<hour>_minute_<minute>" written by flight_scrape.py.
+    path_to_save: str
+        Folder of the "<date>_hour_<hour>_minute_<minute>_structured_data.parquet"
+        file, the error log is saved in its logs folder.
+    circuit_breaker_path: str (default=None)
+        If not None the extraction results feed the scraper circuit breaker.
+    n_jobs: int (default=-1, all cores)
+        Number of cores. The hour has few json's, a small value avoids the cost
+        of starting many workers.
+    ingestion_url: str (default=None)
+        If not None the data is sent to the ArrowIngestionServer of this url
+        instead of being written to a parquet, see save_structured_data.
+    dataset_path: str (default=None)
+        If not None the data is written to this partitioned dataset, see
+        save_structured_data.
+
+    Return
+    ------
+    structured_data_path: str
+        Parquet file written, or batch sent. None if the hour has no json.
+    """
+    day_str = re.findall(r"today_(\d{4}-\d{2}-\d{2})", hour_path)[0]
+    hour, minute = re.findall(r"hour_(\d+)_minute_(\d+)", hour_path)[0]
+    batch_name = f"{day_str}_hour_{hour}_minute_{minute}"
+
+    filenames_all = glob(join(hour_path, "*/*.json"))
+    if len(filenames_all) == 0:
+        return None
+
+    extractor = FlightExtractor(filenames_all, typed_output=True)
+    structured_data, error_log_df = extractor.structure_all_jsons(n_jobs=n_jobs)
+    if circuit_breaker_path is not None:
+        RouteCircuitBreaker(circuit_breaker_path).update_from_extraction(filenames_all,
+                                                                        error_log_df)
+
+    structured_data_path = save_structured_data(structured_data, path_to_save, batch_name,
+                                                ingestion_url=ingestion_url,
+                                                dataset_path=dataset_path, day=day_str,
+                                                hour=int(hour))
+    if not error_log_df.empty:
+        error_log_path = join(path_to_save, "logs", batch_name + "_error_log.csv")
+        error_log_df.to_csv(error_log_path, index=False)
+    return structured_data_path
+
+
+def structure_completed_hours(days_path, path_to_save, circuit_breaker_path=None,
+                              n_jobs=-1, ingestion_url=None, dataset_path=None):
+    """Structure every completed collection hour that has no parquet yet.
+
+    An hour is completed when the scraper wrote its COMPLETED_MARKER file, so
+    an hour still being collected is never extracted.
+
+    Parameters
+    ----------
+    days_path: str
+        Folder with the "today_<date>" folders written by flight_scrape.py.
+    path_to_save: str
+        Folder of the hourly parquets, see structure_hour.
+    circuit_breaker_path: str (default=None)
+        If not None the extraction results feed the scraper circuit breaker.
+    n_jobs: int (default=-1, all cores)
+        Number of cores.
+    ingestion_url: str (default=None)
+        If not None the data is sent to the ArrowIngestionServer of this url
+        instead of being written to a parquet, see save_structured_data.
+    dataset_path: str (default=None)
+        If not None the hours are written to this partitioned dataset, see
+        save_structured_data.
+
+    Return
+    ------
+    structured_data_paths: list[str]
+        Parquet files written, or batches sent.
+    """
+    from flight_scrape import COMPLETED_MARKER
+
+    structured_data_paths = list()
+    for marker_path in sorted(glob(join(days_path, "today_*", "hour_*_minute_*",
+                                        COMPLETED_MARKER))):
+        hour_path = dirname(marker_path)
+        day_str = re.findall(r"today_(\d{4}-\d{2}-\d{2})", hour_path)[0]
+        hour, minute = re.findall(r"hour_(\d+)_minute_(\d+)", hour_path)[0]
+        batch_name = f"{day_str}_hour_{hour}_minute_{minute}"
+        # The parquet may have been transferred and deleted, the marker of the
+        # extraction is kept in the hour folder
+        if isfile(join(hour_path, EXTRACTED_MARKER)):
+            continue
+
+        print(f"Structure data of {batch_name}")
+        structured_data_path = structure_hour(hour_path, path_to_save,
+                                              circuit_breaker_path=circuit_breaker_path,
+                                              n_jobs=n_jobs, ingestion_url=ingestion_url,
+                                              dataset_path=dataset_path)
+        if structured_data_path is not None:
+            structured_data_paths.append(structured_data_path)
+        with open(join(hour_path, EXTRACTED_MARKER), "w") as file:
+            file.write(str(structured_data_path))
+    return structured_data_paths
+
+
+def save_structured_data(structured_data, path_to_save, batch_name, ingestion_url=None,
+                         dataset_path=None, **labels):
+    """Write the structured data of a batch to a parquet or send it to the database.
+
+    Parameters
+    ----------
+    structured_data: pd.DataFrame
+        Output of FlightExtractor.structure_all_jsons.
+    path_to_save: str
+        Folder of the "<batch_name>_structured_data.parquet" file.
+    batch_name: str
+        Name of the batch, e.g. "2023-05-05" or "2023-05-05_hour_10_minute_0".
+    ingestion_url: str (default=None)
+        If not None the data is sent as an Arrow stream to the ArrowIngestionServer
+        of this url, named "<host name>_<batch_name>", and no file is written.
+    dataset_path: str (default=None)
+        If not None the data is written to this partitioned dataset, one file per
+        search date and route, instead of the parquet in path_to_save. See
+        structured_dataset.write_structured_dataset.
+    labels:
+        Information saved with the metrics, e.g. day="2023-05-05".
+
+    Return
+    ------
+    structured_data_path: str
+        Parquet file written, glob pattern of the files written to the dataset, or
+        batch sent.
+    """
+    if ingestion_url is not None:
+        from arrow_ingestion import send_arrow_stream
+
+        ack = send_arrow_stream(structured_data, ingestion_url,
+                                f"{socket.gethostname()}_{batch_name}")
+        print(f"Batch {ack['batch_name']} {ack['status']}")
+        return ack["batch_name"]
+
+    if dataset_path is not None:
+        with StageMetrics("extract.write_dataset", rows=len(structured_data), **labels):
+            write_structured_dataset(structured_data, dataset_path, batch_name)
+        return join(dataset_path, "*", "*", "*", f"{batch_name}-*.parquet")
+
+    structured_data_path = join(path_to_save, batch_name + "_structured_data.parquet")
+    with StageMetrics("extract.write_parquet", rows=len(structured_data), **labels):
+        structured_data.to_parquet(structured_data_path)
+    return structured_data_path
@@ -0,0 +1,261 @@
+import os
+import sys
+from os.path import isfile, join
+from time import perf_counter
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from joblib import Parallel, delayed
+
+sys.path.append("../odbc")
+from connection import load_conn
+
+sys.path.append("../utils")
+from metrics import StageMetrics
+
+# Columns of the public itineraries dataset (see README) that the database stores,
+# with their SQL expression. S is flight.search, F is flight.fare and L is
+# flight.flight, or flight.leg with deduplicate_legs. The segment columns are
+# stored joined by "||" like in the dataset.
+ITINERARIES_COLUMNS = {
+    "legId": 'F."legId"',
+    "searchDate": 'CAST(S."searchTime" AS DATE)',
+    "flightDate": 'S."flightDay"',
+    "startingAirport": 'S."originCode"',
+    "destinationAirport": 'S."destinationCode"',
+    "fareBasisCode": 'F."fareBasisCode"',
+    "travelDuration": 'L."travelDuration"',
+    "elapsedDays": 'L."elapsedDays"',
+    "isBasicEconomy": 'F."isBasicEconomy"',
+    "isRefundable": 'F."isRefundable"',
+    "isNonStop": 'L."isNonStop"',
+    "baseFare": 'CAST(F."baseFare" AS DOUBLE PRECISION)',
+    "totalFare": 'CAST(F."totalFare" AS DOUBLE PRECISION)',
+    "seatsRemaining": 'F."seatsRemaining"',
+    "segmentsDepartureTimeRaw": 'L."departureTimeRaw"',
+    "segmentsArrivalTimeRaw": 'L."arrivalTimeRaw"',
+    "segmentsArrivalAirportCode": 'L."arrivalAirportCode"',
+    "segmentsDepartureAirportCode": 'L."departureAirportCode"',
+    "segmentsAirlineCode": 'L."airlineCode"',
+    "segmentsEquipmentCode": 'L."equipmentCode"',
+    "segmentsDurationInSeconds": 'L."durationInSeconds"',
+}
+ITINERARIES_SCHEMA = pa.schema([
+    ("legId", pa.string()),
+    ("searchDate", pa.date32()),
+    ("flightDate", pa.date32()),
+    ("startingAirport", pa.string()),
+    ("destinationAirport", pa.string()),
+    ("fareBasisCode", pa.string()),
+    ("travelDuration", pa.string()),
+    ("elapsedDays", pa.string()),
+    ("isBasicEconomy", pa.bool_()),
+    ("isRefundable", pa.bool_()),
+    ("isNonStop", pa.bool_()),
+    ("baseFare", pa.float64()),
+    ("totalFare", pa.float64()),
+    ("seatsRemaining", pa.int32()),
+    ("segmentsDepartureTimeRaw", pa.string()),
+    ("segmentsArrivalTimeRaw", pa.string()),
+    ("segmentsArrivalAirportCode", pa.string()),
+    ("segmentsDepartureAirportCode", pa.string()),
+    ("segmentsAirlineCode", pa.string()),
+    ("segmentsEquipmentCode", pa.string()),
+    ("segmentsDurationInSeconds", pa.string()),
+])
+# Output formats: a Parquet compression codec or "csv", and the file extension
+EXPORT_FORMATS = {
+    "snappy": ".snappy.parquet",
+    "gzip": ".gzip.parquet",
+    "zstd": ".zstd.parquet",
+    "brotli": ".brotli.parquet",
+    "csv": ".csv",
+}
+
+
+def export_itineraries(output_folder, formats=("snappy", "gzip"), partition_size=5_000_000,
+                       batch_rows=100_000, deduplicate_legs=False, n_jobs=4):
+    """Export the itineraries dataset (see README) from the database.
+
+    The searchId range is split in partitions of partition_size searchIds, aligned to
+    multiples of partition_size. Each partition is exported by one worker: the join
+    of search, fare and flight (or leg) is read through a server-side cursor,
+    batch_rows rows at a time, and every batch is written as row groups to the files
+    of all formats at once. So the memory of each worker is bounded by batch_rows,
+    whatever the size of the history, and the database is read once per partition.
+
+    The files of a partition are written with temporary names and renamed when the
+    partition is complete. An interrupted export is resumed by running it again: the
+    partitions whose files exist are skipped. The partitions are aligned, so a new run
+    after more inserts only exports the new partitions and the last one, which can
+    have received searchIds since it was exported.
+
+    Parameters
+    ----------
+    output_folder: str
+        Folder of the export, each format has its subfolder with one file per
+        partition, e.g. "<output_folder>/snappy/itineraries_000000000000.snappy.parquet".
+        Each subfolder can be read as one dataset, e.g. pq.read_table(folder).
+    formats: list[str] (default=("snappy", "gzip"))
+        Formats written, keys of EXPORT_FORMATS.
+    partition_size: int (default=5_000_000)
+        Number of searchIds of each partition.
+    batch_rows: int (default=100_000)
+        Rows fetched from the cursor at a time, it is also the row group size.
+    deduplicate_legs: bool (default=False)
+        If True the leg data comes from the leg table, see DatabaseFormat.
+    n_jobs: int (default=4)
+        Number of partitions exported at the same time, each one uses a connection.
+
+    Return
+    ------
+    export_log: list[dict]
+        For each partition, its searchId range, the number of rows, the seconds it took
+        and whether it was skipped because it was already exported.
+    """
+    formats = list(formats)
+    unknown_formats = [file_format for file_format in formats if file_format not in EXPORT_FORMATS]
+    assert len(unknown_formats) == 0, f"formats {unknown_formats} are not in {list(EXPORT_FORMATS)}"
+    assert partition_size > 0, "partition_size must be positive"
+
+    min_search_id, max_search_id = get_search_id_range()
+    if min_search_id is None:
+        print("There is no search to export")
+        return []
+    first_start = (min_search_id // partition_size) * partition_size
+    partitions = [(start, start + partition_size)
+                  for start in range(first_start, max_search_id + 1, partition_size)]
+    for file_format in formats:
+        os.makedirs(join(output_folder, file_format), exist_ok=True)
+
+    print(f"Exporting {len(partitions)} partitions of searchId {min_search_id} to {max_search_id}")
+    with StageMetrics("export.itineraries", partitions=len(partitions),
+                      verbose=True) as stage_metrics:
+        export_log = Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(
+            delayed(export_partition)(output_folder, start, end, formats,
+                                      batch_rows=batch_rows, deduplicate_legs=deduplicate_legs,
+                                      overwrite=end > max_search_id + 1)
+            for start, end in partitions
+        )
+        stage_metrics.rows = sum(partition_log["rows"] for partition_log in export_log)
+        stage_metrics.labels["partitions_skipped"] = sum(partition_log["skipped"]
+                                                         for partition_log in export_log)
+    return export_log
+
+
+def export_partition(output_folder, start, end, formats, batch_rows=100_000,
+                     deduplicate_legs=False, overwrite=False):
+    """Export the itineraries of the searchIds in [start, end), see export_itineraries.
+
+    If overwrite is False and the files of the partition exist, it is skipped.
+
+    Return
+    ------
+    partition_log: dict
+        Keys start, end, rows, seconds and skipped.
+    """
+    file_paths = {file_format: get_partition_path(output_folder, file_format, start)
+                  for file_format in formats}
+    partition_log = {"start": start, "end": end, "rows": 0, "seconds": 0.0, "skipped": False}
+    if not overwrite and all(isfile(file_path) for file_path in file_paths.values()):
+        partition_log["skipped"] = True
+        return partition_log
+
+    start_time = perf_counter()
+    temporary_paths = {file_format: file_path + ".tmp"
+                       for file_format, file_path in file_paths.items()}
+    writers = dict()
+    conn = load_conn()
+    try:
+        for file_format, temporary_path in temporary_paths.items():
+            if file_format == "csv":
+                writers[file_format] = pa_csv.CSVWriter(temporary_path, ITINERARIES_SCHEMA)
+            else:
+                writers[file_format] = pq.ParquetWriter(temporary_path, ITINERARIES_SCHEMA,
+                                                        compression=file_format)
+
+        # A named cursor keeps the result on the server, it is fetched in batches
+        with conn.cursor(name=f"itineraries_export_{start}") as cursor:
+            cursor.itersize = batch_rows
+            cursor.execute(get_itineraries_query(deduplicate_legs),
+                           {"start": start, "end": end})
+            while True:
+                rows = cursor.fetchmany(batch_rows)
+                if len(rows) == 0:
+                    break
+                table = _rows_to_table(rows)
+                for file_format, writer in writers.items():
+                    if file_format == "csv":
+                        writer.write_table(table)
+                    else:
+                        writer.write_table(table, row_group_size=batch_rows)
+                partition_log["rows"] += len(rows)
+
+        for writer in writers.values():
+            writer.close()
+        writers = dict()
+        for file_format, temporary_path in temporary_paths.items():
+            os.replace(temporary_path, file_paths[file_format])
+    finally:
+        conn.close()
+        for writer in writers.values():
+            writer.close()
+        for temporary_path in temporary_paths.values():
+            if isfile(temporary_path):
+                os.remove(temporary_path)
+
+    partition_log["seconds"] = perf_counter() - start_time
+    print(f"Partition {start} to {end}: {partition_log['rows']} rows in "
+          f"{partition_log['seconds']:.1f} s")
+    return partition_log
+
+
+def get_itineraries_query(deduplicate_legs=False):
+    """Get the query of the itineraries of a searchId range, with the parameters start and end.
+
+    The range condition is repeated on every table joined by searchId, so each one
+    is read by a range scan of its primary key.
+    """
+    select_list = ",\n            ".join(f'{expression} AS "{column}"'
+                                         for column, expression in ITINERARIES_COLUMNS.items())
+    if deduplicate_legs:
+        leg_join = 'JOIN flight.leg L ON L."legHash" = F."legHash"'
+        leg_condition = ""
+    else:
+        leg_join = 'JOIN flight.flight L ON L."searchId" = F."searchId"'
+        leg_condition = 'AND L."searchId" >= %(start)s AND L."searchId" < %(end)s'
+    return f"""
+        SELECT {select_list}
+        FROM flight.search S
+            JOIN flight.fare F ON F."searchId" = S."searchId"
+            {leg_join}
+        WHERE S."searchId" >= %(start)s AND S."searchId" < %(end)s
+            AND F."searchId" >= %(start)s AND F."searchId" < %(end)s
+            {leg_condition}
+        ORDER BY S."searchId"
+    """
+
+
+def get_search_id_range():
+    """Get the minimum and maximum searchId of the search table, None if it is empty."""
+    with load_conn() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT min("searchId"), max("searchId") FROM flight.search')
+            min_search_id, max_search_id = cursor.fetchone()
+    conn.close()
+    return min_search_id, max_search_id
+
+
+def get_partition_path(output_folder, file_format, start):
+    """Path of the file of the partition that starts at the searchId start."""
+    return join(output_folder, file_format, f"itineraries_{start:012d}{EXPORT_FORMATS[file_format]}")
+
+
+def _rows_to_table(rows):
+    """Convert the rows fetched from the cursor to an Arrow table of ITINERARIES_SCHEMA."""
+    columns = list(zip(*rows))
+    return pa.Table.from_arrays(
+        [pa.array(values, type=field.type) for values, field in zip(columns, ITINERARIES_SCHEMA)],
+        schema=ITINERARIES_SCHEMA,
+    )
@@ -0,0 +1,419 @@
+import json
+import os
+import signal
+import sys
+import threading
+import traceback
+from collections import deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import cpu_count
+from os.path import abspath, dirname, join
+from queue import Empty, Queue
+from time import perf_counter
+
+from joblib import Parallel, delayed
+from joblib.externals.loky.process_executor import BrokenProcessPool
+
+sys.path.append(join(dirname(abspath(__file__)), "..", "utils"))
+from metrics import StageMetrics
+
+
+class ScheduledStage():
+    """One stage of the pipeline run by PipelineDaemon."""
+    def __init__(self, name, function, minute=0, hour=None, after=None, kwargs=None,
+                 pass_scheduled_time=False):
+        """
+        Parameters
+        ----------
+        name: str
+            Stage name, e.g. "scrape".
+        function: callable
+            Function that runs the stage, it is called with kwargs.
+        minute: int or list[int] (default=0)
+            Minute of the hour when the stage runs, or minutes for several runs per
+            hour. If it is None, the stage only runs after another stage or when it
+            is requested by the status endpoint.
+        hour: int (default=None)
+            Hour of the day when the stage runs. If it is None, the stage runs
+            every hour.
+        after: str (default=None)
+            Name of a stage, this stage runs every time that stage succeeds.
+        kwargs: dict (default=None)
+            Keyword arguments of function.
+        pass_scheduled_time: bool (default=False)
+            If True function also receives scheduled_time, the time the run was
+            scheduled for (datetime), so a run that starts late keeps its label. The
+            stages run by after receive the scheduled_time of the stage that triggered
+            them, the runs requested by the status endpoint the time of the request.
+        """
+        if minute is None:
+            minutes = []
+        else:
+            minutes = sorted(minute if isinstance(minute, list) else [minute])
+        assert all(0 <= minute < 60 for minute in minutes), "minute must be between 0 and 59"
+        assert hour is None or 0 <= hour < 24, "hour must be None or between 0 and 23"
+        self.name = name
+        self.function = function
+        self.minutes = minutes
+        self.hour = hour
+        self.after = after
+        self.kwargs = {} if kwargs is None else kwargs
+        self.pass_scheduled_time = pass_scheduled_time
+
+    def get_next_run(self, now):
+        """Get the first time after now when the stage runs, None if it is not scheduled."""
+        if len(self.minutes) == 0:
+            return None
+        start = now.replace(second=0, microsecond=0)
+        if self.hour is not None:
+            start = start.replace(hour=self.hour)
+        period = timedelta(hours=1) if self.hour is None else timedelta(days=1)
+        for offset in (start - period, start, start + period):
+            for minute in self.minutes:
+                next_run = offset.replace(minute=minute)
+                if next_run > now:
+                    return next_run
+
+
+class PipelineDaemon():
+    """Long running process that schedules the stages of the pipeline.
+
+    The cron jobs start a new interpreter for every run, import pandas and joblib
+    again and spawn a new pool of workers. The daemon keeps all of it warm:
+    - The joblib workers are started once and kept alive between stages, the
+      Parallel calls of the stages reuse them. Use the same n_jobs in the stages,
+      the chains that run at the same time share the workers.
+    - The database configuration and relevant_paths.json are read once per
+      process (see connection.read_config and tools.read_json_cached) and the
+      inserts reuse the engine of each worker (see connection.get_engine).
+
+    Each chain of stages, a stage and the stages that run after it, has its own runner
+    thread, so the chains run at the same time like the cron jobs did, e.g. the hourly
+    scrape is not delayed by the daily extract and transfer. The stages of a chain
+    run one at a time, in the order they are due. A stage that is already waiting or
+    running is not queued again.
+
+    The chains share the joblib workers of the process (loky keeps one executor per
+    process), so a worker that crashes in one chain, e.g. killed by the OOM killer,
+    breaks the executor and the Parallel calls that other chains are running at that
+    time. A stage that fails that way is run again once. Do not run stages whose
+    workers can crash at the same time as stages that can not be repeated, put
+    them in the same chain with after.
+
+    The status endpoint answers:
+    - GET /status: queue depth, state and timings of every stage, and the result
+      of status_function.
+    - GET /health: "ok".
+    - POST /stages/<name>/run: queue the stage now.
+
+    Example
+    -------
+    daemon = PipelineDaemon([ScheduledStage("scrape", run_scrape_hour, minute=0)])
+    daemon.serve_forever()
+    """
+    def __init__(self, stages, n_jobs=-1, status_host="localhost", status_port=8765,
+                 keep_warm_seconds=240, history_size=50, status_function=None):
+        """
+        Parameters
+        ----------
+        stages: list[ScheduledStage]
+            Stages of the pipeline.
+        n_jobs: int (default=-1, all cores)
+            Number of joblib workers kept warm.
+        status_host: str (default="localhost")
+            Host of the status endpoint.
+        status_port: int (default=8765)
+            Port of the status endpoint, 0 chooses a free port.
+        keep_warm_seconds: float (default=240)
+            When no stage runs for this time the workers receive a small job, so
+            they are not stopped by the idle timeout of joblib (300 s).
+        history_size: int (default=50)
+            Number of wall times kept for each stage.
+        status_function: callable (default=None)
+            Function without parameters that returns a dict added to the status,
+            e.g. the status counts of the ScrapeTaskQueue.
+        """
+        stage_names = [stage.name for stage in stages]
+        assert len(stage_names) == len(set(stage_names)), "stage names must be unique"
+        for stage in stages:
+            assert stage.after is None or stage.after in stage_names, (
+                f"stage {stage.name} runs after {stage.after}, which is not a stage"
+            )
+        self.stages = {stage.name: stage for stage in stages}
+        self.n_jobs = n_jobs
+        self.keep_warm_seconds = keep_warm_seconds
+        self.status_function = status_function
+
+        self.started_at = datetime.now()
+        # Each stage runs in the runner of the first stage of its chain
+        self.chain_roots = {name: self._get_chain_root(name) for name in self.stages}
+        self.job_queues = {root: Queue() for root in set(self.chain_roots.values())}
+        self.last_activity = perf_counter()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.stage_status = {
+            name: {"state": "idle", "runs": 0, "failures": 0, "last_start": None,
+                   "last_end": None, "last_wall_time_s": None, "last_result": None,
+                   "last_error": None, "next_run": stage.get_next_run(self.started_at),
+                   "wall_times_s": deque(maxlen=history_size)}
+            for name, stage in self.stages.items()
+        }
+        self.worker_pool_status = {"workers": 0, "last_warm": None}
+
+        self.server = ThreadingHTTPServer((status_host, status_port), self._get_handler())
+        self.server.daemon_threads = True
+        self.threads = list()
+
+    @property
+    def status_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/status"
+
+    def start(self):
+        """Warm the workers and start the scheduler, the stage runners and the endpoint."""
+        self.warm_worker_pool()
+        self.threads = [
+            threading.Thread(target=self._scheduler_loop, daemon=True),
+            threading.Thread(target=self.server.serve_forever, daemon=True),
+        ] + [threading.Thread(target=self._runner_loop, args=(root,), daemon=True)
+             for root in sorted(self.job_queues)]
+        for thread in self.threads:
+            thread.start()
+        print(f"Pipeline daemon started, status on {self.status_url}")
+
+    def stop(self, timeout=None):
+        """Stop the daemon, the running stages are finished first.
+
+        Parameters
+        ----------
+        timeout: float (default=None)
+            Seconds to wait for each running stage, None waits until it ends.
+        """
+        self.stop_event.set()
+        self.server.shutdown()
+        self.server.server_close()
+        for thread in self.threads:
+            thread.join(timeout=timeout)
+        print("Pipeline daemon stopped")
+
+    def serve_forever(self):
+        """Run the daemon until SIGTERM or SIGINT."""
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signal_number, lambda signum, frame: self.stop_event.set())
+        self.start()
+        self.stop_event.wait()
+        self.stop()
+
+    def submit(self, name, scheduled_time=None):
+        """Queue a stage, it is skipped if the stage is already waiting or running.
+
+        Parameters
+        ----------
+        name: str
+            Stage name.
+        scheduled_time: datetime (default=None)
+            Time the run was scheduled for, see ScheduledStage pass_scheduled_time.
+            None for now.
+
+        Return
+        ------
+        submitted: bool
+            True if the stage was queued.
+        """
+        assert name in self.stages, f"name must be one of {list(self.stages)}"
+        with self.lock:
+            if self.stage_status[name]["state"] != "idle":
+                return False
+            self.stage_status[name]["state"] = "pending"
+        scheduled_time = datetime.now() if scheduled_time is None else scheduled_time
+        self.job_queues[self.chain_roots[name]].put((name, scheduled_time))
+        return True
+
+    def get_status(self):
+        """Get the state of the daemon, see the status endpoint."""
+        with self.lock:
+            stages = dict()
+            for name, stage_status in self.stage_status.items():
+                stage_status = dict(stage_status)
+                wall_times = list(stage_status.pop("wall_times_s"))
+                stage_status["mean_wall_time_s"] = (
+                    sum(wall_times) / len(wall_times) if len(wall_times) > 0 else None
+                )
+                stage_status["max_wall_time_s"] = max(wall_times, default=None)
+                stages[name] = stage_status
+            status = {
+                "started_at": self.started_at,
+                "uptime_s": (datetime.now() - self.started_at).total_seconds(),
+                "queue_depth": sum(job_queue.qsize() for job_queue in self.job_queues.values()),
+                "pending": [name for name, stage_status in stages.items()
+                            if stage_status["state"] == "pending"],
+                "running": [name for name, stage_status in stages.items()
+                            if stage_status["state"] == "running"],
+                "stages": stages,
+                "worker_pool": dict(self.worker_pool_status),
+            }
+        if self.status_function is not None:
+            try:
+                status.update(self.status_function())
+            except Exception as error:
+                status["status_function_error"] = str(error)
+        return status
+
+    def warm_worker_pool(self):
+        """Start the joblib workers, or reset their idle time, and import the modules."""
+        n_workers = cpu_count() if self.n_jobs == -1 else self.n_jobs
+        pids = Parallel(n_jobs=self.n_jobs, prefer="processes")(
+            delayed(_import_pipeline_modules)() for _ in range(n_workers)
+        )
+        with self.lock:
+            self.worker_pool_status = {"workers": len(set(pids)), "last_warm": datetime.now()}
+
+    def run_stage(self, name, scheduled_time=None):
+        """Run one stage now, in the current thread, and record its status.
+
+        Parameters
+        ----------
+        name: str
+            Stage name.
+        scheduled_time: datetime (default=None)
+            Time the run was scheduled for, None for now.
+        """
+        stage = self.stages[name]
+        scheduled_time = datetime.now() if scheduled_time is None else scheduled_time
+        kwargs = dict(stage.kwargs)
+        if stage.pass_scheduled_time:
+            kwargs["scheduled_time"] = scheduled_time
+        with self.lock:
+            self.stage_status[name]["state"] = "running"
+            self.stage_status[name]["last_start"] = datetime.now()
+        print(f"Running stage {name}...")
+
+        start_time = perf_counter()
+        result, error = None, None
+        for attempt in (1, 2):
+            try:
+                with StageMetrics(f"daemon.{name}", verbose=True, attempt=attempt):
+                    result = stage.function(**kwargs)
+                error = None
+                break
+            except BrokenProcessPool:
+                # The shared workers were broken, maybe by a crash in another chain
+                error = traceback.format_exc()
+                print(f"Stage {name} failed, its workers were terminated:\n{error}")
+            except Exception:
+                error = traceback.format_exc()
+                print(f"Stage {name} failed:\n{error}")
+                break
+        wall_time = perf_counter() - start_time
+
+        with self.lock:
+            self.last_activity = perf_counter()
+            stage_status = self.stage_status[name]
+            stage_status["state"] = "idle"
+            stage_status["runs"] += 1
+            stage_status["failures"] += error is not None
+            stage_status["last_end"] = datetime.now()
+            stage_status["last_wall_time_s"] = wall_time
+            stage_status["wall_times_s"].append(wall_time)
+            stage_status["last_result"] = _summarize_result(result)
+            stage_status["last_error"] = error
+
+        if error is None:
+            for next_stage in self.stages.values():
+                if next_stage.after == name:
+                    self.submit(next_stage.name, scheduled_time=scheduled_time)
+        return error is None
+
+    def _get_chain_root(self, name):
+        """Get the first stage of the chain of after of a stage."""
+        visited = [name]
+        while self.stages[name].after is not None:
+            name = self.stages[name].after
+            assert name not in visited, f"the stages {visited} run after each other in a cycle"
+            visited.append(name)
+        return name
+
+    def _scheduler_loop(self):
+        while not self.stop_event.is_set():
+            now = datetime.now()
+            for name, stage in self.stages.items():
+                next_run = self.stage_status[name]["next_run"]
+                if next_run is not None and next_run <= now:
+                    with self.lock:
+                        self.stage_status[name]["next_run"] = stage.get_next_run(now)
+                    if not self.submit(name, scheduled_time=next_run):
+                        print(f"Stage {name} skipped, the previous run has not finished")
+
+            with self.lock:
+                is_idle = all(stage_status["state"] == "idle"
+                              for stage_status in self.stage_status.values())
+                is_cold = perf_counter() - self.last_activity > self.keep_warm_seconds
+            if is_idle and is_cold:
+                self.warm_worker_pool()
+                with self.lock:
+                    self.last_activity = perf_counter()
+            self.stop_event.wait(1)
+
+    def _runner_loop(self, root):
+        job_queue = self.job_queues[root]
+        while not self.stop_event.is_set():
+            try:
+                name, scheduled_time = job_queue.get(timeout=1)
+            except Empty:
+                continue
+            self.run_stage(name, scheduled_time=scheduled_time)
+
+    def _get_handler(self):
+        daemon = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/status":
+                    body = json.dumps(daemon.get_status(), default=str, indent=4).encode()
+                    return self._send(200, body, "application/json")
+                if self.path == "/health":
+                    return self._send(200, b"ok", "text/plain")
+                return self._send(404, b"Not found", "text/plain")
+
+            def do_POST(self):
+                parts = self.path.strip("/").split("/")
+                if len(parts) == 3 and parts[0] == "stages" and parts[2] == "run":
+                    if parts[1] not in daemon.stages:
+                        return self._send(404, b"Unknown stage", "text/plain")
+                    submitted = daemon.submit(parts[1])
+                    body = json.dumps({"stage": parts[1], "submitted": submitted}).encode()
+                    return self._send(202 if submitted else 409, body, "application/json")
+                return self._send(404, b"Not found", "text/plain")
+
+            def _send(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                return
+
+        return StatusHandler
+
+
+def _import_pipeline_modules():
+    """Import the heavy modules in a joblib worker and return its pid."""
+    import pandas
+    import pyarrow
+    import requests
+    return os.getpid()
+
+
+def _summarize_result(result):
+    """Keep a small json friendly summary of the result of a stage."""
+    if result is None or isinstance(result, (bool, int, float, str)):
+        return result
+    if isinstance(result, (list, tuple, set)):
+        return {"items": len(result)}
+    if isinstance(result, dict):
+        return {str(key): value for key, value in result.items()
+                if isinstance(value, (bool, int, float, str))}
+    return type(result).__name__
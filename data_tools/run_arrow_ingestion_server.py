@@ -0,0 +1,29 @@
+from functools import partial
+
+from arrow_ingestion import ArrowIngestionServer, load_batch
+
+# Run it on the database machine, the collectors send their data with ingestion_url
+# (see run_flight_extractor.py and run_micro_batch_extractor.py). Set the
+# FLIGHT_INGESTION_TOKEN environment variable on both sides to require a token.
+host = "0.0.0.0"
+port = 8766
+# If True store static leg data once in the leg table instead of the flight table
+deduplicate_legs = False
+# Daily batches are large, the load for small batches fits the hourly ones
+micro_batch = True
+# If True the fares are added to the fare_curve table, see fare_curve_cube.py
+update_fare_curve = False
+# Options of the indexes created after each load, see database_tools.INDEX_OPTIONS
+index_options = None
+# The batches whose load failed after a partial insert are refused until their rows
+# are deleted and ArrowIngestionServer.clear_failed_batch is called (or the batch is
+# removed from this file with the service stopped)
+failed_batches_path = "/home/mborges/arrow_ingestion_failed_batches.json"
+
+server = ArrowIngestionServer(host=host, port=port, failed_batches_path=failed_batches_path,
+                              load_function=partial(load_batch,
+                                                    deduplicate_legs=deduplicate_legs,
+                                                    micro_batch=micro_batch,
+                                                    update_fare_curve=update_fare_curve,
+                                                    index_options=index_options))
+server.serve_forever()
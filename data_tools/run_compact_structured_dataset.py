@@ -0,0 +1,18 @@
+import sys
+
+from structured_dataset import compact_dataset
+
+sys.path.append("../utils")
+from metrics import StageMetrics
+from tools import get_relevant_path
+
+dataset_path = get_relevant_path("structured_dataset")
+# Files smaller than this are merged, e.g. the hourly files of a day. Only the files
+# already inserted (in the data_upload table) are merged, run it on the database machine
+small_file_bytes = 32 * 2**20
+
+
+with StageMetrics("format.compact_structured_dataset", verbose=True) as stage_metrics:
+    compaction_log = compact_dataset(dataset_path, small_file_bytes=small_file_bytes)
+    stage_metrics.labels["partitions"] = len(compaction_log)
+    stage_metrics.labels["files"] = sum(partition["files"] for partition in compaction_log)
@@ -1,34 +1,15 @@
-import sys
-from glob import glob
-from os.path import join
-from pprint import pprint
-from time import time
-
-from database_format import DatabaseFormat
-
-sys.path.append("../odbc")
-import query_tools as qt
-
-sys.path.append("../utils")
-from tools import get_relevant_path
-
-data_upload = qt.get_table("data_upload")
-files_already_computed = set(data_upload["filePath"].unique())
-
-
-parquet_paths = glob(
-    join(get_relevant_path("structured_data"), "*.parquet")
-)
-
-parquet_paths = list(set(parquet_paths) - files_already_computed)
-parquet_paths.sort()
-
-print("Parquets number: ", len(parquet_paths))
-pprint(parquet_paths)
-
-time_start = time()
-database_format = DatabaseFormat(parquet_paths, inset_on_database=True)
-database_format.transform_all_parquets(n_jobs=-1)
-time_end = time()
-
-print(f" Done in {(time_end - time_start)/60} min or equivalently {(time_end - time_start)/ (60 * 60)} hours")
\ No newline at end of file
+from database_format import format_new_parquets
+
+# If True store static leg data once in the leg table instead of the flight table
+deduplicate_legs = False
+# If True the parquets are hourly batches, see run_micro_batch_extractor.py
+micro_batch = False
+# If True the fares are added to the fare_curve table, build it first with
+# odbc/run_rebuild_fare_curve.py, see fare_curve_cube.py
+update_fare_curve = False
+# Options of the indexes created after each load, e.g. ["brin", "covering"], see
+# database_tools.INDEX_OPTIONS. Use the same options in create_index.sql.
+index_options = None
+
+format_new_parquets(deduplicate_legs=deduplicate_legs, micro_batch=micro_batch,
+                    update_fare_curve=update_fare_curve, index_options=index_options)
@@ -13,8 +13,15 @@ from tools import get_relevant_path
 
 sys.path.append("../odbc")
 import database_tools as dt
+import fare_curve_cube as fc
 import query_tools as qt
 
+# If True the fares inserted are added to the fare_curve table, use the value of
+# run_database_format.py
+update_fare_curve = False
+# If True the database stores the legs in the leg table, see run_database_format.py
+deduplicate_legs = False
+
 
 def get_table_name(_str):
     """Extract from 'database_format_not_inserted' path the table name."""
@@ -39,6 +46,10 @@ for parquet_path in parquet_paths:
 
     table_name = get_table_name(parquet_path)
     table = pd.read_parquet(parquet_path)
+    if dt.INSERT_ERROR_COLUMN in table.columns:
+        # Rows with invalid data are quarantined again with their new error
+        print(table[dt.INSERT_ERROR_COLUMN].value_counts())
+        table = table.drop(columns=dt.INSERT_ERROR_COLUMN)
 
     database_format = DatabaseFormat(parquet_paths)
 
@@ -49,10 +60,28 @@ for parquet_path in parquet_paths:
         table = pd.concat([table, current_table])
         table = table.drop_duplicates(ignore_index=True)
 
-    dataframe_not_inserted = dt.insert_database_parallel(table, table_name, if_exists=if_exists)
+    method = "multi"
+    if table_name == "leg":
+        # Legs are identified by legHash, the ones already stored are skipped
+        method = dt.insert_on_conflict_do_nothing
+
+    dataframe_not_inserted = dt.insert_database_parallel(table, table_name, if_exists=if_exists,
+                                                         method=method)
     database_format.save_dataframe_not_inserted(dataframe_not_inserted, table_name)
 
     os.remove(parquet_path)
 
+    if update_fare_curve and table_name == "fare":
+        # The fares of a search are added when none of them is left to insert
+        search_ids_not_inserted = set()
+        for other_path in glob(os.path.join(get_relevant_path("database_format_not_inserted"),
+                                            "fare_*.parquet")):
+            search_ids_not_inserted.update(
+                pd.read_parquet(other_path, columns=["searchId"])["searchId"]
+            )
+        search_ids = set(table["searchId"]) - search_ids_not_inserted
+        n_offers = fc.add_fares_of_searches(search_ids, deduplicate_legs=deduplicate_legs)
+        print(f"{n_offers} fares added to fare_curve")
+
     time_end = time()
     print(f"Total time: {(time_end - time_begin)/60} min table_name = {table_name}, shape = {table.shape} ") 
\ No newline at end of file
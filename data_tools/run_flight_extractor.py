@@ -1,11 +1,7 @@
-import re
 from datetime import datetime, timedelta
 from glob import glob
-from os.path import join
 
-import pandas as pd
-from flight_extractor import FlightExtractor
-from tqdm import tqdm
+from flight_extractor import structure_days
 
 start_date = (datetime.now() - timedelta(days=1)).date()
 end_date = start_date
@@ -15,32 +11,16 @@ end_date = start_date
 path_to_save = "/home/mborges/structured_data"
 days_path_list = glob('/home/mborges/data/*')
 overwrite_files = False
-
-
-if not overwrite_files:
-    structured_data_list = glob(join(path_to_save, "*.parquet"))
-    computed_days = [
-        re.findall(r"(\d{4}-\d{2}-\d{2})_structured_data", path)[0]
-        for path in structured_data_list
-    ]
-
-for day_path in tqdm(days_path_list):
-    day_str = re.findall(r"today_(\d{4}-\d{2}-\d{2})", day_path)[0]
-    day = datetime.strptime(day_str, "%Y-%m-%d").date()
-    if ((day < start_date or end_date < day) or
-        (not overwrite_files and day_str in computed_days)):
-        continue
-    filenames_all = glob(join(day_path, "*/*/*.json"), recursive = True)
-    if len(filenames_all) > 0:
-        print(f"Structure data of the day {day_str}")
-
-        extractor = FlightExtractor(filenames_all)
-        structured_data, error_log_df = extractor.structure_all_jsons(n_jobs=-1)
-
-        structured_data_path = join(path_to_save, day_str + "_structured_data.parquet")
-        structured_data.to_parquet(structured_data_path)
-        if not error_log_df.empty:
-            error_log_path = join(path_to_save, "logs", day_str + "_error_log.csv")
-            error_log_df.to_csv(error_log_path, index=False)
-        del structured_data
-        del error_log_df
+# If not None the extraction results feed the scraper circuit breaker, only where the
+# scraper runs on the same machine, e.g. "/home/mborges/route_circuit_breaker.sqlite"
+circuit_breaker_path = None
+# If not None the data is sent to the ingestion service of the database machine
+# (run_arrow_ingestion_server.py) instead of being written and transferred by SFTP
+ingestion_url = None
+# If not None the data is written to the partitioned dataset (structured_dataset.py)
+# instead of one parquet per day, e.g. "/home/mborges/structured_data/dataset"
+dataset_path = None
+
+structure_days(days_path_list, path_to_save, start_date, end_date,
+               overwrite_files=overwrite_files, circuit_breaker_path=circuit_breaker_path,
+               ingestion_url=ingestion_url, dataset_path=dataset_path)
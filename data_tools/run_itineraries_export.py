@@ -0,0 +1,22 @@
+import sys
+
+from itineraries_export import export_itineraries
+
+sys.path.append("../utils")
+from tools import get_relevant_path
+
+output_folder = get_relevant_path("itineraries_export")
+# Parquet codecs and/or "csv", see EXPORT_FORMATS, every format is written in one pass
+formats = ["snappy", "gzip", "csv"]
+# searchIds per partition, and rows per cursor fetch and row group: the memory of
+# each worker depends on batch_rows only
+partition_size = 5_000_000
+batch_rows = 100_000
+# If True the database stores the legs in the leg table, see run_database_format.py
+deduplicate_legs = False
+# Partitions exported at the same time, each one holds a database connection
+n_jobs = 4
+
+# Run it again to resume an interrupted export, the exported partitions are skipped
+export_itineraries(output_folder, formats=formats, partition_size=partition_size,
+                   batch_rows=batch_rows, deduplicate_legs=deduplicate_legs, n_jobs=n_jobs)
@@ -0,0 +1,33 @@
+import sys
+
+from file_transfer import structured_data_transfer
+from flight_extractor import structure_completed_hours
+
+sys.path.append("../utils")
+from metrics import StageMetrics
+from tools import get_relevant_path
+
+# Number of cores, an hour has few json's
+n_jobs = 4
+# If not None the extraction results feed the scraper circuit breaker, only where the
+# scraper runs on the same machine, e.g. "/home/mborges/route_circuit_breaker.sqlite"
+circuit_breaker_path = None
+# If not None the hours are sent to the ingestion service of the database machine
+# (run_arrow_ingestion_server.py) instead of being transferred by SFTP
+ingestion_url = None
+# If not None the hours are written to the partitioned dataset (structured_dataset.py),
+# e.g. get_relevant_path("structured_dataset")
+dataset_path = None
+
+with StageMetrics("extract.micro_batch", verbose=True) as stage_metrics:
+    structured_data_paths = structure_completed_hours(get_relevant_path("data_scraper"),
+                                                      get_relevant_path("structured_data"),
+                                                      circuit_breaker_path=circuit_breaker_path,
+                                                      n_jobs=n_jobs, ingestion_url=ingestion_url,
+                                                      dataset_path=dataset_path)
+    stage_metrics.labels["files"] = len(structured_data_paths)
+    if len(structured_data_paths) > 0 and ingestion_url is None:
+        # Parquets whose previous transfer failed are sent again
+        transfer_log = structured_data_transfer(dataset_path=dataset_path)
+        stage_metrics.labels["files_failed"] = sum(not file_log["success"]
+                                                   for file_log in transfer_log)
@@ -0,0 +1,3 @@
+source /home/mborges/FlightPrices/setup/FlightPrices/bin/activate
+cd /home/mborges/FlightPrices/data_tools
+python run_micro_batch_extractor.py
@@ -0,0 +1,150 @@
+import sys
+from datetime import timedelta
+from glob import glob
+from os.path import isfile, join
+
+import pandas as pd
+from pipeline_daemon import PipelineDaemon, ScheduledStage
+
+sys.path.append("../scrape")
+
+# Stages run by this machine: the scrape machines run scrape, extract and transfer,
+# the database machine runs format (which inserts the data) and maintenance
+stages_to_run = ["scrape", "extract", "transfer"]
+n_jobs = 8
+status_port = 8765
+
+path = join("/home", "mborges")
+# scrape, see flight_scrape.py
+machines_number = 3
+machines_per_date = 2
+machine_id = 1
+sharding = False
+use_task_queue = False
+queue_path = join(path, "scrape_task_queue.sqlite")
+adaptive_schedule = False
+change_rates_path = join(path, "adaptive_schedule_change_rates.csv")
+use_circuit_breaker = False
+circuit_breaker_path = join(path, "route_circuit_breaker.sqlite")
+# extract, see run_flight_extractor.py
+path_to_save = join(path, "structured_data")
+days_path = join(path, "data")
+extract_hour = 12
+# format, see run_database_format.py
+deduplicate_legs = False
+# If True the fares are added to the fare_curve table, see fare_curve_cube.py
+update_fare_curve = False
+# Options of the indexes created after each load, see database_tools.INDEX_OPTIONS
+index_options = None
+# If True each collection hour is extracted and transferred after the scrape and
+# the database machine inserts it within minutes, instead of the daily extraction.
+# Use the same value on the scrape and database machines.
+micro_batch = False
+# If not None the extracted data is sent to the ingestion service of the database
+# machine (run_arrow_ingestion_server.py) and the transfer stage is not needed
+ingestion_url = None
+# maintenance, run after each format, see odbc/maintenance.py
+maintenance_max_concurrency = 2
+# Maximum sum of the estimated bytes of the tasks running together, not an I/O rate
+maintenance_max_concurrent_task_bytes = 4 * 2**30
+# If not None the extracted data is written to this partitioned dataset
+# (structured_dataset.py) instead of one parquet per day or hour
+dataset_path = None
+
+
+def scrape(scheduled_time):
+    from coordinate_scraper import CoordinateScraper
+    from flight_scrape import run_scrape
+
+    change_rates = None
+    if adaptive_schedule and isfile(change_rates_path):
+        change_rates = pd.read_csv(change_rates_path)
+    coordinate_scraper = CoordinateScraper(machines_number=machines_number,
+                                           machines_per_date=machines_per_date)
+    return run_scrape(scheduled_time, path, coordinate_scraper, machine_id, n_jobs=n_jobs,
+                      sharding=sharding, use_task_queue=use_task_queue,
+                      queue_path=queue_path, adaptive_schedule=adaptive_schedule,
+                      change_rates=change_rates, use_circuit_breaker=use_circuit_breaker,
+                      circuit_breaker_path=circuit_breaker_path)
+
+
+def extract(scheduled_time):
+    from flight_extractor import structure_days
+
+    yesterday = (scheduled_time - timedelta(days=1)).date()
+    return structure_days(glob(join(days_path, "*")), path_to_save, yesterday, yesterday,
+                          circuit_breaker_path=circuit_breaker_path if use_circuit_breaker else None,
+                          n_jobs=n_jobs, ingestion_url=ingestion_url,
+                          dataset_path=dataset_path)
+
+
+def extract_hours():
+    from flight_extractor import structure_completed_hours
+
+    return structure_completed_hours(
+        days_path, path_to_save,
+        circuit_breaker_path=circuit_breaker_path if use_circuit_breaker else None,
+        n_jobs=n_jobs, ingestion_url=ingestion_url, dataset_path=dataset_path
+    )
+
+
+def transfer():
+    from file_transfer import structured_data_transfer
+
+    return structured_data_transfer(dataset_path=dataset_path)
+
+
+def format_and_load():
+    from database_format import format_new_parquets
+
+    return format_new_parquets(deduplicate_legs=deduplicate_legs, micro_batch=micro_batch,
+                               n_jobs=n_jobs, update_fare_curve=update_fare_curve,
+                               index_options=index_options)
+
+
+def maintain():
+    sys.path.append("../odbc")
+    from maintenance import plan_maintenance, run_maintenance
+
+    tasks = plan_maintenance()
+    report = run_maintenance(tasks, max_concurrency=maintenance_max_concurrency,
+                             max_concurrent_task_bytes=maintenance_max_concurrent_task_bytes)
+    return {"maintenance_tasks": len(report),
+            "maintenance_failed": int((~report["success"].astype(bool)).sum()),
+            "reclaimed_bytes": int(report["reclaimed_bytes"].fillna(0).sum())}
+
+
+def get_queue_status():
+    from task_queue import ScrapeTaskQueue
+
+    return {"scrape_task_queue": ScrapeTaskQueue(queue_path).get_status_counts()}
+
+
+if micro_batch:
+    stages = {
+        "scrape": ScheduledStage("scrape", scrape, minute=0, pass_scheduled_time=True),
+        "extract": ScheduledStage("extract", extract_hours, minute=None, after="scrape"),
+        "transfer": ScheduledStage("transfer", transfer, minute=None, after="extract"),
+        "format": ScheduledStage("format", format_and_load, minute=list(range(0, 60, 10))),
+    }
+else:
+    stages = {
+        "scrape": ScheduledStage("scrape", scrape, minute=0, pass_scheduled_time=True),
+        "extract": ScheduledStage("extract", extract, minute=0, hour=extract_hour,
+                                  pass_scheduled_time=True),
+        "transfer": ScheduledStage("transfer", transfer, minute=None, after="extract"),
+        # It only finds new parquets, so it is cheap when there is nothing to insert
+        "format": ScheduledStage("format", format_and_load, minute=30),
+    }
+# The maintenance runs after the loads, never during them
+assert "maintenance" not in stages_to_run or "format" in stages_to_run, (
+    "maintenance runs after format, add format to stages_to_run"
+)
+stages["maintenance"] = ScheduledStage("maintenance", maintain, minute=None, after="format")
+if ingestion_url is not None:
+    stages.pop("transfer")
+stages = [stage for name, stage in stages.items() if name in stages_to_run]
+
+daemon = PipelineDaemon(stages, n_jobs=n_jobs, status_port=status_port,
+                        status_function=get_queue_status if use_task_queue else None)
+daemon.serve_forever()
@@ -1,10 +1,15 @@
-from time import time
+import sys
 
 from file_transfer import structured_data_transfer
 
+sys.path.append("../utils")
+from metrics import StageMetrics
 
-start_time = time()
-structured_data_transfer()
-end_time = time()
+# If not None the files of the partitioned dataset are also transferred,
+# e.g. "/home/mborges/structured_data/dataset"
+dataset_path = None
 
-print(f"Done in {(end_time - start_time) / 60} min.")
\ No newline at end of file
+with StageMetrics("transfer.structured_data_transfer", verbose=True) as stage_metrics:
+    transfer_log = structured_data_transfer(dataset_path=dataset_path)
+    stage_metrics.labels["files"] = len(transfer_log)
+    stage_metrics.labels["files_failed"] = sum(not file_log["success"] for file_log in transfer_log)
\ No newline at end of file
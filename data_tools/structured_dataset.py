@@ -0,0 +1,337 @@
+import json
+import os
+import re
+import sys
+from datetime import date, datetime
+from glob import glob
+from os.path import abspath, basename, dirname, isfile, join, relpath
+from uuid import uuid4
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+sys.path.append(join(dirname(abspath(__file__)), "..", "odbc"))
+
+# Hive layout of the structured dataset:
+# <dataset>/search_date=<date>/origin_code=<code>/destination_code=<code>/<batch>-<i>.parquet
+PARTITION_SCHEMA = pa.schema([("search_date", pa.date32()),
+                              ("origin_code", pa.string()),
+                              ("destination_code", pa.string())])
+PARTITIONING = ds.partitioning(PARTITION_SCHEMA, flavor="hive")
+# Rows are sorted by these columns inside each file, so the min/max statistics of the
+# row groups let the readers skip the flight days they do not need
+SORT_COLUMNS = ["flight_day", "legId"]
+# Prefix of the files written by compact_dataset
+COMPACTED_PREFIX = "compacted-"
+# Names of the batches merged by compact_dataset, in the root folder of the dataset.
+# The "_" prefix keeps it out of the pyarrow datasets.
+COMPACTED_BATCHES_FILE = "_compacted_batches.json"
+
+
+def write_structured_dataset(structured_data, dataset_path, batch_name,
+                             max_rows_per_group=65_536, compression="zstd"):
+    """Write the structured data of a batch to the partitioned dataset.
+
+    Each (search_date, origin_code, destination_code) partition of the batch gets
+    one file named "<batch_name>-<i>.parquet", sorted by SORT_COLUMNS and with the
+    min/max statistics of every row group. The files of a previous write of the
+    same batch are replaced. A batch merged by compact_dataset can not be written
+    again, its rows are in the compacted files.
+
+    Parameters
+    ----------
+    structured_data: pd.DataFrame
+        Output of FlightExtractor.structure_all_jsons.
+    dataset_path: str
+        Root folder of the dataset.
+    batch_name: str
+        Name of the batch, e.g. "2023-05-05" or "2023-05-05_hour_10_minute_0".
+    max_rows_per_group: int (default=65_536)
+        Maximum number of rows of each row group.
+    compression: str (default="zstd")
+        Parquet compression.
+
+    Return
+    ------
+    file_paths: list[str]
+        Files written.
+    """
+    assert batch_name not in list_compacted_batches(dataset_path), \
+        f"The batch {batch_name} was compacted, writing it again would duplicate its rows"
+    remove_dataset_batch(dataset_path, batch_name)
+    if len(structured_data) == 0:
+        return []
+
+    structured_data = structured_data.assign(
+        search_date=pd.to_datetime(structured_data["operational_search_time"]).dt.date,
+        origin_code=structured_data["origin_code"].astype(str),
+        destination_code=structured_data["destination_code"].astype(str),
+    )
+    sort_columns = [column for column in PARTITION_SCHEMA.names + SORT_COLUMNS
+                    if column in structured_data.columns]
+    structured_data = structured_data.sort_values(sort_columns, ignore_index=True)
+    table = pa.Table.from_pandas(structured_data, preserve_index=False)
+    table = table.cast(_get_partition_cast_schema(table.schema))
+
+    file_paths = list()
+    file_format = ds.ParquetFileFormat()
+    ds.write_dataset(
+        table, dataset_path, format=file_format, partitioning=PARTITIONING,
+        basename_template=f"{batch_name}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        file_options=file_format.make_write_options(compression=compression,
+                                                    write_statistics=True),
+        max_rows_per_group=max_rows_per_group,
+        min_rows_per_group=min(max_rows_per_group, len(structured_data)),
+        file_visitor=lambda written_file: file_paths.append(written_file.path),
+    )
+    return file_paths
+
+
+def get_dataset_filter(start_search_date=None, end_search_date=None, origin_codes=None,
+                       destination_codes=None, start_flight_day=None, end_flight_day=None):
+    """Build the filter of read_structured_dataset.
+
+    The search date and route conditions prune whole partitions, the flight day
+    conditions skip the row groups whose min/max statistics are out of the range.
+
+    Parameters
+    ----------
+    start_search_date, end_search_date: datetime.date (default=None)
+        Range of search dates, inclusive.
+    origin_codes, destination_codes: list[str] (default=None)
+        Airport codes.
+    start_flight_day, end_flight_day: datetime.date (default=None)
+        Range of flight days, inclusive.
+
+    Return
+    ------
+    dataset_filter: pyarrow.compute.Expression
+        None if there is no condition.
+    """
+    conditions = list()
+    if start_search_date is not None:
+        conditions.append(ds.field("search_date") >= _to_date(start_search_date))
+    if end_search_date is not None:
+        conditions.append(ds.field("search_date") <= _to_date(end_search_date))
+    if origin_codes is not None:
+        conditions.append(ds.field("origin_code").isin(list(origin_codes)))
+    if destination_codes is not None:
+        conditions.append(ds.field("destination_code").isin(list(destination_codes)))
+    if start_flight_day is not None:
+        conditions.append(ds.field("flight_day") >= pd.Timestamp(start_flight_day))
+    if end_flight_day is not None:
+        conditions.append(ds.field("flight_day") <= pd.Timestamp(end_flight_day))
+
+    dataset_filter = None
+    for condition in conditions:
+        dataset_filter = condition if dataset_filter is None else dataset_filter & condition
+    return dataset_filter
+
+
+def read_structured_dataset(dataset_path, columns=None, dataset_filter=None,
+                            file_paths=None):
+    """Read the partitioned dataset, only the partitions and row groups needed.
+
+    Parameters
+    ----------
+    dataset_path: str
+        Root folder of the dataset.
+    columns: list[str] (default=None)
+        Columns to read, by default all of them.
+    dataset_filter: pyarrow.compute.Expression (default=None)
+        Rows to read, see get_dataset_filter.
+    file_paths: list[str] (default=None)
+        Read only these files of the dataset, e.g. one batch.
+
+    Return
+    ------
+    structured_data: pd.DataFrame
+        Data with the partition columns search_date, origin_code and destination_code.
+    """
+    if file_paths is None:
+        dataset = ds.dataset(dataset_path, format="parquet", partitioning=PARTITIONING)
+    else:
+        dataset = ds.dataset(file_paths, format="parquet", partitioning=PARTITIONING,
+                             partition_base_dir=dataset_path)
+    return dataset.to_table(columns=columns, filter=dataset_filter).to_pandas()
+
+
+def read_structured_file(parquet_path):
+    """Read one structured parquet, flat or of the partitioned dataset.
+
+    The files of the dataset do not store the partition columns, they are taken
+    from the folders.
+    """
+    dataset_path = get_dataset_root(parquet_path)
+    if dataset_path is None:
+        return pd.read_parquet(parquet_path)
+    return read_structured_dataset(dataset_path, file_paths=[parquet_path])
+
+
+def get_dataset_root(parquet_path):
+    """Get the root folder of the dataset of a file, None if it is not in a dataset."""
+    match = re.search(rf"^(.*?)/{PARTITION_SCHEMA.names[0]}=[^/]+/", parquet_path)
+    return None if match is None else match.group(1)
+
+
+def list_dataset_files(dataset_path, include_compacted=True):
+    """List the parquet files of the dataset.
+
+    Parameters
+    ----------
+    dataset_path: str
+        Root folder of the dataset.
+    include_compacted: bool (default=True)
+        If False the files written by compact_dataset are not listed.
+
+    Return
+    ------
+    file_paths: list[str]
+    """
+    file_paths = sorted(glob(join(dataset_path, "*=*", "*=*", "*=*", "*.parquet")))
+    if not include_compacted:
+        file_paths = [path for path in file_paths
+                      if not basename(path).startswith(COMPACTED_PREFIX)]
+    return file_paths
+
+
+def list_dataset_batches(dataset_path):
+    """Group the files of the dataset by batch name.
+
+    Return
+    ------
+    batches: dict[list[str]]
+        Batch name and its files, the compacted files are not listed, see
+        list_compacted_batches.
+    """
+    batches = dict()
+    for path in list_dataset_files(dataset_path, include_compacted=False):
+        batches.setdefault(_get_batch_name(path), []).append(path)
+    return batches
+
+
+def list_compacted_batches(dataset_path):
+    """Get the names of the batches whose files were merged by compact_dataset."""
+    compacted_batches_path = join(dataset_path, COMPACTED_BATCHES_FILE)
+    if not isfile(compacted_batches_path):
+        return set()
+    with open(compacted_batches_path) as file:
+        return set(json.load(file))
+
+
+def filter_loaded_files(file_paths):
+    """Keep the files registered in the data_upload table and the compacted files,
+    the default is_compactable_function of compact_dataset."""
+    import query_tools as qt
+
+    data_upload = qt.get_table("data_upload")
+    files_already_computed = set(data_upload["filePath"].unique())
+    return [path for path in file_paths if path in files_already_computed
+            or basename(path).startswith(COMPACTED_PREFIX)]
+
+
+def remove_dataset_batch(dataset_path, batch_name):
+    """Remove the files of a batch from the dataset."""
+    for path in list_dataset_batches(dataset_path).get(batch_name, []):
+        os.remove(path)
+
+
+def compact_dataset(dataset_path, small_file_bytes=32 * 2**20, max_rows_per_group=65_536,
+                    is_compactable_function=filter_loaded_files, compression="zstd"):
+    """Merge the small files of each partition, e.g. the hourly files, into one file.
+
+    The rows of the merged file are sorted by SORT_COLUMNS again. It is written with
+    a temporary name and renamed, and then the merged files are removed, so the
+    readers never see the rows twice or not at all, except a reader that listed the
+    files before the removal. The names of the merged batches are added to
+    COMPACTED_BATCHES_FILE, so the extraction does not write them again.
+
+    Parameters
+    ----------
+    dataset_path: str
+        Root folder of the dataset.
+    small_file_bytes: int (default=32 MB)
+        Files smaller than this are merged.
+    max_rows_per_group: int (default=65_536)
+        Maximum number of rows of each row group.
+    is_compactable_function: callable (default=filter_loaded_files)
+        Function that receives a list of file paths and returns the ones that can be
+        merged. By default the ones already inserted in the database, format_new_parquets
+        does not insert the compacted files. If None all of them.
+    compression: str (default="zstd")
+        Parquet compression.
+
+    Return
+    ------
+    compaction_log: list[dict]
+        For each merged partition, its folder, the number of files merged and of rows.
+    """
+    partition_files = dict()
+    for path in list_dataset_files(dataset_path):
+        if os.path.getsize(path) < small_file_bytes:
+            partition_files.setdefault(dirname(path), []).append(path)
+
+    compaction_log = list()
+    for partition_path, file_paths in sorted(partition_files.items()):
+        if is_compactable_function is not None:
+            file_paths = list(is_compactable_function(file_paths))
+        if len(file_paths) < 2:
+            continue
+
+        table = pa.concat_tables(
+            [pq.read_table(path) for path in file_paths], promote=True
+        )
+        sort_columns = [column for column in SORT_COLUMNS if column in table.column_names]
+        if len(sort_columns) > 0:
+            table = table.take(pc.sort_indices(table, [(column, "ascending")
+                                                       for column in sort_columns]))
+
+        file_name = f"{COMPACTED_PREFIX}{datetime.now():%Y%m%d%H%M%S}-{uuid4().hex[:8]}.parquet"
+        temporary_path = join(partition_path, "." + file_name)
+        pq.write_table(table, temporary_path, compression=compression,
+                       row_group_size=max_rows_per_group, write_statistics=True)
+        os.replace(temporary_path, join(partition_path, file_name))
+        _add_compacted_batches(dataset_path, [
+            _get_batch_name(path) for path in file_paths
+            if not basename(path).startswith(COMPACTED_PREFIX)
+        ])
+        for path in file_paths:
+            os.remove(path)
+
+        compaction_log.append({"partition": relpath(partition_path, dataset_path),
+                               "files": len(file_paths), "rows": table.num_rows})
+        print(f"Compacted {len(file_paths)} files of {relpath(partition_path, dataset_path)}, "
+              f"{table.num_rows} rows")
+    return compaction_log
+
+
+def _get_batch_name(parquet_path):
+    return basename(parquet_path)[:-len(".parquet")].rsplit("-", 1)[0]
+
+
+def _add_compacted_batches(dataset_path, batch_names):
+    compacted_batches = list_compacted_batches(dataset_path) | set(batch_names)
+    compacted_batches_path = join(dataset_path, COMPACTED_BATCHES_FILE)
+    temporary_path = compacted_batches_path + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(sorted(compacted_batches), file, indent=4)
+    os.replace(temporary_path, compacted_batches_path)
+
+
+def _get_partition_cast_schema(schema):
+    """Schema with the partition columns of PARTITION_SCHEMA and the other columns unchanged."""
+    fields = [PARTITION_SCHEMA.field(field.name) if field.name in PARTITION_SCHEMA.names
+              else field for field in schema]
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return pd.Timestamp(value).date()
@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+# Columns with few distinct values, stored as dictionary encoded categoricals
+CATEGORICAL_COLUMNS = ["origin_code", "origin_city", "destination_code", "destination_city",
+                       "travelDuration", "fareBasisCode", "currency", "providerCode",
+                       "flightFulfillmentMethod"]
+
+BOOLEAN_COLUMNS = ["isNonStop", "isBasicEconomy", "isRefundable", "isFreeChangeAvailable",
+                   "showFees", "hasSeatMap", "loyaltyInfo_isBurnApplied"]
+
+INTEGER_COLUMNS = ["numberOfTickets", "seatsRemaining", "loyaltyInfo_points_base",
+                   "loyaltyInfo_points_bonus", "loyaltyInfo_points_total"]
+
+FLOAT_COLUMNS = ["taxes", "fees", "baseFare", "totalFare", "averageTotalPricePerTicket"]
+
+# Timestamps with the format used to parse them, None lets pandas infer it
+TIMESTAMP_COLUMNS = {"search_time": None,
+                     "operational_search_time": "%Y-%m-%dT%H:%M",
+                     "flight_day": "%Y-%m-%d"}
+
+# Type of the values of the segment columns, the ones not listed are kept as str
+SEGMENT_VALUE_TYPES = {"departureTimeZoneOffsetSeconds": int,
+                       "arrivalTimeZoneOffsetSeconds": int,
+                       "durationInSeconds": int,
+                       "elapsedDays": int,
+                       "stops": int,
+                       "arrivalAirportLatitude": float,
+                       "arrivalAirportLongitude": float,
+                       "departureAirportLatitude": float,
+                       "departureAirportLongitude": float}
+
+
+def apply_structured_schema(structured_data, segment_columns):
+    """Convert the structured data to the typed output schema.
+
+    Parameters
+    ----------
+    structured_data: pd.DataFrame
+        Output of FlightExtractor with typed_output=True, segment columns hold lists.
+    segment_columns: list[str]
+        Columns with one value per flight segment.
+
+    Return
+    ------
+    structured_data: pd.DataFrame
+        Data with categorical, boolean, integer, float, timestamp and list columns.
+    """
+    structured_data = structured_data.copy()
+    for column in structured_data.columns:
+        if column in segment_columns:
+            structured_data[column] = _to_typed_lists(structured_data[column],
+                                                      SEGMENT_VALUE_TYPES.get(column, str))
+        elif column in CATEGORICAL_COLUMNS:
+            structured_data[column] = structured_data[column].astype("category")
+        elif column in BOOLEAN_COLUMNS:
+            structured_data[column] = _to_boolean(structured_data[column])
+        elif column in INTEGER_COLUMNS:
+            structured_data[column] = pd.to_numeric(structured_data[column],
+                                                    errors="coerce").astype("Int64")
+        elif column in FLOAT_COLUMNS:
+            structured_data[column] = pd.to_numeric(structured_data[column],
+                                                    errors="coerce").astype("float64")
+        elif column in TIMESTAMP_COLUMNS:
+            structured_data[column] = pd.to_datetime(structured_data[column],
+                                                     format=TIMESTAMP_COLUMNS[column])
+    return structured_data
+
+
+def get_segment_columns(dataframe):
+    """Get the columns that hold one list of values per flight segment.
+
+    Parameters
+    ----------
+    dataframe: pd.DataFrame
+        Typed structured data, e.g. read from a structured parquet.
+
+    Return
+    ------
+    segment_columns: list[str]
+        Columns that hold one list per row.
+    """
+    segment_columns = list()
+    for column in dataframe.select_dtypes(include="object").columns:
+        first_valid_index = dataframe[column].first_valid_index()
+        if first_valid_index is None:
+            continue
+        # The lists become np.ndarray when they come back from a parquet or Arrow file
+        if isinstance(dataframe[column].loc[first_valid_index], (list, np.ndarray)):
+            segment_columns.append(column)
+    return segment_columns
+
+
+def join_list_columns(dataframe, separator="||"):
+    """Join the list columns into separator strings, the format of the database tables.
+
+    The values are written like the untyped output of FlightExtractor, which joins
+    str(value) of the json values, so the legHash of a leg does not depend on the
+    output the data came from. The floats without fraction, which are json
+    integers cast by SEGMENT_VALUE_TYPES, are written without ".0".
+
+    Parameters
+    ----------
+    dataframe: pd.DataFrame
+        Data read from a structured parquet.
+    separator: str (default="||")
+        Separator between the values of each segment.
+
+    Return
+    ------
+    dataframe: pd.DataFrame
+        Data without list columns. Data without list columns is returned unchanged.
+    """
+    for column in get_segment_columns(dataframe):
+        dataframe[column] = _join_lists(dataframe[column], separator)
+    return dataframe
+
+
+def _join_lists(series, separator):
+    """Join the lists of a column with pyarrow compute, None for the rows without list."""
+    lists = pa.array(series, from_pandas=True)
+    if pa.types.is_null(lists.type):
+        return pd.Series(None, index=series.index, dtype="object")
+    values = lists.values
+    if pa.types.is_floating(values.type):
+        # Few distinct values (coordinates), each one is formatted once
+        unique_values, inverse = np.unique(values.to_numpy(zero_copy_only=False),
+                                           return_inverse=True)
+        texts = np.array([_format_float(value) for value in unique_values], dtype="object")
+        values = pa.array(texts[inverse], type=pa.string())
+    elif not pa.types.is_string(values.type):
+        values = pc.cast(values, pa.string())
+    lists = pa.ListArray.from_arrays(lists.offsets, values, mask=lists.is_null())
+    joined = pc.binary_join(lists, separator).to_pandas()
+    joined.index = series.index
+    return joined
+
+
+def _format_float(value):
+    """str of the float, without ".0" if it has no fraction."""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else str(value)
+
+
+def _to_typed_lists(series, value_type):
+    """Cast the values of each list, keeping str if any value can not be cast."""
+    def cast(values, value_type):
+        if not isinstance(values, (list, np.ndarray)):
+            return None
+        return [value_type(value) for value in values]
+
+    try:
+        return series.map(lambda values: cast(values, value_type))
+    except (TypeError, ValueError):
+        return series.map(lambda values: cast(values, str))
+
+
+def _to_boolean(series):
+    """Cast bool or str values to the nullable boolean dtype."""
+    mapping = {True: True, False: False, "True": True, "False": False,
+               "true": True, "false": False}
+    return series.map(mapping).astype("boolean")
@@ -0,0 +1,80 @@
+import pandas as pd
+import pytest
+import requests
+
+from arrow_ingestion import ArrowIngestionServer, iter_arrow_stream
+
+
+def get_batch():
+    return pd.DataFrame({"legId": ["a", "b", "c"], "totalFare": [100.5, 200.0, 150.25],
+                         "flightDay": pd.to_datetime(["2023-06-01"] * 3)})
+
+
+def post_batch(server, batch_name, body):
+    return requests.post(f"{server.base_url}/ingest/{batch_name}", data=body, timeout=30)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.delenv("FLIGHT_INGESTION_TOKEN", raising=False)
+    loaded_batches = dict()
+
+    def load_function(data, batch_name):
+        if batch_name.startswith("fail"):
+            raise RuntimeError("insert failed")
+        loaded_batches[batch_name] = data
+        return {"search_rows": len(data)}
+
+    def is_loaded_function(batch_name):
+        return batch_name in loaded_batches
+
+    with ArrowIngestionServer(host="127.0.0.1", port=0, load_function=load_function,
+                              is_loaded_function=is_loaded_function) as ingestion_server:
+        ingestion_server.loaded_batches = loaded_batches
+        yield ingestion_server
+
+
+def test_ingest_loads_batch_once(server):
+    response = post_batch(server, "2023-06-01", iter_arrow_stream(get_batch()))
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "loaded"
+    assert response.json()["rows"] == 3
+    pd.testing.assert_frame_equal(server.loaded_batches["2023-06-01"], get_batch())
+
+    response = post_batch(server, "2023-06-01", iter_arrow_stream(get_batch()))
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "duplicate"
+
+
+def test_ingest_refuses_batch_whose_load_failed(server):
+    response = post_batch(server, "fail_2023-06-01", iter_arrow_stream(get_batch()))
+
+    assert response.status_code == 500
+    assert response.json()["status"] == "load_failed"
+
+    response = post_batch(server, "fail_2023-06-01", iter_arrow_stream(get_batch()))
+
+    assert response.status_code == 409
+    assert "fail_2023-06-01" in server.get_status()["failed_batches"]
+
+
+def test_ingest_rejects_invalid_stream(server):
+    body = b"".join(iter_arrow_stream(get_batch()))
+
+    response = post_batch(server, "2023-06-01", body[:len(body) // 2])
+
+    assert response.status_code == 400
+    assert "2023-06-01" not in server.loaded_batches
+
+    response = post_batch(server, "2023-06-01", body)
+
+    assert response.status_code == 200
+
+
+def test_ingest_rejects_invalid_batch_name(server):
+    response = post_batch(server, "2023 06 01", iter_arrow_stream(get_batch()))
+
+    assert response.status_code == 400
+    assert len(server.loaded_batches) == 0
@@ -0,0 +1,147 @@
+import io
+import os
+import shlex
+import subprocess
+
+import pytest
+
+from file_transfer import SFTPTransferPool
+
+
+class LocalChannel():
+    """Stand-in of paramiko.Channel that runs the command in the remote folder."""
+    def __init__(self, remote_folder):
+        self.remote_folder = remote_folder
+        self.process = None
+
+    def exec_command(self, command):
+        self.process = subprocess.run(shlex.split(command), cwd=self.remote_folder,
+                                      capture_output=True)
+
+    def makefile(self, mode):
+        return io.BytesIO(self.process.stdout)
+
+    def recv_exit_status(self):
+        return self.process.returncode
+
+    def close(self):
+        return
+
+
+class LocalTransport():
+    """Stand-in of paramiko.Transport, it only opens command channels."""
+    def __init__(self, remote_folder):
+        self.remote_folder = remote_folder
+        self.commands = list()
+
+    def open_session(self):
+        self.commands.append(None)
+        return LocalChannel(self.remote_folder)
+
+    def close(self):
+        return
+
+
+class LocalSFTPClient():
+    """Stand-in of paramiko.SFTPClient over a local folder, the remote server."""
+    def __init__(self, remote_folder, run_commands=True):
+        self.remote_folder = remote_folder
+        self.transport = LocalTransport(remote_folder) if run_commands else None
+        self.read_paths = list()
+
+    def stat(self, path):
+        return os.stat(self._get_path(path))
+
+    def open(self, path, mode="r"):
+        if "r" in mode:
+            self.read_paths.append(path)
+        return open(self._get_path(path), mode)
+
+    def mkdir(self, path):
+        os.mkdir(self._get_path(path))
+
+    def remove(self, path):
+        os.remove(self._get_path(path))
+
+    def close(self):
+        return
+
+    def _get_path(self, path):
+        return os.path.join(self.remote_folder, path)
+
+
+@pytest.fixture
+def local_file(tmp_path):
+    local_file = tmp_path / "local" / "2023-06-01_structured_data.parquet"
+    local_file.parent.mkdir()
+    local_file.write_bytes(os.urandom(3 * 2**20 + 123))
+    return str(local_file)
+
+
+def get_pool(tmp_path, clients, run_commands=True, **pool_parameters):
+    remote_folder = tmp_path / "remote"
+    remote_folder.mkdir(exist_ok=True)
+
+    def connect_function(host, port, user, password, window_size, max_packet_size):
+        clients.append(LocalSFTPClient(str(remote_folder), run_commands=run_commands))
+        return clients[-1]
+
+    return SFTPTransferPool("localhost", "user", "password", n_connections=1,
+                            buffer_size=2**20, connect_function=connect_function,
+                            **pool_parameters), remote_folder
+
+
+def test_transfer_verifies_remote_checksum_without_reading_back(tmp_path, local_file):
+    clients = list()
+    pool, remote_folder = get_pool(tmp_path, clients)
+    destination_path = "structured_data/2023-06-01_structured_data.parquet"
+
+    with pool:
+        file_log = pool.transfer(local_file, destination_path)
+
+    assert file_log["success"]
+    assert file_log["transferred_bytes"] == os.path.getsize(local_file)
+    assert (remote_folder / destination_path).read_bytes() == open(local_file, "rb").read()
+    assert len(clients[0].transport.commands) == 1
+    assert clients[0].read_paths == []
+
+
+def test_transfer_resumes_partial_upload(tmp_path, local_file):
+    clients = list()
+    pool, remote_folder = get_pool(tmp_path, clients)
+    data = open(local_file, "rb").read()
+    (remote_folder / "partial.parquet").write_bytes(data[:2**20])
+
+    with pool:
+        file_log = pool.transfer(local_file, "partial.parquet")
+
+    assert file_log["success"]
+    assert file_log["transferred_bytes"] == len(data) - 2**20
+    assert (remote_folder / "partial.parquet").read_bytes() == data
+
+
+def test_transfer_sends_again_corrupted_upload(tmp_path, local_file):
+    clients = list()
+    pool, remote_folder = get_pool(tmp_path, clients)
+    data = open(local_file, "rb").read()
+    (remote_folder / "corrupted.parquet").write_bytes(b"x" * 2**20)
+
+    with pool:
+        file_log = pool.transfer(local_file, "corrupted.parquet")
+
+    assert file_log["success"]
+    assert file_log["transferred_bytes"] == 2 * len(data) - 2**20
+    assert (remote_folder / "corrupted.parquet").read_bytes() == data
+
+
+@pytest.mark.parametrize("pool_parameters", [{"run_commands": False},
+                                             {"remote_sha256_command": "false"}])
+def test_transfer_reads_back_if_command_can_not_run(tmp_path, local_file, pool_parameters):
+    clients = list()
+    pool, _ = get_pool(tmp_path, clients, **pool_parameters)
+
+    with pool:
+        file_log = pool.transfer(local_file, "read_back.parquet")
+
+    assert file_log["success"]
+    assert clients[0].read_paths == ["read_back.parquet"]
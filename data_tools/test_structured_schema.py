@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+from structured_schema import apply_structured_schema, get_segment_columns, join_list_columns
+
+
+# Segment values as they come from the json's, one row per leg
+SEGMENTS = {
+    "departureAirportLatitude": [[-23.4356, -30], [-15.8697], None],
+    "durationInSeconds": [[3600, 5400], [7200], None],
+    "flightNumber": [["1234", "5678"], ["4321"], None],
+}
+
+
+def get_untyped_segments():
+    """Segments joined like FlightExtractor without typed_output."""
+    return pd.DataFrame({
+        column: ["||".join(str(value) for value in values) if values is not None else None
+                 for values in rows]
+        for column, rows in SEGMENTS.items()
+    })
+
+
+def test_join_list_columns_matches_untyped_output(tmp_path):
+    typed_data = apply_structured_schema(pd.DataFrame(SEGMENTS), list(SEGMENTS))
+    typed_data["origin_code"] = ["GRU", "BSB", "POA"]
+    # The lists come back as np.ndarray from the parquet
+    typed_data.to_parquet(tmp_path / "structured_data.parquet")
+    data = pd.read_parquet(tmp_path / "structured_data.parquet")
+    assert isinstance(data["durationInSeconds"].iloc[0], np.ndarray)
+
+    joined_data = join_list_columns(data)
+
+    pd.testing.assert_frame_equal(joined_data[list(SEGMENTS)], get_untyped_segments())
+    assert joined_data["origin_code"].tolist() == ["GRU", "BSB", "POA"]
+
+
+def test_get_segment_columns():
+    data = pd.DataFrame({"flightNumber": [None, ["1234"]], "legId": ["a", "b"],
+                         "stops": [None, None]})
+
+    assert get_segment_columns(data) == ["flightNumber"]
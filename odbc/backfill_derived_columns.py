@@ -0,0 +1,123 @@
+import math
+import sys
+
+import pandas as pd
+from joblib import Parallel, delayed
+from psycopg2.extras import execute_values
+
+from connection import load_conn
+from filter_warnings import filter_warnings
+
+sys.path.append("../data_tools")
+from derived_columns import DERIVED_COLUMNS, get_derived_columns
+
+sys.path.append("../utils")
+from metrics import StageMetrics
+
+# Key and derived columns of each table, see DatabaseFormat add_derived_columns
+BACKFILL_TABLES = {
+    "search": ("searchId", ["daysToDeparture"]),
+    "flight": ("searchId", ["departureHour", "timeOfDay", "travelDurationMinutes"]),
+    "leg": ("legHash", ["departureHour", "timeOfDay", "travelDurationMinutes"]),
+}
+# Type of the derived columns, the values of the UPDATE are cast to it
+DERIVED_COLUMNS_TYPES = {
+    "daysToDeparture": "SMALLINT",
+    "departureHour": "SMALLINT",
+    "timeOfDay": "VARCHAR(10)",
+    "travelDurationMinutes": "INTEGER",
+}
+
+
+def backfill_derived_columns(table_name, partition_size=1_000_000, n_jobs=4, schema="flight"):
+    """Fill the derived columns of the rows inserted before DatabaseFormat computed them.
+
+    The key range of the table is split in partitions of about partition_size rows,
+    processed in parallel: the rows of the partition with a null derived column are
+    read, the columns are computed by derived_columns.get_derived_columns, the same
+    code of the load, and written back with one UPDATE per page of rows. Only the
+    rows still null are read, so an interrupted backfill is resumed by running it
+    again.
+
+    Parameters
+    ----------
+    table_name: str
+        One of BACKFILL_TABLES.
+    partition_size: int (default=1_000_000)
+        Approximate number of rows of each partition.
+    n_jobs: int (default=4)
+        Number of partitions processed at the same time.
+    schema: str (default="flight")
+        The name of the database schema.
+
+    Return
+    ------
+    n_rows: int
+        Number of rows updated.
+    """
+    assert table_name in BACKFILL_TABLES, f"table_name must be one of {list(BACKFILL_TABLES)}"
+    key, derived_columns = BACKFILL_TABLES[table_name]
+
+    with load_conn() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f'SELECT min("{key}"), max("{key}"), count(*) FROM {schema}.{table_name}')
+            min_key, max_key, n_table_rows = cursor.fetchone()
+    conn.close()
+    if n_table_rows == 0:
+        return 0
+
+    # The keys are spread evenly: searchId is sequential and legHash is a hash
+    n_partitions = max(math.ceil(n_table_rows / partition_size), 1)
+    key_range = max_key - min_key + 1
+    bounds = [min_key + key_range * partition // n_partitions
+              for partition in range(n_partitions + 1)]
+
+    with StageMetrics("odbc.backfill_derived_columns", table=table_name,
+                      partitions=n_partitions, verbose=True) as stage_metrics:
+        n_rows_list = Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(
+            delayed(_backfill_partition)(table_name, start, end, schema)
+            for start, end in zip(bounds[:-1], bounds[1:])
+        )
+        stage_metrics.rows = sum(n_rows_list)
+    print(f"{stage_metrics.rows} rows of {table_name} updated")
+    return stage_metrics.rows
+
+
+@filter_warnings
+def _backfill_partition(table_name, start, end, schema, page_size=10_000):
+    """Backfill the rows of the keys in [start, end)."""
+    key, derived_columns = BACKFILL_TABLES[table_name]
+    source_columns = sorted({column for derived_column in derived_columns
+                             for column in DERIVED_COLUMNS[derived_column]})
+    null_condition = " OR ".join(f'"{column}" IS NULL' for column in derived_columns)
+    query = f"""
+        SELECT "{key}", {", ".join(f'"{column}"' for column in source_columns)}
+        FROM {schema}.{table_name}
+        WHERE "{key}" >= %(start)s AND "{key}" < %(end)s AND ({null_condition})
+    """
+    conn = load_conn()
+    try:
+        data = pd.read_sql(query, conn, params={"start": start, "end": end})
+        if len(data) == 0:
+            return 0
+        derived_data = get_derived_columns(data, derived_columns)
+        derived_data = derived_data.astype(object).where(derived_data.notna(), None)
+        rows = list(zip(data[key].tolist(),
+                        *[derived_data[column].tolist() for column in derived_columns]))
+
+        set_list = ", ".join(f'"{column}" = V."{column}"' for column in derived_columns)
+        values_columns = ", ".join(f'"{column}"' for column in [key] + derived_columns)
+        update_query = f"""
+            UPDATE {schema}.{table_name} T SET {set_list}
+            FROM (VALUES %s) AS V({values_columns})
+            WHERE T."{key}" = V."{key}"
+        """
+        template = "(%s, " + ", ".join(f"CAST(%s AS {DERIVED_COLUMNS_TYPES[column]})"
+                                       for column in derived_columns) + ")"
+        with conn:
+            with conn.cursor() as cursor:
+                execute_values(cursor, update_query, rows, template=template,
+                               page_size=page_size)
+    finally:
+        conn.close()
+    return len(rows)
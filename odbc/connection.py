@@ -1,18 +1,25 @@
 import json
+import os
+from functools import lru_cache
 
 import psycopg2
 from sqlalchemy import create_engine
 
 
-def load_conn(config_file="../settings/database_config.json", config_dict=None,
+DEFAULT_CONFIG_FILE = "../settings/database_config.json"
+
+
+def load_conn(config_file=None, config_dict=None,
               connection_type="psycopg2"):
     """Creates psycopg2 or engine connection to a PostgreSQL database.
 
     Parameters
     ----------
-        config_file: str (default="../settings/database_config.json")
+        config_file: str (default=None)
             The path to a JSON file containing the configuration
-            parameters.
+            parameters. If it is None, the path in the FLIGHT_DATABASE_CONFIG
+            environment variable is used, or "../settings/database_config.json"
+            when the variable is not set.
 
         config_dict: dict (default=None)
             A dictionary containing the configuration parameters.
@@ -27,11 +34,13 @@ def load_conn(config_file="../settings/database_config.json", config_dict=None,
     """
     assert connection_type in ["engine", "psycopg2"], "connection_type must be equal 'engine' or 'psycopg2' "
     
+    if config_file is None:
+        config_file = os.environ.get("FLIGHT_DATABASE_CONFIG", DEFAULT_CONFIG_FILE)
+
     if config_dict is not None:
         config = config_dict
     else:
-        with open(config_file, 'r') as f:
-            config = json.load(f)
+        config = read_config(config_file)
     
     if connection_type == "psycopg2":
         conn = psycopg2.connect(
@@ -46,3 +55,45 @@ def load_conn(config_file="../settings/database_config.json", config_dict=None,
         engine = create_engine(conn_str)
         conn = engine
     return conn
+
+
+@lru_cache(maxsize=None)
+def read_config(config_file):
+    """Read the database configuration once per process.
+
+    Long running processes, such as the pipeline daemon and its workers, do not
+    read the JSON again for every connection. Call read_config.cache_clear() to
+    read the changes of the file.
+    """
+    with open(config_file, 'r') as f:
+        return json.load(f)
+
+
+def get_engine(config_file=None):
+    """Get the engine of this process, it keeps a pool of open connections.
+
+    The engine is created on the first call and reused by the next ones, so the
+    inserts of a warm worker do not open a new connection each time. Call
+    engine.dispose() to close the pooled connections, e.g. after an error.
+
+    Parameters
+    ----------
+        config_file: str (default=None)
+            The path to a JSON file containing the configuration parameters,
+            see load_conn.
+    Return
+    ------
+        A SQLAlchemy engine.
+    """
+    if config_file is None:
+        config_file = os.environ.get("FLIGHT_DATABASE_CONFIG", DEFAULT_CONFIG_FILE)
+    return _get_engine(os.path.abspath(config_file), os.getpid())
+
+
+@lru_cache(maxsize=None)
+def _get_engine(config_file, pid):
+    # The pid is part of the key, a forked process must not share the pool of its parent
+    config = read_config(config_file)
+    conn_str = f"postgresql+psycopg2://{config['user']}:{config['password']}@{config['host']}:{config['port']}/{config['database']}"
+    return create_engine(conn_str, pool_size=2, max_overflow=2, pool_pre_ping=True,
+                         pool_recycle=3600)
@@ -1,12 +1,99 @@
+import csv
+import sys
+from contextlib import contextmanager
+from io import StringIO
+from time import sleep
+
 import pandas as pd
 import numpy as np
+import psycopg2
 from os import cpu_count
 from joblib import Parallel, delayed
+from sqlalchemy import exc
+from sqlalchemy.dialects.postgresql import insert
 
 import query_tools as qt
-from connection import load_conn
+from connection import get_engine, load_conn
 from filter_warnings import filter_warnings
 
+sys.path.append("../utils")
+from arrow_handoff import read_arrow_partition, remove_handoff_file, write_arrow_partitions
+from metrics import StageMetrics
+
+# Column added to the rows that could not be inserted, with the database error
+INSERT_ERROR_COLUMN = "insertErrorMessage"
+# SQLSTATE classes: connection exception, transaction rollback (deadlock and
+# serialization failure), insufficient resources, operator intervention and
+# lock not available
+TRANSIENT_ERROR_CLASSES = ("08", "40", "53", "57P", "55P03")
+# Null marker of the CSV of insert_copy, an empty field is an empty string
+COPY_NULL = "\\N"
+# SQLSTATE classes: data exception and integrity constraint violation
+DATA_ERROR_CLASSES = ("22", "23")
+# Key of the PostgreSQL advisory lock of the loads that take new searchIds, see load_lock
+LOAD_LOCK_KEY = 5_117_201
+# Indexes of each table, created by create_table_index after the loads, keep it equal
+# to setup/sql/create_index.sql. See get_index_command for the keys of each index.
+INDEXES_CONFIG = {
+    "search": [
+        {"unique":"UNIQUE", "index_name":"search_pkey", "column":"searchId"},
+        {"unique":"", "index_name":"operationalSearchTime_index", "column":"operationalSearchTime"},
+        {"unique":"", "index_name":"origin_destination_code_index", "column":["originCode", "destinationCode"]}
+    ],
+    "flight": [
+        {"unique":"UNIQUE", "index_name":"flight_pkey", "column":"searchId"},
+        {"unique":"", "index_name":"legId_flight_index", "column":"legId"}
+    ],
+    "fare": [
+        {"unique":"UNIQUE", "index_name":"fare_pkey", "column":"searchId"},
+        {"unique":"", "index_name":"legId_fare_index", "column":"legId"},
+        {"unique":"", "index_name":"totalFare_index", "column":"totalFare"},
+        {"unique":"", "index_name":"legHash_fare_index", "column":"legHash"}
+    ],
+    "leg": [
+        {"unique":"UNIQUE", "index_name":"leg_pkey", "column":"legHash"},
+        {"unique":"", "index_name":"legId_leg_index", "column":"legId"}
+    ]
+}
+# Optional indexes, see get_indexes_config:
+#   brin: the rows are loaded in time order (see DatabaseFormat sort_rows), so a BRIN
+#       index, a few pages, answers the time ranges instead of a btree as large as
+#       the column.
+#   covering: route and time range filters of search answered by an index-only scan
+#       that also returns searchId and flightDay, and the fares of a leg answered
+#       without reading the fare table.
+INDEX_OPTIONS = {
+    "brin": {
+        "search": [
+            {"unique":"", "index_name":"operationalSearchTime_brin_index",
+             "column":"operationalSearchTime", "method":"brin", "pages_per_range":32,
+             "replaces":"operationalSearchTime_index"},
+            {"unique":"", "index_name":"insertionTime_search_brin_index",
+             "column":"insertionTime", "method":"brin", "pages_per_range":32}
+        ],
+        "flight": [
+            {"unique":"", "index_name":"insertionTime_flight_brin_index",
+             "column":"insertionTime", "method":"brin", "pages_per_range":32}
+        ],
+        "fare": [
+            {"unique":"", "index_name":"insertionTime_fare_brin_index",
+             "column":"insertionTime", "method":"brin", "pages_per_range":32}
+        ]
+    },
+    "covering": {
+        "search": [
+            {"unique":"", "index_name":"route_operationalSearchTime_covering_index",
+             "column":["originCode", "destinationCode", "operationalSearchTime"],
+             "include":["searchId", "flightDay"],
+             "replaces":"origin_destination_code_index"}
+        ],
+        "fare": [
+            {"unique":"", "index_name":"legId_fare_covering_index", "column":"legId",
+             "include":["searchId", "totalFare"], "replaces":"legId_fare_index"}
+        ]
+    }
+}
+
 
 @filter_warnings
 def insert_database_parallel(dataframe, table_name, schema="flight",
@@ -14,7 +101,8 @@ def insert_database_parallel(dataframe, table_name, schema="flight",
                              method="multi", n_jobs=None,
                              n_dataframe_divisions=None, 
                              max_n_attempts=5, 
-                             temporarily_disable_table_indexes=True):
+                             temporarily_disable_table_indexes=True,
+                             handoff="arrow", index_options=None):
     """Insert dataframe on database.
     
     Parameters
@@ -47,6 +135,16 @@ def insert_database_parallel(dataframe, table_name, schema="flight",
         Maximum number of attempts to insert data into the database.
     temporarily_disable_table_indexes: bool (defaul=True)
         Se True drop table index and recreate it after isertion data.
+    handoff: str (default="arrow")
+        How the partitions reach the workers:
+            arrow: the dataframe is written once to an Arrow IPC file (in /dev/shm
+                when it exists), one record batch per partition, and each worker
+                memory maps only its batch and converts it to pandas. Nothing is
+                pickled.
+            None: each partition is pickled and copied to a worker.
+        If the dataframe can not be converted to Arrow, the partitions are pickled.
+    index_options: list[str] (default=None)
+        Options of the indexes created again after the insert, see get_indexes_config.
 
     Return
     ------
@@ -61,25 +159,39 @@ def insert_database_parallel(dataframe, table_name, schema="flight",
         n_dataframe_divisions = max(len(dataframe) // chunksize, 1)
     
     if temporarily_disable_table_indexes:
-        drop_index(table_name, schema=schema)
+        with StageMetrics("load.drop_index", table=table_name):
+            drop_index(table_name, schema=schema)
     
-    dataframe_not_inserted_list = Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(
-        [delayed(insert_database)(
-            dataframe=dataframe_part,
-            table_name=table_name,
-            schema=schema, 
-            if_exists=if_exists,
-            chunksize=chunksize,
-            method=method,
-            max_n_attempts=max_n_attempts
-         )
-         for dataframe_part in np.array_split(dataframe, n_dataframe_divisions)
-        ]
-    )
+    assert handoff in ("arrow", None), "handoff must be 'arrow' or None"
+    insert_parameters = {"table_name": table_name, "schema": schema, "if_exists": if_exists,
+                         "chunksize": chunksize, "method": method,
+                         "max_n_attempts": max_n_attempts}
+    handoff_path = None
+    if handoff == "arrow":
+        with StageMetrics("load.write_handoff", rows=len(dataframe), table=table_name):
+            handoff_path, n_partitions = write_arrow_partitions(dataframe,
+                                                                n_dataframe_divisions)
+    if handoff_path is not None:
+        delayed_list = [delayed(insert_database_partition)(handoff_path, partition,
+                                                           **insert_parameters)
+                        for partition in range(n_partitions)]
+    else:
+        delayed_list = [delayed(insert_database)(dataframe=dataframe_part, **insert_parameters)
+                        for dataframe_part in np.array_split(dataframe, n_dataframe_divisions)]
+
+    with StageMetrics("load.insert_database_parallel", rows=len(dataframe), table=table_name,
+                      n_jobs=n_jobs, n_dataframe_divisions=n_dataframe_divisions,
+                      handoff=handoff if handoff_path is not None else None):
+        try:
+            dataframe_not_inserted_list = Parallel(n_jobs=n_jobs, prefer="processes",
+                                                   verbose=1)(delayed_list)
+        finally:
+            remove_handoff_file(handoff_path)
     
     if temporarily_disable_table_indexes:
-        create_table_index(table_name, schema=schema)
-        reindex(index_name=f"{table_name}_pkey", schema=schema)
+        with StageMetrics("load.create_table_index", table=table_name):
+            create_table_index(table_name, schema=schema, index_options=index_options)
+            reindex(index_name=f"{table_name}_pkey", schema=schema)
         
     
     dataframe_not_inserted = pd.concat(dataframe_not_inserted_list)
@@ -89,8 +201,19 @@ def insert_database_parallel(dataframe, table_name, schema="flight",
 @filter_warnings
 def insert_database(dataframe, table_name, schema="flight",
                     if_exists="append", chunksize=20_000,
-                    method="multi", max_n_attempts=5):
+                    method="multi", max_n_attempts=5,
+                    retry_backoff_seconds=1):
     """Insert dataframe on database.
+
+    Errors are handled by type:
+        transient (connection lost, deadlock, serialization failure, server
+            shutdown...): the insert is retried up to max_n_attempts times with
+            exponential backoff and new connections.
+        data (invalid value, constraint violation...): the dataframe is divided in
+            two halves that are inserted again, recursively, so only the offending
+            rows are not inserted.
+        other (e.g. a column that does not exist): the dataframe is not inserted.
+    The rows not inserted are returned with the error in INSERT_ERROR_COLUMN.
     
     Parameters
     ----------
@@ -113,36 +236,181 @@ def insert_database(dataframe, table_name, schema="flight",
             multi: Pass multiple values in a single INSERT clause.
             callable with signature (pd_table, conn, keys, data_iter).
      max_n_attempts: int (default=5)
-        Maximum number of attempts to insert data into the database.
+        Maximum number of attempts to insert data after transient errors.
+    retry_backoff_seconds: float (default=1)
+        Wait before the second attempt, it doubles after each attempt.
     
     Return
     ------
     dataframe_not_inserted: pd.DataFrame
         Dataframe that could not be inserted into the database.
     """
-    counter = 1
-    while max_n_attempts >= counter:
+    with StageMetrics("load.insert_database", rows=len(dataframe),
+                      table=table_name) as stage_metrics:
+        insert_parameters = {"table_name": table_name, "schema": schema,
+                             "chunksize": chunksize, "method": method,
+                             "max_n_attempts": max_n_attempts,
+                             "retry_backoff_seconds": retry_backoff_seconds}
+        not_inserted_list = list()
+        n_inserts = _insert_bisecting(dataframe, if_exists, insert_parameters,
+                                      not_inserted_list)
+
+        if len(not_inserted_list) > 0:
+            dataframe_not_inserted = pd.concat(not_inserted_list)
+            for error_message, rows in (dataframe_not_inserted[INSERT_ERROR_COLUMN]
+                                        .value_counts().items()):
+                print(f"{rows} rows not inserted in {table_name}: {error_message}")
+        else:
+            dataframe_not_inserted = pd.DataFrame()
+        stage_metrics.labels["rows_not_inserted"] = len(dataframe_not_inserted)
+        stage_metrics.labels["inserts"] = n_inserts
+    return dataframe_not_inserted
+
+
+def _insert_bisecting(dataframe, if_exists, insert_parameters, not_inserted_list):
+    """Insert dataframe, divide it in halves after data errors. Return the number of inserts."""
+    error = _insert_with_retry(dataframe, if_exists, **insert_parameters)
+    if error is None:
+        return 1
+    if is_data_error(error) and len(dataframe) > 1:
+        middle = len(dataframe) // 2
+        # pandas rolls back the failed insert, but "replace" already recreated the table
+        n_inserts = _insert_bisecting(dataframe.iloc[:middle], if_exists, insert_parameters,
+                                      not_inserted_list)
+        n_inserts += _insert_bisecting(dataframe.iloc[middle:], "append", insert_parameters,
+                                       not_inserted_list)
+        return n_inserts + 1
+
+    error_message = get_error_message(error)
+    not_inserted_list.append(dataframe.assign(**{INSERT_ERROR_COLUMN: error_message}))
+    return 1
+
+
+def _insert_with_retry(dataframe, if_exists, table_name, schema, chunksize, method,
+                       max_n_attempts, retry_backoff_seconds):
+    """Insert dataframe, retrying transient errors. Return None or the last error.
+
+    Errors that are not raised by the database or the connection, e.g. a KeyError or
+    an AssertionError of the code, are raised.
+    """
+    for attempt in range(1, max_n_attempts + 1):
+        # The engine of the process is reused, warm workers keep their connections
+        engine = get_engine()
         try:
-            engine = load_conn(connection_type="engine")
-            dataframe.to_sql(name=table_name, con=engine, schema=schema, 
+            dataframe.to_sql(name=table_name, con=engine, schema=schema,
                              if_exists=if_exists, chunksize=chunksize,
                              method=method, index=False)
-            dataframe_not_inserted = pd.DataFrame()
-            break
-
+            return None
         except Exception as error:
-            log = f":" if counter == 0 else "mensage was omitted."
-            print(f"ATTEMPT NUMBER {counter}, error" + log)
-            if counter == 1:
-                print(error)
-            dataframe_not_inserted = dataframe
-        finally:
+            if not is_database_error(error):
+                raise
+            if not is_transient_error(error) or attempt == max_n_attempts:
+                return error
+            print(f"ATTEMPT NUMBER {attempt}, transient error: {get_error_message(error)}")
+            # The next attempt opens new connections
             engine.dispose()
-        
-        counter += 1
-    return dataframe_not_inserted
-        
-        
+            sleep(retry_backoff_seconds * 2 ** (attempt - 1))
+
+
+def is_transient_error(error):
+    """True if the insert may succeed if it is tried again later.
+
+    Errors with the SQLSTATE of connection errors, deadlocks, serialization failures,
+    lack of resources and server shutdowns are transient, and so are the lost
+    connections: OperationalError or InterfaceError without SQLSTATE, invalidated
+    connections and network errors (OSError). Any other error is not transient.
+    """
+    # insert_copy raises the psycopg2 errors without the SQLAlchemy wrapper
+    pgcode = get_error_code(error)
+    if pgcode is not None:
+        return pgcode.startswith(TRANSIENT_ERROR_CLASSES)
+    if isinstance(error, (exc.OperationalError, exc.InterfaceError, psycopg2.OperationalError,
+                          psycopg2.InterfaceError, exc.DisconnectionError, exc.TimeoutError)):
+        return True
+    if isinstance(error, exc.DBAPIError):
+        return error.connection_invalidated
+    return isinstance(error, OSError)
+
+
+def is_database_error(error):
+    """True if the error was raised by the database, its driver or the connection."""
+    return isinstance(error, (exc.SQLAlchemyError, psycopg2.Error, OSError))
+
+
+def is_data_error(error):
+    """True if some rows are invalid: bad values (SQLSTATE 22) or constraints (SQLSTATE 23)."""
+    if isinstance(error, (exc.DataError, exc.IntegrityError)):
+        return True
+    pgcode = get_error_code(error)
+    return pgcode is not None and pgcode.startswith(DATA_ERROR_CLASSES)
+
+
+def get_error_code(error):
+    """Get the PostgreSQL SQLSTATE of an error, None if it has not one."""
+    return getattr(getattr(error, "orig", error), "pgcode", None)
+
+
+def get_error_message(error):
+    """Get the message of the database error, without the SQL statement."""
+    return str(getattr(error, "orig", error)).strip()
+
+
+def insert_database_partition(handoff_path, partition, **insert_parameters):
+    """Read one partition written by arrow_handoff.write_arrow_partitions and insert it.
+
+    Parameters
+    ----------
+    handoff_path: str
+        Arrow IPC file with one record batch per partition.
+    partition: int
+        Index of the partition.
+    insert_parameters:
+        Parameters of insert_database.
+
+    Return
+    ------
+    dataframe_not_inserted: pd.DataFrame
+        Dataframe that could not be inserted into the database.
+    """
+    dataframe = read_arrow_partition(handoff_path, partition)
+    return insert_database(dataframe, **insert_parameters)
+
+
+def insert_on_conflict_do_nothing(pd_table, conn, keys, data_iter):
+    """pandas.DataFrame.to_sql method that skips rows that violate a unique constraint.
+
+    It is used for tables whose rows are identified by a content hash, such as the
+    leg table, where rows already stored by previous loads must not be inserted again.
+    """
+    data = [dict(zip(keys, row)) for row in data_iter]
+    statement = insert(pd_table.table).values(data).on_conflict_do_nothing()
+    result = conn.execute(statement)
+    return result.rowcount
+
+
+def insert_copy(pd_table, conn, keys, data_iter):
+    """pandas.DataFrame.to_sql method that loads the rows with COPY FROM STDIN.
+
+    COPY is much faster than INSERT for bulk appends, such as the hourly batches,
+    because the rows are streamed as one CSV and parsed by the server in one go.
+    The nulls are written as \\N, so the empty strings are stored as '' like the INSERT
+    methods do, instead of the NULL of the empty CSV fields.
+    """
+    buffer = StringIO()
+    csv.writer(buffer).writerows([COPY_NULL if value is None else value for value in row]
+                                 for row in data_iter)
+    buffer.seek(0)
+
+    columns = ", ".join(f'"{key}"' for key in keys)
+    table_name = (f'{pd_table.schema}."{pd_table.name}"' if pd_table.schema
+                  else f'"{pd_table.name}"')
+    dbapi_conn = conn.connection
+    with dbapi_conn.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN "
+                           f"(FORMAT csv, NULL '{COPY_NULL}')", buffer)
+        return cursor.rowcount
+
+
 @filter_warnings
 def truncate_cascade_table(table_name, schema="flight"):
     """Truncate table using cascade method.
@@ -226,6 +494,35 @@ def kill_database_processes(database_processes):
     return
 
     
+@contextmanager
+def load_lock(key=LOAD_LOCK_KEY):
+    """Hold a PostgreSQL advisory lock while the block runs.
+
+    The loads take the next searchIds from the maximum of the search table and
+    insert them later from other connections, so two loads that run at the same
+    time (e.g. the cron of run_database_format.py and the Arrow ingestion service)
+    would take the same searchIds. Each load holds this lock from reading the
+    maximum until its inserts end, the other ones wait for it.
+
+    The lock belongs to the session of its own connection, so it is released when
+    the block ends or when the process dies.
+
+    Parameters
+    ----------
+    key: int (default=LOAD_LOCK_KEY)
+        Key of the advisory lock.
+    """
+    conn = load_conn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (key,))
+        conn.commit()
+        yield
+    finally:
+        # Closing the session releases the lock
+        conn.close()
+
+
 def drop_index(table_name, schema="flight"):
     """Drop indexes on a specific table in a PostgreSQL database. 
 
@@ -275,9 +572,10 @@ def delete_rows_by_insertionTime(date, table_name, schema="flight"):
     schema: str (default="flight")
         The name of the schema where the table is located.
     """
+    # A range instead of DATE_TRUNC, so an index on insertionTime can be used
     query = f"""
     DELETE FROM {schema}.{table_name}
-    WHERE DATE_TRUNC('day', "insertionTime") = DATE '{date}'
+    WHERE "insertionTime" >= DATE '{date}' AND "insertionTime" < DATE '{date}' + 1
     """
     conn = load_conn()
     cursor = conn.cursor()
@@ -293,7 +591,7 @@ def delete_rows_by_insertionTime(date, table_name, schema="flight"):
     return
 
 
-def create_table_index(table_name, schema="flight"):
+def create_table_index(table_name, schema="flight", index_options=None):
     """Create indexes for a specified table.
 
     This function creates indexes for the specified table based on a pre-defined configuration.
@@ -304,37 +602,17 @@ def create_table_index(table_name, schema="flight"):
         The name of the table for which indexes will be created.
     schema: str (default="flight")
         The name of the schema where the table is located.   
+    index_options: list[str] (default=None)
+        Options of INDEX_OPTIONS applied to INDEXES_CONFIG, see get_indexes_config.
     """
-    indexes_config = {
-        "search": [
-            {"unique":"UNIQUE", "index_name":"search_pkey", "column":"searchId"},
-            {"unique":"", "index_name":"operationalSearchTime_index", "column":"operationalSearchTime"},
-            {"unique":"", "index_name":"origin_destination_code_index", "column":"""originCode", "destinationCode"""}
-        ],
-        "flight": [
-            {"unique":"UNIQUE", "index_name":"flight_pkey", "column":"searchId"},
-            {"unique":"", "index_name":"legId_flight_index", "column":"legId"}
-        ],
-        "fare": [
-            {"unique":"UNIQUE", "index_name":"fare_pkey", "column":"searchId"},
-            {"unique":"", "index_name":"legId_fare_index", "column":"legId"},
-            {"unique":"", "index_name":"totalFare_index", "column":"totalFare"}
-        ]
-    }
-    indexes_to_create = indexes_config.get(table_name, [])
+    indexes_to_create = get_indexes_config(index_options).get(table_name, [])
 
     conn = load_conn()
     cursor = conn.cursor()
 
     try:
         for index_to_create in indexes_to_create:
-            unique = index_to_create.get("unique", "")
-            index_name = index_to_create.get("index_name")
-            column = index_to_create.get("column")
-            command = f"""
-                CREATE {unique} INDEX IF NOT EXISTS "{index_name}"
-                ON {schema}.{table_name} USING btree ("{column}")
-            """
+            command = get_index_command(table_name, index_to_create, schema=schema)
             print(command, "...")
             cursor.execute(command)
         conn.commit()
@@ -348,3 +626,67 @@ def create_table_index(table_name, schema="flight"):
         cursor.close()
         conn.close()
     return
+
+
+def get_indexes_config(index_options=None):
+    """Get the indexes of each table, INDEXES_CONFIG with the options applied.
+
+    Parameters
+    ----------
+    index_options: list[str] (default=None)
+        Keys of INDEX_OPTIONS. The indexes of an option are added and replace the
+        indexes named in their "replaces" key.
+
+    Return
+    ------
+    indexes_config: dict[list[dict]]
+        Indexes of each table, see INDEXES_CONFIG.
+    """
+    index_options = [] if index_options is None else list(index_options)
+    unknown_options = [option for option in index_options if option not in INDEX_OPTIONS]
+    assert len(unknown_options) == 0, f"index_options {unknown_options} are not in {list(INDEX_OPTIONS)}"
+
+    indexes_config = {table_name: list(indexes) for table_name, indexes in INDEXES_CONFIG.items()}
+    for option in index_options:
+        for table_name, indexes in INDEX_OPTIONS[option].items():
+            replaced = {index["replaces"] for index in indexes if "replaces" in index}
+            indexes_config[table_name] = [index for index in indexes_config.get(table_name, [])
+                                          if index["index_name"] not in replaced] + indexes
+    return indexes_config
+
+
+def get_index_command(table_name, index_config, schema="flight"):
+    """Get the CREATE INDEX command of an entry of INDEXES_CONFIG.
+
+    Parameters
+    ----------
+    table_name: str
+        The name of the table.
+    index_config: dict
+        Keys:
+            index_name: name of the index.
+            column: column name, or list of column names.
+            unique (default=""): "UNIQUE" or "".
+            method (default="btree"): index method, e.g. "btree" or "brin".
+            include (default=None): columns stored in a btree index to answer the
+                queries with index-only scans (covering index).
+            pages_per_range (default=None): table pages summarized by each BRIN entry.
+    schema: str (default="flight")
+        The name of the schema where the table is located.
+
+    Return
+    ------
+    command: str
+    """
+    columns = index_config["column"]
+    columns = [columns] if isinstance(columns, str) else columns
+    columns_sql = ", ".join(f'"{column}"' for column in columns)
+    command = (f"CREATE {index_config.get('unique', '')} INDEX IF NOT EXISTS "
+               f"\"{index_config['index_name']}\" ON {schema}.{table_name} "
+               f"USING {index_config.get('method', 'btree')} ({columns_sql})")
+    if index_config.get("include") is not None:
+        include_sql = ", ".join(f'"{column}"' for column in index_config["include"])
+        command += f" INCLUDE ({include_sql})"
+    if index_config.get("pages_per_range") is not None:
+        command += f" WITH (pages_per_range = {int(index_config['pages_per_range'])})"
+    return command
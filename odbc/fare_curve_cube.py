@@ -0,0 +1,447 @@
+import sys
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from psycopg2.extras import execute_values
+
+import query_tools as qt
+from connection import load_conn
+from filter_warnings import filter_warnings
+
+sys.path.append("../data_tools")
+import derived_columns as dc
+
+sys.path.append("../utils")
+from metrics import StageMetrics
+
+# Table of the cube, see setup/sql/flight_database_config.sql
+CUBE_TABLE = "fare_curve"
+CUBE_KEYS = ["originCode", "destinationCode", "daysToDeparture", "airlineCode", "timeOfDay"]
+CUBE_VALUES = ["offers", "minFare", "maxFare", "sumFare", "fareHistogram"]
+# Edges of the fare bins, log spaced: each bin is about 6% wide, so the quantiles
+# interpolated in a bin are within 3% of the exact ones. The histogram has one more
+# bin below the first edge and one above the last.
+FARE_BIN_EDGES = np.geomspace(10, 20_000, 129)
+N_FARE_BINS = len(FARE_BIN_EDGES) + 1
+# Columns read by aggregate_fare_curve, in the database format
+SOURCE_COLUMNS = ["originCode", "destinationCode", "flightDay", "operationalSearchTime",
+                  "airlineCode", "departureTimeRaw", "totalFare"]
+
+
+def aggregate_fare_curve(data, separator="||"):
+    """Aggregate fares into rows of the cube.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Fares with the SOURCE_COLUMNS, e.g. search, fare and flight joined by searchId.
+    separator: str (default="||")
+        Separator of the segment columns.
+
+    Return
+    ------
+    cube: pd.DataFrame
+        One row per CUBE_KEYS with the CUBE_VALUES, fareHistogram holds arrays of
+        N_FARE_BINS counts. The rows with a null key or fare are not counted.
+    """
+    cube_data = pd.DataFrame({
+        "originCode": data["originCode"].astype(str).str.strip(),
+        "destinationCode": data["destinationCode"].astype(str).str.strip(),
+        "daysToDeparture": dc.get_days_to_departure(data["flightDay"],
+                                                    data["operationalSearchTime"]),
+        "airlineCode": dc.get_first_segment(data["airlineCode"], separator=separator),
+        "timeOfDay": dc.get_time_of_day(dc.get_departure_hour(data["departureTimeRaw"])),
+        "totalFare": pd.to_numeric(data["totalFare"], errors="coerce"),
+    }).dropna()
+    if len(cube_data) == 0:
+        return _empty_cube()
+
+    grouped = cube_data.groupby(CUBE_KEYS, sort=False)
+    cube = grouped["totalFare"].agg(["count", "min", "max", "sum"]).reset_index()
+    cube.columns = CUBE_KEYS + ["offers", "minFare", "maxFare", "sumFare"]
+
+    histograms = np.zeros((len(cube), N_FARE_BINS), dtype=np.int64)
+    fare_bins = np.searchsorted(FARE_BIN_EDGES, cube_data["totalFare"].to_numpy(), side="right")
+    np.add.at(histograms, (grouped.ngroup().to_numpy(), fare_bins), 1)
+    cube["fareHistogram"] = list(histograms)
+    cube["daysToDeparture"] = cube["daysToDeparture"].astype(int)
+    return cube
+
+
+def merge_fare_curves(cube, keys=None):
+    """Merge the rows of a cube with the same keys, e.g. the cubes of several batches.
+
+    Parameters
+    ----------
+    cube: pd.DataFrame
+        Rows with the CUBE_VALUES, the keys can be repeated.
+    keys: list[str] (default=None)
+        Columns of the merged rows, by default CUBE_KEYS. Fewer keys roll up the
+        cube, e.g. ["daysToDeparture"] merges the airlines and times of day.
+
+    Return
+    ------
+    cube: pd.DataFrame
+        One row per keys.
+    """
+    keys = CUBE_KEYS if keys is None else keys
+    if len(cube) == 0:
+        return _empty_cube()[keys + CUBE_VALUES]
+
+    grouped = cube.groupby(keys, sort=False)
+    merged = grouped.agg(offers=("offers", "sum"), minFare=("minFare", "min"),
+                         maxFare=("maxFare", "max"), sumFare=("sumFare", "sum")).reset_index()
+    histograms = np.zeros((len(merged), N_FARE_BINS), dtype=np.int64)
+    np.add.at(histograms, grouped.ngroup().to_numpy(),
+              np.stack(cube["fareHistogram"].to_numpy()).astype(np.int64))
+    merged["fareHistogram"] = list(histograms)
+    return merged
+
+
+@filter_warnings
+def upsert_fare_curve(cube, schema="flight", page_size=1_000):
+    """Add the rows of a cube to the cube table.
+
+    The new keys are inserted, the existing ones are updated: offers, sumFare and
+    fareHistogram are added and minFare and maxFare are kept if they are lower and
+    higher. So loading the cube of each batch keeps the table equal to the cube of
+    all fares.
+
+    The table is approximate after some changes of the fares: minFare and maxFare
+    are only bounds after subtract_fare_curve, and the fares of a batch whose load
+    failed after a partial insert may be counted or not. rebuild_fare_curve (see
+    run_rebuild_fare_curve.py) makes it exact again.
+
+    Parameters
+    ----------
+    cube: pd.DataFrame
+        Output of aggregate_fare_curve or merge_fare_curves, with unique keys.
+    schema: str (default="flight")
+        The name of the database schema.
+    page_size: int (default=1_000)
+        Rows sent per INSERT.
+    """
+    if len(cube) == 0:
+        return
+    columns = CUBE_KEYS + CUBE_VALUES
+    query = f"""
+        INSERT INTO {schema}.{CUBE_TABLE} AS T ({", ".join(f'"{column}"' for column in columns)})
+        VALUES %s
+        ON CONFLICT ({", ".join(f'"{column}"' for column in CUBE_KEYS)}) DO UPDATE SET
+            "offers" = T."offers" + EXCLUDED."offers",
+            "minFare" = LEAST(T."minFare", EXCLUDED."minFare"),
+            "maxFare" = GREATEST(T."maxFare", EXCLUDED."maxFare"),
+            "sumFare" = T."sumFare" + EXCLUDED."sumFare",
+            "fareHistogram" = ARRAY(
+                SELECT old_count + new_count
+                FROM unnest(T."fareHistogram", EXCLUDED."fareHistogram")
+                    WITH ORDINALITY AS H(old_count, new_count, position)
+                ORDER BY position
+            ),
+            "updateTime" = CURRENT_TIMESTAMP
+    """
+    rows = [(origin_code, destination_code, int(days_to_departure), airline_code,
+             time_of_day, int(offers), float(min_fare), float(max_fare), float(sum_fare),
+             histogram.tolist())
+            for (origin_code, destination_code, days_to_departure, airline_code, time_of_day,
+                 offers, min_fare, max_fare, sum_fare, histogram)
+            in cube[columns].itertuples(index=False)]
+    conn = load_conn()
+    try:
+        with conn:
+            with conn.cursor() as cursor:
+                execute_values(cursor, query, rows, page_size=page_size)
+    finally:
+        conn.close()
+
+
+@filter_warnings
+def subtract_fare_curve(cube, schema="flight", page_size=1_000):
+    """Remove the rows of a cube from the cube table, e.g. the cube of deleted fares.
+
+    offers, sumFare and fareHistogram are subtracted and the keys left without offers
+    are deleted. minFare and maxFare can not be subtracted, they are kept, so they
+    become bounds of the fares left until the cube is rebuilt (see rebuild_fare_curve).
+
+    Parameters
+    ----------
+    cube: pd.DataFrame
+        Output of aggregate_fare_curve or merge_fare_curves, with unique keys.
+    schema: str (default="flight")
+        The name of the database schema.
+    page_size: int (default=1_000)
+        Rows sent per UPDATE.
+    """
+    if len(cube) == 0:
+        return
+    columns = CUBE_KEYS + ["offers", "sumFare", "fareHistogram"]
+    query = f"""
+        UPDATE {schema}.{CUBE_TABLE} AS T SET
+            "offers" = GREATEST(T."offers" - V."offers", 0),
+            "sumFare" = T."sumFare" - V."sumFare",
+            "fareHistogram" = ARRAY(
+                SELECT GREATEST(old_count - removed_count, 0)
+                FROM unnest(T."fareHistogram", V."fareHistogram")
+                    WITH ORDINALITY AS H(old_count, removed_count, position)
+                ORDER BY position
+            ),
+            "updateTime" = CURRENT_TIMESTAMP
+        FROM (VALUES %s) AS V({", ".join(f'"{column}"' for column in columns)})
+        WHERE {" AND ".join(f'T."{key}" = V."{key}"' for key in CUBE_KEYS)}
+    """
+    template = "(%s, %s, %s::smallint, %s, %s, %s::bigint, %s::double precision, %s::bigint[])"
+    rows = [(origin_code, destination_code, int(days_to_departure), airline_code,
+             time_of_day, int(offers), float(sum_fare), histogram.tolist())
+            for (origin_code, destination_code, days_to_departure, airline_code, time_of_day,
+                 offers, sum_fare, histogram)
+            in cube[columns].itertuples(index=False)]
+    conn = load_conn()
+    try:
+        with conn:
+            with conn.cursor() as cursor:
+                execute_values(cursor, query, rows, template=template, page_size=page_size)
+                cursor.execute(f'DELETE FROM {schema}.{CUBE_TABLE} WHERE "offers" <= 0')
+    finally:
+        conn.close()
+
+
+def remove_fares_by_insertion_date(date, deduplicate_legs=False, schema="flight"):
+    """Remove from the cube table the fares inserted on a date, before they are deleted.
+
+    Run it before database_tools.delete_rows_by_insertionTime deletes the fares and
+    their flight or leg rows, the fares are read joined with them.
+
+    Parameters
+    ----------
+    date: str
+        The date of the insertionTime of the fares (format: 'YYYY-MM-DD').
+    deduplicate_legs: bool (default=False)
+        If True the leg data comes from the leg table, see DatabaseFormat.
+    schema: str (default="flight")
+        The name of the database schema.
+
+    Return
+    ------
+    n_offers: int
+        Number of fares removed from the cube.
+    """
+    cube = aggregate_fare_curve(_read_fares(
+        'F."insertionTime" >= DATE %(date)s AND F."insertionTime" < DATE %(date)s + 1',
+        {"date": date}, deduplicate_legs, schema
+    ))
+    subtract_fare_curve(cube, schema=schema)
+    return int(cube["offers"].sum())
+
+
+def add_fares_of_searches(search_ids, deduplicate_legs=False, schema="flight"):
+    """Add to the cube table all fares of some searches, e.g. the searches whose fares
+    were not inserted by DatabaseFormat and were inserted later.
+
+    DatabaseFormat does not count the searches with a fare not inserted, so the fares
+    of a search are added once, when none of them is left to insert.
+
+    Parameters
+    ----------
+    search_ids: list[int]
+        searchId of the searches.
+    deduplicate_legs: bool (default=False)
+        If True the leg data comes from the leg table, see DatabaseFormat.
+    schema: str (default="flight")
+        The name of the database schema.
+
+    Return
+    ------
+    n_offers: int
+        Number of fares added to the cube.
+    """
+    search_ids = [int(search_id) for search_id in search_ids]
+    if len(search_ids) == 0:
+        return 0
+    cube = aggregate_fare_curve(_read_fares(
+        'S."searchId" = ANY(%(search_ids)s) AND F."searchId" = ANY(%(search_ids)s)',
+        {"search_ids": search_ids}, deduplicate_legs, schema
+    ))
+    upsert_fare_curve(cube, schema=schema)
+    return int(cube["offers"].sum())
+
+
+@filter_warnings
+def get_fare_curve(origin_code, destination_code, airline_codes=None, times_of_day=None,
+                   max_days_to_departure=None, quantiles=(0.25, 0.5, 0.75), schema="flight"):
+    """Get the fare by days to departure of a route from the cube.
+
+    Only the cube rows of the route are read, through the primary key, and the
+    airlines and times of day are merged in memory, so the curve is returned in
+    milliseconds whatever the number of fares.
+
+    Parameters
+    ----------
+    origin_code, destination_code: str
+        Airport codes of the route.
+    airline_codes: list[str] (default=None)
+        Airlines of the first segment, by default all of them.
+    times_of_day: list[str] (default=None)
+        Departure times of day, see derived_columns.TIME_OF_DAY_LABELS, by default
+        all of them.
+    max_days_to_departure: int (default=None)
+        Last day of the curve, by default all days.
+    quantiles: list[float] (default=(0.25, 0.5, 0.75))
+        Quantiles of the fare, estimated from the histograms.
+    schema: str (default="flight")
+        The name of the database schema.
+
+    Return
+    ------
+    fare_curve: pd.DataFrame
+        One row per daysToDeparture with offers, minFare, maxFare, meanFare and a
+        column per quantile, e.g. fareQuantile50 for 0.5.
+    """
+    conditions = ['"originCode" = %(origin_code)s', '"destinationCode" = %(destination_code)s']
+    params = {"origin_code": origin_code, "destination_code": destination_code}
+    if airline_codes is not None:
+        conditions.append('"airlineCode" = ANY(%(airline_codes)s)')
+        params["airline_codes"] = list(airline_codes)
+    if times_of_day is not None:
+        conditions.append('"timeOfDay" = ANY(%(times_of_day)s)')
+        params["times_of_day"] = list(times_of_day)
+    if max_days_to_departure is not None:
+        conditions.append('"daysToDeparture" <= %(max_days_to_departure)s')
+        params["max_days_to_departure"] = int(max_days_to_departure)
+    query = f"""
+        SELECT "daysToDeparture", {", ".join(f'"{column}"' for column in CUBE_VALUES)}
+        FROM {schema}.{CUBE_TABLE}
+        WHERE {" AND ".join(conditions)}
+    """
+    with load_conn() as conn:
+        cube = pd.read_sql(query, conn, params=params)
+    conn.close()
+    cube[["minFare", "maxFare"]] = cube[["minFare", "maxFare"]].astype(float)
+
+    fare_curve = merge_fare_curves(cube, keys=["daysToDeparture"])
+    fare_curve = fare_curve.sort_values("daysToDeparture", ignore_index=True)
+    fare_curve["meanFare"] = fare_curve["sumFare"] / fare_curve["offers"]
+    for quantile in quantiles:
+        fare_curve[f"fareQuantile{quantile * 100:g}"] = [
+            get_histogram_quantile(histogram, min_fare, max_fare, quantile)
+            for histogram, min_fare, max_fare
+            in zip(fare_curve["fareHistogram"], fare_curve["minFare"], fare_curve["maxFare"])
+        ]
+    return fare_curve.drop(columns=["sumFare", "fareHistogram"])
+
+
+def get_histogram_quantile(histogram, min_fare, max_fare, quantile):
+    """Estimate a quantile of the fares of a histogram of FARE_BIN_EDGES.
+
+    The quantile is interpolated inside its bin, the bins are limited by the minimum
+    and the maximum fare.
+    """
+    histogram = np.asarray(histogram, dtype=float)
+    total = histogram.sum()
+    if total == 0:
+        return np.nan
+    if quantile <= 0:
+        return min_fare
+    if quantile >= 1:
+        return max_fare
+    cumulative = np.cumsum(histogram)
+    target = quantile * total
+    fare_bin = min(int(np.searchsorted(cumulative, target, side="left")), N_FARE_BINS - 1)
+    lower = FARE_BIN_EDGES[fare_bin - 1] if fare_bin > 0 else min_fare
+    upper = FARE_BIN_EDGES[fare_bin] if fare_bin < len(FARE_BIN_EDGES) else max_fare
+    lower, upper = max(lower, min_fare), min(upper, max_fare)
+    fraction = (target - (cumulative[fare_bin] - histogram[fare_bin])) / histogram[fare_bin]
+    return lower + min(max(fraction, 0.0), 1.0) * (upper - lower)
+
+
+def rebuild_fare_curve(partition_size=1_000_000, deduplicate_legs=False, n_jobs=4,
+                       schema="flight"):
+    """Build the cube table again from all fares of the database.
+
+    The cube table is emptied, and the fares are read and aggregated by searchId
+    partitions in parallel. The cubes of n_jobs partitions at a time are merged and
+    added to the table, so the memory does not depend on the size of the history.
+    Run it with the loads stopped, the fares inserted during the rebuild could be
+    counted twice. It is also the way to correct the drift of the table, see
+    upsert_fare_curve.
+
+    Parameters
+    ----------
+    partition_size: int (default=1_000_000)
+        Number of searchIds read by each worker at a time.
+    deduplicate_legs: bool (default=False)
+        If True the leg data comes from the leg table, see DatabaseFormat.
+    n_jobs: int (default=4)
+        Number of partitions read at the same time.
+    schema: str (default="flight")
+        The name of the database schema.
+
+    Return
+    ------
+    n_offers: int
+        Number of fares in the cube.
+    """
+    search_id_range = qt.run_query(
+        f'SELECT min("searchId") AS min_id, max("searchId") AS max_id FROM {schema}.search'
+    )
+    min_search_id, max_search_id = search_id_range.loc[0, ["min_id", "max_id"]]
+    with load_conn() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"TRUNCATE TABLE {schema}.{CUBE_TABLE}")
+    conn.close()
+    if pd.isna(min_search_id):
+        return 0
+
+    starts = list(range(int(min_search_id), int(max_search_id) + 1, partition_size))
+    n_offers = 0
+    with StageMetrics("odbc.rebuild_fare_curve", partitions=len(starts),
+                      verbose=True) as stage_metrics:
+        for index in range(0, len(starts), n_jobs):
+            cubes = Parallel(n_jobs=n_jobs, prefer="processes")(
+                delayed(_aggregate_partition)(start, start + partition_size,
+                                              deduplicate_legs, schema)
+                for start in starts[index:index + n_jobs]
+            )
+            cube = merge_fare_curves(pd.concat(cubes, ignore_index=True))
+            upsert_fare_curve(cube, schema=schema)
+            n_offers += int(cube["offers"].sum())
+            print(f"{min(index + n_jobs, len(starts))} of {len(starts)} partitions, "
+                  f"{n_offers} fares")
+        stage_metrics.rows = n_offers
+    return n_offers
+
+
+def _aggregate_partition(start, end, deduplicate_legs, schema):
+    """Read the fares of the searchIds in [start, end) and aggregate them."""
+    condition = ('S."searchId" >= %(start)s AND S."searchId" < %(end)s '
+                 'AND F."searchId" >= %(start)s AND F."searchId" < %(end)s')
+    if not deduplicate_legs:
+        condition += ' AND L."searchId" >= %(start)s AND L."searchId" < %(end)s'
+    return aggregate_fare_curve(_read_fares(condition, {"start": start, "end": end},
+                                            deduplicate_legs, schema))
+
+
+@filter_warnings
+def _read_fares(condition, params, deduplicate_legs, schema):
+    """Read the SOURCE_COLUMNS of the fares that match condition, on the search S, the
+    fare F and the flight or leg L tables."""
+    if deduplicate_legs:
+        leg_join = f'JOIN {schema}.leg L ON L."legHash" = F."legHash"'
+    else:
+        leg_join = f'JOIN {schema}.flight L ON L."searchId" = F."searchId"'
+    query = f"""
+        SELECT S."originCode", S."destinationCode", S."flightDay", S."operationalSearchTime",
+            L."airlineCode", L."departureTimeRaw", F."totalFare"
+        FROM {schema}.search S
+            JOIN {schema}.fare F ON F."searchId" = S."searchId"
+            {leg_join}
+        WHERE {condition}
+    """
+    with load_conn() as conn:
+        data = pd.read_sql(query, conn, params=params)
+    conn.close()
+    return data
+
+
+def _empty_cube():
+    return pd.DataFrame(columns=CUBE_KEYS + CUBE_VALUES)
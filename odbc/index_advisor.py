@@ -0,0 +1,506 @@
+import json
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+from connection import load_conn
+from database_tools import get_indexes_config
+from filter_warnings import filter_warnings
+
+sys.path.append("../utils")
+from metrics import read_metrics
+
+# Plan nodes that read the whole table
+SEQ_SCAN_NODES = ("Seq Scan", "Parallel Seq Scan")
+# Operators of the plan filters that a btree index can answer: the equality columns
+# lead the suggested index and one range column ends it
+EQUALITY_OPERATORS = ("=",)
+RANGE_OPERATORS = (">=", "<=", ">", "<")
+# A column, e.g. "originCode" or ("legId")::text (the casts of varchar to text do not
+# change the order, the index of the column answers them), and its operator
+FILTER_CONDITION_PATTERN = (r'"?([A-Za-z_][A-Za-z0-9_]*)"?(?:\)::(?:text|bpchar))?'
+                            r'\s*(>=|<=|<>|=|>|<)\s')
+# Bytes of each btree entry besides the columns: tuple header and line pointer
+INDEX_ENTRY_OVERHEAD_BYTES = 12
+BTREE_FILLFACTOR = 0.9
+
+
+def advise_indexes(n_queries=20, sample_queries=None, schema="flight",
+                   min_table_rows=100_000, max_selectivity=0.05, statement_timeout_ms=60_000,
+                   metrics_path=None):
+    """Analyze the workload of the database and advise on its indexes.
+
+    The statements that took the most time are read from pg_stat_statements and the
+    top ones are sampled with EXPLAIN (ANALYZE, BUFFERS). Queries with parameters
+    ($1, ...) can not run, they are planned with EXPLAIN (GENERIC_PLAN) on PostgreSQL
+    16 or newer and skipped before. Only SELECT queries are sampled, each one in a
+    transaction that is rolled back.
+
+    The sequential scans of the plans that keep few of the rows they read are the
+    missing indexes: their filter columns, the equalities first and one range last,
+    give a btree index unless an existing index already starts with them.
+
+    The loader drops the secondary indexes and creates them again after each insert
+    (see database_tools.insert_database_parallel), so every index is written whole
+    by every load. Its write amplification is the bytes of the index written per byte
+    of table inserted by a load, and its load time is the time of
+    load.create_table_index in the metrics file shared by the indexes of the table by
+    size.
+
+    Parameters
+    ----------
+    n_queries: int (default=20)
+        Number of statements of pg_stat_statements sampled with EXPLAIN.
+    sample_queries: dict[str] (default=None)
+        Name and SQL of other queries to sample, e.g. the queries of the notebooks.
+    schema: str (default="flight")
+        The name of the database schema.
+    min_table_rows: int (default=100_000)
+        Smaller tables are not reported as sequential scan hot spots and do not get
+        missing indexes, a sequential scan is cheap on them.
+    max_selectivity: float (default=0.05)
+        A sequential scan that returns at most this share of the rows it reads can use
+        an index.
+    statement_timeout_ms: int (default=60_000)
+        Timeout of each sampled query.
+    metrics_path: str (default=None)
+        Metrics file of the loader, see metrics.get_metrics_path. If it can not be
+        read the load time of the indexes is not estimated.
+
+    Return
+    ------
+    advice: dict
+        statements: pd.DataFrame, top statements of pg_stat_statements.
+        plans: pd.DataFrame, sequential scans of the sampled plans.
+        unused_indexes: pd.DataFrame, secondary indexes never scanned.
+        seq_scan_hot_spots: pd.DataFrame, tables read by sequential scans.
+        missing_indexes: pd.DataFrame, suggested indexes and their estimated cost.
+        suggested_indexes_config: dict[list[dict]], the missing indexes in the
+            format of database_tools.INDEXES_CONFIG.
+        write_amplification: pd.DataFrame, load cost of each existing index.
+    """
+    table_stats = get_table_stats(schema)
+    index_stats = get_index_stats(schema)
+    statements = get_statement_stats(n_queries, schema=schema)
+
+    queries = dict()
+    for _, statement in statements.iterrows():
+        queries[f"queryid_{statement['queryid']}"] = statement["query"]
+    queries.update(sample_queries or {})
+    plans = pd.DataFrame([seq_scan
+                          for query_name, query in queries.items()
+                          for seq_scan in sample_seq_scans(query_name, query, schema=schema,
+                                                           statement_timeout_ms=statement_timeout_ms)],
+                         columns=["query_name", "table", "filter", "rows_read",
+                                  "rows_returned", "selectivity", "time_ms", "analyzed"])
+
+    missing_indexes = get_missing_indexes(plans, table_stats, index_stats, schema=schema,
+                                          min_table_rows=min_table_rows,
+                                          max_selectivity=max_selectivity)
+    suggested_indexes_config = dict()
+    for _, missing_index in missing_indexes.iterrows():
+        suggested_indexes_config.setdefault(missing_index["table"], []).append(
+            missing_index["index_config"])
+
+    return {
+        "statements": statements,
+        "plans": plans,
+        "unused_indexes": get_unused_indexes(index_stats),
+        "seq_scan_hot_spots": get_seq_scan_hot_spots(table_stats, min_table_rows=min_table_rows),
+        "missing_indexes": missing_indexes,
+        "suggested_indexes_config": suggested_indexes_config,
+        "write_amplification": get_write_amplification(index_stats, table_stats,
+                                                       metrics_path=metrics_path),
+    }
+
+
+@filter_warnings
+def get_statement_stats(n_queries=20, schema="flight"):
+    """Get the statements on the schema that took the most time, from pg_stat_statements.
+
+    Return
+    ------
+    statements: pd.DataFrame
+        queryid, query, calls, total_ms, mean_ms, rows, shared_blks_hit and
+        shared_blks_read. Empty if pg_stat_statements is not installed, it needs
+        shared_preload_libraries = 'pg_stat_statements' and CREATE EXTENSION.
+    """
+    columns = ["queryid", "query", "calls", "total_ms", "mean_ms", "rows",
+               "shared_blks_hit", "shared_blks_read"]
+    conn = load_conn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements'")
+            is_installed = cursor.fetchone() is not None
+        if not is_installed:
+            print("pg_stat_statements is not installed, the statements are not analyzed")
+            return pd.DataFrame(columns=columns)
+
+        # The time columns were renamed in PostgreSQL 13
+        is_new_version = conn.server_version >= 130000
+        total_column = "total_exec_time" if is_new_version else "total_time"
+        mean_column = "mean_exec_time" if is_new_version else "mean_time"
+        query = f"""
+            SELECT queryid, query, calls, {total_column} AS total_ms, {mean_column} AS mean_ms,
+                rows, shared_blks_hit, shared_blks_read
+            FROM pg_stat_statements
+            WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+                AND query ILIKE %(schema_pattern)s
+                AND query NOT ILIKE '%%pg_stat_statements%%'
+            ORDER BY {total_column} DESC
+            LIMIT %(n_queries)s
+        """
+        statements = pd.read_sql(query, conn, params={"schema_pattern": f"%{schema}.%",
+                                                      "n_queries": n_queries})
+    except Exception as e:
+        print(f"pg_stat_statements can not be read: {str(e)}")
+        statements = pd.DataFrame(columns=columns)
+    finally:
+        conn.close()
+    return statements
+
+
+@filter_warnings
+def get_table_stats(schema="flight"):
+    """Get the scans, inserts and sizes of the tables of the schema.
+
+    Return
+    ------
+    table_stats: pd.DataFrame
+        One row per table: seq_scan, seq_tup_read, idx_scan, n_live_tup, n_tup_ins,
+        heap_bytes and the columns of the table.
+    """
+    query = """
+        SELECT T.relname AS table, T.seq_scan, T.seq_tup_read,
+            COALESCE(T.idx_scan, 0) AS idx_scan, T.n_live_tup, T.n_tup_ins,
+            pg_relation_size(T.relid) AS heap_bytes,
+            ARRAY(SELECT attname FROM pg_attribute
+                  WHERE attrelid = T.relid AND attnum > 0 AND NOT attisdropped
+                  ORDER BY attnum) AS columns
+        FROM pg_stat_user_tables T
+        WHERE T.schemaname = %(schema)s
+    """
+    with load_conn() as conn:
+        table_stats = pd.read_sql(query, conn, params={"schema": schema})
+    conn.close()
+    return table_stats
+
+
+@filter_warnings
+def get_index_stats(schema="flight"):
+    """Get the scans, sizes and columns of the indexes of the schema.
+
+    Return
+    ------
+    index_stats: pd.DataFrame
+        One row per index: table, index_name, idx_scan, idx_tup_read, index_bytes,
+        is_unique, columns (the key columns in order) and definition.
+    """
+    query = """
+        SELECT S.relname AS table, S.indexrelname AS index_name, S.idx_scan,
+            S.idx_tup_read, pg_relation_size(S.indexrelid) AS index_bytes,
+            I.indisunique AS is_unique,
+            ARRAY(SELECT A.attname
+                  FROM unnest(I.indkey) WITH ORDINALITY AS K(attnum, position)
+                      JOIN pg_attribute A ON A.attrelid = I.indrelid AND A.attnum = K.attnum
+                  WHERE K.position <= I.indnkeyatts
+                  ORDER BY K.position) AS columns,
+            pg_get_indexdef(S.indexrelid) AS definition
+        FROM pg_stat_user_indexes S
+            JOIN pg_index I ON I.indexrelid = S.indexrelid
+        WHERE S.schemaname = %(schema)s
+    """
+    with load_conn() as conn:
+        index_stats = pd.read_sql(query, conn, params={"schema": schema})
+    conn.close()
+    return index_stats
+
+
+def sample_seq_scans(query_name, query, schema="flight", statement_timeout_ms=60_000):
+    """Run EXPLAIN on a query and get the sequential scans of its plan.
+
+    Return
+    ------
+    seq_scans: list[dict]
+        For each sequential scan of a table of the schema: the query name, the table,
+        the filter, the rows read and returned, the selectivity (returned / read),
+        the time in ms (None without ANALYZE) and whether the plan was analyzed.
+    """
+    if not re.match(r"^\s*(SELECT|WITH)\b", query, flags=re.IGNORECASE) or re.search(
+            r"\b(INSERT|UPDATE|DELETE)\b", query, flags=re.IGNORECASE):
+        return []
+
+    conn = load_conn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SET LOCAL statement_timeout = {int(statement_timeout_ms)}")
+            has_parameters = re.search(r"\$\d+", query) is not None
+            if not has_parameters:
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}")
+            elif conn.server_version >= 160000:
+                cursor.execute(f"EXPLAIN (GENERIC_PLAN, FORMAT JSON) {query}")
+            else:
+                return []
+            plan = cursor.fetchone()[0]
+    except Exception as e:
+        print(f"EXPLAIN of {query_name} failed: {str(e)}")
+        return []
+    finally:
+        conn.rollback()
+        conn.close()
+
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    seq_scans = list()
+    for node in _iter_plan_nodes(plan[0]["Plan"]):
+        if node["Node Type"] not in SEQ_SCAN_NODES or node.get("Schema", schema) != schema:
+            continue
+        analyzed = "Actual Rows" in node
+        if analyzed:
+            loops = node.get("Actual Loops", 1)
+            rows_returned = node["Actual Rows"] * loops
+            rows_read = rows_returned + node.get("Rows Removed by Filter", 0) * loops
+        else:
+            rows_returned = node["Plan Rows"]
+            rows_read = None
+        seq_scans.append({
+            "query_name": query_name,
+            "table": node["Relation Name"],
+            "filter": node.get("Filter"),
+            "rows_read": rows_read,
+            "rows_returned": rows_returned,
+            "selectivity": None if not rows_read else rows_returned / rows_read,
+            "time_ms": node.get("Actual Total Time"),
+            "analyzed": analyzed,
+        })
+    return seq_scans
+
+
+def get_missing_indexes(plans, table_stats, index_stats, schema="flight",
+                        min_table_rows=100_000, max_selectivity=0.05):
+    """Suggest btree indexes for the selective sequential scans of the sampled plans.
+
+    Return
+    ------
+    missing_indexes: pd.DataFrame
+        One row per suggested index: table, columns, index_config (INDEXES_CONFIG
+        format), the queries that need it, the estimated bytes of the index and its
+        write amplification on the loader.
+    """
+    table_stats = table_stats.set_index("table")
+    indexes_config = get_indexes_config()
+    suggestions = dict()
+    for _, seq_scan in plans.iterrows():
+        table_name = seq_scan["table"]
+        if seq_scan["filter"] is None or table_name not in table_stats.index:
+            continue
+        n_rows = table_stats.loc[table_name, "n_live_tup"]
+        if n_rows < min_table_rows:
+            continue
+        # Without ANALYZE the rows returned are an estimate of the planner
+        selectivity = seq_scan["selectivity"]
+        if selectivity is None or pd.isna(selectivity):
+            selectivity = seq_scan["rows_returned"] / max(n_rows, 1)
+        if selectivity > max_selectivity:
+            continue
+
+        columns = get_filter_index_columns(seq_scan["filter"],
+                                           table_stats.loc[table_name, "columns"])
+        if len(columns) == 0 or _is_covered(columns, table_name, index_stats, indexes_config):
+            continue
+        suggestion = suggestions.setdefault((table_name, tuple(columns)),
+                                            {"table": table_name, "columns": columns,
+                                             "queries": []})
+        suggestion["queries"].append(seq_scan["query_name"])
+
+    rows = list()
+    for suggestion in suggestions.values():
+        table_name, columns = suggestion["table"], suggestion["columns"]
+        index_bytes = estimate_index_bytes(table_name, columns,
+                                           table_stats.loc[table_name, "n_live_tup"],
+                                           schema=schema)
+        heap_bytes = table_stats.loc[table_name, "heap_bytes"]
+        rows.append({
+            **suggestion,
+            "index_config": {"unique": "",
+                             "index_name": f"{'_'.join(columns)}_{table_name}_index",
+                             "column": columns if len(columns) > 1 else columns[0]},
+            "estimated_index_bytes": index_bytes,
+            "write_amplification": None if heap_bytes == 0 else index_bytes / heap_bytes,
+        })
+    return pd.DataFrame(rows, columns=["table", "columns", "queries", "index_config",
+                                       "estimated_index_bytes", "write_amplification"])
+
+
+def get_filter_index_columns(filter_condition, table_columns):
+    """Get the columns of a btree index for a plan filter.
+
+    Parameters
+    ----------
+    filter_condition: str
+        Filter of a plan node, e.g. '(("originCode" = \'GRU\'::bpchar) AND
+        ("operationalSearchTime" >= \'2023-06-01\'::timestamp without time zone))'.
+    table_columns: list[str]
+        Columns of the table, other names of the filter are ignored.
+
+    Return
+    ------
+    columns: list[str]
+        The equality columns in the order of the filter and then the first range
+        column, e.g. ["originCode", "operationalSearchTime"].
+    """
+    # The conditions of an OR can not use one index together
+    if re.search(r"\bOR\b", filter_condition):
+        return []
+    equality_columns, range_columns = list(), list()
+    for column, operator in re.findall(FILTER_CONDITION_PATTERN, filter_condition):
+        if column not in table_columns:
+            continue
+        if operator in EQUALITY_OPERATORS and column not in equality_columns:
+            equality_columns.append(column)
+        elif operator in RANGE_OPERATORS and column not in range_columns:
+            range_columns.append(column)
+    range_columns = [column for column in range_columns if column not in equality_columns]
+    return equality_columns + range_columns[:1]
+
+
+@filter_warnings
+def estimate_index_bytes(table_name, columns, n_rows, schema="flight"):
+    """Estimate the size of a btree index from the average width of its columns in pg_stats."""
+    query = """
+        SELECT attname, avg_width FROM pg_stats
+        WHERE schemaname = %(schema)s AND tablename = %(table)s
+    """
+    with load_conn() as conn:
+        widths = pd.read_sql(query, conn, params={"schema": schema, "table": table_name})
+    conn.close()
+    return get_btree_bytes(columns, n_rows, widths.set_index("attname")["avg_width"])
+
+
+def get_btree_bytes(columns, n_rows, column_widths):
+    """Size of a compact btree index of the columns with n_rows entries.
+
+    Parameters
+    ----------
+    columns: list[str]
+        Columns of the index, key and included.
+    n_rows: int
+        Number of rows of the table.
+    column_widths: dict or pd.Series
+        Average width in bytes of each column, avg_width of pg_stats. The columns
+        without statistics (never analyzed) count as 8 bytes.
+
+    Return
+    ------
+    index_bytes: int
+    """
+    entry_bytes = sum(int(column_widths.get(column, 8)) for column in columns)
+    entry_bytes = int(np.ceil(entry_bytes / 8) * 8) + INDEX_ENTRY_OVERHEAD_BYTES
+    return int(n_rows * entry_bytes / BTREE_FILLFACTOR)
+
+
+def get_unused_indexes(index_stats):
+    """Get the secondary indexes never scanned since the statistics were reset.
+
+    The unique indexes enforce the keys, they are never reported.
+    """
+    unused_indexes = index_stats[(index_stats["idx_scan"] == 0) & ~index_stats["is_unique"]]
+    return unused_indexes[["table", "index_name", "index_bytes", "definition"]].sort_values(
+        "index_bytes", ascending=False, ignore_index=True)
+
+
+def get_seq_scan_hot_spots(table_stats, min_table_rows=100_000):
+    """Get the tables where the sequential scans read the most rows.
+
+    Return
+    ------
+    seq_scan_hot_spots: pd.DataFrame
+        Tables with at least min_table_rows rows and a sequential scan, with the rows
+        read by sequential scans, the average rows of each one and the share of the
+        scans that are sequential.
+    """
+    hot_spots = table_stats[(table_stats["n_live_tup"] >= min_table_rows)
+                            & (table_stats["seq_scan"] > 0)].copy()
+    hot_spots["rows_per_seq_scan"] = hot_spots["seq_tup_read"] / hot_spots["seq_scan"]
+    hot_spots["seq_scan_share"] = hot_spots["seq_scan"] / (hot_spots["seq_scan"]
+                                                           + hot_spots["idx_scan"])
+    return hot_spots[["table", "n_live_tup", "seq_scan", "seq_tup_read", "rows_per_seq_scan",
+                      "seq_scan_share"]].sort_values("seq_tup_read", ascending=False,
+                                                     ignore_index=True)
+
+
+def get_write_amplification(index_stats, table_stats, metrics_path=None):
+    """Estimate the load cost of each index.
+
+    The loader creates every secondary index again after each insert, so the bytes
+    written for an index in a load are its whole size.
+
+    Return
+    ------
+    write_amplification: pd.DataFrame
+        For each index: its size, the rows inserted by a load (median of
+        load.insert_database_parallel in the metrics), the bytes of index written per
+        byte of table inserted and the seconds of each load, its share by size of the
+        median time of load.create_table_index of the table. The metrics columns are
+        null if the metrics can not be read.
+    """
+    load_rows, load_seconds = dict(), dict()
+    try:
+        records = pd.DataFrame(read_metrics(metrics_path))
+    except Exception as e:
+        print(f"The metrics can not be read, the load time is not estimated: {str(e)}")
+        records = pd.DataFrame(columns=["stage", "table", "rows", "wall_time_s", "success"])
+    if "table" in records.columns:
+        records = records[records["success"] == True]
+        load_rows = records[records["stage"] == "load.insert_database_parallel"].groupby(
+            "table")["rows"].median().to_dict()
+        load_seconds = records[records["stage"] == "load.create_table_index"].groupby(
+            "table")["wall_time_s"].median().to_dict()
+
+    table_stats = table_stats.set_index("table")
+    write_amplification = index_stats[["table", "index_name", "index_bytes", "is_unique"]].copy()
+    heap_bytes_per_row = (table_stats["heap_bytes"] / table_stats["n_live_tup"].clip(lower=1))
+    table_index_bytes = write_amplification.groupby("table")["index_bytes"].transform("sum")
+
+    write_amplification["load_rows"] = write_amplification["table"].map(load_rows)
+    load_heap_bytes = (write_amplification["load_rows"]
+                       * write_amplification["table"].map(heap_bytes_per_row))
+    write_amplification["write_amplification"] = (write_amplification["index_bytes"]
+                                                  / load_heap_bytes.replace(0, np.nan))
+    write_amplification["load_seconds"] = (write_amplification["table"].map(load_seconds)
+                                           * write_amplification["index_bytes"]
+                                           / table_index_bytes.replace(0, np.nan))
+    return write_amplification.sort_values("index_bytes", ascending=False, ignore_index=True)
+
+
+def print_advice(advice):
+    """Print the report of advise_indexes."""
+    sections = [("Top statements", "statements"), ("Sequential scans of the plans", "plans"),
+                ("Unused indexes", "unused_indexes"),
+                ("Sequential scan hot spots", "seq_scan_hot_spots"),
+                ("Missing indexes", "missing_indexes"),
+                ("Write amplification of the indexes on the loader", "write_amplification")]
+    with pd.option_context("display.max_colwidth", 80, "display.width", 200):
+        for title, key in sections:
+            print(f"\n{title}:")
+            print("None" if len(advice[key]) == 0 else advice[key].to_string(index=False))
+    print("\nSuggested indexes_config entries (see database_tools.INDEXES_CONFIG):")
+    print(json.dumps(advice["suggested_indexes_config"], indent=4))
+
+
+def _is_covered(columns, table_name, index_stats, indexes_config):
+    """Whether an existing or configured index of the table starts with the columns."""
+    existing_columns = list(index_stats.loc[index_stats["table"] == table_name, "columns"])
+    for index_config in indexes_config.get(table_name, []):
+        index_columns = index_config["column"]
+        existing_columns.append([index_columns] if isinstance(index_columns, str)
+                                else index_columns)
+    return any(list(index_columns[:len(columns)]) == list(columns)
+               for index_columns in existing_columns)
+
+
+def _iter_plan_nodes(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from _iter_plan_nodes(child)
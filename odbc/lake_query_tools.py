@@ -0,0 +1,231 @@
+import os
+import sys
+from functools import lru_cache
+from glob import glob
+from os.path import join
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.append("../data_tools")
+from structured_dataset import get_dataset_root
+
+sys.path.append("../utils")
+from tools import get_relevant_path
+
+# Tables of the lake, in the schema flight like the database. offers has one row per
+# offer with the search, flight and fare columns, the other tables are its projections
+# with the columns of the database tables.
+LAKE_TABLES_COLUMNS = {
+    "search": ["searchId", "searchTime", "operationalSearchTime", "flightDay",
+               "originCode", "destinationCode"],
+    "flight": ["searchId", "legId", "travelDuration", "duration", "durationInSeconds",
+               "elapsedDays", "isNonStop", "departureTimeRaw",
+               "departureTimeZoneOffsetSeconds", "arrivalTimeRaw",
+               "arrivalTimeZoneOffsetSeconds", "flightNumber", "stops", "airlineCode",
+               "equipmentCode", "arrivalAirportCode", "departureAirportCode",
+               "arrivalAirportLatitude", "arrivalAirportLongitude",
+               "departureAirportLatitude", "departureAirportLongitude"],
+    "fare": ["searchId", "legId", "fareBasisCode", "isBasicEconomy", "isRefundable",
+             "isFreeChangeAvailable", "taxes", "fees", "showFees", "currency", "baseFare",
+             "totalFare", "numberOfTickets", "freeCancellationBy", "hasSeatMap",
+             "providerCode", "seatsRemaining"],
+}
+LAKE_TABLES = ["offers"] + list(LAKE_TABLES_COLUMNS)
+# Structured data columns renamed to the database names, see DatabaseFormat._transform_data
+RENAME_COLUMNS = {
+    "search_time": "searchTime",
+    "operational_search_time": "operationalSearchTime",
+    "flight_day": "flightDay",
+    "origin_code": "originCode",
+    "destination_code": "destinationCode",
+}
+# Conversion of the columns stored as text by the FlightExtractor without typed_output,
+# they are also text when files with and without typed_output are read together
+TEXT_CONVERSIONS = {
+    "search_time": "TRY_CAST({column} AS TIMESTAMP)",
+    "operational_search_time": ("COALESCE(try_strptime({column}, '%Y-%m-%dT%H:%M'), "
+                                "TRY_CAST({column} AS TIMESTAMP))"),
+    "flight_day": "TRY_CAST({column} AS DATE)",
+}
+# Conversion of the typed columns whose type is not the type of the database
+TYPED_CONVERSIONS = {
+    "flight_day": "CAST({column} AS DATE)",
+}
+
+
+def get_lake_paths():
+    """Get the parquet files of the lake: the structured data of the extractor.
+
+    Return
+    ------
+    lake_paths: list[str]
+        Glob patterns of the parquet files, the flat ones and the ones of the
+        partitioned dataset.
+    """
+    lake_paths = [join(get_relevant_path("structured_data"), "*.parquet")]
+    dataset_path = get_relevant_path("structured_dataset")
+    if dataset_path is not None:
+        lake_paths.append(join(dataset_path, "*=*", "*=*", "*=*", "*.parquet"))
+    return lake_paths
+
+
+def get_lake_connection(lake_paths=None, threads=None, memory_limit=None):
+    """Get the DuckDB connection of this process, with the lake tables as views.
+
+    The connection is cached for the files that match lake_paths, it is created
+    again when files are added or removed, so the next query sees them.
+
+    Parameters
+    ----------
+    lake_paths: list[str] (default=None)
+        Parquet files or glob patterns, by default get_lake_paths().
+    threads: int (default=None)
+        Number of DuckDB threads, by default all cores.
+    memory_limit: str (default=None)
+        Memory limit of DuckDB, e.g. "4GB", by default 80% of the memory.
+
+    Return
+    ------
+    conn: duckdb.DuckDBPyConnection
+        Connection with the views flight.offers, flight.search, flight.flight and
+        flight.fare.
+    """
+    lake_paths = get_lake_paths() if lake_paths is None else lake_paths
+    file_paths = sorted({path for pattern in lake_paths for path in glob(pattern)})
+    assert len(file_paths) > 0, "there is no parquet file in the lake"
+    return _get_lake_connection(tuple(file_paths), threads, memory_limit, os.getpid())
+
+
+@lru_cache(maxsize=4)
+def _get_lake_connection(file_paths, threads, memory_limit, pid):
+    # The pid is part of the key, a forked process must not share the connection
+    conn = duckdb.connect(database=":memory:")
+    if threads is not None:
+        conn.execute(f"SET threads TO {int(threads)}")
+    if memory_limit is not None:
+        conn.execute(f"SET memory_limit = '{memory_limit}'")
+
+    # A segment column can not be a list in some files and text in others in the same
+    # read_parquet, so the files are read in groups with the same list columns. The
+    # files of the partitioned dataset are another group, their search_date,
+    # origin_code and destination_code are in the folder names.
+    file_groups = dict()
+    for path in file_paths:
+        list_columns = _get_list_columns(path, os.path.getmtime(path))
+        is_dataset = get_dataset_root(path) is not None
+        file_groups.setdefault((list_columns, is_dataset), []).append(path)
+    offers_query = " UNION ALL BY NAME ".join(
+        _get_offers_select(conn, group_paths, hive_partitioning=is_dataset)
+        for (_, is_dataset), group_paths in file_groups.items()
+    )
+
+    conn.execute("CREATE SCHEMA IF NOT EXISTS flight")
+    conn.execute(f"CREATE VIEW flight.offers AS {offers_query}")
+    offers_columns = [column for column, *_ in
+                      conn.execute("DESCRIBE SELECT * FROM flight.offers").fetchall()]
+    for table_name, table_columns in LAKE_TABLES_COLUMNS.items():
+        columns = ", ".join(f'"{column}"' for column in table_columns
+                            if column in offers_columns)
+        conn.execute(f"CREATE VIEW flight.{table_name} AS SELECT {columns} FROM flight.offers")
+    return conn
+
+
+@lru_cache(maxsize=None)
+def _get_list_columns(path, mtime):
+    """Get the list columns of a parquet, only its footer is read."""
+    schema = pq.read_schema(path)
+    return tuple(sorted(field.name for field in schema if pa.types.is_list(field.type)))
+
+
+def _get_offers_select(conn, file_paths, hive_partitioning=False):
+    """Get the SELECT of the offers of some parquets, with the database column names.
+
+    With hive_partitioning the partition columns are read from the folder names, and
+    DuckDB skips the files of the partitions excluded by the WHERE of the query.
+    """
+    paths_sql = ", ".join("'" + path.replace("'", "''") + "'" for path in file_paths)
+    source = (f"read_parquet([{paths_sql}], union_by_name=true, filename=true, "
+              f"file_row_number=true, hive_partitioning={str(hive_partitioning).lower()})")
+    column_types = conn.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()
+
+    # The searchId of the database is not in the parquet, the lake uses a hash of the
+    # row position, so the views can be joined by searchId like the database tables
+    select_list = ["hash(filename || ':' || file_row_number) AS \"searchId\""]
+    for column, column_type, *_ in column_types:
+        if column in ("filename", "file_row_number", "search_date"):
+            continue
+        expression = f'"{column}"'
+        if column_type.endswith("[]"):
+            # Typed segment lists are joined like the database columns
+            expression = f"array_to_string({expression}, '||')"
+        elif column_type == "VARCHAR" and column in TEXT_CONVERSIONS:
+            expression = TEXT_CONVERSIONS[column].format(column=expression)
+        elif column in TYPED_CONVERSIONS:
+            expression = TYPED_CONVERSIONS[column].format(column=expression)
+        select_list.append(f'{expression} AS "{RENAME_COLUMNS.get(column, column)}"')
+    return f"SELECT {', '.join(select_list)} FROM {source}"
+
+
+def reset_lake_connections():
+    """Close the cached connections, the next queries read the lake columns again."""
+    _get_lake_connection.cache_clear()
+
+
+def get_table(table, condition="", schema="flight", lake_paths=None):
+    """Get any table of the lake, like query_tools.get_table.
+
+    Parameters
+    ----------
+    table: str
+        Table name, one of LAKE_TABLES.
+    condition: str (default="")
+        Any SQL condition. Eg: where "originCode" = 'GRU'
+    schema: str (default="flight")
+        Schema of the views.
+    lake_paths: list[str] (default=None)
+        See get_lake_connection.
+
+    Return
+    ------
+    table: pd.DataFrame
+        Table returned by query.
+    """
+    assert table in LAKE_TABLES, f"table must be one of {LAKE_TABLES}"
+    query = f"""
+            SELECT *
+            FROM {schema}.{table}
+            {condition}
+        """
+    return run_query(query, lake_paths=lake_paths)
+
+
+def run_query(query, lake_paths=None):
+    """Run any query on the lake, like query_tools.run_query.
+
+    DuckDB scans only the columns and the row groups the query needs, and uses all
+    cores, so aggregations over many rows are much faster than in PostgreSQL and
+    do not load the database. The lake is the structured data, the tables airport,
+    airline, equipment and data_upload are only in the database, and the searchId of
+    the lake is not the searchId of the database.
+
+    Parameters
+    ----------
+    query: str
+        SQL query in the DuckDB dialect, which accepts the usual PostgreSQL
+        functions (DATE_TRUNC, stddev, count(DISTINCT ...), ...).
+    lake_paths: list[str] (default=None)
+        See get_lake_connection.
+
+    Return
+    ------
+    dataframe: pd.DataFrame
+        DataFrame returned by query.
+    """
+    # Each thread needs its own cursor of the shared connection
+    cursor = get_lake_connection(lake_paths).cursor()
+    try:
+        return cursor.execute(query).df()
+    finally:
+        cursor.close()
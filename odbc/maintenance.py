@@ -0,0 +1,389 @@
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from time import perf_counter
+
+import pandas as pd
+
+from connection import load_conn
+from filter_warnings import filter_warnings
+from index_advisor import get_btree_bytes
+
+sys.path.append("../utils")
+from metrics import StageMetrics
+
+# Kinds of maintenance tasks, in the order they run on the same table: the dead rows
+# are removed before the indexes are rebuilt
+TASK_KINDS = ["vacuum", "analyze", "reindex"]
+# Rows read by ANALYZE are 300 * default_statistics_target (100) at most
+ANALYZE_SAMPLE_ROWS = 30_000
+PAGE_BYTES = 8192
+
+
+@filter_warnings
+def get_table_maintenance_stats(schema="flight"):
+    """Get the dead rows, changes since the last ANALYZE and visibility of each table.
+
+    Return
+    ------
+    table_stats: pd.DataFrame
+        One row per table: n_live_tup, n_dead_tup, dead_tuple_ratio,
+        n_mod_since_analyze, all_visible_share (share of the pages marked all-visible
+        in the visibility map, which the index-only scans and the next VACUUM skip),
+        heap_bytes, total_bytes (with indexes and TOAST), last_vacuum and last_analyze
+        (manual or automatic).
+    """
+    query = """
+        SELECT T.relname AS table, T.n_live_tup, T.n_dead_tup, T.n_mod_since_analyze,
+            C.relpages, C.relallvisible,
+            pg_relation_size(T.relid) AS heap_bytes,
+            pg_total_relation_size(T.relid) AS total_bytes,
+            GREATEST(T.last_vacuum, T.last_autovacuum) AS last_vacuum,
+            GREATEST(T.last_analyze, T.last_autoanalyze) AS last_analyze
+        FROM pg_stat_user_tables T
+            JOIN pg_class C ON C.oid = T.relid
+        WHERE T.schemaname = %(schema)s
+    """
+    with load_conn() as conn:
+        table_stats = pd.read_sql(query, conn, params={"schema": schema})
+    conn.close()
+    n_tuples = (table_stats["n_live_tup"] + table_stats["n_dead_tup"]).clip(lower=1)
+    table_stats["dead_tuple_ratio"] = table_stats["n_dead_tup"] / n_tuples
+    table_stats["all_visible_share"] = (table_stats["relallvisible"]
+                                        / table_stats["relpages"].clip(lower=1)).clip(upper=1)
+    table_stats.loc[table_stats["relpages"] == 0, "all_visible_share"] = 1.0
+    return table_stats
+
+
+@filter_warnings
+def get_index_bloat(schema="flight"):
+    """Estimate the bloat of the btree indexes of the schema.
+
+    The size of a compact index is estimated from the rows of the table and the
+    average width of its columns in pg_stats (see index_advisor.get_btree_bytes), so
+    pgstattuple is not needed. The estimate is rough, use a high max_bloat_ratio.
+    The tables never analyzed (reltuples = -1) have no row count, their indexes
+    have no estimate, plan_maintenance analyzes them first.
+
+    Return
+    ------
+    index_bloat: pd.DataFrame
+        One row per btree index: table, index_name, is_valid, index_bytes,
+        expected_bytes, bloat_ratio (index_bytes / expected_bytes) and
+        bloat_bytes (index_bytes - expected_bytes). The last three are NaN for the
+        tables never analyzed.
+    """
+    index_query = """
+        SELECT T.relname AS table, IC.relname AS index_name, I.indisvalid AS is_valid,
+            pg_relation_size(I.indexrelid) AS index_bytes, T.reltuples,
+            ARRAY(SELECT A.attname
+                  FROM unnest(I.indkey) AS K(attnum)
+                      JOIN pg_attribute A ON A.attrelid = I.indrelid AND A.attnum = K.attnum
+                  ) AS columns
+        FROM pg_index I
+            JOIN pg_class IC ON IC.oid = I.indexrelid
+            JOIN pg_class T ON T.oid = I.indrelid
+            JOIN pg_namespace N ON N.oid = T.relnamespace
+            JOIN pg_am AM ON AM.oid = IC.relam
+        WHERE N.nspname = %(schema)s AND AM.amname = 'btree'
+    """
+    widths_query = """
+        SELECT tablename AS table, attname, avg_width FROM pg_stats
+        WHERE schemaname = %(schema)s
+    """
+    with load_conn() as conn:
+        index_bloat = pd.read_sql(index_query, conn, params={"schema": schema})
+        widths = pd.read_sql(widths_query, conn, params={"schema": schema})
+    conn.close()
+
+    table_widths = {table_name: table_widths.set_index("attname")["avg_width"]
+                    for table_name, table_widths in widths.groupby("table")}
+    # A btree has a metapage and a root page at least
+    index_bloat["expected_bytes"] = pd.Series([
+        max(get_btree_bytes(index["columns"], index["reltuples"],
+                            table_widths.get(index["table"], {})), 2 * PAGE_BYTES)
+        if index["reltuples"] >= 0 else None
+        for _, index in index_bloat.iterrows()
+    ], index=index_bloat.index, dtype="float64")
+    index_bloat["bloat_ratio"] = index_bloat["index_bytes"] / index_bloat["expected_bytes"]
+    index_bloat["bloat_bytes"] = (index_bloat["index_bytes"]
+                                  - index_bloat["expected_bytes"]).clip(lower=0)
+    return index_bloat.drop(columns=["reltuples", "columns"])
+
+
+def plan_maintenance(schema="flight", tables=None, dead_tuple_ratio=0.1,
+                     min_dead_tuples=10_000, analyze_ratio=0.1, min_all_visible_share=0.8,
+                     max_bloat_ratio=2.0, min_index_bytes=8 * 2**20, reindex_all=False):
+    """Choose the maintenance tasks of the tables and indexes from their statistics.
+
+    A table gets:
+        vacuum, VACUUM (ANALYZE): if its dead rows are at least dead_tuple_ratio of
+            the rows and min_dead_tuples, e.g. after delete_rows_by_insertionTime or
+            failed loads, or if less than min_all_visible_share of its pages are
+            all-visible, e.g. after large appends (the VACUUM refreshes the
+            visibility map).
+        analyze, ANALYZE: otherwise, if the rows changed since the last ANALYZE are at
+            least analyze_ratio of the rows, or if it was never analyzed.
+    An index gets reindex, REINDEX INDEX CONCURRENTLY, if it is invalid (e.g. left by
+    an interrupted concurrent build) or if it is larger than min_index_bytes and
+    its bloat ratio (see get_index_bloat) is at least max_bloat_ratio. The indexes of
+    the tables never analyzed have no bloat ratio, they are only rebuilt if invalid.
+
+    Parameters
+    ----------
+    schema: str (default="flight")
+        The name of the database schema.
+    tables: list[str] (default=None)
+        Tables to maintain, by default all the tables of the schema.
+    dead_tuple_ratio, min_dead_tuples, analyze_ratio, min_all_visible_share,
+    max_bloat_ratio, min_index_bytes:
+        Thresholds of the tasks, see above.
+    reindex_all: bool (default=False)
+        If True every index of the tables is rebuilt, like REINDEX TABLE but online.
+
+    Return
+    ------
+    tasks: pd.DataFrame
+        One row per task: kind, table, index_name (None for the table tasks), command,
+        reason, estimated_bytes (bytes read and written, see max_concurrent_task_bytes
+        of run_maintenance) and reclaimable_bytes (estimated space reclaimed).
+    """
+    table_stats = get_table_maintenance_stats(schema)
+    index_bloat = get_index_bloat(schema)
+    if tables is not None:
+        table_stats = table_stats[table_stats["table"].isin(tables)]
+        index_bloat = index_bloat[index_bloat["table"].isin(tables)]
+    table_index_bytes = index_bloat.groupby("table")["index_bytes"].sum()
+    never_analyzed_tables = set(index_bloat.loc[index_bloat["expected_bytes"].isna(), "table"])
+
+    tasks = list()
+    for _, table in table_stats.iterrows():
+        reasons = list()
+        if (table["dead_tuple_ratio"] >= dead_tuple_ratio
+                and table["n_dead_tup"] >= min_dead_tuples):
+            reasons.append(f"{int(table['n_dead_tup'])} dead rows ({table['dead_tuple_ratio']:.0%})")
+        if table["all_visible_share"] < min_all_visible_share:
+            reasons.append(f"{table['all_visible_share']:.0%} of the pages all-visible")
+        unvisited_bytes = table["heap_bytes"] * (1 - table["all_visible_share"])
+        if len(reasons) > 0:
+            # VACUUM reads the pages not all-visible and, with dead rows, every index
+            index_bytes = table_index_bytes.get(table["table"], 0) if table["n_dead_tup"] > 0 else 0
+            tasks.append({"kind": "vacuum", "table": table["table"], "index_name": None,
+                          "command": f"VACUUM (ANALYZE) {schema}.{table['table']}",
+                          "reason": ", ".join(reasons),
+                          "estimated_bytes": int(unvisited_bytes + index_bytes),
+                          "reclaimable_bytes": int(table["heap_bytes"] * table["dead_tuple_ratio"])})
+        elif (table["n_mod_since_analyze"] >= analyze_ratio * max(table["n_live_tup"], 1)
+                or table["table"] in never_analyzed_tables):
+            reason = (f"{int(table['n_mod_since_analyze'])} rows changed since the last ANALYZE"
+                      if table["table"] not in never_analyzed_tables else "never analyzed")
+            tasks.append({"kind": "analyze", "table": table["table"], "index_name": None,
+                          "command": f"ANALYZE {schema}.{table['table']}",
+                          "reason": reason,
+                          "estimated_bytes": int(min(table["heap_bytes"],
+                                                     ANALYZE_SAMPLE_ROWS * PAGE_BYTES)),
+                          "reclaimable_bytes": 0})
+
+    heap_bytes = table_stats.set_index("table")["heap_bytes"]
+    for _, index in index_bloat.iterrows():
+        if not index["is_valid"]:
+            reason = "invalid index"
+        elif reindex_all:
+            reason = "reindex_all"
+        elif index["index_bytes"] >= min_index_bytes and index["bloat_ratio"] >= max_bloat_ratio:
+            reason = f"bloat ratio {index['bloat_ratio']:.1f}"
+        else:
+            continue
+        # The build reads the table and writes the new index
+        has_estimate = not pd.isna(index["expected_bytes"])
+        new_index_bytes = index["expected_bytes"] if has_estimate else index["index_bytes"]
+        tasks.append({"kind": "reindex", "table": index["table"], "index_name": index["index_name"],
+                      "command": f'REINDEX INDEX CONCURRENTLY {schema}."{index["index_name"]}"',
+                      "reason": reason,
+                      "estimated_bytes": int(heap_bytes.get(index["table"], 0) + new_index_bytes),
+                      "reclaimable_bytes": int(index["bloat_bytes"]) if has_estimate else 0})
+
+    tasks = pd.DataFrame(tasks, columns=["kind", "table", "index_name", "command", "reason",
+                                         "estimated_bytes", "reclaimable_bytes"])
+    # The table tasks first, then the largest gains
+    tasks["kind_order"] = tasks["kind"].map(TASK_KINDS.index)
+    tasks = tasks.sort_values(["kind_order", "reclaimable_bytes"], ascending=[True, False],
+                              ignore_index=True)
+    return tasks.drop(columns="kind_order")
+
+
+def run_maintenance(tasks, schema="flight", max_concurrency=2, max_concurrent_task_bytes=None,
+                    vacuum_cost_delay_ms=2, vacuum_cost_limit=200,
+                    maintenance_work_mem=None, lock_timeout_ms=None):
+    """Run the maintenance tasks in parallel within a concurrency and size limit.
+
+    Every task runs online: VACUUM and ANALYZE do not block reads and writes, and
+    REINDEX INDEX CONCURRENTLY (PostgreSQL 12 or newer) builds the new index while
+    the table is used and swaps it. Two tasks of the same table never run together,
+    they would wait for each other's lock, and the tasks of a table run in the order
+    of tasks. Run it when no load is running, the loader drops and creates the
+    indexes (see database_tools.insert_database_parallel).
+
+    The limits choose which tasks run together, they do not limit the I/O rate.
+    The rate of VACUUM and ANALYZE is throttled by the cost based delay
+    (vacuum_cost_delay_ms and vacuum_cost_limit), by default the one autovacuum
+    uses since PostgreSQL 12, while a manual VACUUM is not throttled by the server
+    settings. REINDEX is not throttled, max_concurrent_task_bytes keeps two large
+    rebuilds from running together.
+
+    Parameters
+    ----------
+    tasks: pd.DataFrame
+        Output of plan_maintenance.
+    schema: str (default="flight")
+        The name of the database schema.
+    max_concurrency: int (default=2)
+        Maximum number of tasks running at the same time, each one uses a connection.
+    max_concurrent_task_bytes: int (default=None)
+        Maximum sum of estimated_bytes of the running tasks. A task larger than the
+        limit runs alone. None for no limit.
+    vacuum_cost_delay_ms: float (default=2)
+        vacuum_cost_delay of the VACUUM and ANALYZE sessions, a positive value
+        throttles their I/O. None for the server setting (0, no throttle, by default).
+    vacuum_cost_limit: int (default=200)
+        vacuum_cost_limit of the VACUUM and ANALYZE sessions, the cost of the pages
+        processed before each delay. None for the server setting.
+    maintenance_work_mem: str (default=None)
+        maintenance_work_mem of the sessions, e.g. "1GB", it speeds up the index
+        builds and the index scans of VACUUM. None for the server setting.
+    lock_timeout_ms: int (default=None)
+        lock_timeout of the sessions, a task that waits longer for a lock fails
+        instead of holding the other queries behind it.
+
+    Return
+    ------
+    report: pd.DataFrame
+        The tasks with start_time, seconds, bytes_before, bytes_after,
+        reclaimed_bytes, success and error.
+    """
+    assert max_concurrency >= 1, "max_concurrency must be at least 1"
+    settings = {"vacuum_cost_delay": vacuum_cost_delay_ms, "vacuum_cost_limit": vacuum_cost_limit,
+                "maintenance_work_mem": maintenance_work_mem, "lock_timeout": lock_timeout_ms}
+    settings = {name: value for name, value in settings.items() if value is not None}
+
+    pending = tasks.to_dict("records")
+    running = dict()
+    results = list()
+    with StageMetrics("odbc.maintenance", tasks=len(pending), verbose=True) as stage_metrics, \
+            ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            busy_tables = {task["table"] for task in running.values()}
+            running_bytes = sum(task["estimated_bytes"] for task in running.values())
+            for task in list(pending):
+                if len(running) >= max_concurrency:
+                    break
+                # The first pending task of each table is the next one of that table
+                is_next_of_table = next(pending_task for pending_task in pending
+                                        if pending_task["table"] == task["table"]) is task
+                fits_budget = (max_concurrent_task_bytes is None or len(running) == 0
+                               or running_bytes + task["estimated_bytes"]
+                               <= max_concurrent_task_bytes)
+                if task["table"] in busy_tables or not is_next_of_table or not fits_budget:
+                    continue
+                pending.remove(task)
+                future = executor.submit(run_maintenance_task, task, schema=schema,
+                                         settings=settings)
+                running[future] = task
+                busy_tables.add(task["table"])
+                running_bytes += task["estimated_bytes"]
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                results.append(future.result())
+        stage_metrics.labels["reclaimed_bytes"] = sum(result["reclaimed_bytes"] or 0
+                                                      for result in results)
+
+    report = pd.DataFrame(results, columns=list(tasks.columns) + [
+        "start_time", "seconds", "bytes_before", "bytes_after", "reclaimed_bytes",
+        "success", "error"])
+    return report
+
+
+def run_maintenance_task(task, schema="flight", settings=None):
+    """Run one task of plan_maintenance in its own connection and measure it.
+
+    The size before and after is the size of the index for reindex and of the table
+    with its indexes for vacuum and analyze. If a concurrent reindex fails, the
+    invalid index it leaves ("<index>_ccnew") is dropped.
+
+    Return
+    ------
+    result: dict
+        The task with start_time, seconds, bytes_before, bytes_after,
+        reclaimed_bytes, success and error.
+    """
+    settings = {} if settings is None else settings
+    result = {**task, "start_time": datetime.now(), "seconds": None,
+              "bytes_before": None, "bytes_after": None, "reclaimed_bytes": None,
+              "success": False, "error": None}
+    if task["kind"] == "reindex":
+        size_query = f"""SELECT pg_relation_size('{schema}."{task["index_name"]}"')"""
+    else:
+        size_query = f"SELECT pg_total_relation_size('{schema}.{task['table']}')"
+
+    print(task["command"], "...")
+    conn = load_conn()
+    # VACUUM and REINDEX CONCURRENTLY can not run inside a transaction
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            for name, value in settings.items():
+                cursor.execute(f"SET {name} = %s", (str(value),))
+            cursor.execute(size_query)
+            result["bytes_before"] = cursor.fetchone()[0]
+
+            start_time = perf_counter()
+            with StageMetrics("odbc.maintenance_task", table=task["table"], kind=task["kind"],
+                              index_name=task["index_name"]):
+                cursor.execute(task["command"])
+            result["seconds"] = perf_counter() - start_time
+
+            cursor.execute(size_query)
+            result["bytes_after"] = cursor.fetchone()[0]
+        result["reclaimed_bytes"] = result["bytes_before"] - result["bytes_after"]
+        result["success"] = True
+        print(f"{task['command']} done in {result['seconds']:.1f} s, "
+              f"{result['reclaimed_bytes'] / 2**20:.1f} MB reclaimed")
+    except Exception as e:
+        result["error"] = str(e)
+        print(f"{task['command']} failed: {str(e)}")
+        if task["kind"] == "reindex":
+            _drop_invalid_index(conn, f'{task["index_name"]}_ccnew', schema)
+    finally:
+        conn.close()
+    return result
+
+
+def print_maintenance_report(report):
+    """Print the tasks run, their time and the space reclaimed."""
+    columns = ["kind", "table", "index_name", "reason", "seconds", "bytes_before",
+               "reclaimed_bytes", "success", "error"]
+    with pd.option_context("display.max_colwidth", 60, "display.width", 200):
+        print("None" if len(report) == 0 else report[columns].to_string(index=False))
+    n_failed = int((~report["success"].astype(bool)).sum())
+    print(f"{len(report)} tasks, {n_failed} failed, "
+          f"{report['seconds'].fillna(0).sum():.1f} s of tasks, "
+          f"{report['reclaimed_bytes'].fillna(0).sum() / 2**20:.1f} MB reclaimed")
+
+
+def _drop_invalid_index(conn, index_name, schema):
+    """Drop an index if it exists and it is invalid."""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT 1 FROM pg_index I
+                    JOIN pg_class C ON C.oid = I.indexrelid
+                    JOIN pg_namespace N ON N.oid = C.relnamespace
+                WHERE N.nspname = %s AND C.relname = %s AND NOT I.indisvalid
+            """, (schema, index_name))
+            if cursor.fetchone() is not None:
+                print(f"Dropping invalid index {index_name}")
+                cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {schema}."{index_name}"')
+    except Exception as e:
+        print(f"Invalid index {index_name} was not dropped: {str(e)}")
@@ -4,8 +4,12 @@ from connection import load_conn
 from filter_warnings import filter_warnings
 
 
+# postgres: the database; lake: DuckDB over the structured parquets, see lake_query_tools
+ENGINES = ["postgres", "lake"]
+
+
 @filter_warnings
-def get_table(table, condition="", schema="flight"):
+def get_table(table, condition="", schema="flight", engine="postgres"):
     """Get any table on database.
     
     Parameters
@@ -15,12 +19,20 @@ def get_table(table, condition="", schema="flight"):
     
     condition: str (default="")
         Any SQL condition. Eg: where serchID = 1
+
+    engine: str (default="postgres")
+        Engine of the query, one of ENGINES, see run_query.
     
     Return
     ------
     table: pd.DataFrame
         Table returned by query.
     """
+    assert engine in ENGINES, f"engine must be one of {ENGINES}"
+    if engine == "lake":
+        import lake_query_tools
+        return lake_query_tools.get_table(table, condition=condition, schema=schema)
+
     query = f"""
             SELECT *
             FROM {schema}.{table}
@@ -56,19 +68,32 @@ def get_max_search_id(table="search", schema="flight"):
 
 
 @filter_warnings
-def run_query(query):
+def run_query(query, engine="postgres"):
     """Run any query on database.
     
     Parameters
     ----------
     query: str
         SQL query.
+
+    engine: str (default="postgres")
+        Engine of the query:
+            postgres: the database.
+            lake: DuckDB over the structured parquets, with the tables search, flight,
+                fare and offers (see lake_query_tools). Use it for analytical scans,
+                e.g. aggregations of fare and search by route and day, they are much
+                faster and do not compete with the inserts.
     
     Return
     ------
     dataframe: pd.DataFrame
         DataFrame returned by query.
     """
+    assert engine in ENGINES, f"engine must be one of {ENGINES}"
+    if engine == "lake":
+        import lake_query_tools
+        return lake_query_tools.run_query(query)
+
     with load_conn() as conn:
         dataframe = pd.read_sql(query, conn)
     return dataframe
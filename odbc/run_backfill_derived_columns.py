@@ -0,0 +1,12 @@
+from backfill_derived_columns import backfill_derived_columns
+
+# Run it once after adding the derived columns to an existing database (see
+# setup/sql/flight_database_config.sql), it can run while the loads go on.
+# Use "leg" instead of "flight" if the database stores the legs in the leg table.
+tables_list = ["search", "flight"]
+partition_size = 1_000_000
+n_jobs = 4
+
+for table_name in tables_list:
+    print(f"Backfill of table {table_name}")
+    backfill_derived_columns(table_name, partition_size=partition_size, n_jobs=n_jobs)
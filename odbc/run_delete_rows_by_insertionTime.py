@@ -1,11 +1,22 @@
 import pandas as pd
 
 import database_tools as dt
+import fare_curve_cube as fc
 import query_tools as qt
 
 
 # Alter this line
 # date = "2023-06-03"
+# If True the deleted fares are removed from the fare_curve table, use the value of
+# run_database_format.py
+update_fare_curve = False
+# If True the database stores the legs in the leg table, see run_database_format.py
+deduplicate_legs = False
+
+if update_fare_curve:
+    # The fares are read with their flight rows, before any of them is deleted
+    n_offers = fc.remove_fares_by_insertion_date(date, deduplicate_legs=deduplicate_legs)
+    print(f"{n_offers} fares removed from fare_curve")
 
 # The list of tables has to be in that order because
 # it is not possible to delete the search lines if a
@@ -15,7 +26,7 @@ for table_name in ["flight", "fare", "search"]:
     query = f"""
     SELECT *
     FROM flight.{table_name}
-    WHERE DATE_TRUNC('day', "insertionTime") = DATE '{date}'
+    WHERE "insertionTime" >= DATE '{date}' AND "insertionTime" < DATE '{date}' + 1
     """
 
     table = qt.run_query(query)
@@ -23,5 +34,5 @@ for table_name in ["flight", "fare", "search"]:
 
     dt.delete_rows_by_insertionTime(date, table_name)
 
-    table = run_query(query)
+    table = qt.run_query(query)
     print("Len table: ", len(table))
@@ -0,0 +1,21 @@
+import json
+
+from index_advisor import advise_indexes, print_advice
+
+# pg_stat_statements must be enabled on the server: shared_preload_libraries =
+# 'pg_stat_statements' in postgresql.conf and CREATE EXTENSION pg_stat_statements;
+# Run it after some days of normal use, the statistics count since their last reset.
+n_queries = 20
+# Other queries sampled with EXPLAIN (ANALYZE, BUFFERS), e.g. the queries of the notebooks
+sample_queries = {}
+min_table_rows = 100_000
+# If not None the suggested entries are saved in this json, add the ones you accept to
+# database_tools.INDEXES_CONFIG and setup/sql/create_index.sql
+suggestions_path = None
+
+advice = advise_indexes(n_queries=n_queries, sample_queries=sample_queries,
+                        min_table_rows=min_table_rows)
+print_advice(advice)
+if suggestions_path is not None:
+    with open(suggestions_path, "w") as file:
+        json.dump(advice["suggested_indexes_config"], file, indent=4)
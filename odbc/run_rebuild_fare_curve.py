@@ -0,0 +1,13 @@
+from fare_curve_cube import rebuild_fare_curve
+
+# Run it once to create the fare_curve table from the fares already inserted, and after
+# deleting a batch that failed with a partial insert (see upsert_fare_curve), with the
+# loads stopped, then set update_fare_curve = True in run_database_format.py
+partition_size = 1_000_000
+# If True the database stores the legs in the leg table, see run_database_format.py
+deduplicate_legs = False
+n_jobs = 4
+
+n_offers = rebuild_fare_curve(partition_size=partition_size,
+                              deduplicate_legs=deduplicate_legs, n_jobs=n_jobs)
+print(f"fare_curve has {n_offers} fares")
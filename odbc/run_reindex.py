@@ -1,12 +1,29 @@
-from time import time
-from database_tools import reindex
+from maintenance import plan_maintenance, print_maintenance_report, run_maintenance
 
+# Online maintenance of the tables: VACUUM (ANALYZE) of the tables with dead rows or
+# pages not all-visible, ANALYZE after large appends and REINDEX INDEX CONCURRENTLY of
+# the bloated indexes, see maintenance.py. The tables stay readable and writable, but
+# run it when no load is running, the loads drop and create the indexes.
+tables_list = ["search", "flight", "fare", "leg", "airport", "airline", "equipment", "data_upload"]
+# If True every index is rebuilt, like the REINDEX TABLE of every table, but online
+reindex_all = False
+max_concurrency = 2
+# Maximum sum of the estimated MB read and written by the tasks running together, it
+# is not an I/O rate. None for no limit
+max_concurrent_task_mb = 4096
+# vacuum_cost_delay of the VACUUM sessions, a positive value throttles their I/O, None
+# for the server setting (not throttled)
+vacuum_cost_delay_ms = 2
+maintenance_work_mem = "1GB"
+# If True only the planned tasks are printed
+dry_run = False
 
-tables_list = ["search", "flight", "fare", "airport", "airline", "equipment", "data_upload"]
-for table_name in tables_list:
-    print(f"Reindex on table {table_name}")
-    start_time = time()
-    reindex(table_name)
-    end_time = time()
-    print(f"Done in {(end_time - start_time) / 60} min")
-    
\ No newline at end of file
+tasks = plan_maintenance(tables=tables_list, reindex_all=reindex_all)
+print(tasks[["kind", "table", "index_name", "reason"]].to_string(index=False))
+if not dry_run:
+    report = run_maintenance(tasks, max_concurrency=max_concurrency,
+                             max_concurrent_task_bytes=(None if max_concurrent_task_mb is None
+                                                        else max_concurrent_task_mb * 2**20),
+                             vacuum_cost_delay_ms=vacuum_cost_delay_ms,
+                             maintenance_work_mem=maintenance_work_mem)
+    print_maintenance_report(report)
@@ -0,0 +1,248 @@
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from connection import load_conn
+from database_tools import INSERT_ERROR_COLUMN
+from filter_warnings import filter_warnings
+
+# Prefix of the INSERT_ERROR_COLUMN messages of the rows rejected before the insert
+VALIDATION_ERROR_PREFIX = "validation: "
+INTEGER_RANGES = {
+    "smallint": (-2**15, 2**15 - 1),
+    "integer": (-2**31, 2**31 - 1),
+    "bigint": (-2**63, 2**63 - 1),
+}
+FLOAT_TYPES = ("real", "double precision")
+TEXT_TYPES = ("character", "character varying", "text")
+TIMESTAMP_TYPES = ("timestamp without time zone", "timestamp with time zone")
+BOOLEAN_VALUES = {"true": True, "t": True, "1": True, "1.0": True, "yes": True, "y": True,
+                  "false": False, "f": False, "0": False, "0.0": False, "no": False, "n": False}
+
+
+@lru_cache(maxsize=None)
+@filter_warnings
+def get_table_schema(table_name, schema="flight"):
+    """Read the columns and the unique constraints of a table from information_schema.
+
+    The result is cached, the database is queried once per table and process.
+    Call get_table_schema.cache_clear() after changing the table definition.
+
+    Parameters
+    ----------
+    table_name: str
+        Table name.
+    schema: str (default="flight")
+        The name of the database schema.
+
+    Return
+    ------
+    columns: dict[dict]
+        Columns in table order, each one with data_type, nullable, has_default,
+        max_length, precision and scale. Do not modify it, it is shared.
+    unique_keys: tuple[tuple[str]]
+        Columns of the primary key and of every unique constraint.
+    """
+    columns_query = """
+        SELECT column_name, data_type, is_nullable, column_default,
+               character_maximum_length, numeric_precision, numeric_scale
+        FROM information_schema.columns
+        WHERE table_schema = %(schema)s AND table_name = %(table_name)s
+        ORDER BY ordinal_position
+    """
+    keys_query = """
+        SELECT tc.constraint_name, kcu.column_name
+        FROM information_schema.table_constraints AS tc
+        JOIN information_schema.key_column_usage AS kcu
+            ON tc.constraint_schema = kcu.constraint_schema
+            AND tc.constraint_name = kcu.constraint_name
+        WHERE tc.table_schema = %(schema)s AND tc.table_name = %(table_name)s
+            AND tc.constraint_type IN ('PRIMARY KEY', 'UNIQUE')
+        ORDER BY tc.constraint_name, kcu.ordinal_position
+    """
+    params = {"schema": schema, "table_name": table_name}
+    with load_conn() as conn:
+        columns_table = pd.read_sql(columns_query, conn, params=params)
+        keys_table = pd.read_sql(keys_query, conn, params=params)
+    assert len(columns_table) > 0, f"table {schema}.{table_name} does not exist"
+
+    columns = dict()
+    for row in columns_table.itertuples(index=False):
+        columns[row.column_name] = {
+            "data_type": row.data_type,
+            "nullable": row.is_nullable == "YES",
+            "has_default": row.column_default is not None,
+            "max_length": None if pd.isna(row.character_maximum_length)
+            else int(row.character_maximum_length),
+            "precision": None if pd.isna(row.numeric_precision) else int(row.numeric_precision),
+            "scale": None if pd.isna(row.numeric_scale) else int(row.numeric_scale),
+        }
+    unique_keys = tuple(tuple(key["column_name"])
+                        for _, key in keys_table.groupby("constraint_name", sort=False))
+    return columns, unique_keys
+
+
+def validate_table(dataframe, table_name, schema="flight", check_unique=True, verbose=True):
+    """Coerce the columns of a batch to the types of the table and split off the invalid rows.
+
+    The checks are vectorized, one pass per column over the whole batch, and follow
+    the table definition read by get_table_schema:
+        - integers, decimals and floats are parsed, integers must be integral and in
+          the range of the type, decimals must fit DECIMAL(precision, scale) after
+          rounding to scale;
+        - booleans accept bool values and true/false, t/f, 1/0, yes/no;
+        - dates and timestamps are parsed;
+        - text must fit CHAR(n) and VARCHAR(n);
+        - NOT NULL columns without default must have a value;
+        - the primary key and the unique constraints must not be repeated in the batch.
+    The rows rejected here would fail the insert, and each one would cost a bisection
+    of insert_database.
+
+    Parameters
+    ----------
+    dataframe: pd.DataFrame
+        Batch to insert, its columns must be columns of the table.
+    table_name: str
+        Table name.
+    schema: str (default="flight")
+        The name of the database schema.
+    check_unique: bool (default=True)
+        If True reject the rows that repeat a unique key of the batch. Use False for
+        tables inserted with ON CONFLICT DO NOTHING.
+    verbose: bool (default=True)
+        If True print the count of rows of each rejection reason.
+
+    Return
+    ------
+    dataframe_valid: pd.DataFrame
+        Valid rows with the coerced columns.
+    dataframe_not_valid: pd.DataFrame
+        Invalid rows with their original values and the reasons in INSERT_ERROR_COLUMN.
+    """
+    columns, unique_keys = get_table_schema(table_name, schema)
+    unknown_columns = [column for column in dataframe.columns if column not in columns]
+    assert len(unknown_columns) == 0, (
+        f"columns {unknown_columns} are not in table {schema}.{table_name}"
+    )
+
+    errors = np.full(len(dataframe), "", dtype=object)
+
+    def add_error(mask, reason):
+        mask = _to_mask(mask)
+        if mask.any():
+            errors[mask] = errors[mask] + reason + "; "
+
+    coerced_columns = dict()
+    for column, values in dataframe.items():
+        coerced, checks = _coerce_column(values, columns[column])
+        column_schema = columns[column]
+        if not column_schema["nullable"] and not column_schema["has_default"]:
+            checks.append((values.isna(), "null value"))
+        for mask, reason in checks:
+            add_error(mask, f"{column} {reason}")
+        coerced_columns[column] = coerced
+
+    for column, column_schema in columns.items():
+        if (column not in dataframe.columns and not column_schema["nullable"]
+                and not column_schema["has_default"]):
+            add_error(np.ones(len(dataframe), dtype=bool), f"{column} missing")
+
+    if check_unique:
+        for key in unique_keys:
+            if all(column in dataframe.columns for column in key):
+                add_error(dataframe.duplicated(subset=list(key), keep="first"),
+                          f"duplicate key ({', '.join(key)})")
+
+    not_valid = errors != ""
+    dataframe_valid = pd.DataFrame({column: coerced.array for column, coerced
+                                    in coerced_columns.items()},
+                                   index=dataframe.index)[~not_valid]
+    reasons = pd.Series(errors[not_valid], dtype=object).str.rstrip("; ")
+    dataframe_not_valid = dataframe[not_valid].assign(
+        **{INSERT_ERROR_COLUMN: (VALIDATION_ERROR_PREFIX + reasons).to_numpy()}
+    )
+
+    if verbose and len(dataframe_not_valid) > 0:
+        print(f"{len(dataframe_not_valid)} of {len(dataframe)} rows of {table_name} are not valid")
+        for reason, rows in reasons.value_counts().head(10).items():
+            print(f"    {rows} rows: {reason}")
+    return dataframe_valid, dataframe_not_valid
+
+
+def _coerce_column(values, column_schema):
+    """Coerce one column to its database type.
+
+    Return
+    ------
+    coerced: pd.Series
+        Coerced values, the invalid ones are null.
+    checks: list[tuple]
+        List of (mask of the invalid rows, reason).
+    """
+    data_type = column_schema["data_type"]
+    checks = list()
+    if data_type in INTEGER_RANGES or data_type == "numeric" or data_type in FLOAT_TYPES:
+        numbers = pd.to_numeric(values, errors="coerce")
+        if pd.api.types.is_bool_dtype(numbers):
+            numbers = numbers.astype(int)
+        not_number = values.notna() & numbers.isna()
+        checks.append((not_number, f"is not {data_type}"))
+        if data_type in INTEGER_RANGES:
+            minimum, maximum = INTEGER_RANGES[data_type]
+            not_integral = _to_mask(numbers.notna() & (numbers % 1 != 0))
+            out_of_range = _to_mask((numbers < minimum) | (numbers > maximum))
+            checks.append((not_integral, "is not integral"))
+            checks.append((out_of_range, f"is out of the {data_type} range"))
+            coerced = numbers.where(~(not_integral | out_of_range)).astype("Int64")
+        elif data_type == "numeric" and column_schema["precision"] is not None:
+            scale = column_schema["scale"] or 0
+            numbers = numbers.round(scale)
+            out_of_range = _to_mask(numbers.abs() >= 10.0 ** (column_schema["precision"] - scale))
+            checks.append((out_of_range, (f"does not fit DECIMAL({column_schema['precision']},"
+                                          f"{scale})")))
+            coerced = numbers.where(~out_of_range)
+        else:
+            coerced = numbers
+    elif data_type == "boolean":
+        if pd.api.types.is_bool_dtype(values):
+            coerced = values.astype("boolean")
+        else:
+            booleans = values.where(values.isna(), values.astype(str).str.strip().str.lower())
+            coerced = booleans.map(BOOLEAN_VALUES).astype("boolean")
+            checks.append((values.notna() & coerced.isna(), "is not boolean"))
+    elif data_type == "date" or data_type in TIMESTAMP_TYPES:
+        if pd.api.types.is_datetime64_any_dtype(values):
+            timestamps = values
+        else:
+            timestamps = pd.to_datetime(values, errors="coerce")
+        checks.append((values.notna() & timestamps.isna(), f"is not {data_type}"))
+        if data_type == "date":
+            # Dates are sent as dates, not as timestamps at midnight
+            coerced = timestamps.dt.date.where(timestamps.notna(), None)
+        else:
+            coerced = timestamps
+    elif data_type in TEXT_TYPES:
+        # The values are kept, the database converts them to text like before
+        coerced = values
+        if column_schema["max_length"] is not None:
+            text = values.astype(str)
+            if data_type == "character":
+                # CHAR(n) pads with spaces, the trailing ones do not count
+                text = text.str.rstrip(" ")
+            too_long = values.notna() & (text.str.len() > column_schema["max_length"])
+            checks.append((too_long, f"is longer than {column_schema['max_length']}"))
+    else:
+        coerced = values
+    return coerced, checks
+
+
+def _to_mask(mask):
+    """Convert a mask to a bool array, the missing values of nullable masks are False.
+
+    The comparisons of the nullable columns (Int64, Float64, boolean) are NA where the
+    value is null, the null values are checked apart.
+    """
+    if isinstance(mask, np.ndarray) and mask.dtype == bool:
+        return mask
+    return pd.Series(mask, copy=False).fillna(False).to_numpy(dtype=bool)
@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+
+import schema_validation as sv
+
+
+def get_column_schema(data_type, max_length=None, precision=None, scale=None):
+    return {"data_type": data_type, "nullable": True, "has_default": False,
+            "max_length": max_length, "precision": precision, "scale": scale}
+
+
+# One column of each type branch of _coerce_column, with a missing value
+NULLABLE_COLUMNS = {
+    "smallint_column": (get_column_schema("smallint"), pd.array([1, None, 3], dtype="Int64")),
+    "integer_column": (get_column_schema("integer"), pd.array([1, None, 3], dtype="Int64")),
+    "numeric_column": (get_column_schema("numeric", precision=10, scale=2),
+                       pd.array([1.5, None, 3.25], dtype="Float64")),
+    "real_column": (get_column_schema("real"), pd.array([1.5, None, 3.0], dtype="Float64")),
+    "boolean_column": (get_column_schema("boolean"), pd.array([True, None, False], dtype="boolean")),
+    "date_column": (get_column_schema("date"), ["2023-06-01", None, "2023-06-03"]),
+    "timestamp_column": (get_column_schema("timestamp without time zone"),
+                         ["2023-06-01 10:00", None, "2023-06-03 12:00"]),
+    "varchar_column": (get_column_schema("character varying", max_length=10), ["a", pd.NA, "c"]),
+}
+
+
+@pytest.mark.parametrize("column", list(NULLABLE_COLUMNS))
+def test_validate_table_missing_values(monkeypatch, column):
+    column_schema, values = NULLABLE_COLUMNS[column]
+    monkeypatch.setattr(sv, "get_table_schema",
+                        lambda table_name, schema="flight": ({column: column_schema}, ()))
+    dataframe = pd.DataFrame({column: values})
+
+    dataframe_valid, dataframe_not_valid = sv.validate_table(dataframe, "table", verbose=False)
+
+    assert len(dataframe_valid) == 3
+    assert len(dataframe_not_valid) == 0
+    assert pd.isna(dataframe_valid[column].iloc[1])
+
+
+def test_validate_table_missing_values_with_invalid_rows(monkeypatch):
+    columns = {"departureHour": get_column_schema("smallint"),
+               "totalFare": get_column_schema("numeric", precision=4, scale=2)}
+    monkeypatch.setattr(sv, "get_table_schema",
+                        lambda table_name, schema="flight": (columns, ()))
+    dataframe = pd.DataFrame({
+        "departureHour": pd.array([10, None, 40_000], dtype="Int64"),
+        "totalFare": pd.array([None, 10.5, 100.0], dtype="Float64"),
+    })
+
+    dataframe_valid, dataframe_not_valid = sv.validate_table(dataframe, "table", verbose=False)
+
+    assert list(dataframe_valid.index) == [0, 1]
+    assert list(dataframe_not_valid.index) == [2]
+    reason = dataframe_not_valid[sv.INSERT_ERROR_COLUMN].iloc[0]
+    assert "departureHour is out of the smallint range" in reason
+    assert "totalFare does not fit DECIMAL(4,2)" in reason
@@ -0,0 +1,210 @@
+import hashlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+class AdaptiveScheduler():
+    """Chooses how often each (route, flight_day) is collected.
+
+    The interval of a task grows with the days to departure and shrinks with the
+    fare change rate observed for the route at the same days to departure. The change
+    rate is the number of changes of the minimum totalFare per hour, so the chance
+    of the fare changing within k hours is 1 - exp(-rate * k).
+
+    The scheduler has no state besides the change rates: a task with interval k runs
+    when (hours since epoch + phase) % k == 0, where the phase is a hash of the task.
+    This spreads the requests evenly over the hours and gives the same answer on every
+    machine.
+    """
+    def __init__(self, max_interval_by_days=None, max_change_probability=0.5,
+                 change_rates=None):
+        """
+        Parameters
+        ----------
+        max_interval_by_days: list[tuple[int]] (default=None)
+            List of (days_to_departure, max_interval_hours), sorted by days. A task with
+            days to departure <= days can have at most max_interval_hours. Tasks beyond
+            the last days use the last interval. By default:
+            [(7, 1), (14, 2), (30, 6), (60, 12)]
+        max_change_probability: float (default=0.5)
+            Highest accepted chance of the fare changing between two collections.
+        change_rates: pd.DataFrame (default=None)
+            Output of get_change_rates. If it is None, only the days to departure
+            define the interval.
+        """
+        if max_interval_by_days is None:
+            max_interval_by_days = [(7, 1), (14, 2), (30, 6), (60, 12)]
+        assert 0 < max_change_probability < 1, "max_change_probability must be in (0, 1)."
+        self.max_interval_by_days = sorted(max_interval_by_days)
+        self.max_change_probability = max_change_probability
+        self.change_rates = dict()
+        if change_rates is not None:
+            self.set_change_rates(change_rates)
+
+    def set_change_rates(self, change_rates):
+        """Set the change rates used to define the intervals.
+
+        Parameters
+        ----------
+        change_rates: pd.DataFrame
+            Columns originCode, destinationCode, daysToDeparture and changeRate,
+            see get_change_rates.
+        """
+        self.change_rates = {
+            (origin, destination, int(days)): rate
+            for origin, destination, days, rate in zip(change_rates["originCode"],
+                                                      change_rates["destinationCode"],
+                                                      change_rates["daysToDeparture"],
+                                                      change_rates["changeRate"])
+        }
+
+    def get_interval(self, departure_airport, arrival_airport, days_to_departure):
+        """Get the collection interval of a task.
+
+        Return
+        ------
+        interval: int
+            Hours between two collections of the task, at least 1.
+        """
+        max_interval = self.max_interval_by_days[-1][1]
+        for days, interval in self.max_interval_by_days:
+            if days_to_departure <= days:
+                max_interval = interval
+                break
+
+        rate = self.change_rates.get((departure_airport, arrival_airport, days_to_departure))
+        if rate is None or rate <= 0:
+            return max_interval
+        # Largest interval with 1 - exp(-rate * interval) <= max_change_probability
+        interval = int(np.floor(-np.log(1 - self.max_change_probability) / rate))
+        return int(np.clip(interval, 1, max_interval))
+
+    def filter_tasks(self, tasks, date):
+        """Get the tasks that must be collected in the hour of date.
+
+        Parameters
+        ----------
+        tasks: list[tuple]
+            List of (flight_day, departure_airport, arrival_airport).
+        date: datetime.datetime
+            Date of the collection.
+
+        Return
+        ------
+        tasks_to_run: list[tuple]
+            Tasks of the hour.
+        report: dict
+            requests_ratio: fraction of the tasks that run this hour, on average.
+            estimated_coverage: expected fraction of the fare changes that are still
+                observed, considering only tasks with known change rates.
+        """
+        hours_since_epoch = int((date - datetime(1970, 1, 1)).total_seconds() // 3600)
+        tasks_to_run = list()
+        requests_ratio = list()
+        coverages = list()
+        coverage_weights = list()
+        for task in tasks:
+            flight_day, departure_airport, arrival_airport = task
+            days_to_departure = (flight_day - date.date()).days
+            interval = self.get_interval(departure_airport, arrival_airport, days_to_departure)
+            if (hours_since_epoch + self._phase(task)) % interval == 0:
+                tasks_to_run.append(task)
+            requests_ratio.append(1 / interval)
+
+            rate = self.change_rates.get((departure_airport, arrival_airport, days_to_departure))
+            if rate is not None and rate > 0:
+                # Changes in the same interval are seen as one change
+                coverages.append((1 - np.exp(-rate * interval)) / (rate * interval))
+                coverage_weights.append(rate)
+
+        report = {
+            "tasks": len(tasks),
+            "tasks_to_run": len(tasks_to_run),
+            "requests_ratio": float(np.mean(requests_ratio)) if requests_ratio else None,
+            "estimated_coverage": (float(np.average(coverages, weights=coverage_weights))
+                                   if coverages else None),
+        }
+        return tasks_to_run, report
+
+    @staticmethod
+    def _phase(task):
+        """Stable offset of the task, so tasks with the same interval run in different hours."""
+        key = "|".join(map(str, task))
+        return int(hashlib.md5(key.encode()).hexdigest()[:8], 16)
+
+
+def get_change_rates(fare_history):
+    """Compute the fare change rate per route and days to departure.
+
+    Parameters
+    ----------
+    fare_history: pd.DataFrame
+        Columns originCode, destinationCode, flightDay, operationalSearchTime and
+        totalFare, one line per fare, e.g. from the search and fare tables or from the
+        structured parquet (see read_fare_history_parquet).
+
+    Return
+    ------
+    change_rates: pd.DataFrame
+        Columns originCode, destinationCode, daysToDeparture, changes, gaps, hours and
+        changeRate (changes of the minimum totalFare per hour).
+
+    A gap between two observations only shows if the fare changed, not how many
+    times, and a change that reverts is not seen at all, so changes / hours would be
+    too low for long gaps. The changes are taken as a Poisson process: a gap of
+    mean_gap hours has a change with probability 1 - exp(-rate * mean_gap), whose
+    maximum likelihood estimate is changes / gaps, so
+    rate = -log(1 - changes / gaps) / mean_gap. When every gap has a change the
+    estimate is unbounded, half a change less is used.
+    """
+    fare_history = fare_history.copy()
+    fare_history["operationalSearchTime"] = pd.to_datetime(fare_history["operationalSearchTime"])
+    fare_history["flightDay"] = pd.to_datetime(fare_history["flightDay"])
+    task_columns = ["originCode", "destinationCode", "flightDay"]
+
+    min_fare = (
+        fare_history
+        .groupby(task_columns + ["operationalSearchTime"], observed=True)["totalFare"]
+        .min()
+        .reset_index()
+        .sort_values(task_columns + ["operationalSearchTime"])
+    )
+    grouped = min_fare.groupby(task_columns, observed=True)
+    min_fare["changes"] = (grouped["totalFare"].diff().fillna(0) != 0).astype(int)
+    min_fare["hours"] = (
+        grouped["operationalSearchTime"].diff().dt.total_seconds().fillna(0) / 3600
+    )
+    min_fare["daysToDeparture"] = (
+        min_fare["flightDay"] - min_fare["operationalSearchTime"].dt.normalize()
+    ).dt.days
+
+    # The first observation of each task has no gap before it
+    min_fare = min_fare[min_fare["hours"] > 0]
+
+    change_rates = (
+        min_fare
+        .groupby(["originCode", "destinationCode", "daysToDeparture"], observed=True)
+        .agg(changes=("changes", "sum"), gaps=("changes", "size"), hours=("hours", "sum"))
+        .reset_index()
+    )
+    change_fraction = (np.minimum(change_rates["changes"], change_rates["gaps"] - 0.5)
+                       / change_rates["gaps"])
+    mean_gap = change_rates["hours"] / change_rates["gaps"]
+    change_rates["changeRate"] = -np.log1p(-change_fraction) / mean_gap
+    return change_rates.reset_index(drop=True)
+
+
+def read_fare_history_parquet(parquet_paths):
+    """Read the columns used by get_change_rates from structured parquet files."""
+    columns = ["origin_code", "destination_code", "flight_day",
+               "operational_search_time", "totalFare"]
+    rename = {"origin_code": "originCode", "destination_code": "destinationCode",
+              "flight_day": "flightDay", "operational_search_time": "operationalSearchTime"}
+    fare_history = pd.concat(
+        [pd.read_parquet(parquet_path, columns=columns) for parquet_path in parquet_paths],
+        ignore_index=True
+    )
+    fare_history["totalFare"] = pd.to_numeric(fare_history["totalFare"], errors="coerce")
+    return fare_history.rename(columns=rename)
@@ -0,0 +1,309 @@
+import os
+import re
+import sqlite3
+from datetime import datetime, timedelta
+
+OUTCOMES = ["success", "empty", "error"]
+
+
+class RouteCircuitBreaker():
+    """Stops collecting routes that keep returning empty or invalid data.
+
+    Each (departure_airport, arrival_airport, flight_day) has a state:
+    - closed: the task is collected normally.
+    - open: after failure_threshold consecutive empty or failed results the task is
+      skipped until open_until.
+    - half_open: after open_until one probe is allowed, and the next probe waits one
+      more backoff. A success closes the circuit, a failure opens it again with
+      twice the backoff, up to max_backoff_hours.
+
+    The results come from the scraper (see get_response_outcome) or from the
+    extraction error log (see update_from_extraction). Each key counts one result per
+    collection time, a result that is not newer than the last one of its key is
+    ignored, so the extraction of an hour already recorded by the scraper, or of an
+    older hour, does not count it twice. The states are kept in a SQLite database.
+    """
+    def __init__(self, db_path, failure_threshold=6, base_backoff_hours=6,
+                 max_backoff_hours=7 * 24):
+        """
+        Parameters
+        ----------
+        db_path: str
+            Path of the SQLite database, it is created if it does not exist.
+        failure_threshold: int (default=6)
+            Consecutive empty or failed results that open the circuit.
+        base_backoff_hours: int (default=6)
+            Hours the circuit stays open the first time.
+        max_backoff_hours: int (default=168)
+            Maximum hours the circuit stays open.
+        """
+        self.db_path = db_path
+        self.failure_threshold = failure_threshold
+        self.base_backoff_hours = base_backoff_hours
+        self.max_backoff_hours = max_backoff_hours
+        self._create_table()
+
+    def record(self, departure_airport, arrival_airport, flight_day, outcome, date=None):
+        """Record the result of one collection.
+
+        Parameters
+        ----------
+        departure_airport: str
+            Three-character IATA airport code for the initial location.
+        arrival_airport: str
+            Three-character IATA airport code for the arrival location.
+        flight_day: datetime.date or str
+            Day of the flight, a str in the format "%Y-%m-%d".
+        outcome: str
+            One of "success", "empty" (no legs or offers) or "error".
+        date: datetime.datetime (default=None)
+            Collection time of the result, by default now.
+        """
+        self.record_many([(departure_airport, arrival_airport, flight_day, outcome)],
+                         date=date)
+
+    def record_many(self, results, date=None):
+        """Record several results, see record.
+
+        Parameters
+        ----------
+        results: list[tuple]
+            List of (departure_airport, arrival_airport, flight_day, outcome).
+        date: datetime.datetime (default=None)
+            Collection time of the results, by default now.
+        """
+        if date is None:
+            date = datetime.now()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for departure_airport, arrival_airport, flight_day, outcome in results:
+                assert outcome in OUTCOMES, f"outcome must be one of {OUTCOMES}"
+                key = (departure_airport, arrival_airport, str(flight_day))
+                state = self._get_state(conn, key)
+                if (state["updated_at"] is not None
+                        and date <= datetime.fromisoformat(state["updated_at"])):
+                    continue
+                state[f"total_{outcome}"] += 1
+
+                if outcome == "success":
+                    state.update({"state": "closed", "consecutive_failures": 0,
+                                  "backoff_hours": self.base_backoff_hours,
+                                  "open_until": None})
+                else:
+                    state["consecutive_failures"] += 1
+                    if state["state"] == "half_open":
+                        state["backoff_hours"] = min(state["backoff_hours"] * 2,
+                                                     self.max_backoff_hours)
+                        self._open(state, date)
+                    elif (state["state"] == "closed"
+                          and state["consecutive_failures"] >= self.failure_threshold):
+                        self._open(state, date)
+                self._save_state(conn, key, state, date)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def filter_tasks(self, tasks, date):
+        """Remove the tasks whose circuit is open.
+
+        Tasks whose backoff has ended are kept as probes and their circuit becomes
+        half_open.
+
+        Parameters
+        ----------
+        tasks: list[tuple]
+            List of (flight_day, departure_airport, arrival_airport).
+        date: datetime.datetime
+            Date of the collection.
+
+        Return
+        ------
+        allowed_tasks: list[tuple]
+            Tasks that should be collected.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            blocked_states = {
+                (row[0], row[1], row[2]): (row[3], row[4], row[5])
+                for row in conn.execute("""
+                    SELECT departure_airport, arrival_airport, flight_day,
+                           state, open_until, backoff_hours
+                    FROM route_state
+                    WHERE state != 'closed'
+                """)
+            }
+            allowed_tasks = list()
+            for task in tasks:
+                flight_day, departure_airport, arrival_airport = task
+                key = (departure_airport, arrival_airport, str(flight_day))
+                if key not in blocked_states:
+                    allowed_tasks.append(task)
+                    continue
+
+                state, open_until, backoff_hours = blocked_states[key]
+                if datetime.fromisoformat(open_until) <= date:
+                    # Probe, the next probe waits until the result of this one is known
+                    allowed_tasks.append(task)
+                    conn.execute("""
+                        UPDATE route_state SET state = 'half_open', open_until = ?
+                        WHERE departure_airport = ? AND arrival_airport = ? AND flight_day = ?
+                    """, ((date + timedelta(hours=backoff_hours)).isoformat(), *key))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return allowed_tasks
+
+    def update_from_extraction(self, json_paths, error_log_df, date=None):
+        """Record the results of FlightExtractor.
+
+        The results are recorded in the order of the collection hours, each one with
+        the time of its hour, so a backfill of several hours or days gives the same
+        states as extracting each hour when it was collected.
+
+        Parameters
+        ----------
+        json_paths: list[str]
+            All json's structured by the extractor.
+        error_log_df: pd.DataFrame
+            Error log returned by FlightExtractor.structure_all_jsons. Files with
+            "Legs or offers with len 0" are empty results, other errors are errors and
+            files not in the log, or only with WARNING_PREFIX messages, are successes.
+        date: datetime.datetime (default=None)
+            Date of the results whose path has no collection time, by default now.
+        """
+        # Imported here, flight_extractor imports this module
+        from flight_extractor import WARNING_PREFIX
+
+        if date is None:
+            date = datetime.now()
+        # Warnings, e.g. offers without leg, are logged for files that were structured
+        errors = error_log_df[~error_log_df["error_message"].str.startswith(WARNING_PREFIX)]
+        error_messages = dict(zip(errors["json_path"], errors["error_message"]))
+        results_by_time = dict()
+        for json_path in json_paths:
+            task_info = self.get_task_from_path(json_path)
+            if task_info is None:
+                continue
+            error_message = error_messages.get(json_path)
+            if error_message is None:
+                outcome = "success"
+            elif "len 0" in error_message:
+                outcome = "empty"
+            else:
+                outcome = "error"
+            collection_time = self.get_collection_time_from_path(json_path) or date
+            results_by_time.setdefault(collection_time, []).append((*task_info, outcome))
+        for collection_time, results in sorted(results_by_time.items()):
+            self.record_many(results, date=collection_time)
+
+    def get_statistics(self):
+        """Get the state and the result counts of every (route, flight_day).
+
+        Return
+        ------
+        statistics: list[dict]
+            One dict per key with the state, consecutive failures, totals and open_until.
+        """
+        conn = self._connect()
+        try:
+            conn.row_factory = sqlite3.Row
+            statistics = [dict(row) for row in conn.execute("SELECT * FROM route_state")]
+        finally:
+            conn.close()
+        return statistics
+
+    @staticmethod
+    def get_task_from_path(json_path):
+        """Get (departure_airport, arrival_airport, flight_day) from a json path."""
+        flight_day = re.findall(r"flight_day_(\d{4}-\d{2}-\d{2})", json_path)
+        if len(flight_day) == 0:
+            return None
+        departure_airport, arrival_airport = (
+            os.path.basename(json_path).split(".")[0].split("_to_")
+        )
+        return departure_airport, arrival_airport, flight_day[0]
+
+    @staticmethod
+    def get_collection_time_from_path(json_path):
+        """Get the collection time from the "today_<date>/hour_<hour>_minute_<minute>"
+        folders of a json path, None if the path has no hour folder."""
+        collection_time = re.findall(r"today_(\d{4}-\d{2}-\d{2})/hour_(\d+)_minute_(\d+)",
+                                     json_path)
+        if len(collection_time) == 0:
+            return None
+        today, hour, minute = collection_time[0]
+        return datetime.strptime(today, "%Y-%m-%d").replace(hour=int(hour), minute=int(minute))
+
+    @staticmethod
+    def get_response_outcome(request_json):
+        """Get the outcome of a collected json with the checks of
+        FlightExtractor._data_checks: "error" if a necessary key is missing, "empty"
+        if it has no legs or offers and "success" otherwise."""
+        necessary_keys = ["legs", "offers", "search_time", "searchCities"]
+        if not all(key in request_json for key in necessary_keys):
+            return "error"
+        if len(request_json["legs"]) == 0 or len(request_json["offers"]) == 0:
+            return "empty"
+        return "success"
+
+    def _open(self, state, date):
+        state["state"] = "open"
+        state["open_until"] = (date + timedelta(hours=state["backoff_hours"])).isoformat()
+
+    def _get_state(self, conn, key):
+        row = conn.execute("""
+            SELECT state, consecutive_failures, total_success, total_empty, total_error,
+                   backoff_hours, open_until, updated_at
+            FROM route_state
+            WHERE departure_airport = ? AND arrival_airport = ? AND flight_day = ?
+        """, key).fetchone()
+        columns = ["state", "consecutive_failures", "total_success", "total_empty",
+                   "total_error", "backoff_hours", "open_until", "updated_at"]
+        if row is None:
+            row = ("closed", 0, 0, 0, 0, self.base_backoff_hours, None, None)
+        return dict(zip(columns, row))
+
+    def _save_state(self, conn, key, state, date):
+        conn.execute("""
+            INSERT OR REPLACE INTO route_state
+                (departure_airport, arrival_airport, flight_day, state,
+                 consecutive_failures, total_success, total_empty, total_error,
+                 backoff_hours, open_until, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (*key, state["state"], state["consecutive_failures"], state["total_success"],
+              state["total_empty"], state["total_error"], state["backoff_hours"],
+              state["open_until"], date.isoformat()))
+
+    def _create_table(self):
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS route_state (
+                    departure_airport TEXT NOT NULL,
+                    arrival_airport TEXT NOT NULL,
+                    flight_day TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    consecutive_failures INTEGER NOT NULL,
+                    total_success INTEGER NOT NULL,
+                    total_empty INTEGER NOT NULL,
+                    total_error INTEGER NOT NULL,
+                    backoff_hours REAL NOT NULL,
+                    open_until TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (departure_airport, arrival_airport, flight_day)
+                )
+            """)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
@@ -1,3 +1,5 @@
+import hashlib
+from bisect import bisect
 from datetime import datetime
 
 
@@ -5,8 +7,16 @@ class CoordinateScraper():
     """Coordinates at what time each machine should collect data.
     
     The class assumes that data will be collected hourly.
+
+    There are two modes:
+    - hour: check_should_run_hour chooses one machine to collect all the data of an hour.
+    - sharding: every machine that runs on the date collects, every hour, only its share
+      of the (flight_day, route) tasks, see get_machine_tasks. The tasks are split with
+      consistent hashing, so adding or removing a machine moves only the tasks of that
+      machine, and each machine computes its share without a central service.
     """
-    def __init__(self, machines_number=3, machines_per_date=2, base_date=None):
+    def __init__(self, machines_number=3, machines_per_date=2, base_date=None,
+                 virtual_nodes=100):
         """Initialize the class.
 
         Parameters
@@ -17,6 +27,9 @@ class CoordinateScraper():
             Number of machines that will run the scraper per date.
         base_date: datetime.datetime (default=datetime(2000, 12, 11, 10, 27, 30))
             Base date, used as a reference to define which machine runs at what time.
+        virtual_nodes: int (default=100)
+            Number of points of each machine on the consistent hashing ring, more points
+            split the tasks more evenly. Used only in the sharding mode.
         """
         assert machines_per_date <= machines_number, ("machines_per_date must be "
                                                       "less than or equal to machines_number")
@@ -28,8 +41,10 @@ class CoordinateScraper():
             self.base_date = base_date
         self.machines_number = machines_number
         self.machines_per_date = machines_per_date
+        self.virtual_nodes = virtual_nodes
         self.complete_relay_cycle = None
         self.timesheet = None
+        self.hash_rings = dict()
         
     def check_should_run_hour(self, date, machine_id):
         """Checks if the machine should run in a hour.
@@ -165,6 +180,79 @@ class CoordinateScraper():
                 self.complete_relay_cycle = complete_relay_cycle
         return self.complete_relay_cycle    
 
+    def get_machine_tasks(self, date, machine_id, tasks):
+        """Get the tasks that the machine must collect on a date in the sharding mode.
+
+        Parameters
+        ----------
+        date: datetime.datetime
+            Date to check.
+        machine_id: int
+            The number that identifies the machine.
+        tasks: list[tuple]
+            All tasks of the hour, e.g. (flight_day, departure_airport, arrival_airport).
+            Every machine must receive the same list.
+
+        Return
+        ------
+        machine_tasks: list[tuple]
+            Tasks of the machine, empty if the machine does not run on the date.
+        """
+        self.__assert_machine_values(machine_id)
+        self.__assert_date(date)
+
+        if not self.check_should_run_date(date, machine_id):
+            return list()
+        machines_run_date = self.get_machines_run_date(date)
+        machine_tasks = [task for task in tasks
+                         if self.get_task_machine(task, machines_run_date) == machine_id]
+        return machine_tasks
+
+    def get_task_machine(self, task, machines):
+        """Get the machine responsible for a task with consistent hashing.
+
+        Parameters
+        ----------
+        task: tuple
+            Task identifier, its str representation is hashed.
+        machines: list[int]
+            Machines that share the tasks.
+
+        Return
+        ------
+        machine_id: int
+            The machine responsible for the task.
+        """
+        ring_hashes, ring_machines = self.get_hash_ring(machines)
+        index = bisect(ring_hashes, self._hash("|".join(map(str, task))))
+        # The ring is circular, hashes after the last point belong to the first one
+        return ring_machines[index % len(ring_machines)]
+
+    def get_hash_ring(self, machines):
+        """Get the consistent hashing ring of a group of machines.
+
+        Return
+        ------
+        ring_hashes: list[int]
+            Sorted positions of the points of the ring.
+        ring_machines: list[int]
+            Machine of each point of the ring.
+        """
+        key = tuple(sorted(machines))
+        if key not in self.hash_rings:
+            ring = sorted(
+                (self._hash(f"machine_{machine_id}_node_{node}"), machine_id)
+                for machine_id in key
+                for node in range(self.virtual_nodes)
+            )
+            self.hash_rings[key] = ([point[0] for point in ring], [point[1] for point in ring])
+        return self.hash_rings[key]
+
+    @staticmethod
+    def _hash(value):
+        """Hash that does not change between processes and machines, unlike hash()."""
+        return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
     def __assert_machine_values(self, machine_id):
         machine_values = list(range(1, self.machines_number+1))
         assert machine_id in machine_values, (
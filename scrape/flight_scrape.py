@@ -1,16 +1,25 @@
 import itertools
 import json
+import sys
 import traceback
-from datetime import date, datetime, timedelta
-from os import makedirs
-from os.path import dirname, join, isfile
+from datetime import datetime, timedelta
+from os import cpu_count, makedirs
+from os.path import abspath, dirname, join, isfile
 from time import sleep, time
 
+import pandas as pd
 import requests
 from joblib import Parallel, delayed
 
+from adaptive_scheduler import AdaptiveScheduler
+from circuit_breaker import RouteCircuitBreaker
 from coordinate_scraper import CoordinateScraper
 from log_manager import LogManager
+from task_queue import ScrapeTaskQueue
+
+# The scraper runs from cron, so the path must not depend on the working directory
+sys.path.append(join(dirname(abspath(__file__)), "..", "utils"))
+from metrics import StageMetrics, measure_stage
 
 
 # United States of America airports
@@ -32,10 +41,15 @@ AIRPORTS = ["BSB", "CGH", "GRU", "POA", "CNF", "GIG", "SDU", "SSA", "MAO"]
 AIRPORT_PAIRS = [pair for pair in itertools.product(AIRPORTS, repeat = 2)
                  if pair[0] != pair[1] and pair not in black_list]
 
+EXPEDIA_URL = "https://www.expedia.com"
+# Written in the hour folder when all tasks of the hour were processed
+COMPLETED_MARKER = "_COMPLETED"
+
 def collect_flight_data(today, hour, minute, departure_airport,
                         arrival_airport, flight_day,
                         maxExceptions=5, overwrite_data=False,
-			path=""):
+			path="", base_url=EXPEDIA_URL, timeout=None,
+                        retry_sleep_seconds=10, return_outcome=False):
     """ Air ticket price web scraper.
 
     Collects the data and saves it in json format in the correct folder structure
@@ -59,13 +73,25 @@ def collect_flight_data(today, hour, minute, departure_airport,
         If True overwrite already computed data, if False do not overwrite
     path: str
 	Directory where data should be saved
+    base_url: str (default=EXPEDIA_URL)
+        Server that answers /api/flight/search, it can point to a local stub server
+    timeout: float (default=None)
+        Seconds to wait for the server answer, None waits forever
+    retry_sleep_seconds: float (default=10)
+        Seconds to wait before a new attempt
+    return_outcome: bool (default=False)
+        If True the outcome of RouteCircuitBreaker.get_response_outcome is returned
+        too, "error" if failure occurred and None if the data had already been computed
     Return
     ------
     success: bool
         True if the data was successfully collected, False if failure occurred
         and None if the data had already been computed
+    outcome: str
+        Only if return_outcome is True
     """
     success = False
+    outcome = "error"
     exceptionCounter = 0
     while True:
         try:
@@ -76,12 +102,13 @@ def collect_flight_data(today, hour, minute, departure_airport,
             if isfile(filename) and not overwrite_data:
                 print("Data already computed")
                 success = None
+                outcome = None
                 break
 
 	    # Read the HTML of the webpage
-            URL = (f"https://www.expedia.com/api/flight/search?departureDate={flight_day}"
+            URL = (f"{base_url}/api/flight/search?departureDate={flight_day}"
                    f"&departureAirport={departure_airport}&arrivalAirport={arrival_airport}")
-            request_json = requests.get(URL).json()
+            request_json = requests.get(URL, timeout=timeout).json()
 
             # Recording the search time
             request_json["search_time"] = datetime.now().isoformat()
@@ -95,30 +122,57 @@ def collect_flight_data(today, hour, minute, departure_airport,
 
             print("SUCCESS" + "!"*20)
             success = True
+            outcome = RouteCircuitBreaker.get_response_outcome(request_json)
             break
 
         except Exception:
             # Increments the exception counter
             exceptionCounter += 1
 
-            # Displays the error and leaves the code on hold for 10 seconds
+            # Displays the error
             print(f"Error detected at flight_day {flight_day} for departure_airporture"
                   f"{departure_airport} and arrival {arrival_airport}:")
             # traceback.print_exc() # Print error occurred
-            sleep(10)
 
             # If the number of attempts has been exceeded, then go to the next run
             if exceptionCounter > maxExceptions:
                 print('Skipping...')
                 break
             else:
+                # Leaves the code on hold before the next attempt
+                sleep(retry_sleep_seconds)
                 print('Continuing...')
+    if return_outcome:
+        return success, outcome
     return success
 
 
+def get_scrape_tasks(today, max_additional_day=60):
+    """ Lists all (flight_day, departure_airport, arrival_airport) tasks of an hour.
+    Parameters
+    ----------
+    today: datetime.date
+        Current day, represents the day data is being collected
+    max_additional_day: int (default=60)
+        Maximum number of attempts per flight day/departure airport/arrival airport
+    Return
+    ------
+    tasks: list[tuple]
+        List of (flight_day, departure_airport, arrival_airport)
+    """
+    flight_day_list = [today + timedelta(days = additional_day)
+                       for additional_day in range(1, max_additional_day+1)]
+    tasks = [(flight_day, departure_airport, arrival_airport)
+             for flight_day in flight_day_list
+             for departure_airport, arrival_airport in AIRPORT_PAIRS]
+    return tasks
+
+
 def runner_collect_flight_data(max_additional_day=60, maxExceptions=5,
                                n_jobs=-1, hour=None, minute=None,
-			       overwrite_data=False, path=""):
+			       overwrite_data=False, path="", base_url=EXPEDIA_URL,
+                               tasks=None, circuit_breaker=None, timeout=None,
+                               retry_sleep_seconds=10, today=None):
     """ Runs collect_flight_data in parallel.
     Parameters
     ----------
@@ -139,11 +193,29 @@ def runner_collect_flight_data(max_additional_day=60, maxExceptions=5,
         If True overwrite already computed data, if False do not overwrite
     path: str
         Directory where data should be saved
+    base_url: str (default=EXPEDIA_URL)
+        Server that answers /api/flight/search, it can point to a local stub server
+    tasks: list[tuple] (default=None)
+        List of (flight_day, departure_airport, arrival_airport) to collect. If the
+        value is None, all tasks of get_scrape_tasks are collected
+    circuit_breaker: RouteCircuitBreaker (default=None)
+        If it is not None, the outcome of each collection is recorded on it
+    timeout: float (default=None)
+        Seconds to wait for the server answer, None waits forever
+    retry_sleep_seconds: float (default=10)
+        Seconds to wait before a new attempt
+    today: datetime.date (default=None)
+        Day of the collection folder. If the value is None, the current day is used
+    Return
+    ------
+    success_list: list
+        Output of collect_flight_data for each task, in the order of tasks
     """
-    today = date.today()
     now = datetime.now()
-    flight_day_list = [today + timedelta(days = additional_day)
-                       for additional_day in range(1, max_additional_day+1)]
+    if today is None:
+        today = now.date()
+    if tasks is None:
+        tasks = get_scrape_tasks(today, max_additional_day=max_additional_day)
 
     if hour is None:
         hour = now.hour
@@ -151,18 +223,322 @@ def runner_collect_flight_data(max_additional_day=60, maxExceptions=5,
         minute = now.minute
 
     delayed_list = list()
-    for flight_day in flight_day_list:
-        for departure_airport, arrival_airport in AIRPORT_PAIRS:
-            delayed_list.append(
-                delayed(collect_flight_data)(
-                    today, hour, minute, departure_airport,
-                    arrival_airport, flight_day,
-                    maxExceptions=maxExceptions,
-                    overwrite_data=overwrite_data,
-		    path=path
-                )
+    for flight_day, departure_airport, arrival_airport in tasks:
+        delayed_list.append(
+            delayed(collect_flight_data)(
+                today, hour, minute, departure_airport,
+                arrival_airport, flight_day,
+                maxExceptions=maxExceptions,
+                overwrite_data=overwrite_data,
+                path=path,
+                base_url=base_url,
+                timeout=timeout,
+                retry_sleep_seconds=retry_sleep_seconds,
+                return_outcome=True
+            )
+        )
+    with StageMetrics("scrape.runner_collect_flight_data", rows=len(delayed_list),
+                      n_jobs=n_jobs) as stage_metrics:
+        results = Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(delayed_list)
+        success_list = [success for success, _ in results]
+        stage_metrics.labels["failed"] = sum(success is False for success in success_list)
+
+    if circuit_breaker is not None:
+        # The hour already computed (outcome None) was recorded when it was collected
+        run_time = datetime.combine(today, datetime.min.time()).replace(hour=int(hour),
+                                                                        minute=int(minute))
+        circuit_breaker.record_many([
+            (departure_airport, arrival_airport, flight_day, outcome)
+            for (flight_day, departure_airport, arrival_airport), (_, outcome)
+            in zip(tasks, results) if outcome is not None
+        ], date=run_time)
+    mark_hour_completed(path, today, hour, minute, n_tasks=len(tasks),
+                        n_failed=sum(success is False for success in success_list))
+    return success_list
+
+
+def mark_hour_completed(path, today, hour, minute, n_tasks, n_failed):
+    """ Writes the COMPLETED_MARKER file, the hour folder can be extracted.
+    Parameters
+    ----------
+    path: str
+        Directory where data is saved
+    today: datetime.date
+        Day of the collection
+    hour: int
+        Hour of the collection folder
+    minute: int
+        Minute of the collection folder
+    n_tasks: int
+        Number of tasks of the hour
+    n_failed: int
+        Number of tasks that could not be collected
+    """
+    hour_path = join(path, "data", f"today_{today}", f"hour_{hour}_minute_{minute}")
+    makedirs(hour_path, exist_ok=True)
+    with open(join(hour_path, COMPLETED_MARKER), "w") as file:
+        json.dump({"finished_at": datetime.now().isoformat(), "tasks": n_tasks,
+                   "failed": n_failed}, file)
+
+@measure_stage("scrape.collect_from_queue", rows=lambda n_tasks: n_tasks)
+def collect_from_queue(queue_path, maxExceptions=0, overwrite_data=True, path="",
+                       base_url=EXPEDIA_URL, circuit_breaker_path=None):
+    """ Collects tasks leased from the queue until there is no available task.
+    Parameters
+    ----------
+    queue_path: str
+        Path of the ScrapeTaskQueue database
+    maxExceptions: int (default=0)
+        Maximum number of attempts inside collect_flight_data, the queue
+        already retries failed tasks with backoff
+    overwrite_data: bool (default=True)
+        If True overwrite already computed data. The queue knows which tasks
+        are done, so the file check is not needed
+    path: str
+        Directory where data should be saved
+    base_url: str (default=EXPEDIA_URL)
+        Server that answers /api/flight/search, it can point to a local stub server
+    circuit_breaker_path: str (default=None)
+        If it is not None, the outcome of each collected task is recorded on the
+        RouteCircuitBreaker of this path. Failed tasks are retried by the queue, they
+        are recorded by mark_finished_runs_completed
+    Return
+    ------
+    n_tasks: int
+        Number of tasks processed by this worker
+    """
+    queue = ScrapeTaskQueue(queue_path)
+    circuit_breaker = None
+    if circuit_breaker_path is not None:
+        circuit_breaker = RouteCircuitBreaker(circuit_breaker_path)
+    worker_id = queue.get_worker_id()
+    n_tasks = 0
+    while True:
+        tasks = queue.lease(worker_id=worker_id)
+        if len(tasks) == 0:
+            break
+        for task in tasks:
+            today, hour, minute = task["run_id"].split("_")
+            success, outcome = collect_flight_data(
+                today, hour, minute, task["departure_airport"],
+                task["arrival_airport"], task["flight_day"],
+                maxExceptions=maxExceptions, overwrite_data=overwrite_data,
+                path=path, base_url=base_url, return_outcome=True
+            )
+            # None means the data had already been computed
+            queue.complete(task["task_id"], success is not False, worker_id=worker_id,
+                           error_message=None if success is not False else "collect failed")
+            if circuit_breaker is not None and success is True:
+                run_time = datetime.strptime(today, "%Y-%m-%d").replace(hour=int(hour),
+                                                                         minute=int(minute))
+                circuit_breaker.record(task["departure_airport"], task["arrival_airport"],
+                                       task["flight_day"], outcome, date=run_time)
+            n_tasks += 1
+    return n_tasks
+
+
+def runner_collect_flight_data_queue(queue_path, max_additional_day=60, n_jobs=-1,
+                                     hour=None, minute=None, path="",
+                                     base_url=EXPEDIA_URL, tasks=None, circuit_breaker=None,
+                                     today=None):
+    """ Enqueues the tasks of this hour and runs queue workers in parallel.
+
+    Tasks that were not finished by previous runs stay in the queue and are
+    collected too, the ones closer to the flight day first. The hours of this and
+    of the previous runs whose tasks are all done or failed are marked as completed,
+    so an hour with a retry waiting for its backoff is completed by a later run.
+    Parameters
+    ----------
+    queue_path: str
+        Path of the ScrapeTaskQueue database
+    max_additional_day: int (default=60)
+        Maximum number of attempts per flight day/departure airport/arrival airport
+    n_jobs: int (default=-1)
+        Number of queue workers. By default -1 which uses all cores
+    hour: int (default=None)
+        Time the function was called. If the value is None, the variable
+        is calculated automatically
+    minute: int (default=None)
+        Minute in which function was called. If the value is None,
+        the variable is calculated automatically
+    path: str
+        Directory where data should be saved
+    base_url: str (default=EXPEDIA_URL)
+        Server that answers /api/flight/search, it can point to a local stub server
+    tasks: list[tuple] (default=None)
+        List of (flight_day, departure_airport, arrival_airport) to enqueue. If the
+        value is None, all tasks of get_scrape_tasks are enqueued
+    circuit_breaker: RouteCircuitBreaker (default=None)
+        If it is not None, the outcome of the collected tasks is recorded on it by the
+        workers, and the tasks that failed all their attempts when their hour is
+        completed
+    today: datetime.date (default=None)
+        Day of the collection folder and of the run_id. If the value is None, the
+        current day is used
+    Return
+    ------
+    status_counts: dict
+        Number of tasks of this run by status
+    """
+    now = datetime.now()
+    if today is None:
+        today = now.date()
+    if tasks is None:
+        tasks = get_scrape_tasks(today, max_additional_day=max_additional_day)
+    if hour is None:
+        hour = now.hour
+    if minute is None:
+        minute = now.minute
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+
+    queue = ScrapeTaskQueue(queue_path)
+    run_id = f"{today}_{hour}_{minute}"
+    # Flights closer to the departure have higher priority
+    priorities = [-(flight_day - today).days for flight_day, _, _ in tasks]
+    n_enqueued = queue.enqueue(run_id, tasks, priorities=priorities)
+    print(f"{n_enqueued} tasks enqueued, run_id = {run_id}")
+
+    with StageMetrics("scrape.runner_collect_flight_data_queue", rows=len(tasks),
+                      n_jobs=n_jobs):
+        Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(
+            delayed(collect_from_queue)(
+                queue_path, path=path, base_url=base_url,
+                circuit_breaker_path=(circuit_breaker.db_path
+                                      if circuit_breaker is not None else None)
             )
-    Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(delayed_list)
+            for _ in range(n_jobs)
+        )
+    status_counts = queue.get_status_counts(run_id=run_id)
+    print(f"Queue status of {run_id}: {status_counts}")
+    mark_finished_runs_completed(queue, path, circuit_breaker=circuit_breaker)
+    return status_counts
+
+
+def mark_finished_runs_completed(queue, path, circuit_breaker=None):
+    """ Marks the hours of the queue runs whose tasks are all done or failed.
+
+    Failed tasks are not retried anymore, pending or leased ones keep the hour open.
+    Parameters
+    ----------
+    queue: ScrapeTaskQueue
+        Queue of the runs
+    path: str
+        Directory where data is saved
+    circuit_breaker: RouteCircuitBreaker (default=None)
+        If it is not None, the failed tasks of the newly completed hours are
+        recorded on it
+    Return
+    ------
+    completed_run_ids: list[str]
+        Runs whose hour was marked by this call
+    """
+    completed_run_ids = list()
+    for run_id, status_counts in sorted(queue.get_finished_runs().items()):
+        today, hour, minute = run_id.split("_")
+        hour_path = join(path, "data", f"today_{today}", f"hour_{hour}_minute_{minute}")
+        if isfile(join(hour_path, COMPLETED_MARKER)):
+            continue
+        failed_tasks = queue.get_failed_tasks(run_id)
+        if circuit_breaker is not None and len(failed_tasks) > 0:
+            run_time = datetime.strptime(today, "%Y-%m-%d").replace(hour=int(hour),
+                                                                     minute=int(minute))
+            circuit_breaker.record_many([
+                (departure_airport, arrival_airport, flight_day, "error")
+                for flight_day, departure_airport, arrival_airport in failed_tasks
+            ], date=run_time)
+        mark_hour_completed(path, today, hour, minute,
+                            n_tasks=status_counts["done"] + status_counts["failed"],
+                            n_failed=status_counts["failed"])
+        completed_run_ids.append(run_id)
+        print(f"Hour of {run_id} completed: {status_counts}")
+    return completed_run_ids
+
+
+def run_scrape(now, path, coordinate_scraper, machine_id, n_jobs=-1, hour=None,
+               minute=None, overwrite_data=False, sharding=False, use_task_queue=False,
+               queue_path=None, adaptive_schedule=False, change_rates=None,
+               use_circuit_breaker=False, circuit_breaker_path=None):
+    """ Runs the collection of one hour, as the cron job or the pipeline daemon do.
+    Parameters
+    ----------
+    now: datetime.datetime
+        Start of the collection
+    path: str
+        Directory where data should be saved
+    coordinate_scraper: CoordinateScraper
+        Decides if this machine should collect in this hour or which tasks it collects
+    machine_id: int
+        Id of this machine in coordinate_scraper
+    n_jobs: int (default=-1)
+        Number of machine cores that should be used for parallelism
+    hour: int (default=None)
+        Hour of the collection folder, None uses the hour of now
+    minute: int (default=None)
+        Minute of the collection folder, None uses the minute of now
+    overwrite_data: bool (default=False)
+        If True overwrite already computed data, if False do not overwrite
+    sharding: bool (default=False)
+        If True every machine of the date collects its share of the tasks every hour
+    use_task_queue: bool (default=False)
+        If True the tasks go through a durable queue with leases and retries
+    queue_path: str (default=None)
+        Path of the ScrapeTaskQueue database, used if use_task_queue is True
+    adaptive_schedule: bool (default=False)
+        If True each task is collected at an interval defined by its days to
+        departure and by its fare change rate
+    change_rates: pd.DataFrame (default=None)
+        Change rates of AdaptiveScheduler, see run_fit_adaptive_schedule.py
+    use_circuit_breaker: bool (default=False)
+        If True routes that keep returning empty data are skipped for a while
+    circuit_breaker_path: str (default=None)
+        Path of the RouteCircuitBreaker database, used if use_circuit_breaker is True
+    Return
+    ------
+    should_run: bool
+        True if this machine collected data in this hour
+    """
+    # A run that starts late, e.g. when the daemon was busy, keeps the folder of its
+    # scheduled time now
+    if hour is None:
+        hour = now.hour
+    if minute is None:
+        minute = now.minute
+    tasks = None
+    circuit_breaker = None
+    if use_circuit_breaker:
+        circuit_breaker = RouteCircuitBreaker(circuit_breaker_path)
+        tasks = circuit_breaker.filter_tasks(get_scrape_tasks(now.date()), now)
+        print(f"Circuit breaker: {len(tasks)} tasks allowed")
+    if adaptive_schedule:
+        adaptive_scheduler = AdaptiveScheduler(change_rates=change_rates)
+        tasks, schedule_report = adaptive_scheduler.filter_tasks(
+            get_scrape_tasks(now.date()) if tasks is None else tasks, now
+        )
+        print(f"Adaptive schedule: {schedule_report}")
+    if sharding:
+        tasks = coordinate_scraper.get_machine_tasks(
+            now, machine_id, get_scrape_tasks(now.date()) if tasks is None else tasks
+        )
+        should_run = len(tasks) > 0
+        print(f"should_run = {should_run}, tasks = {len(tasks)}, start = {now}")
+    else:
+        should_run = coordinate_scraper.check_should_run_hour(now, machine_id)
+        should_run = should_run and (tasks is None or len(tasks) > 0)
+        print(f"should_run = {should_run}, start = {now}")
+    if should_run and use_task_queue:
+        runner_collect_flight_data_queue(queue_path, n_jobs=n_jobs, hour=hour, minute=minute,
+                                         path=path, tasks=tasks,
+                                         circuit_breaker=circuit_breaker, today=now.date())
+        print("Executed!\n\n")
+    elif should_run:
+        runner_collect_flight_data(n_jobs=n_jobs, hour=hour, minute=minute,
+                                   overwrite_data=overwrite_data, path=path,
+                                   tasks=tasks, circuit_breaker=circuit_breaker,
+                                   today=now.date())
+        print("Executed!\n\n")
+    return should_run
+
 
 if __name__ == "__main__":
     path = join("/home","mborges")
@@ -175,16 +551,31 @@ if __name__ == "__main__":
     machines_number = 3
     machines_per_date = 2
     machine_id = 1
+    # If True every machine of the date collects its share of the tasks every hour
+    sharding = False
+    # If True the tasks go through a durable queue with leases and retries
+    use_task_queue = False
+    queue_path = join(path, "scrape_task_queue.sqlite")
+    # If True each task is collected at an interval defined by its days to departure
+    # and by its fare change rate, see run_fit_adaptive_schedule.py
+    adaptive_schedule = False
+    change_rates_path = join(path, "adaptive_schedule_change_rates.csv")
+    # If True routes that keep returning empty data are skipped for a while
+    use_circuit_breaker = False
+    circuit_breaker_path = join(path, "route_circuit_breaker.sqlite")
     now = datetime.now()
 
     coordinate_scraper = CoordinateScraper(machines_number=machines_number,
                                            machines_per_date=machines_per_date)
-    should_run = coordinate_scraper.check_should_run_hour(now, machine_id)
-    print(f"should_run = {should_run}, start = {now}")
-    if should_run:
-        runner_collect_flight_data(n_jobs=n_jobs, hour=hour, minute=minute,
-                                   overwrite_data=overwrite_data, path=path)
-        print("Executed!\n\n")
+    change_rates = None
+    if adaptive_schedule and isfile(change_rates_path):
+        change_rates = pd.read_csv(change_rates_path)
+    run_scrape(now, path, coordinate_scraper, machine_id, n_jobs=n_jobs, hour=hour,
+               minute=minute, overwrite_data=overwrite_data, sharding=sharding,
+               use_task_queue=use_task_queue, queue_path=queue_path,
+               adaptive_schedule=adaptive_schedule, change_rates=change_rates,
+               use_circuit_breaker=use_circuit_breaker,
+               circuit_breaker_path=circuit_breaker_path)
     end = datetime.now()
     print(f"end = {end}")
     
@@ -195,4 +586,3 @@ if __name__ == "__main__":
                                  log_path=log_path,
                                  logs_folder=logs_folder)
         log_manager.rename_and_move()
-        
@@ -0,0 +1,29 @@
+import re
+from datetime import datetime, timedelta
+from glob import glob
+from os.path import join
+
+from adaptive_scheduler import get_change_rates, read_fare_history_parquet
+
+
+# Fare history used to compute the change rates
+history_days = 14
+structured_data_path = "/home/mborges/structured_data"
+change_rates_path = "/home/mborges/adaptive_schedule_change_rates.csv"
+
+# Daily "<date>_structured_data.parquet" and hourly
+# "<date>_hour_<hour>_minute_<minute>_structured_data.parquet" files
+parquet_name_pattern = r"(\d{4}-\d{2}-\d{2})(?:_hour_\d+_minute_\d+)?_structured_data\.parquet$"
+
+first_day = (datetime.now() - timedelta(days=history_days)).date()
+parquet_paths = list()
+for path in glob(join(structured_data_path, "*_structured_data.parquet")):
+    match = re.search(parquet_name_pattern, path)
+    if match is not None and datetime.strptime(match.group(1), "%Y-%m-%d").date() >= first_day:
+        parquet_paths.append(path)
+print(f"Reading {len(parquet_paths)} parquets since {first_day}")
+
+fare_history = read_fare_history_parquet(parquet_paths)
+change_rates = get_change_rates(fare_history)
+change_rates.to_csv(change_rates_path, index=False)
+print(f"{len(change_rates)} change rates saved in {change_rates_path}")
@@ -0,0 +1,306 @@
+import os
+import socket
+import sqlite3
+from datetime import datetime, timedelta
+
+
+class ScrapeTaskQueue():
+    """Durable queue of scrape tasks with leases, retries and priorities.
+
+    The queue is a SQLite database in WAL mode, so several worker processes can lease
+    tasks at the same time. A worker leases a task for lease_seconds; if it dies, the
+    lease expires and another worker takes the task. Failed tasks go back to the queue
+    with an exponential backoff until max_attempts is reached.
+
+    Each (run_id, flight_day, departure_airport, arrival_airport) is one task, where
+    run_id identifies the hourly run, "<date>_<hour>_<minute>", e.g. "2023-06-01_10_0".
+    """
+    def __init__(self, queue_path, lease_seconds=600, max_attempts=3, retry_delay_seconds=60):
+        """
+        Parameters
+        ----------
+        queue_path: str
+            Path of the SQLite database, it is created if it does not exist.
+        lease_seconds: int (default=600)
+            Time a worker has to finish a task before another worker can take it.
+        max_attempts: int (default=3)
+            Maximum number of attempts of each task.
+        retry_delay_seconds: int (default=60)
+            Delay before the first retry, it doubles after each failed attempt.
+        """
+        self.queue_path = queue_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay_seconds = retry_delay_seconds
+        self._create_table()
+
+    def enqueue(self, run_id, tasks, priorities=None):
+        """Add tasks to the queue, tasks already in the queue are ignored.
+
+        Parameters
+        ----------
+        run_id: str
+            Identifier of the hourly run.
+        tasks: list[tuple]
+            List of (flight_day, departure_airport, arrival_airport).
+        priorities: list[int] (default=None)
+            Priority of each task, higher values are leased first. If it is None,
+            all tasks have priority 0.
+
+        Return
+        ------
+        n_enqueued: int
+            Number of new tasks.
+        """
+        if priorities is None:
+            priorities = [0] * len(tasks)
+        now = self._now()
+        rows = [(run_id, str(flight_day), departure_airport, arrival_airport, priority, now)
+                for (flight_day, departure_airport, arrival_airport), priority
+                in zip(tasks, priorities)]
+        with self._connect() as conn:
+            cursor = conn.executemany("""
+                INSERT OR IGNORE INTO task
+                    (run_id, flight_day, departure_airport, arrival_airport,
+                     priority, available_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, rows)
+            n_enqueued = cursor.rowcount
+        return n_enqueued
+
+    def lease(self, worker_id=None, n_tasks=1):
+        """Lease the next available tasks.
+
+        A task is available if it is pending and its retry delay has passed, or if it is
+        leased and its lease has expired.
+
+        Parameters
+        ----------
+        worker_id: str (default=None)
+            Worker identifier, by default "<hostname>_<pid>".
+        n_tasks: int (default=1)
+            Maximum number of tasks to lease.
+
+        Return
+        ------
+        tasks: list[dict]
+            Leased tasks with the keys task_id, run_id, flight_day, departure_airport,
+            arrival_airport and attempts.
+        """
+        if worker_id is None:
+            worker_id = self.get_worker_id()
+        now = self._now()
+        lease_expires_at = self._now(seconds=self.lease_seconds)
+
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock, two workers never lease the same task
+            conn.execute("BEGIN IMMEDIATE")
+            # A worker died on the last attempt of these tasks, they can not be retried
+            conn.execute("""
+                UPDATE task
+                SET status = 'failed', finished_at = ?, lease_owner = NULL,
+                    lease_expires_at = NULL, last_error = 'lease expired on the last attempt'
+                WHERE status = 'leased' AND lease_expires_at <= ? AND attempts >= ?
+            """, (now, now, self.max_attempts))
+            rows = conn.execute("""
+                SELECT task_id, run_id, flight_day, departure_airport, arrival_airport, attempts
+                FROM task
+                WHERE attempts < ?
+                    AND ((status = 'pending' AND available_at <= ?)
+                         OR (status = 'leased' AND lease_expires_at <= ?))
+                ORDER BY priority DESC, task_id
+                LIMIT ?
+            """, (self.max_attempts, now, now, n_tasks)).fetchall()
+            conn.executemany("""
+                UPDATE task
+                SET status = 'leased', lease_owner = ?, lease_expires_at = ?,
+                    attempts = attempts + 1
+                WHERE task_id = ?
+            """, [(worker_id, lease_expires_at, row[0]) for row in rows])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        columns = ["task_id", "run_id", "flight_day", "departure_airport",
+                   "arrival_airport", "attempts"]
+        tasks = [dict(zip(columns, row)) for row in rows]
+        for task in tasks:
+            task["attempts"] += 1
+        return tasks
+
+    def complete(self, task_id, success, worker_id=None, error_message=None):
+        """Record the result of a leased task.
+
+        Parameters
+        ----------
+        task_id: int
+            Task identifier returned by lease.
+        success: bool
+            If True the task is done, otherwise it is retried after the backoff or it
+            is marked as failed when max_attempts was reached.
+        worker_id: str (default=None)
+            Worker identifier, by default "<hostname>_<pid>". Results of a worker whose
+            lease was taken by another worker are ignored.
+        error_message: str (default=None)
+            Error of the failed attempt.
+        """
+        if worker_id is None:
+            worker_id = self.get_worker_id()
+        with self._connect() as conn:
+            if success:
+                conn.execute("""
+                    UPDATE task
+                    SET status = 'done', finished_at = ?, last_error = NULL
+                    WHERE task_id = ? AND lease_owner = ?
+                """, (self._now(), task_id, worker_id))
+                return
+
+            attempts = conn.execute("SELECT attempts FROM task WHERE task_id = ?",
+                                    (task_id,)).fetchone()[0]
+            status = "failed" if attempts >= self.max_attempts else "pending"
+            delay = self.retry_delay_seconds * 2 ** (attempts - 1)
+            finished_at = self._now() if status == "failed" else None
+            conn.execute("""
+                UPDATE task
+                SET status = ?, available_at = ?, finished_at = ?, lease_owner = NULL,
+                    lease_expires_at = NULL, last_error = ?
+                WHERE task_id = ? AND lease_owner = ?
+            """, (status, self._now(seconds=delay), finished_at, error_message, task_id,
+                  worker_id))
+
+    def extend_lease(self, task_id, worker_id=None):
+        """Renew the lease of a task that is taking longer than lease_seconds."""
+        if worker_id is None:
+            worker_id = self.get_worker_id()
+        with self._connect() as conn:
+            conn.execute("""
+                UPDATE task SET lease_expires_at = ?
+                WHERE task_id = ? AND lease_owner = ? AND status = 'leased'
+            """, (self._now(seconds=self.lease_seconds), task_id, worker_id))
+
+    def get_status_counts(self, run_id=None):
+        """Count the tasks by status.
+
+        Parameters
+        ----------
+        run_id: str (default=None)
+            If it is not None, only the tasks of this run are counted.
+
+        Return
+        ------
+        status_counts: dict
+            Number of tasks of each status: pending, leased, done and failed.
+        """
+        query = "SELECT status, COUNT(*) FROM task"
+        parameters = ()
+        if run_id is not None:
+            query += " WHERE run_id = ?"
+            parameters = (run_id,)
+        query += " GROUP BY status"
+        with self._connect() as conn:
+            status_counts = dict(conn.execute(query, parameters).fetchall())
+        return status_counts
+
+    def get_finished_runs(self):
+        """Get the runs whose tasks are all done or failed.
+
+        Return
+        ------
+        finished_runs: dict[dict]
+            run_id and its number of tasks by status, done and failed.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("""
+                SELECT run_id, SUM(status = 'done'), SUM(status = 'failed')
+                FROM task
+                GROUP BY run_id
+                HAVING SUM(status IN ('pending', 'leased')) = 0
+            """).fetchall()
+        return {run_id: {"done": n_done, "failed": n_failed}
+                for run_id, n_done, n_failed in rows}
+
+    def get_failed_tasks(self, run_id):
+        """Get the (flight_day, departure_airport, arrival_airport) of the failed tasks
+        of a run."""
+        with self._connect() as conn:
+            rows = conn.execute("""
+                SELECT flight_day, departure_airport, arrival_airport
+                FROM task
+                WHERE run_id = ? AND status = 'failed'
+                ORDER BY task_id
+            """, (run_id,)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def delete_finished_runs(self, older_than_days=7):
+        """Delete done and failed tasks that finished more than older_than_days ago.
+
+        The tasks that failed before finished_at was set for them are deleted by
+        available_at.
+        """
+        limit = (datetime.now() - timedelta(days=older_than_days)).isoformat()
+        with self._connect() as conn:
+            conn.execute("""
+                DELETE FROM task
+                WHERE status IN ('done', 'failed')
+                    AND COALESCE(finished_at, available_at) < ?
+            """, (limit,))
+
+    @staticmethod
+    def get_worker_id():
+        return f"{socket.gethostname()}_{os.getpid()}"
+
+    def _create_table(self):
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS task (
+                    task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    run_id TEXT NOT NULL,
+                    flight_day TEXT NOT NULL,
+                    departure_airport TEXT NOT NULL,
+                    arrival_airport TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at TEXT NOT NULL,
+                    lease_owner TEXT,
+                    lease_expires_at TEXT,
+                    finished_at TEXT,
+                    last_error TEXT,
+                    UNIQUE (run_id, flight_day, departure_airport, arrival_airport)
+                )
+            """)
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS task_status_index
+                ON task (status, priority DESC, task_id)
+            """)
+
+    def _connect(self):
+        # isolation_level=None lets lease control the transaction with BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.queue_path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA busy_timeout = 60000")
+        return _AutoCommitConnection(conn)
+
+    @staticmethod
+    def _now(seconds=0):
+        return (datetime.now() + timedelta(seconds=seconds)).isoformat()
+
+
+class _AutoCommitConnection():
+    """sqlite3 connection that is closed at the end of a with block."""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.close()
+        return False
@@ -2,6 +2,8 @@
 \c flight
 
 
+-- The flight and leg tables store the result for the departure of each leg in the
+-- "timeOfDay" column (see DatabaseFormat add_derived_columns), prefer it in the queries
 CREATE FUNCTION get_time_of_day(datetime_val TIMESTAMP)
 RETURNS VARCHAR(10)
 AS
@@ -35,6 +35,45 @@ CREATE INDEX IF NOT EXISTS
 CREATE INDEX IF NOT EXISTS
 "totalFare_index" ON flight.fare USING btree ("totalFare");
 
+CREATE INDEX IF NOT EXISTS
+"legHash_fare_index" ON flight.fare USING btree ("legHash");
+
+
+-- leg table
+CREATE UNIQUE INDEX IF NOT EXISTS
+leg_pkey ON flight.leg USING btree ("legHash");
+
+CREATE INDEX IF NOT EXISTS
+"legId_leg_index" ON flight.leg USING btree ("legId");
+
+
+-- Optional indexes, the same as database_tools.INDEX_OPTIONS. Use the same
+-- index_options in run_database_format.py, the load creates its indexes again.
+-- brin: the loads write the rows in time order (DatabaseFormat sort_rows), a BRIN
+-- index of a few pages answers the time ranges. It replaces operationalSearchTime_index.
+-- CREATE INDEX IF NOT EXISTS
+-- "operationalSearchTime_brin_index" ON flight.search
+-- USING brin ("operationalSearchTime") WITH (pages_per_range = 32);
+-- CREATE INDEX IF NOT EXISTS
+-- "insertionTime_search_brin_index" ON flight.search
+-- USING brin ("insertionTime") WITH (pages_per_range = 32);
+-- CREATE INDEX IF NOT EXISTS
+-- "insertionTime_flight_brin_index" ON flight.flight
+-- USING brin ("insertionTime") WITH (pages_per_range = 32);
+-- CREATE INDEX IF NOT EXISTS
+-- "insertionTime_fare_brin_index" ON flight.fare
+-- USING brin ("insertionTime") WITH (pages_per_range = 32);
+
+-- covering: index-only scans for the route and time filters and the fares of a leg.
+-- They replace origin_destination_code_index and legId_fare_index.
+-- CREATE INDEX IF NOT EXISTS
+-- "route_operationalSearchTime_covering_index" ON flight.search
+-- USING btree ("originCode", "destinationCode", "operationalSearchTime")
+-- INCLUDE ("searchId", "flightDay");
+-- CREATE INDEX IF NOT EXISTS
+-- "legId_fare_covering_index" ON flight.fare
+-- USING btree ("legId") INCLUDE ("searchId", "totalFare");
+
 
 -- Check the indexes that now exist
 SELECT * FROM pg_indexes WHERE schemaname = 'flight';
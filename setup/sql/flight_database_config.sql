@@ -8,6 +8,10 @@ WHERE NOT EXISTS (SELECT FROM pg_database WHERE datname = 'flight')\gexec
 
 CREATE SCHEMA IF NOT EXISTS flight;
 
+-- Statistics of the statements, used by odbc/index_advisor.py. It needs
+-- shared_preload_libraries = 'pg_stat_statements' in postgresql.conf.
+-- CREATE EXTENSION IF NOT EXISTS pg_stat_statements;
+
 CREATE TABLE IF NOT EXISTS flight.search (
     "searchId" BIGINT PRIMARY KEY,
     "searchTime" TIMESTAMP NOT NULL,
@@ -15,6 +19,7 @@ CREATE TABLE IF NOT EXISTS flight.search (
     "flightDay" DATE NOT NULL,
     "originCode" CHAR(3) NOT NULL,
     "destinationCode" CHAR(3) NOT NULL,
+    "daysToDeparture" SMALLINT,
     "insertionTime" TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -40,6 +45,9 @@ CREATE TABLE IF NOT EXISTS flight.flight (
     "departureAirportLongitude" VARCHAR NOT NULL,
     "arrivalAirportCode" VARCHAR NOT NULL,
     "departureAirportCode" VARCHAR NOT NULL,
+    "departureHour" SMALLINT,
+    "timeOfDay" VARCHAR(10),
+    "travelDurationMinutes" INTEGER,
     "insertionTime" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY ("searchId") REFERENCES flight.search("searchId")
 );
@@ -62,10 +70,53 @@ CREATE TABLE IF NOT EXISTS flight.fare (
     "hasSeatMap" VARCHAR NOT NULL,
     "providerCode" VARCHAR,
     "seatsRemaining" INTEGER NOT NULL,
+    "legHash" BIGINT,
     "insertionTime" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY ("searchId") REFERENCES flight.search("searchId")
 );
 
+-- Databases created before the leg table existed
+ALTER TABLE flight.fare ADD COLUMN IF NOT EXISTS "legHash" BIGINT;
+
+-- Static leg data, stored once per legId and static attributes (see DatabaseFormat deduplicate_legs)
+CREATE TABLE IF NOT EXISTS flight.leg (
+    "legHash" BIGINT PRIMARY KEY,
+    "legId" VARCHAR(50) NOT NULL,
+    "travelDuration" VARCHAR NOT NULL,
+    "duration" VARCHAR NOT NULL,
+    "durationInSeconds" VARCHAR NOT NULL,
+    "elapsedDays" VARCHAR NOT NULL,
+    "isNonStop" BOOLEAN NOT NULL,
+    "departureTimeRaw" VARCHAR NOT NULL,
+    "departureTimeZoneOffsetSeconds" VARCHAR NOT NULL,
+    "arrivalTimeRaw" VARCHAR NOT NULL,
+    "arrivalTimeZoneOffsetSeconds" VARCHAR NOT NULL,
+    "flightNumber" VARCHAR NOT NULL,
+    "stops" VARCHAR NOT NULL,
+    "airlineCode" VARCHAR NOT NULL,
+    "equipmentCode" VARCHAR NOT NULL,
+    "arrivalAirportLatitude" VARCHAR NOT NULL,
+    "arrivalAirportLongitude" VARCHAR NOT NULL,
+    "departureAirportLatitude" VARCHAR NOT NULL,
+    "departureAirportLongitude" VARCHAR NOT NULL,
+    "arrivalAirportCode" VARCHAR NOT NULL,
+    "departureAirportCode" VARCHAR NOT NULL,
+    "departureHour" SMALLINT,
+    "timeOfDay" VARCHAR(10),
+    "travelDurationMinutes" INTEGER,
+    "insertionTime" TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Columns computed at load time (see DatabaseFormat add_derived_columns), the rows of
+-- databases created before them are filled by odbc/run_backfill_derived_columns.py
+ALTER TABLE flight.search ADD COLUMN IF NOT EXISTS "daysToDeparture" SMALLINT;
+ALTER TABLE flight.flight ADD COLUMN IF NOT EXISTS "departureHour" SMALLINT;
+ALTER TABLE flight.flight ADD COLUMN IF NOT EXISTS "timeOfDay" VARCHAR(10);
+ALTER TABLE flight.flight ADD COLUMN IF NOT EXISTS "travelDurationMinutes" INTEGER;
+ALTER TABLE flight.leg ADD COLUMN IF NOT EXISTS "departureHour" SMALLINT;
+ALTER TABLE flight.leg ADD COLUMN IF NOT EXISTS "timeOfDay" VARCHAR(10);
+ALTER TABLE flight.leg ADD COLUMN IF NOT EXISTS "travelDurationMinutes" INTEGER;
+
 CREATE TABLE IF NOT EXISTS flight.airport (
     "airportCode" CHAR(3) PRIMARY KEY,
     "airportLatitude" DECIMAL(10,6) NOT NULL,
@@ -93,6 +144,24 @@ CREATE TABLE IF NOT EXISTS flight.data_upload (
     "insertionTime" TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Aggregates of totalFare by route, days to departure, airline of the first segment and
+-- departure time of day, updated by DatabaseFormat (see odbc/fare_curve_cube.py).
+-- fareHistogram counts the fares of each bin of FARE_BIN_EDGES, it gives the quantiles.
+CREATE TABLE IF NOT EXISTS flight.fare_curve (
+    "originCode" CHAR(3) NOT NULL,
+    "destinationCode" CHAR(3) NOT NULL,
+    "daysToDeparture" SMALLINT NOT NULL,
+    "airlineCode" VARCHAR(3) NOT NULL,
+    "timeOfDay" VARCHAR(10) NOT NULL,
+    "offers" BIGINT NOT NULL,
+    "minFare" DECIMAL(10,2) NOT NULL,
+    "maxFare" DECIMAL(10,2) NOT NULL,
+    "sumFare" DOUBLE PRECISION NOT NULL,
+    "fareHistogram" BIGINT[] NOT NULL,
+    "updateTime" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY ("originCode", "destinationCode", "daysToDeparture", "airlineCode", "timeOfDay")
+);
+
 -- Show tables of schema flight
 \dt flight.*
 
@@ -0,0 +1,186 @@
+import os
+import shutil
+import tempfile
+from os.path import join
+from uuid import uuid4
+
+import pandas as pd
+import pyarrow as pa
+
+
+# Free space kept in /dev/shm besides the file, it is shared with the other processes
+SHM_RESERVE_BYTES = 256 * 2**20
+
+
+def get_handoff_folder(n_bytes=0):
+    """Get the folder of the handoff files.
+
+    /dev/shm keeps the files in memory on Linux, so writing and mapping them does
+    not touch the disk. The temporary folder is used if /dev/shm does not exist or
+    does not have n_bytes free (Docker gives it 64 MB by default).
+
+    Parameters
+    ----------
+    n_bytes: int (default=0)
+        Size of the file that will be written.
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        if shutil.disk_usage("/dev/shm").free >= n_bytes + SHM_RESERVE_BYTES:
+            return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def write_arrow_partitions(dataframe, n_partitions=1, folder=None, prefix="flight_handoff_"):
+    """Write a DataFrame once to an Arrow IPC file, one record batch per partition.
+
+    The workers of joblib receive only the path and the partition index and read
+    their rows from the memory map (see read_arrow_partition), so the partitions
+    are not pickled and copied into every process. Each partition is converted and
+    written on its own, so the parent holds the Arrow copy of one partition at a
+    time, not of the whole DataFrame.
+
+    Parameters
+    ----------
+    dataframe: pd.DataFrame
+        Data to share with the workers.
+    n_partitions: int (default=1)
+        Number of record batches, the rows are divided like np.array_split.
+    folder: str (default=None)
+        Folder of the file, by default get_handoff_folder().
+    prefix: str (default="flight_handoff_")
+        Prefix of the file name.
+
+    Return
+    ------
+    handoff_path: str
+        Path of the file, the caller removes it. None if the DataFrame could not
+        be converted to Arrow (e.g. an object column with mixed types), is empty or
+        could not be written (e.g. the disk is full).
+    n_partitions: int
+        Number of record batches written, it is at most the number of rows.
+    """
+    if len(dataframe) == 0:
+        return None, 0
+    try:
+        schema = _get_schema(dataframe)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return None, 0
+
+    n_partitions = max(min(n_partitions, len(dataframe)), 1)
+    base_size, n_larger = divmod(len(dataframe), n_partitions)
+    folder = (get_handoff_folder(int(dataframe.memory_usage(deep=True).sum()))
+              if folder is None else folder)
+    handoff_path = join(folder, f"{prefix}{uuid4().hex}.arrow")
+    try:
+        with pa.OSFile(handoff_path, "wb") as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                offset = 0
+                for partition in range(n_partitions):
+                    size = base_size + (1 if partition < n_larger else 0)
+                    # A categorical slice keeps all its categories, so every batch
+                    # has the same dictionary, as the IPC file format requires
+                    writer.write_batch(pa.RecordBatch.from_pandas(
+                        dataframe.iloc[offset:offset + size], schema=schema,
+                        preserve_index=False
+                    ))
+                    offset += size
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        remove_handoff_file(handoff_path)
+        return None, 0
+    except OSError as error:
+        print(f"The handoff file could not be written, the data is pickled: {str(error)}")
+        remove_handoff_file(handoff_path)
+        return None, 0
+    return handoff_path, n_partitions
+
+
+def _get_schema(dataframe, n_sample_rows=10_000):
+    """Arrow schema of a DataFrame, with the large types of _get_large_type.
+
+    The types are inferred from the first rows, a column whose first rows are all
+    null from its first values that are not null. A later value of another type
+    fails the conversion of its partition, and the data is pickled.
+    """
+    schema = pa.Schema.from_pandas(dataframe.iloc[:n_sample_rows], preserve_index=False)
+    fields = list()
+    for position, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            values = dataframe.iloc[:, position].dropna().iloc[:n_sample_rows]
+            field = field.with_type(pa.array(values, from_pandas=True).type)
+        # The strings use 64 bit offsets, a partition of more than 2 GB fits in one batch
+        fields.append(field.with_type(_get_large_type(field.type)))
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+def _get_large_type(data_type):
+    """Same type with the strings and binaries, also nested ones, as large_string and large_binary."""
+    if pa.types.is_string(data_type):
+        return pa.large_string()
+    if pa.types.is_binary(data_type):
+        return pa.large_binary()
+    if pa.types.is_list(data_type):
+        return pa.list_(data_type.value_field.with_type(_get_large_type(data_type.value_type)))
+    if pa.types.is_struct(data_type):
+        return pa.struct([field.with_type(_get_large_type(field.type)) for field in data_type])
+    return data_type
+
+
+def read_arrow_partition(handoff_path, partition=None):
+    """Read one partition of a file written by write_arrow_partitions.
+
+    Parameters
+    ----------
+    handoff_path: str
+        Path of the file.
+    partition: int (default=None)
+        Index of the partition, None reads all of them.
+
+    Return
+    ------
+    dataframe: pd.DataFrame
+        Rows of the partition, with the pandas dtypes of the written DataFrame. The
+        conversion copies the rows of the partition out of the memory map.
+    """
+    with pa.memory_map(handoff_path, "r") as source:
+        reader = pa.ipc.open_file(source)
+        if partition is None:
+            table = reader.read_all()
+        else:
+            # The schema keeps the pandas metadata, it restores the dtypes
+            table = pa.Table.from_batches([reader.get_batch(partition)], schema=reader.schema)
+        return table.to_pandas()
+
+
+def read_arrow_files(handoff_paths, remove=True):
+    """Read and concatenate several handoff files, e.g. the results of the workers.
+
+    Parameters
+    ----------
+    handoff_paths: list[str or pd.DataFrame]
+        Paths of files written by write_arrow_partitions. DataFrames are kept as they
+        are, they are the results that could not be converted to Arrow.
+    remove: bool (default=True)
+        If True remove the files after reading them.
+
+    Return
+    ------
+    dataframe: pd.DataFrame
+        Concatenation of every file, in the order of handoff_paths.
+    """
+    dataframes = list()
+    for handoff_path in handoff_paths:
+        if isinstance(handoff_path, pd.DataFrame):
+            dataframes.append(handoff_path)
+            continue
+        dataframes.append(read_arrow_partition(handoff_path))
+        if remove:
+            remove_handoff_file(handoff_path)
+    if len(dataframes) == 0:
+        return pd.DataFrame()
+    return pd.concat(dataframes, ignore_index=True)
+
+
+def remove_handoff_file(handoff_path):
+    """Remove a handoff file, missing files are ignored."""
+    if handoff_path is not None and os.path.isfile(handoff_path):
+        os.remove(handoff_path)
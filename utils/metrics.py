@@ -0,0 +1,375 @@
+import json
+import os
+import re
+import resource
+import socket
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from functools import lru_cache, wraps
+from glob import escape, glob
+from os.path import abspath, dirname, join, splitext
+from time import perf_counter, process_time
+
+PATH_TO_RELEVANT_PATHS = join(dirname(abspath(__file__)), "..", "settings", "relevant_paths.json")
+# Stages of this process that have not ended, their memory peaks are updated before
+# the high-water mark of the process is reset by a new stage
+_open_stages = list()
+_open_stages_lock = threading.Lock()
+
+
+class StageMetrics():
+    """Measure one stage of the pipeline and append the result to the metrics file.
+
+    It records wall time, CPU time, rows processed, bytes read/written and memory.
+    The bytes and the CPU time of the process that runs the stage are measured, the
+    CPU time of finished child processes (e.g. joblib workers) is reported apart.
+    peak_rss_mb is the peak resident memory of the process during the stage: the
+    high-water mark of the process (VmHWM) is reset when the stage starts, by writing
+    to /proc/self/clear_refs, and read when it ends. Stages that run at the same time
+    in several threads share the peak of the process. It is None where the mark can
+    not be reset or when the FLIGHT_METRICS_RESET_PEAK_RSS environment variable is
+    "0", e.g. in the benchmarks, which read the peak of the whole process (ru_maxrss
+    is reset too).
+    Measure stages of a batch of work (a day, an hour, a table), not single files:
+    each stage run is one line of the metrics file.
+
+    Example
+    -------
+    with StageMetrics("format.insert", table="fare") as stage_metrics:
+        dt.insert_database_parallel(table, "fare")
+        stage_metrics.rows = len(table)
+    """
+    def __init__(self, stage, rows=None, metrics_path=None, verbose=False, **labels):
+        """
+        Parameters
+        ----------
+        stage: str
+            Stage name, e.g. "extract.structure_all_jsons".
+        rows: int (default=None)
+            Number of rows processed, it can also be set inside the with block.
+        metrics_path: str (default=None)
+            JSON lines file where the metrics are appended, one file per day, see
+            get_dated_metrics_path. If it is None, get_metrics_path() is used.
+        verbose: bool (default=False)
+            If True print the wall time of the stage when it ends.
+        labels:
+            Any other information to save with the metrics, e.g. table="fare".
+        """
+        self.stage = stage
+        self.rows = rows
+        self.metrics_path = metrics_path
+        self.verbose = verbose
+        self.labels = labels
+        self.record = None
+
+    def __enter__(self):
+        self._start_wall_time = perf_counter()
+        self._start_cpu_time = process_time()
+        self._start_children_cpu_time = _get_children_cpu_time()
+        self._start_io = _read_process_io()
+        self._start_rss = _get_rss_mb()
+        self._start_time = datetime.now()
+        with _open_stages_lock:
+            _update_peak_rss(_open_stages)
+            self._peak_rss = _get_rss_mb().get("rss_mb") if _reset_peak_rss() else None
+            _open_stages.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_time = perf_counter() - self._start_wall_time
+        end_io = _read_process_io()
+        with _open_stages_lock:
+            _update_peak_rss(_open_stages)
+            _open_stages.remove(self)
+
+        self.record = OrderedDict([
+            ("stage", self.stage),
+            ("start_time", self._start_time.isoformat()),
+            ("end_time", datetime.now().isoformat()),
+            ("success", exc_type is None),
+            ("wall_time_s", wall_time),
+            ("cpu_time_s", process_time() - self._start_cpu_time),
+            ("children_cpu_time_s", _get_children_cpu_time() - self._start_children_cpu_time),
+            ("rows", self.rows),
+            ("rows_per_s", None if self.rows is None or wall_time == 0 else self.rows / wall_time),
+            ("bytes_read", _get_delta(self._start_io, end_io, "rchar")),
+            ("bytes_written", _get_delta(self._start_io, end_io, "wchar")),
+            ("peak_rss_mb", self._peak_rss),
+            # Change of the resident memory of the process during the stage
+            ("rss_delta_mb", _get_delta(self._start_rss, _get_rss_mb(), "rss_mb")),
+            ("pid", os.getpid()),
+            ("host", socket.gethostname()),
+        ])
+        self.record.update(self.labels)
+
+        if self.verbose:
+            print(f"{self.stage} done in {wall_time / 60} min")
+        write_metrics(self.record, metrics_path=self.metrics_path)
+        return False
+
+
+def measure_stage(stage, rows=None, verbose=False, **labels):
+    """Decorator that records the function as a stage, see StageMetrics.
+
+    Parameters
+    ----------
+    stage: str
+        Stage name.
+    rows: callable (default=None)
+        Function that receives the output of the decorated function and returns the
+        number of rows processed. If it is None, rows is not recorded.
+    verbose: bool (default=False)
+        If True print the wall time of the stage when it ends.
+    labels:
+        Any other information to save with the metrics.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with StageMetrics(stage, verbose=verbose, **labels) as stage_metrics:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    stage_metrics.rows = rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def get_metrics_path():
+    """Get the metrics file path.
+
+    The FLIGHT_METRICS_PATH environment variable has priority over the "metrics" key
+    of settings/relevant_paths.json, which is read once per process. If neither
+    exists, None is returned and no metrics are written.
+    """
+    metrics_path = os.environ.get("FLIGHT_METRICS_PATH")
+    if metrics_path is None:
+        metrics_path = _read_configured_metrics_path()
+    return metrics_path
+
+
+def get_dated_metrics_path(metrics_path, day):
+    """Get the file of the metrics of one day, e.g. "metrics_2023-06-01.jsonl" for
+    metrics_path "metrics.jsonl"."""
+    root, extension = splitext(metrics_path)
+    return f"{root}_{day:%Y-%m-%d}{extension}"
+
+
+def list_metrics_files(metrics_path=None, start_date=None):
+    """List the daily files of the metrics, oldest first.
+
+    Parameters
+    ----------
+    metrics_path: str (default=None)
+        Metrics file path, if it is None get_metrics_path() is used.
+    start_date: datetime.date (default=None)
+        If not None only the files of this day and later are listed.
+
+    Return
+    ------
+    file_paths: list[str]
+        The file metrics_path itself, written before the daily files, is listed first
+        when start_date is None. Empty if there is no metrics path.
+    """
+    if metrics_path is None:
+        metrics_path = get_metrics_path()
+    if metrics_path is None:
+        return []
+    root, extension = splitext(metrics_path)
+    file_paths = list()
+    if start_date is None and os.path.isfile(metrics_path):
+        file_paths.append(metrics_path)
+    for path in sorted(glob(f"{escape(root)}_*{extension}")):
+        day = _get_metrics_file_date(path, root, extension)
+        if day is not None and (start_date is None or start_date <= day):
+            file_paths.append(path)
+    return file_paths
+
+
+def write_metrics(record, metrics_path=None):
+    """Append one record to the JSON lines metrics file of the day.
+
+    Each record is written with a single write call in append mode, so records of
+    parallel workers are not mixed. Errors are printed and never stop the pipeline.
+    """
+    if metrics_path is None:
+        metrics_path = get_metrics_path()
+    if metrics_path is None:
+        return
+    try:
+        os.makedirs(dirname(abspath(metrics_path)), exist_ok=True)
+        line = json.dumps(record, default=str) + "\n"
+        with open(get_dated_metrics_path(metrics_path, date.today()), "a") as file:
+            file.write(line)
+    except Exception as e:
+        print(f"Error writing metrics: {str(e)}")
+    return
+
+
+def read_metrics(metrics_path=None, start_date=None):
+    """Read the records of the JSON lines metrics files.
+
+    Parameters
+    ----------
+    metrics_path: str (default=None)
+        Metrics file path, if it is None get_metrics_path() is used.
+    start_date: datetime.date (default=None)
+        If not None only the files of this day and later are read.
+
+    Return
+    ------
+    records: list[dict]
+        One dict per measured stage, invalid lines are skipped.
+    """
+    if metrics_path is None:
+        metrics_path = get_metrics_path()
+    records = list()
+    for file_path in list_metrics_files(metrics_path, start_date=start_date):
+        with open(file_path, "r") as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def remove_old_metrics(metrics_path=None, keep_days=30):
+    """Remove the daily metrics files older than keep_days days.
+
+    Return
+    ------
+    removed_paths: list[str]
+    """
+    start_date = date.today() - timedelta(days=keep_days)
+    kept_paths = set(list_metrics_files(metrics_path, start_date=start_date))
+    removed_paths = [path for path in list_metrics_files(metrics_path)
+                     if path not in kept_paths]
+    for path in removed_paths:
+        os.remove(path)
+    return removed_paths
+
+
+def export_prometheus_textfile(textfile_path, metrics_path=None, n_days=7):
+    """Write the last record of each stage in the Prometheus textfile format.
+
+    The file can be read by the textfile collector of node_exporter. It is written
+    to a temporary file and renamed, so the collector never reads a partial file.
+
+    Parameters
+    ----------
+    textfile_path: str
+        Path of the .prom file.
+    metrics_path: str (default=None)
+        JSON lines metrics file, if it is None get_metrics_path() is used.
+    n_days: int (default=7)
+        Only the files of the last n_days days are read, the stages that did not run
+        in this period are not exported.
+    """
+    gauges = {"wall_time_s": "Wall time of the last run of the stage in seconds.",
+              "cpu_time_s": "CPU time of the last run of the stage in seconds.",
+              "rows": "Rows processed by the last run of the stage.",
+              "rows_per_s": "Rows per second of the last run of the stage.",
+              "bytes_read": "Bytes read by the last run of the stage.",
+              "bytes_written": "Bytes written by the last run of the stage.",
+              "peak_rss_mb": "Peak resident memory during the last run of the stage in MB.",
+              "rss_delta_mb": "Change of the resident memory during the last run of the stage in MB.",
+              "success": "1 if the last run of the stage succeeded, 0 otherwise."}
+
+    last_records = OrderedDict()
+    for record in read_metrics(metrics_path, start_date=date.today() - timedelta(days=n_days)):
+        key = (record["stage"], record.get("host"), record.get("table"))
+        last_records[key] = record
+
+    lines = list()
+    for metric, description in gauges.items():
+        name = f"flight_pipeline_{metric}"
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        for (stage, host, table), record in last_records.items():
+            value = record.get(metric)
+            if value is None:
+                continue
+            labels = f'stage="{stage}",host="{host}"'
+            if table is not None:
+                labels += f',table="{table}"'
+            lines.append(f"{name}{{{labels}}} {float(value)}")
+
+    temporary_path = textfile_path + ".tmp"
+    with open(temporary_path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+    os.replace(temporary_path, textfile_path)
+    return
+
+
+@lru_cache(maxsize=None)
+def _read_configured_metrics_path():
+    try:
+        with open(PATH_TO_RELEVANT_PATHS, "r") as file:
+            return json.load(file).get("metrics")
+    except (OSError, ValueError):
+        return None
+
+
+def _get_metrics_file_date(path, root, extension):
+    match = re.fullmatch(r"(\d{4}-\d{2}-\d{2})", path[len(root) + 1:len(path) - len(extension)])
+    if match is None:
+        return None
+    return datetime.strptime(match.group(1), "%Y-%m-%d").date()
+
+
+def _get_rss_mb():
+    """Read the resident memory from /proc/self/statm, returns an empty dict where it does
+    not exist."""
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return {"rss_mb": int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20}
+    except (OSError, ValueError):
+        return {}
+
+
+def _reset_peak_rss():
+    """Reset VmHWM to the current resident memory, False where it is not possible."""
+    if os.environ.get("FLIGHT_METRICS_RESET_PEAK_RSS") == "0":
+        return False
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _update_peak_rss(stages):
+    """Raise the peak of the stages to VmHWM, read from /proc/self/status."""
+    try:
+        with open("/proc/self/status", "r") as file:
+            high_water_mark = next(int(line.split()[1]) / 1024 for line in file
+                                   if line.startswith("VmHWM:"))
+    except (OSError, StopIteration, ValueError):
+        return
+    for stage in stages:
+        if stage._peak_rss is not None:
+            stage._peak_rss = max(stage._peak_rss, high_water_mark)
+
+
+def _get_children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _read_process_io():
+    """Read /proc/self/io, returns an empty dict where it does not exist."""
+    try:
+        with open("/proc/self/io", "r") as file:
+            return {key: int(value) for key, value in
+                    (line.split(":") for line in file if ":" in line)}
+    except OSError:
+        return {}
+
+
+def _get_delta(start, end, key):
+    if key not in start or key not in end:
+        return None
+    return end[key] - start[key]
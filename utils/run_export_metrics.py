@@ -0,0 +1,12 @@
+from metrics import PATH_TO_RELEVANT_PATHS, export_prometheus_textfile, remove_old_metrics
+from tools import read_json
+
+# Days of metrics files kept, the metrics are written in one file per day
+keep_days = 30
+
+textfile_path = read_json(json_path=PATH_TO_RELEVANT_PATHS).get("metrics_textfile")
+export_prometheus_textfile(textfile_path)
+print(f"Metrics exported to {textfile_path}")
+removed_paths = remove_old_metrics(keep_days=keep_days)
+if len(removed_paths) > 0:
+    print(f"Removed {len(removed_paths)} metrics files older than {keep_days} days")
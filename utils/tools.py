@@ -1,4 +1,5 @@
 import json
+from functools import lru_cache
 from os.path import join
 
 PATH_TO_RELEVANT_PATHS = join("..", "settings","relevant_paths.json")
@@ -11,9 +12,18 @@ def read_json(json_path=PATH_TO_RELEVANT_PATHS):
         return json.load(file)
 
 
+@lru_cache(maxsize=None)
+def read_json_cached(json_path):
+    """Read any json once per process, call read_json_cached.cache_clear() to read it again.
+
+    Do not change the returned dict, it is shared by every call.
+    """
+    return read_json(json_path=json_path)
+
+
 def get_relevant_path(key):
     """Get any key form relevant_path json."""
-    return read_json(json_path=PATH_TO_RELEVANT_PATHS).get(key)
+    return read_json_cached(PATH_TO_RELEVANT_PATHS).get(key)
 
 
 def get_structured_data_transfer_credentials():